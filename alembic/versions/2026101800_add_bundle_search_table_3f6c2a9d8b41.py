@@ -0,0 +1,116 @@
+"""Add bundle_search table
+
+Revision ID: 3f6c2a9d8b41
+Revises: 54e95ff2e718
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f6c2a9d8b41'
+down_revision = '54e95ff2e718'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Number of bundles whose search fields are copied at a time
+BATCH_SIZE = 10000
+
+# Metadata key -> function converting its value to the type of its column
+SEARCH_FIELDS = {
+    'name': str,
+    'created': int,
+    'data_size': int,
+    'time': float,
+    'request_cpus': int,
+    'request_gpus': int,
+    'request_priority': int,
+    'request_queue': str,
+    'request_docker_image': str,
+}
+
+
+def upgrade():
+    bundle_search = op.create_table(
+        'bundle_search',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('bundle_uuid', sa.String(length=63), nullable=False),
+        sa.Column('name', sa.Text(), nullable=True),
+        sa.Column('created', sa.BigInteger(), nullable=True),
+        sa.Column('data_size', sa.BigInteger(), nullable=True),
+        sa.Column('time', sa.Float(), nullable=True),
+        sa.Column('request_cpus', sa.Integer(), nullable=True),
+        sa.Column('request_gpus', sa.Integer(), nullable=True),
+        sa.Column('request_priority', sa.Integer(), nullable=True),
+        sa.Column('request_queue', sa.Text(), nullable=True),
+        sa.Column('request_docker_image', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['bundle_uuid'], ['bundle.uuid']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('bundle_uuid', name='uix_1'),
+    )
+    op.create_index('bundle_search_name_index', 'bundle_search', ['name'], mysql_length=63)
+    op.create_index('bundle_search_created_index', 'bundle_search', ['created'])
+    op.create_index('bundle_search_data_size_index', 'bundle_search', ['data_size'])
+    op.create_index('bundle_search_time_index', 'bundle_search', ['time'])
+    op.create_index('bundle_search_request_cpus_index', 'bundle_search', ['request_cpus'])
+    op.create_index('bundle_search_request_gpus_index', 'bundle_search', ['request_gpus'])
+    op.create_index('bundle_search_request_priority_index', 'bundle_search', ['request_priority'])
+    op.create_index(
+        'bundle_search_request_queue_index', 'bundle_search', ['request_queue'], mysql_length=63
+    )
+    op.create_index(
+        'bundle_search_request_docker_image_index',
+        'bundle_search',
+        ['request_docker_image'],
+        mysql_length=63,
+    )
+
+    # Copy the search fields of the existing bundles
+    bundle = sa.table('bundle', sa.column('id', sa.Integer), sa.column('uuid', sa.String))
+    bundle_metadata = sa.table(
+        'bundle_metadata',
+        sa.column('bundle_uuid', sa.String),
+        sa.column('metadata_key', sa.String),
+        sa.column('metadata_value', sa.Text),
+    )
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        bundles = connection.execute(
+            sa.select([bundle.c.id, bundle.c.uuid])
+            .where(bundle.c.id > last_id)
+            .order_by(bundle.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not bundles:
+            break
+        last_id = bundles[-1].id
+        rows = {}
+        for row in bundles:
+            rows[row.uuid] = dict({key: None for key in SEARCH_FIELDS}, bundle_uuid=row.uuid)
+        metadata_rows = connection.execute(
+            sa.select(
+                [
+                    bundle_metadata.c.bundle_uuid,
+                    bundle_metadata.c.metadata_key,
+                    bundle_metadata.c.metadata_value,
+                ]
+            ).where(
+                sa.and_(
+                    bundle_metadata.c.bundle_uuid.in_(list(rows)),
+                    bundle_metadata.c.metadata_key.in_(list(SEARCH_FIELDS)),
+                )
+            )
+        )
+        for row in metadata_rows:
+            try:
+                rows[row.bundle_uuid][row.metadata_key] = SEARCH_FIELDS[row.metadata_key](
+                    row.metadata_value
+                )
+            except ValueError:
+                pass
+        op.bulk_insert(bundle_search, list(rows.values()))
+
+
+def downgrade():
+    op.drop_table('bundle_search')
@@ -0,0 +1,148 @@
+"""Add search_token table
+
+Revision ID: 8c1e4b7f2d05
+Revises: 3f6c2a9d8b41
+Create Date: 2026-10-18 01:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c1e4b7f2d05'
+down_revision = '3f6c2a9d8b41'
+
+from collections import defaultdict
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+# Number of bundles or worksheets whose words are indexed at a time
+BATCH_SIZE = 10000
+
+# Indexed field -> weight of a match on one of its words
+BUNDLE_TOKEN_FIELDS = {'name': 4, 'tags': 2, 'description': 1}
+WORKSHEET_TOKEN_FIELDS = {'name': 4, 'title': 2, 'tags': 2}
+SEARCH_TOKEN_REGEX = re.compile('[a-z0-9]+')
+SEARCH_TOKEN_LENGTH = 63
+
+
+def get_rows(object_type, uuid, values, weights):
+    rows = []
+    for field, texts in values.items():
+        tokens = set()
+        for text in texts:
+            if text:
+                tokens.update(
+                    token[:SEARCH_TOKEN_LENGTH]
+                    for token in SEARCH_TOKEN_REGEX.findall(str(text).lower())
+                )
+        rows.extend(
+            {
+                'object_type': object_type,
+                'object_uuid': uuid,
+                'field': field,
+                'token': token,
+                'weight': weights[field],
+            }
+            for token in sorted(tokens)
+        )
+    return rows
+
+
+def batches(connection, table, columns):
+    """Yields the rows of table in batches of BATCH_SIZE."""
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([table.c.id] + columns)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        yield rows
+
+
+def upgrade():
+    search_token = op.create_table(
+        'search_token',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('object_type', sa.String(length=16), nullable=False),
+        sa.Column('object_uuid', sa.String(length=63), nullable=False),
+        sa.Column('field', sa.String(length=63), nullable=False),
+        sa.Column('token', sa.String(length=63), nullable=False),
+        sa.Column('weight', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('search_token_token_index', 'search_token', ['object_type', 'token'])
+    op.create_index('search_token_object_uuid_index', 'search_token', ['object_uuid'])
+
+    connection = op.get_bind()
+
+    # Index the words of the existing bundles
+    bundle = sa.table('bundle', sa.column('id', sa.Integer), sa.column('uuid', sa.String))
+    bundle_metadata = sa.table(
+        'bundle_metadata',
+        sa.column('bundle_uuid', sa.String),
+        sa.column('metadata_key', sa.String),
+        sa.column('metadata_value', sa.Text),
+    )
+    for bundles in batches(connection, bundle, [bundle.c.uuid]):
+        values = {row.uuid: defaultdict(list) for row in bundles}
+        metadata_rows = connection.execute(
+            sa.select(
+                [
+                    bundle_metadata.c.bundle_uuid,
+                    bundle_metadata.c.metadata_key,
+                    bundle_metadata.c.metadata_value,
+                ]
+            ).where(
+                sa.and_(
+                    bundle_metadata.c.bundle_uuid.in_(list(values)),
+                    bundle_metadata.c.metadata_key.in_(list(BUNDLE_TOKEN_FIELDS)),
+                )
+            )
+        )
+        for row in metadata_rows:
+            values[row.bundle_uuid][row.metadata_key].append(row.metadata_value)
+        rows = []
+        for uuid, bundle_values in values.items():
+            rows.extend(get_rows('bundle', uuid, bundle_values, BUNDLE_TOKEN_FIELDS))
+        if rows:
+            op.bulk_insert(search_token, rows)
+
+    # Index the words of the existing worksheets
+    worksheet = sa.table(
+        'worksheet',
+        sa.column('id', sa.Integer),
+        sa.column('uuid', sa.String),
+        sa.column('name', sa.String),
+        sa.column('title', sa.Unicode),
+    )
+    worksheet_tag = sa.table(
+        'worksheet_tag', sa.column('worksheet_uuid', sa.String), sa.column('tag', sa.String)
+    )
+    for worksheets in batches(
+        connection, worksheet, [worksheet.c.uuid, worksheet.c.name, worksheet.c.title]
+    ):
+        values = {
+            row.uuid: {'name': [row.name], 'title': [row.title], 'tags': []} for row in worksheets
+        }
+        tag_rows = connection.execute(
+            sa.select([worksheet_tag.c.worksheet_uuid, worksheet_tag.c.tag]).where(
+                worksheet_tag.c.worksheet_uuid.in_(list(values))
+            )
+        )
+        for row in tag_rows:
+            values[row.worksheet_uuid]['tags'].append(row.tag)
+        rows = []
+        for uuid, worksheet_values in values.items():
+            rows.extend(get_rows('worksheet', uuid, worksheet_values, WORKSHEET_TOKEN_FIELDS))
+        if rows:
+            op.bulk_insert(search_token, rows)
+
+
+def downgrade():
+    op.drop_table('search_token')
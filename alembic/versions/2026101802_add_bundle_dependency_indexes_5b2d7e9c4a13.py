@@ -0,0 +1,23 @@
+"""Add indexes on bundle_dependency uuids
+
+Revision ID: 5b2d7e9c4a13
+Revises: 8c1e4b7f2d05
+Create Date: 2026-10-18 02:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b2d7e9c4a13'
+down_revision = '8c1e4b7f2d05'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('bundle_dependency_child_uuid_index', 'bundle_dependency', ['child_uuid'])
+    op.create_index('bundle_dependency_parent_uuid_index', 'bundle_dependency', ['parent_uuid'])
+
+
+def downgrade():
+    op.drop_index('bundle_dependency_parent_uuid_index', table_name='bundle_dependency')
+    op.drop_index('bundle_dependency_child_uuid_index', table_name='bundle_dependency')
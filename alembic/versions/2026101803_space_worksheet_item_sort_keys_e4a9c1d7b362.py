@@ -0,0 +1,49 @@
+"""Give every worksheet item a spaced out sort key
+
+Revision ID: e4a9c1d7b362
+Revises: 5b2d7e9c4a13
+Create Date: 2026-10-18 03:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e4a9c1d7b362'
+down_revision = '5b2d7e9c4a13'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Must match WORKSHEET_ITEM_SORT_KEY_GAP in codalab.objects.worksheet
+SORT_KEY_GAP = 1024
+
+
+def upgrade():
+    op.alter_column(
+        'worksheet_item',
+        'sort_key',
+        type_=sa.BigInteger(),
+        existing_type=sa.Integer(),
+        existing_nullable=True,
+    )
+    # Items used to be sorted by their sort key, or by their id if they had none. Scaling the
+    # resulting keys preserves the order of the items, while leaving gaps to insert items into.
+    op.execute('UPDATE worksheet_item SET sort_key = COALESCE(sort_key, id) * %d' % SORT_KEY_GAP)
+    op.create_index(
+        'worksheet_item_worksheet_uuid_sort_key_index',
+        'worksheet_item',
+        ['worksheet_uuid', 'sort_key'],
+    )
+
+
+def downgrade():
+    op.drop_index('worksheet_item_worksheet_uuid_sort_key_index', table_name='worksheet_item')
+    # Scale the keys back down, which preserves the order of the items (up to ties between items
+    # inserted into the same gap)
+    op.execute('UPDATE worksheet_item SET sort_key = FLOOR(sort_key / %d)' % SORT_KEY_GAP)
+    op.alter_column(
+        'worksheet_item',
+        'sort_key',
+        type_=sa.Integer(),
+        existing_type=sa.BigInteger(),
+        existing_nullable=True,
+    )
@@ -0,0 +1,89 @@
+"""Add run_status and last_updated to bundle_search, and an index on the states of bundles
+
+Revision ID: 9a7d3c5e1f28
+Revises: e4a9c1d7b362
+Create Date: 2026-10-18 04:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9a7d3c5e1f28'
+down_revision = 'e4a9c1d7b362'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Number of bundles whose fields are copied at a time
+BATCH_SIZE = 10000
+
+# Metadata key -> function converting its value to the type of its column
+STATE_FIELDS = {'run_status': str, 'last_updated': int}
+
+
+def upgrade():
+    op.add_column('bundle_search', sa.Column('run_status', sa.Text(), nullable=True))
+    op.add_column('bundle_search', sa.Column('last_updated', sa.BigInteger(), nullable=True))
+    op.create_index('bundle_search_last_updated_index', 'bundle_search', ['last_updated'])
+    op.create_index('bundle_uuid_state_index', 'bundle', ['uuid', 'state'])
+
+    # Copy the fields of the existing bundles
+    bundle_search = sa.table(
+        'bundle_search',
+        sa.column('id', sa.Integer),
+        sa.column('bundle_uuid', sa.String),
+        sa.column('run_status', sa.Text),
+        sa.column('last_updated', sa.BigInteger),
+    )
+    bundle_metadata = sa.table(
+        'bundle_metadata',
+        sa.column('bundle_uuid', sa.String),
+        sa.column('metadata_key', sa.String),
+        sa.column('metadata_value', sa.Text),
+    )
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([bundle_search.c.id, bundle_search.c.bundle_uuid])
+            .where(bundle_search.c.id > last_id)
+            .order_by(bundle_search.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        values = {}
+        metadata_rows = connection.execute(
+            sa.select(
+                [
+                    bundle_metadata.c.bundle_uuid,
+                    bundle_metadata.c.metadata_key,
+                    bundle_metadata.c.metadata_value,
+                ]
+            ).where(
+                sa.and_(
+                    bundle_metadata.c.bundle_uuid.in_([row.bundle_uuid for row in rows]),
+                    bundle_metadata.c.metadata_key.in_(list(STATE_FIELDS)),
+                )
+            )
+        )
+        for row in metadata_rows:
+            try:
+                values.setdefault(row.bundle_uuid, {})[row.metadata_key] = STATE_FIELDS[
+                    row.metadata_key
+                ](row.metadata_value)
+            except ValueError:
+                pass
+        for bundle_uuid, bundle_values in values.items():
+            connection.execute(
+                bundle_search.update()
+                .where(bundle_search.c.bundle_uuid == bundle_uuid)
+                .values(bundle_values)
+            )
+
+
+def downgrade():
+    op.drop_index('bundle_uuid_state_index', table_name='bundle')
+    op.drop_index('bundle_search_last_updated_index', table_name='bundle_search')
+    op.drop_column('bundle_search', 'last_updated')
+    op.drop_column('bundle_search', 'run_status')
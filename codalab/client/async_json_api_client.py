@@ -0,0 +1,143 @@
+"""
+AsyncJsonApiClient provides the methods of JsonApiClient as coroutines, for scripts that send many
+requests concurrently, e.g. to create the thousands of run bundles of a sweep and wait for them:
+
+    client = AsyncJsonApiClient(CodaLabManager().client(address))
+    infos = loop.run_until_complete(client.create_bundles(infos, params={'worksheet': uuid}))
+    states = loop.run_until_complete(client.wait_bundles([info['id'] for info in infos]))
+
+Requests are sent by the wrapped JsonApiClient from a bounded pool of threads, over the keep-alive
+connections of its HttpTransport, so that the requests, responses and errors are exactly those of
+JsonApiClient.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from codalab.common import NotFoundError
+from codalab.worker.bundle_state import State
+
+
+class AsyncJsonApiClient(object):
+    """
+    Asyncio wrapper around a JsonApiClient that sends at most max_concurrency requests at a time.
+    """
+
+    # Number of bundles created per request by create_bundles, and whose states are fetched per
+    # request by wait_bundles
+    BATCH_SIZE = 100
+    # Size of the chunks yielded by fetch_contents_blob
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, client, max_concurrency=8):
+        """
+        :param client: JsonApiClient sending the requests
+        :param max_concurrency: maximum number of requests sent at the same time
+        """
+        self._client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def close(self):
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def _call(self, f, *args, **kwargs):
+        """
+        Runs f(*args, **kwargs) in the thread pool and returns its result.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(f, *args, **kwargs))
+
+    async def fetch(self, resource_type, resource_id=None, params=None, include=None):
+        return await self._call(self._client.fetch, resource_type, resource_id, params, include)
+
+    async def fetch_one(self, resource_type, resource_id=None, params=None):
+        return await self._call(self._client.fetch_one, resource_type, resource_id, params)
+
+    async def create(self, resource_type, data, params=None):
+        return await self._call(self._client.create, resource_type, data, params)
+
+    async def update(self, resource_type, data, params=None):
+        return await self._call(self._client.update, resource_type, data, params)
+
+    async def delete(self, resource_type, resource_ids, params=None):
+        return await self._call(self._client.delete, resource_type, resource_ids, params)
+
+    async def fetch_contents_info(self, target, depth=0):
+        return await self._call(self._client.fetch_contents_info, target, depth)
+
+    async def fetch_contents_blob(self, target, range_=None, head=None, tail=None):
+        """
+        Same as JsonApiClient.fetch_contents_blob, but returns an asynchronous iterator over the
+        chunks of the contents, which are streamed rather than read in memory at once:
+
+            async for chunk in client.fetch_contents_blob(target):
+                ...
+        """
+        response = await self._call(
+            self._client.fetch_contents_blob, target, range_, head=head, tail=tail
+        )
+        try:
+            while True:
+                chunk = await self._call(response.read, self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    async def fetch_bundle_states(self, bundle_uuids):
+        return await self._call(self._client.fetch_bundle_states, bundle_uuids)
+
+    async def upload_contents_blob(self, bundle_id, fileobj=None, params=None):
+        return await self._call(self._client.upload_contents_blob, bundle_id, fileobj, params)
+
+    async def create_bundles(self, infos, params=None):
+        """
+        Creates the bundles of the given infos (e.g. the run bundles of a sweep), BATCH_SIZE
+        bundles per request, with up to max_concurrency requests at a time.
+
+        :param infos: list of bundle info dicts, as JsonApiClient.create takes them
+        :param params: query parameters of the requests, e.g. {'worksheet': worksheet_uuid}
+        :return: the list of the infos of the created bundles, in the same order
+        """
+        batches = await asyncio.gather(
+            *(
+                self.create('bundles', infos[i : i + self.BATCH_SIZE], params=params)
+                for i in range(0, len(infos), self.BATCH_SIZE)
+            )
+        )
+        return [info for batch in batches for info in batch]
+
+    async def wait_bundles(self, uuids, poll_interval=5.0):
+        """
+        Waits until the bundles with the given uuids are in a final state (ready, failed or
+        killed). The bundles not in a final state yet are polled every poll_interval seconds,
+        BATCH_SIZE bundles per request.
+
+        :return: {uuid: state} of the bundles once they are all in a final state
+        :raises NotFoundError: if any of the bundles doesn't exist
+        """
+        states = {}
+        pending = list(uuids)
+        while True:
+            batches = await asyncio.gather(
+                *(
+                    self.fetch_bundle_states(pending[i : i + self.BATCH_SIZE])
+                    for i in range(0, len(pending), self.BATCH_SIZE)
+                )
+            )
+            for batch in batches:
+                states.update((uuid, info['state']) for uuid, info in batch.items())
+            missing = [uuid for uuid in pending if uuid not in states]
+            if missing:
+                raise NotFoundError('Could not find bundles %s' % ' '.join(missing))
+            pending = [uuid for uuid in pending if states[uuid] not in State.FINAL_STATES]
+            if not pending:
+                return {uuid: states[uuid] for uuid in uuids}
+            await asyncio.sleep(poll_interval)
@@ -1,11 +1,22 @@
+import base64
+from contextlib import closing
 import http.client
+import json
 import socket
 import sys
+import time
 import six
 import urllib.request, urllib.parse, urllib.error
 
-from codalab.common import http_error_to_exception, precondition, ensure_str, UsageError
+from codalab.common import (
+    http_error_to_exception,
+    precondition,
+    ensure_str,
+    NotFoundError,
+    UsageError,
+)
 from codalab.worker.rest_client import RestClient, RestClientException
+from codalab.worker.bundle_state import State
 from codalab.worker.download_util import BundleTarget
 
 
@@ -142,18 +153,54 @@ class EmptyJsonApiRelationship(JsonApiRelationship):
         return 'EmptyJsonApiRelationship()'
 
 
+def parse_byteranges_document(contents, boundary):
+    """
+    Parses the body of a multipart/byteranges response.
+    Returns {start: bytes of the part whose Content-Range starts at start}.
+    """
+    sections = {}
+    delimiter = ('--' + boundary).encode()
+    position = 0
+    while True:
+        position = contents.find(delimiter, position)
+        if position < 0 or contents.startswith(b'--', position + len(delimiter)):
+            return sections
+        headers_end = contents.index(b'\r\n\r\n', position)
+        headers = contents[position + len(delimiter) : headers_end].decode().split('\r\n')
+        start, end = None, None
+        for header in headers:
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-range':
+                start, end = map(int, value.split()[1].split('/')[0].split('-'))
+        if start is None:
+            raise RestClientException('Invalid multipart/byteranges document', False)
+        position = headers_end + 4
+        sections[start] = contents[position : position + end - start + 1]
+        position += end - start + 1
+
+
 class JsonApiClient(RestClient):
     """
     Simple JSON API client.
     """
 
-    def __init__(self, address, get_access_token, extra_headers={}, check_version=lambda _: None):
+    # Maximum number of bundles whose states are fetched per request by fetch_bundle_states
+    BUNDLE_STATES_BATCH_SIZE = 10000
+
+    def __init__(
+        self,
+        address,
+        get_access_token,
+        extra_headers={},
+        check_version=lambda _: None,
+        transport=None,
+    ):
         self._get_access_token = get_access_token
         self._extra_headers = extra_headers
         self._check_version = check_version
         self.address = address  # Used as key in client and token caches
         base_url = address + '/rest'
-        super(JsonApiClient, self).__init__(base_url)
+        super(JsonApiClient, self).__init__(base_url, transport)
 
     @staticmethod
     def _get_resource_path(resource_type, resource_id=None, relationship=None):
@@ -416,6 +463,40 @@ class JsonApiClient(RestClient):
             )
         )
 
+    def fetch_iter(self, resource_type, params=None, page_size=1000):
+        """
+        Same as JsonApiClient.fetch for searches (`keywords` parameter), but returns an iterator
+        over all the results. They are fetched page_size at a time, following the `next_cursor` of
+        each page (any `.limit` keyword is overridden), and each page is streamed as
+        newline-delimited JSON, so that neither the server nor the client holds all the results
+        in memory at once.
+
+        :param resource_type: resource type as string
+        :param params: dict of query parameters
+        :param page_size: number of objects fetched per request
+        :return: iterator over the fetched objects
+        """
+        params = dict(params or {}, stream=True, cursor='')
+        params['keywords'] = list(params.get('keywords', [])) + ['.limit=%d' % page_size]
+        while params['cursor'] is not None:
+            with closing(self._fetch_stream(resource_type, dict(params))) as response:
+                params['cursor'] = None
+                for line in response:
+                    if not line.strip():
+                        continue
+                    document = json.loads(line.decode())
+                    params['cursor'] = document.get('meta', {}).get('next_cursor')
+                    yield from self._unpack_document(document)
+
+    @wrap_exception('Unable to fetch {1}')
+    def _fetch_stream(self, resource_type, params):
+        return self._make_request(
+            method='GET',
+            path=self._get_resource_path(resource_type),
+            query_params=self._pack_params(params),
+            return_response=True,
+        )
+
     def fetch_one(self, resource_type, resource_id=None, params=None):
         """
         Same as JsonApiClient.fetch, but always returns exactly one resource
@@ -467,6 +548,45 @@ class JsonApiClient(RestClient):
         # Return list iff original data was list
         return result if isinstance(data, list) else result[0]
 
+    @wrap_exception('Unable to create bundles')
+    def create_bundles_ndjson(self, infos, params=None):
+        """
+        Request to create many bundles at once, sent as newline-delimited JSON.
+        See /rest/bundles/_create_bundles_ndjson.
+
+        :param infos: iterable of bundle info dicts, as for JsonApiClient.create
+        :param params: dict of query parameters
+        :return: the uuids of the created bundles
+        """
+        data = b''.join(
+            (json.dumps(self._pack_document([info], 'bundles')['data'][0]) + '\n').encode()
+            for info in infos
+        )
+        uuids = []
+        with closing(
+            self._make_request(
+                method='POST',
+                path='/bundles/ndjson',
+                query_params=self._pack_params(params),
+                headers={'Content-Type': 'application/x-ndjson'},
+                data=data,
+                return_response=True,
+            )
+        ) as response:
+            for line in response:
+                if not line.strip():
+                    continue
+                result = json.loads(line.decode())
+                if 'error' in result:
+                    message = result['error']
+                    if 'line' in result:
+                        message = 'Invalid bundle on line %d: %s' % (result['line'], message)
+                    raise UsageError(
+                        '%s (%d bundles created: %s)' % (message, len(uuids), ' '.join(uuids))
+                    )
+                uuids.append(result['id'])
+        return uuids
+
     @wrap_exception('Unable to update {1}')
     def update(self, resource_type, data, params=None):
         """
@@ -601,6 +721,80 @@ class JsonApiClient(RestClient):
         )
         return response['data']
 
+    @wrap_exception('Unable to fetch updates of bundle {1}')
+    def fetch_bundle_updates(self, bundle_uuid, state=None, files=(), timeout=30):
+        """
+        Waits until the state of the bundle differs from the given state, or until any of the
+        given files has new contents, for up to timeout seconds. See
+        /rest/bundles/_fetch_bundle_updates.
+
+        :param bundle_uuid: uuid of the bundle
+        :param state: state of the bundle last seen, or None to return right away
+        :param files: list of (subpath, offset) of the files of the bundle to follow
+        :param timeout: maximum number of seconds to wait
+        :return: {'state': ..., 'files': [{'subpath': ..., 'offset': ..., 'contents': bytes}]},
+            with 'retry_after': seconds to wait before asking again if the server didn't wait
+        """
+        params = {
+            'subpath': [subpath for subpath, _ in files],
+            'offset': [offset for _, offset in files],
+            'timeout': timeout,
+        }
+        if state is not None:
+            params['state'] = state
+        response = self._make_request(
+            'GET', '/bundles/%s/updates' % bundle_uuid, query_params=self._pack_params(params)
+        )
+        for file in response['data']['files']:
+            file['contents'] = base64.b64decode(file['contents'])
+        return response['data']
+
+    @wrap_exception('Unable to fetch states of bundles')
+    def fetch_bundle_states(self, bundle_uuids):
+        """
+        Fetches the states of the bundles with the given uuids, BUNDLE_STATES_BATCH_SIZE bundles
+        per request. See /rest/bundles/_fetch_bundle_states.
+
+        :return: {uuid: {'state': ..., 'run_status': ..., 'last_updated': ...}} of the bundles
+            that exist
+        """
+        states = {}
+        for i in range(0, len(bundle_uuids), self.BUNDLE_STATES_BATCH_SIZE):
+            response = self._make_request(
+                'POST',
+                '/bundles/states',
+                data={'uuids': bundle_uuids[i : i + self.BUNDLE_STATES_BATCH_SIZE]},
+            )
+            states.update(response['data'])
+        return states
+
+    def wait_all(self, bundle_uuids, min_interval=1.0, max_interval=30.0, backoff=1.5):
+        """
+        Waits until the bundles with the given uuids are in a final state (ready, failed or
+        killed), fetching the states of those that aren't yet with fetch_bundle_states.
+        The interval between polls starts at min_interval and grows by a factor of backoff, up
+        to max_interval, while no bundle changes, and goes back to min_interval when one does.
+
+        :return: {uuid: {'state': ..., 'run_status': ..., 'last_updated': ...}} of the bundles
+            once they are all in a final state
+        :raises NotFoundError: if any of the bundles doesn't exist
+        """
+        states = {}
+        pending = list(bundle_uuids)
+        interval = min_interval
+        while True:
+            updated = self.fetch_bundle_states(pending)
+            missing = [uuid for uuid in pending if uuid not in updated]
+            if missing:
+                raise NotFoundError('Could not find bundles %s' % ' '.join(missing))
+            changed = any(states.get(uuid) != info for uuid, info in updated.items())
+            states.update(updated)
+            pending = [uuid for uuid in pending if states[uuid]['state'] not in State.FINAL_STATES]
+            if not pending:
+                return {uuid: states[uuid] for uuid in bundle_uuids}
+            interval = min_interval if changed else min(interval * backoff, max_interval)
+            time.sleep(interval)
+
     @wrap_exception('Unable to fetch contents blob of bundle {1}')
     def fetch_contents_blob(self, target, range_=None, head=None, tail=None, truncation_text=None):
         """
@@ -630,6 +824,35 @@ class JsonApiClient(RestClient):
             'GET', request_path, headers=headers, query_params=params, return_response=True
         )
 
+    @wrap_exception('Unable to fetch contents blob of bundle {1}')
+    def fetch_contents_blob_ranges(self, target, ranges):
+        """
+        Fetches several byte ranges of the target file with one request.
+
+        :param target: A worker.download_util.BundleTarget
+        :param ranges: list of (start, end) byte ranges, both inclusive
+        :return: list of the bytes of each range, which are shorter than the range (possibly
+            empty) past the end of the file
+        """
+        request_path = '/bundles/%s/contents/blob/%s' % (
+            target.bundle_uuid,
+            urllib.parse.quote(target.subpath),
+        )
+        headers = {'Range': 'bytes=' + ','.join('%d-%d' % range_ for range_ in ranges)}
+        with closing(
+            self._make_request('GET', request_path, headers=headers, return_response=True)
+        ) as response:
+            content_type = response.headers.get('Content-Type', '')
+            contents = response.read()
+        if not content_type.startswith('multipart/byteranges'):
+            # A single range was fetched
+            return [contents] + [
+                self.fetch_contents_blob_ranges(target, [range_])[0] for range_ in ranges[1:]
+            ]
+        boundary = content_type.split('boundary=')[1].strip().strip('"')
+        sections = parse_byteranges_document(contents, boundary)
+        return [sections.get(start, b'') for start, _ in ranges]
+
     @wrap_exception('Unable to upload contents of bundle {1}')
     def upload_contents_blob(self, bundle_id, fileobj=None, params=None, progress_callback=None):
         """
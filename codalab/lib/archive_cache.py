@@ -0,0 +1,172 @@
+"""
+archive_cache
+Caches the archives of the directories of bundles (e.g. the .tar.gz streamed by
+GET /bundles/<uuid>/contents/blob/ on a directory), so that popular directories (e.g. datasets
+that many workers download as dependencies) are compressed once rather than on every download.
+
+Only directories of bundles in a final state are cached: their contents never change, so entries
+are keyed by the bundle uuid, the subpath of the directory, the data hash of the bundle and the
+codec of the archive, and never need to be invalidated.
+
+Archives are written to the cache while they are streamed to the first client that downloads them,
+and are served from the files of the cache afterwards, which the server can send without copying
+them through Python. The cache directory is shared by the processes of the server, and bounded in
+size: the least recently used archives are deleted first.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveCache(object):
+    """
+    Bounded on-disk cache of directory archives. All methods are thread-safe.
+    """
+
+    # Codec of the archives of tar_gzip_directory
+    TAR_GZ = 'tar.gz'
+    # Number of bytes written to the cache between checks of its size
+    PRUNE_INTERVAL = 256 * 1024 * 1024
+    # Prefix of the archives being written
+    TEMP_PREFIX = '.tmp'
+
+    def __init__(self, cache_dir, max_bytes):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._num_bytes_written = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(bundle_uuid, subpath, data_hash, codec):
+        """
+        Returns the key of the archive of the given directory of a bundle.
+        """
+        contents = json.dumps([bundle_uuid, subpath, data_hash, codec])
+        return hashlib.sha1(contents.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the archive cached under key, opened for reading, or None.
+        """
+        path = self._get_path(key)
+        try:
+            fileobj = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            # Entries are pruned by last access time
+            os.utime(path)
+        except (IOError, OSError):
+            pass
+        return fileobj
+
+    def tee(self, key, fileobj, is_complete=None):
+        """
+        Returns a file-like object reading fileobj, which writes what it reads to the cache. The
+        archive is cached under key once fileobj has been read to the end, and discarded if the
+        returned object is closed before that.
+
+        is_complete: Function called once fileobj has been read to the end, which returns whether
+                     the archive is complete (e.g. whether the process writing it succeeded). The
+                     archive is discarded if it returns False.
+        """
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self._cache_dir, prefix=self.TEMP_PREFIX)
+        except (IOError, OSError):
+            logger.exception('Cannot write archive cache entry %s', key)
+            return fileobj
+        return TeeReader(self, key, fileobj, os.fdopen(fd, 'wb'), temp_path, is_complete)
+
+    def _add_entry(self, key, temp_path, size):
+        os.replace(temp_path, self._get_path(key))
+        with self._lock:
+            self._num_bytes_written += size
+            should_prune = self._num_bytes_written >= self.PRUNE_INTERVAL or size > self._max_bytes
+            if should_prune:
+                self._num_bytes_written = 0
+        if should_prune:
+            self._prune_entries()
+
+    def _prune_entries(self):
+        """
+        Deletes the least recently used archives, down to 90% of max_bytes, if the cache is larger
+        than max_bytes.
+        """
+        try:
+            entries = [
+                entry
+                for entry in os.scandir(self._cache_dir)
+                if entry.is_file() and not entry.name.startswith(self.TEMP_PREFIX)
+            ]
+            size = sum(entry.stat().st_size for entry in entries)
+            if size <= self._max_bytes:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                if size <= self._max_bytes * 0.9:
+                    break
+                size -= entry.stat().st_size
+                os.remove(entry.path)
+        except (IOError, OSError):
+            # Other processes might be pruning at the same time
+            logger.exception('Cannot prune archive cache entries')
+
+    def _get_path(self, key):
+        return os.path.join(self._cache_dir, key)
+
+
+class TeeReader(object):
+    """
+    File-like object returned by ArchiveCache.tee.
+    """
+
+    def __init__(self, cache, key, fileobj, temp_file, temp_path, is_complete=None):
+        self._cache = cache
+        self._key = key
+        self._fileobj = fileobj
+        self._temp_file = temp_file
+        self._temp_path = temp_path
+        self._is_complete = is_complete
+        self._size = 0
+
+    def read(self, num_bytes=-1):
+        data = self._fileobj.read(num_bytes)
+        if self._temp_file is None:
+            return data
+        try:
+            self._temp_file.write(data)
+            self._size += len(data)
+            if (not data and num_bytes != 0) or num_bytes is None or num_bytes < 0:
+                # End of the archive
+                if self._is_complete is not None and not self._is_complete():
+                    logger.error('Incomplete archive cache entry %s', self._key)
+                    self._discard()
+                    return data
+                self._temp_file.close()
+                self._temp_file = None
+                self._cache._add_entry(self._key, self._temp_path, self._size)
+        except (IOError, OSError):
+            logger.exception('Cannot write archive cache entry %s', self._key)
+            self._discard()
+        return data
+
+    def close(self):
+        if self._temp_file is not None:
+            self._discard()
+        self._fileobj.close()
+
+    def _discard(self):
+        if self._temp_file is not None:
+            self._temp_file.close()
+            self._temp_file = None
+        try:
+            os.remove(self._temp_path)
+        except (IOError, OSError):
+            pass
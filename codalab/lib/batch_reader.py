@@ -0,0 +1,209 @@
+"""
+batch_reader
+Reads the target infos and the first lines of many files of bundles at once, as needed to display
+tables and graphs of genpaths (e.g. /stats:train/acc) on worksheets.
+
+Reading a file of a running bundle is a round trip to its worker, so reading the files of a table
+one at a time can take minutes. Instead, targets are grouped by bundle: all the targets of a
+bundle that are in the same directory are resolved with a single listing of that directory, and
+the files of a bundle are read by the same task. The tasks of the different bundles run on a
+bounded pool of threads, with at most max_reads_per_worker tasks on the bundles of each worker, so
+that a large table doesn't flood a single worker with requests. The other tasks on the bundles of
+a worker wait in a queue of that worker rather than on a thread of the pool, so that a slow worker
+doesn't hold up the reads of other requests and other workers.
+
+Permissions are not checked; as with the DownloadManager, it is the caller's responsibility.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import defaultdict, deque
+import os
+import threading
+
+from codalab.common import NotFoundError
+from codalab.worker.download_util import BundleTarget
+
+
+class BatchReader(object):
+    """
+    Bounded pool of threads reading targets of bundles. All methods are thread-safe, so that a
+    single reader can serve all the requests of a process.
+    """
+
+    # Number of threads reading targets
+    MAX_THREADS = 16
+    # Maximum number of bundles of the same worker that are read concurrently
+    MAX_READS_PER_WORKER = 4
+
+    def __init__(self, max_threads=MAX_THREADS, max_reads_per_worker=MAX_READS_PER_WORKER):
+        self._executor = ThreadPoolExecutor(max_workers=max_threads)
+        self._max_reads_per_worker = max_reads_per_worker
+        # (user_id, worker_id) -> {'num_running': number of tasks submitted to the pool,
+        # 'waiting': deque of tasks waiting to be submitted}, for the workers with tasks
+        self._worker_tasks = {}
+        self._lock = threading.Lock()
+
+    def get_target_infos(self, bundle_model, download_manager, targets):
+        """
+        Returns {target: target_info} for the given BundleTargets, as returned by
+        download_manager.get_target_info(target, 0). Targets that are not found are mapped to
+        None.
+        """
+        subpaths = defaultdict(set)
+        for target in targets:
+            subpaths[target.bundle_uuid].add(target.subpath)
+        results = self._map_bundles(
+            bundle_model,
+            lambda bundle_uuid: self._get_bundle_target_infos(
+                download_manager, bundle_uuid, subpaths[bundle_uuid]
+            ),
+            subpaths,
+        )
+        return {
+            BundleTarget(bundle_uuid, subpath): info
+            for bundle_uuid, infos in results.items()
+            for subpath, info in infos.items()
+        }
+
+    def head_targets(self, bundle_model, download_manager, targets, max_num_lines, max_line_length):
+        """
+        Returns {target: lines} with the first max_num_lines lines of the given BundleTargets, as
+        lists of strings truncated to max_line_length bytes. The targets must be files; those that
+        are not found are mapped to None.
+        """
+        subpaths = defaultdict(set)
+        for target in targets:
+            subpaths[target.bundle_uuid].add(target.subpath)
+
+        def head_bundle_targets(bundle_uuid):
+            results = {}
+            for subpath in subpaths[bundle_uuid]:
+                target = BundleTarget(bundle_uuid, subpath)
+                try:
+                    # Note: summarize_file returns bytes, but should be decodable to a string.
+                    results[target] = (
+                        download_manager.summarize_file(
+                            target, max_num_lines, 0, max_line_length, None, gzipped=False
+                        )
+                        .decode()
+                        .splitlines(True)
+                    )
+                except NotFoundError:
+                    results[target] = None
+            return results
+
+        results = self._map_bundles(bundle_model, head_bundle_targets, subpaths)
+        return {
+            target: lines for lines_map in results.values() for target, lines in lines_map.items()
+        }
+
+    def _map_bundles(self, bundle_model, fn, bundle_uuids):
+        """
+        Calls fn(bundle_uuid) for each of the given bundles on the pool, and returns
+        {bundle_uuid: result}. Raises the exception of the first call that failed, if any.
+        """
+        bundle_uuids = list(bundle_uuids)
+        if len(bundle_uuids) == 1:
+            return {bundle_uuids[0]: fn(bundle_uuids[0])}
+        workers = bundle_model.get_bundle_workers(bundle_uuids)
+        # Files of bundles that are not running (without a worker) are read from the bundle store
+        futures = {
+            bundle_uuid: self._submit(workers.get(bundle_uuid), fn, bundle_uuid)
+            for bundle_uuid in bundle_uuids
+        }
+        return {bundle_uuid: future.result() for bundle_uuid, future in futures.items()}
+
+    def _submit(self, worker, fn, *args):
+        """
+        Schedules fn(*args) on the pool, once fewer than max_reads_per_worker tasks on the bundles
+        of worker are running (right away if worker is None). Returns a Future of the result.
+        """
+        task = (Future(), fn, args)
+        if worker is not None:
+            with self._lock:
+                worker_tasks = self._worker_tasks.setdefault(
+                    worker, {'num_running': 0, 'waiting': deque()}
+                )
+                if worker_tasks['num_running'] >= self._max_reads_per_worker:
+                    worker_tasks['waiting'].append(task)
+                    return task[0]
+                worker_tasks['num_running'] += 1
+        self._executor.submit(self._run_task, worker, task)
+        return task[0]
+
+    def _run_task(self, worker, task):
+        """
+        Runs the task on a thread of the pool, then submits the next task waiting on the worker.
+        """
+        future, fn, args = task
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        if worker is None:
+            return
+        with self._lock:
+            worker_tasks = self._worker_tasks[worker]
+            if not worker_tasks['waiting']:
+                worker_tasks['num_running'] -= 1
+                if worker_tasks['num_running'] == 0:
+                    del self._worker_tasks[worker]
+                return
+            next_task = worker_tasks['waiting'].popleft()
+        self._executor.submit(self._run_task, worker, next_task)
+
+    def _get_bundle_target_infos(self, download_manager, bundle_uuid, subpaths):
+        """
+        Returns {subpath: target_info} for the given subpaths of the bundle. Subpaths in the same
+        directory are resolved with a single listing of that directory; those that aren't in the
+        listing (e.g. paths into dependencies) are resolved one at a time.
+        """
+
+        def get_target_info(subpath):
+            try:
+                return download_manager.get_target_info(BundleTarget(bundle_uuid, subpath), 0)
+            except NotFoundError:
+                return None
+
+        directories = defaultdict(list)
+        infos = {}
+        for subpath in subpaths:
+            directory, name = os.path.split(os.path.normpath(subpath).strip(os.path.sep))
+            if name in ('', '.', '..') or '..' in directory.split(os.path.sep):
+                infos[subpath] = get_target_info(subpath)
+            else:
+                directories[directory].append((subpath, name))
+
+        for directory, entries in directories.items():
+            if len(entries) == 1:
+                subpath, _ = entries[0]
+                infos[subpath] = get_target_info(subpath)
+                continue
+            try:
+                directory_info = download_manager.get_target_info(
+                    BundleTarget(bundle_uuid, directory), 1
+                )
+            except NotFoundError:
+                directory_info = None
+            if directory_info is None or directory_info['type'] != 'directory':
+                # The directory might be a dependency or a link to one
+                for subpath, _ in entries:
+                    infos[subpath] = get_target_info(subpath)
+                continue
+            contents = {entry['name']: entry for entry in directory_info['contents']}
+            resolved_target = directory_info['resolved_target']
+            for subpath, name in entries:
+                if name in contents:
+                    infos[subpath] = dict(
+                        contents[name],
+                        resolved_target=BundleTarget(
+                            resolved_target.bundle_uuid,
+                            os.path.join(resolved_target.subpath, name)
+                            if resolved_target.subpath
+                            else name,
+                        ),
+                    )
+                else:
+                    infos[subpath] = get_target_info(subpath)
+        return infos
@@ -0,0 +1,81 @@
+"""
+block_cache
+Caches the worksheet blocks resolved by the interpret API (contents of files, tables of
+genpaths, images, graphs), which is the most expensive part of interpreting a worksheet since
+it reads files from the bundle store or from workers.
+
+A resolved block is cached under a digest of the block as it was before being resolved. That
+block is built from the worksheet items it displays and from the infos of their bundles (state,
+metadata, permission of the user...), so that a block is only resolved again when one of these
+changes, and never shared with users who see different bundle infos. The files of a bundle that
+is not in a final state can change while its info stays the same, so blocks displaying such
+bundles are never cached.
+"""
+
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import threading
+
+from codalab.worker.bundle_state import State
+
+
+def get_block_key(block, brief):
+    """
+    Returns the key under which the resolved version of the given interpreted block is cached, or
+    None if it can't be cached.
+    """
+    bundle_infos = block.get('bundles_spec', {}).get('bundle_infos', [])
+    if not bundle_infos or any(
+        info is None or info.get('state') not in State.FINAL_STATES for info in bundle_infos
+    ):
+        return None
+    contents = json.dumps([block, brief], sort_keys=True, default=str)
+    return hashlib.sha1(contents.encode()).hexdigest()
+
+
+class BlockCache(object):
+    """
+    Bounded LRU cache of resolved blocks. Blocks are copied in and out of the cache, so that
+    callers can modify them. All methods are thread-safe.
+    """
+
+    # Maximum number of blocks cached
+    MAX_BLOCKS = 4096
+    # Maximum total size of the cached blocks, as serialized to JSON
+    MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_blocks=MAX_BLOCKS, max_bytes=MAX_BYTES):
+        self._max_blocks = max_blocks
+        self._max_bytes = max_bytes
+        # key -> (block, size)
+        self._blocks = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a copy of the block cached under key, or None.
+        """
+        with self._lock:
+            entry = self._blocks.pop(key, None)
+            if entry is None:
+                return None
+            self._blocks[key] = entry
+            return copy.deepcopy(entry[0])
+
+    def put(self, key, block):
+        size = len(json.dumps(block, default=str))
+        if size > self._max_bytes:
+            return
+        block = copy.deepcopy(block)
+        with self._lock:
+            old_entry = self._blocks.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            self._blocks[key] = (block, size)
+            self._size += size
+            while len(self._blocks) > self._max_blocks or self._size > self._max_bytes:
+                _, (_, evicted_size) = self._blocks.popitem(last=False)
+                self._size -= evicted_size
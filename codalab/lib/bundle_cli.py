@@ -2312,6 +2312,17 @@ class BundleCLI(object):
             Commands.Argument(
                 '--verbose', help='Verbose mode for BundleFUSE.', action='store_true', default=False
             ),
+            Commands.Argument(
+                '--single-threaded',
+                help='Handle one filesystem call at a time.',
+                action='store_true',
+                default=False,
+            ),
+            Commands.Argument(
+                '--cache-size',
+                help='Maximum size of the on-disk cache of the contents of ready bundles, shared by mounts (e.g., 2g). Default is 1g; 0 disables the cache.',
+                default='1g',
+            ),
             Commands.Argument(
                 '-w',
                 '--worksheet-spec',
@@ -2341,7 +2352,20 @@ class BundleCLI(object):
                 'BundleFUSE will run and maintain the mounted filesystem in the foreground. CTRL-C to cancel.',
                 file=self.stdout,
             )
-            bundle_fuse.bundle_mount(client, mountpoint, target.bundle_uuid, args.verbose)
+            cache_size = formatting.parse_size(args.cache_size)
+            disk_cache = None
+            if cache_size > 0:
+                disk_cache = bundle_fuse.DiskChunkCache(
+                    os.path.join(self.manager.codalab_home, 'mount_cache'), cache_size
+                )
+            bundle_fuse.bundle_mount(
+                client,
+                mountpoint,
+                target.bundle_uuid,
+                args.verbose,
+                multithreaded=not args.single_threaded,
+                disk_cache=disk_cache,
+            )
             print('BundleFUSE shutting down.', file=self.stdout)
         else:
             print('fuse is not installed', file=self.stdout)
@@ -2542,31 +2566,75 @@ class BundleCLI(object):
         subpath_targets = [None] * len(subpaths)
 
         SLEEP_PERIOD = 1.0
+        # Maximum number of seconds that the server holds a request for updates
+        UPDATES_TIMEOUT = 30
 
-        # Wait for all files to become ready (or until run finishes)
-        run_state = client.fetch('bundles', bundle_uuid)['state']
-        for subpath in subpaths:
-            while run_state not in State.FINAL_STATES:
-                run_state = client.fetch('bundles', bundle_uuid)['state']
-                try:
-                    client.fetch_contents_info(BundleTarget(bundle_uuid, subpath), 0)
-                except NotFoundError:
-                    time.sleep(SLEEP_PERIOD)
-                    continue
-                break
-
+        def read_target(i):
+            """
+            Print the new contents of the i-th subpath, read with fetch_contents_blob.
+            Return whether there were any.
+            """
+            READ_LENGTH = 16384
+            has_contents = False
+            while True:
+                byte_range = (subpath_offset[i], subpath_offset[i] + READ_LENGTH - 1)
+                with closing(
+                    client.fetch_contents_blob(subpath_targets[i], byte_range)
+                ) as contents:
+                    result = contents.read()
+                if not result:
+                    break
+                has_contents = True
+                subpath_offset[i] += len(result)
+                self.stdout.write(ensure_str(result))
+                if len(result) < READ_LENGTH:
+                    # No more to read.
+                    break
+            return has_contents
+
+        run_state = None
+        # Indices of the subpaths that are files of the bundle, whose new contents come with the
+        # updates of the bundle
+        followed = []
         while True:
-            if not run_state in State.FINAL_STATES:
-                run_state = client.fetch('bundles', bundle_uuid)['state']
+            # Wait for the state of the bundle to change, or for new contents of the followed
+            # files. Subpaths that don't exist yet are looked for every SLEEP_PERIOD, and nothing
+            # changes once the run finished.
+            if run_state in State.FINAL_STATES:
+                timeout = 0
+            elif None in subpath_is_file:
+                timeout = SLEEP_PERIOD
+            else:
+                timeout = UPDATES_TIMEOUT
+            updates = client.fetch_bundle_updates(
+                bundle_uuid,
+                run_state,
+                [(subpath_targets[i].subpath, subpath_offset[i]) for i in followed],
+                timeout=timeout,
+            )
+            run_state = updates['state']
+            if 'retry_after' in updates:
+                # The server is too busy to wait for updates
+                time.sleep(min(updates['retry_after'], timeout))
+            has_contents = False
+            for i, file_updates in zip(followed, updates['files']):
+                if file_updates['contents']:
+                    has_contents = True
+                    subpath_offset[i] += len(file_updates['contents'])
+                    self.stdout.write(ensure_str(file_updates['contents']))
 
-            # Read data.
             for i in range(0, len(subpaths)):
                 # If the subpath we're interested in appears, check if it's a
                 # file and if so, initialize the offset.
                 if subpath_is_file[i] is None:
-                    target_info = client.fetch_contents_info(
-                        BundleTarget(bundle_uuid, subpaths[i]), 0
-                    )
+                    try:
+                        target_info = client.fetch_contents_info(
+                            BundleTarget(bundle_uuid, subpaths[i]), 0
+                        )
+                    except NotFoundError:
+                        if run_state in State.FINAL_STATES:
+                            raise
+                        continue
                     subpath_targets[i] = target_info['resolved_target']
                     if target_info['type'] == 'file':
                         subpath_is_file[i] = True
@@ -2575,37 +2643,23 @@ class BundleCLI(object):
                         else:
                             # Go to near the end of the file (TODO: make this match up with lines)
                             subpath_offset[i] = max(target_info['size'] - 64, 0)
+                        if subpath_targets[i].bundle_uuid == bundle_uuid:
+                            followed.append(i)
+                            # Read with the next updates
+                            has_contents = True
                     else:
                         subpath_is_file[i] = False
 
-                if not subpath_is_file[i]:
-                    continue
-
-                # Read from that file.
-                while True:
-                    READ_LENGTH = 16384
-                    byte_range = (subpath_offset[i], subpath_offset[i] + READ_LENGTH - 1)
-                    with closing(
-                        client.fetch_contents_blob(subpath_targets[i], byte_range)
-                    ) as contents:
-                        result = contents.read()
-                    if not result:
-                        break
-                    subpath_offset[i] += len(result)
-                    self.stdout.write(ensure_str(result))
-                    if len(result) < READ_LENGTH:
-                        # No more to read.
-                        break
+                # Files that resolve to other bundles, which are done, are read directly
+                if subpath_is_file[i] and i not in followed:
+                    has_contents = read_target(i) or has_contents
 
             self.stdout.flush()
 
             # The run finished and we read all the data.
-            if run_state in State.FINAL_STATES:
+            if run_state in State.FINAL_STATES and not has_contents:
                 break
 
-            # Sleep, since we've finished reading all the data available.
-            time.sleep(SLEEP_PERIOD)
-
         return run_state
 
     @Commands.command(
@@ -3,11 +3,19 @@
 
 import os
 import errno
+import hashlib
+import itertools
+import json
+import logging
+import posixpath
 import stat
+import tempfile
+import threading
 import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
 
-from contextlib import closing
 from codalab.worker.download_util import BundleTarget
 
 try:
@@ -17,132 +25,276 @@ try:
 except EnvironmentError:
     fuse_is_available = False
 
-if fuse_is_available:
-    from codalab.common import NotFoundError
-
-    class ByteRangeReader(object):
+logger = logging.getLogger(__name__)
+
+
+class DiskChunkCache(object):
+    '''
+    Bounded on-disk cache of the chunks of files that can't change (those of READY bundles), shared
+    by the mounts that use the same directory. Chunks are evicted least recently used first once
+    the total size of the cached chunks exceeds max_size bytes.
+    '''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # file name -> size, the least recently used first
+        self._size = 0
+        # Chunks cached by previous mounts, the least recently written first
+        files = [entry for entry in os.scandir(directory) if entry.is_file()]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            if entry.name.startswith('.'):
+                continue
+            self._entries[entry.name] = entry.stat().st_size
+            self._size += entry.stat().st_size
+        self._evict()
+
+    def get(self, key):
+        ''' Return the cached chunk of the given key, or None. '''
+        name = self._get_name(key)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # Evicted by another thread
+            return None
+
+    def put(self, key, data):
+        ''' Cache the chunk of the given key. '''
+        name = self._get_name(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, os.path.join(self.directory, name))
+        with self._lock:
+            self._size += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+        self._evict()
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            while self._size > self.max_size and self._entries:
+                name, size = self._entries.popitem(last=False)
+                self._size -= size
+                evicted.append(name)
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _get_name(key):
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+class ByteRangeReader(object):
+    '''
+    Manages Byte Ranges for BundleFuse and operates like a cache, fetching via the client
+    to refresh or obtain new byte ranges through the REST api whenever it needs to.
+    One reader for one bundle at a time (same as BundleFuse)
+
+    Sequential reads of a file are detected, and the chunks that follow them are fetched ahead of
+    time by a pool of read_ahead_threads threads, up to max_read_ahead chunks ahead, so that
+    reading a large file isn't bound by the round-trip time of every chunk. The chunks missing
+    for a read, or read ahead, are fetched with one request per chunks_per_request chunks.
+
+    The files of immutable bundles can't change: their chunks never expire, and are also kept in
+    the disk_cache (a DiskChunkCache) if there is one.
+    '''
+
+    def __init__(
+        self,
+        client,
+        bundle_uuid,
+        timeout=60,
+        max_num_chunks=100,
+        chunk_size=None,
+        max_read_ahead=8,
+        read_ahead_threads=4,
+        chunks_per_request=4,
+        immutable=False,
+        disk_cache=None,
+    ):
+        if chunk_size is None:
+            chunk_size = 1 * 1000 * 1000  # 1 MB
+
+        self.chunk_size = chunk_size
+        self.max_num_chunks = max_num_chunks
+        self.timeout = timeout
+        self.client = client
+        self.bundle_uuid = bundle_uuid
+        self.max_read_ahead = max_read_ahead
+        self.chunks_per_request = chunks_per_request
+        self.immutable = immutable
+        self.disk_cache = disk_cache if immutable else None
+        self.cache = OrderedDict()  # (path, chunk_id) -> (time, bytearray)
+        # (path, chunk_id) -> Future of {chunk_id: bytearray} of the chunks being read ahead with it
+        self.pending = {}
+        self.streams = {}  # path -> (offset following the last read, number of chunks read ahead)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=read_ahead_threads)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def read(self, path, length, offset, size=None):
         '''
-        Manages Byte Ranges for BundleFuse and operates like a cache, fetching via the client
-        to refresh or obtain new byte ranges through the REST api whenever it needs to.
-        One reader for one bundle at a time (same as BundleFuse)
+        Return length bytes of the file at path from offset.
+        size is the size of the file if known, which bounds the chunks read ahead.
         '''
-
-        def __init__(self, client, bundle_uuid, timeout=60, max_num_chunks=100, chunk_size=None):
-            if chunk_size is None:
-                chunk_size = 1 * 1000 * 1000  # 1 MB
-
-            self.chunk_size = chunk_size
-            self.max_num_chunks = max_num_chunks
-            self.timeout = timeout
-            self.client = client
-            self.bundle_uuid = bundle_uuid
-            self.cache = OrderedDict()  # (path, chunk_id) -> (time, bytearray)
-
-        def read(self, path, length, offset):
-            start_offset = offset
-            end_offset = offset + length - 1
-
-            start_chunk = self._get_chunk_id(start_offset)
-            end_chunk = self._get_chunk_id(end_offset)
-            arr = ''
-            for chunk_id in range(start_chunk, end_chunk + 1):
-                arr += self._fetch_chunk(path, chunk_id)
-            return arr[
-                offset
-                - start_chunk * self.chunk_size : offset
-                - start_chunk * self.chunk_size
-                + length
+        if length <= 0:
+            return b''
+        start_offset = offset
+        end_offset = offset + length - 1
+
+        start_chunk = self._get_chunk_id(start_offset)
+        end_chunk = self._get_chunk_id(end_offset)
+        self._read_ahead(path, offset, length, end_chunk, size)
+        arr = b''.join(self._fetch_chunks(path, list(range(start_chunk, end_chunk + 1))))
+        return arr[
+            offset - start_chunk * self.chunk_size : offset - start_chunk * self.chunk_size + length
+        ]
+
+    def _read_ahead(self, path, offset, length, end_chunk, size):
+        '''
+        Start fetching the chunks following end_chunk if the file at path is read sequentially.
+        The number of chunks read ahead doubles with each sequential read, up to max_read_ahead,
+        and goes back to 0 on random reads.
+        '''
+        futures = []
+        with self.lock:
+            next_offset, num_chunks = self.streams.get(path, (0, 0))
+            # Reads can be slightly out of order when FUSE is multithreaded
+            if abs(offset - next_offset) <= self.chunk_size:
+                num_chunks = min(max(2 * num_chunks, 1), self.max_read_ahead)
+            else:
+                num_chunks = 0
+            self.streams[path] = (offset + length, num_chunks)
+            last_chunk = end_chunk + num_chunks
+            if size is not None:
+                last_chunk = min(last_chunk, self._get_chunk_id(size - 1))
+            chunk_ids = [
+                chunk_id
+                for chunk_id in range(end_chunk + 1, last_chunk + 1)
+                if (path, chunk_id) not in self.pending
+                and self._get_cached_chunk((path, chunk_id)) is None
             ]
+            for i in range(0, len(chunk_ids), self.chunks_per_request):
+                group = chunk_ids[i : i + self.chunks_per_request]
+                future = self.executor.submit(self._load_chunks, path, group)
+                for chunk_id in group:
+                    self.pending[(path, chunk_id)] = future
+                    futures.append(((path, chunk_id), future))
+        # Callbacks of futures already done are called right away, and take the lock
+        for key, future in futures:
+            future.add_done_callback(functools.partial(self._forget_pending, key))
+
+    def _forget_pending(self, key, future):
+        '''
+        Called once a chunk was read ahead, which is in the cache from then on unless it's partial.
+        '''
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
 
-        def _fetch_chunk(self, path, chunk_id):
-            '''
-            Fetch and return a chunk from the cache, or with the client as necessary.
-            Refreshes chunks that are older than self.timeout
-            Only save full chunks to the cache.
-            Partial chunks (i.e. at the end of a file) are not cached because they could grow.
-            '''
-
-            now = int(time.time())
-            key = (path, chunk_id)
-
-            if key in self.cache:
-                t, arr = self.cache[key]
-                if now - t < self.timeout:
-                    return arr  # return chunk from cache
-                else:
-                    self.cache.pop(key)  # pop out expired entry
-
-            # grab from client
-            byte_range = (
-                chunk_id * self.chunk_size,
-                chunk_id * self.chunk_size + self.chunk_size - 1,
-            )
-            with closing(
-                self.client.fetch_contents_blob(BundleTarget(self.bundle_uuid, path), byte_range)
-            ) as contents:
-                arr = contents.read()
-
-            if len(arr) == self.chunk_size:  # only cache if fetched full chunk
-                if len(self.cache) >= self.max_num_chunks:  # if full, remove the oldest item
-                    self.cache.popitem(last=False)
-                self.cache[key] = (now, arr)
-
-            return arr
-
-        def _get_chunk_id(self, offset):
-            ''' Return chunk id given offset '''
-            return offset // self.chunk_size
+    def _fetch_chunks(self, path, chunk_ids):
+        '''
+        Fetch and return the given chunks from the cache, from the chunks being read ahead, or
+        with the client as necessary.
+        '''
+        chunks = {}
+        futures = {}
+        with self.lock:
+            for chunk_id in chunk_ids:
+                key = (path, chunk_id)
+                arr = self._get_cached_chunk(key)
+                if arr is not None:
+                    chunks[chunk_id] = arr
+                elif key in self.pending:
+                    futures[chunk_id] = self.pending.pop(key)
+        for chunk_id, future in futures.items():
+            try:
+                chunks[chunk_id] = future.result()[chunk_id]
+            except Exception:
+                logger.debug('Reading ahead chunk %s failed', (path, chunk_id), exc_info=True)
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in chunks]
+        for i in range(0, len(missing), self.chunks_per_request):
+            chunks.update(self._load_chunks(path, missing[i : i + self.chunks_per_request]))
+        return [chunks[chunk_id] for chunk_id in chunk_ids]
+
+    def _get_cached_chunk(self, key):
+        '''
+        Return the chunk from the memory cache, or None.
+        Refreshes chunks that are older than self.timeout, unless the bundle is immutable.
+        Must be called with self.lock held.
+        '''
+        if key not in self.cache:
+            return None
+        t, arr = self.cache[key]
+        if not self.immutable and int(time.time()) - t >= self.timeout:
+            self.cache.pop(key)  # pop out expired entry
+            return None
+        self.cache.move_to_end(key)
+        return arr
+
+    def _cache_chunk(self, key, arr):
+        ''' Must be called with self.lock held. '''
+        self.cache.pop(key, None)
+        if len(self.cache) >= self.max_num_chunks:  # if full, remove the oldest item
+            self.cache.popitem(last=False)
+        self.cache[key] = (int(time.time()), arr)
+
+    def _load_chunks(self, path, chunk_ids):
+        '''
+        Return {chunk_id: bytearray} of the given chunks from the disk cache, or fetch them with
+        the client, with one request, and cache them.
+        Partial chunks (i.e. at the end of a file) are only cached if the bundle is immutable,
+        since they could grow otherwise.
+        '''
+        chunks = {}
+        if self.disk_cache is not None:
+            for chunk_id in chunk_ids:
+                arr = self.disk_cache.get((self.bundle_uuid, path, self.chunk_size, chunk_id))
+                if arr is not None:
+                    chunks[chunk_id] = arr
+                    with self.lock:
+                        self._cache_chunk((path, chunk_id), arr)
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in chunks]
+        if not missing:
+            return chunks
+
+        byte_ranges = [
+            (chunk_id * self.chunk_size, chunk_id * self.chunk_size + self.chunk_size - 1)
+            for chunk_id in missing
+        ]
+        sections = self.client.fetch_contents_blob_ranges(
+            BundleTarget(self.bundle_uuid, path), byte_ranges
+        )
+        for chunk_id, arr in zip(missing, sections):
+            chunks[chunk_id] = arr
+            if self.immutable or len(arr) == self.chunk_size:
+                with self.lock:
+                    self._cache_chunk((path, chunk_id), arr)
+                if self.disk_cache is not None:
+                    self.disk_cache.put((self.bundle_uuid, path, self.chunk_size, chunk_id), arr)
+        return chunks
+
+    def _get_chunk_id(self, offset):
+        ''' Return chunk id given offset '''
+        return offset // self.chunk_size
 
-    class MWT(object):
-        """
-        Memoize With Timeout
-        https://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/
-        """
 
-        _caches = {}
-        _timeouts = {}
-
-        def __init__(self, timeout=2):
-            self.timeout = timeout
-
-        def collect(self):
-            """Clear cache of results which have timed out"""
-            for func in self._caches:
-                cache = {}
-                for key in self._caches[func]:
-                    if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                        cache[key] = self._caches[func][key]
-                self._caches[func] = cache
-
-        def __call__(self, f):
-            self.cache = self._caches[f] = {}
-            self._timeouts[f] = self.timeout
-
-            def func(*args, **kwargs):
-                kw = kwargs.items()
-                kw.sort()
-                key = (args, tuple(kw))
-                try:
-                    v = self.cache[key]
-                    if (time.time() - v[1]) > self.timeout:
-                        raise KeyError
-                except KeyError:
-                    v = self.cache[key] = f(*args, **kwargs), time.time()
-                return v[0]
-
-            func.__name__ = f.__name__
-
-            return func
-
-    class Memoize(MWT):
-        '''A superset of MWT that adds the possibility to yank paths from cached results'''
-
-        def yank_path(self, path):
-            """Clear cache of results from a specific path"""
-            for func in self._caches:
-                for key in self._caches[func].keys():
-                    if path in key[0]:
-                        del self._caches[func][key]
+if fuse_is_available:
+    from codalab.common import NotFoundError
+    from codalab.worker.bundle_state import State
 
     class BundleFuse(Operations):
         """
@@ -152,17 +304,31 @@ if fuse_is_available:
 
         If the bundle is a single file, the mountpoint will look like a directory that contains that single file.
 
+        The contents of READY bundles can't change: their directory trees are cached for the
+        lifetime of the mount, and their file chunks in the disk cache if there is one. Those of
+        other bundles are refreshed after INFO_TIMEOUT seconds.
         """
 
-        def __init__(self, client, bundle_uuid, verbose=False):
+        # Number of seconds for which the infos of the contents of mutable bundles are cached
+        INFO_TIMEOUT = 5
+        # Number of levels of a directory tree fetched at once for immutable bundles
+        IMMUTABLE_INFO_DEPTH = 3
+
+        def __init__(self, client, bundle_uuid, verbose=False, disk_cache=None):
             self.client = client
             self.bundle_uuid = bundle_uuid
-            self.fd = 0  # file descriptor
+            self.fds = itertools.count(1)  # file descriptors
             self.verbose = verbose
-            self.bundle_metadata = self.client.fetch('bundles', self.bundle_uuid)['metadata']
+            bundle_info = self.client.fetch('bundles', self.bundle_uuid)
+            self.bundle_metadata = bundle_info['metadata']
+            self.immutable = bundle_info['state'] == State.READY
+            self.infos = {}  # path -> (time, info)
+            self.infos_lock = threading.Lock()
 
             self.single_file_bundle = False
-            self.reader = ByteRangeReader(self.client, self.bundle_uuid)
+            self.reader = ByteRangeReader(
+                self.client, self.bundle_uuid, immutable=self.immutable, disk_cache=disk_cache
+            )
             info = self._get_info('/')
             if info['type'] == 'file':
                 self.single_file_bundle = True
@@ -173,15 +339,36 @@ if fuse_is_available:
         # Helpers
         # =======
 
-        @Memoize(timeout=5)
-        def _get_info(self, path):
-            ''' Set a request through the json api client to get info about the bundle '''
+        def _get_info(self, path, need_contents=False):
+            '''
+            Return the info of the given path from the cache, or set a request through the json
+            api client to get info about the bundle. The infos of the entries of the directories
+            fetched are cached as well, so that listing a directory and getting the attributes of
+            its entries takes a single request.
+            '''
+            now = time.time()
+            with self.infos_lock:
+                if path in self.infos:
+                    t, info = self.infos[path]
+                    if (self.immutable or now - t < self.INFO_TIMEOUT) and (
+                        not need_contents or info['type'] != 'directory' or 'contents' in info
+                    ):
+                        return info
+            depth = self.IMMUTABLE_INFO_DEPTH if self.immutable else 1
             try:
-                info = self.client.fetch_contents_info(BundleTarget(self.bundle_uuid, path), 1)
+                info = self.client.fetch_contents_info(BundleTarget(self.bundle_uuid, path), depth)
             except NotFoundError:
                 raise FuseOSError(errno.ENOENT)
+            with self.infos_lock:
+                self._cache_infos(path, info, now)
             return info
 
+        def _cache_infos(self, path, info, now):
+            ''' Must be called with self.infos_lock held. '''
+            self.infos[path] = (now, info)
+            for child in info.get('contents', []):
+                self._cache_infos(posixpath.join(path, child['name']), child, now)
+
         def verbose_print(self, msg):
             if self.verbose:
                 print('[BundleFUSE]:', msg)
@@ -237,7 +424,7 @@ if fuse_is_available:
             if self.single_file_bundle:
                 dirents.append(self.bundle_metadata['name'])
             else:
-                info = self._get_info(path)
+                info = self._get_info(path, need_contents=True)
                 items = info.get('contents', [])
                 for d in items:
                     dirents.append(d['name'])
@@ -265,6 +452,10 @@ if fuse_is_available:
             else:
                 return pathname
 
+        def destroy(self, path):
+            ''' Called when the filesystem is unmounted. '''
+            self.reader.close()
+
         # File methods
         # ============
 
@@ -274,9 +465,9 @@ if fuse_is_available:
             (fabianc: This seems to be the way people do it, I have no idea why it's done this way.)
             '''
 
-            self.fd += 1
+            fd = next(self.fds)
             self.verbose_print('open path={}'.format(path))
-            return self.fd
+            return fd
 
         def read(self, path, length, offset, fh):
             ''' Return a range of bytes from a path as specified.  '''
@@ -284,11 +475,21 @@ if fuse_is_available:
             if self.single_file_bundle:
                 path = '/'
 
-            result = self.reader.read(path, length, offset)
+            result = self.reader.read(path, length, offset, self._get_info(path)['size'])
 
             self.verbose_print('read path={}, length={}, offset={}'.format(path, length, offset))
             return result
 
-    def bundle_mount(client, mountpoint, bundle_uuid, verbose=False):
-        ''' Mount the filesystem on the mountpoint. '''
-        FUSE(BundleFuse(client, bundle_uuid, verbose), mountpoint, nothreads=True, foreground=True)
+    def bundle_mount(
+        client, mountpoint, bundle_uuid, verbose=False, multithreaded=True, disk_cache=None
+    ):
+        '''
+        Mount the filesystem on the mountpoint.
+        Filesystem calls are handled concurrently unless multithreaded is False.
+        '''
+        FUSE(
+            BundleFuse(client, bundle_uuid, verbose, disk_cache),
+            mountpoint,
+            nothreads=not multithreaded,
+            foreground=True,
+        )
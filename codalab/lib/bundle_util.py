@@ -38,6 +38,87 @@ def bundle_to_bundle_info(model, bundle):
     return info
 
 
+# bundle_type -> (keys of the metadata set by default, {key: (constructor, is_list)})
+_compiled_metadata_specs = {}
+
+
+def _get_compiled_metadata_specs(bundle_type):
+    """
+    Helper: Return the metadata specs of the bundle subclass of the given type, in the form used
+    by bundle_rows_to_bundle_infos to build metadata the same way Metadata.collapse_dicts does.
+    """
+    compiled_specs = _compiled_metadata_specs.get(bundle_type)
+    if compiled_specs is None:
+        specs = get_bundle_subclass(bundle_type).METADATA_SPECS
+        default_keys = [spec.key for spec in specs if spec.type == list or not spec.generated]
+        constructors = {spec.key: (spec.get_constructor(), spec.type == list) for spec in specs}
+        compiled_specs = _compiled_metadata_specs[bundle_type] = (default_keys, constructors)
+    return compiled_specs
+
+
+def bundle_rows_to_bundle_infos(bundle_rows, dependency_rows, metadata_rows, parent_names):
+    """
+    Helper: Convert the rows returned by BundleModel.batch_get_bundle_info_rows to bundle_infos,
+    as bundle_to_bundle_info does for each of the corresponding bundles, without constructing
+    Bundle objects or querying names of dependencies one bundle at a time.
+    Return {uuid: bundle_info}
+    """
+    names = dict(parent_names)
+    infos = {}
+    constructors = {}  # uuid -> {metadata key: (constructor, is_list)}
+    for row in bundle_rows:
+        default_keys, constructors[row.uuid] = _get_compiled_metadata_specs(row.bundle_type)
+        infos[row.uuid] = {
+            'uuid': row.uuid,
+            'bundle_type': row.bundle_type,
+            'owner_id': row.owner_id,
+            'command': row.command,
+            'data_hash': row.data_hash,
+            'state': row.state,
+            'is_anonymous': row.is_anonymous,
+            'metadata': {key: constructors[row.uuid][key][0]() for key in default_keys},
+            'args': '',
+            'dependencies': [],
+            'location': None,
+        }
+
+    for row in metadata_rows:
+        key = str(row.metadata_key)
+        if key == 'name':
+            names[row.bundle_uuid] = row.metadata_value
+        if key not in constructors[row.bundle_uuid]:
+            continue  # As in Metadata.collapse_dicts
+        metadata = infos[row.bundle_uuid]['metadata']
+        constructor, is_list = constructors[row.bundle_uuid][key]
+        if is_list:
+            metadata[key].append(row.metadata_value)
+        else:
+            if metadata.get(key):
+                raise UsageError(
+                    'Got duplicate values {} and {} for key {} of bundle {}'.format(
+                        metadata[key], row.metadata_value, key, row.bundle_uuid
+                    )
+                )
+            metadata[key] = constructor(row.metadata_value)
+
+    for row in dependency_rows:
+        infos[row.child_uuid]['dependencies'].append(
+            {
+                'parent_name': names.get(row.parent_uuid),
+                'parent_path': row.parent_path,
+                'parent_uuid': row.parent_uuid,
+                'child_path': row.child_path,
+                'child_uuid': row.child_uuid,
+                'location': None,
+            }
+        )
+
+    for info in infos.values():
+        # For some reason computing the args requires the rest of the dict
+        info['args'] = worksheet_util.interpret_genpath(info, 'args')
+    return infos
+
+
 def mimic_bundles(
     client,
     old_inputs,
@@ -68,53 +149,22 @@ def mimic_bundles(
     if metadata_override is None:
         metadata_override = {}
 
-    # Build the graph (get all the infos).
+    # Build the graph (get all the infos) in a single request.
     # If old_output is given, look at ancestors of old_output until we
     # reached some depth.  If it's not given, we first get all the
     # descendants first, and then get their ancestors.
+    # The infos of the ancestors are fetched down to depth - 1 levels: the
+    # parents at the last level are only reached as the inputs of those bundles.
+    ancestor_depth = max(depth - 1, 0)
     if old_output:
-        infos = client.fetch('bundles', params={'specs': old_output})
-        assert isinstance(infos, list)
+        params = {'specs': old_output, 'depth': ancestor_depth}
     else:
         # Fetch bundles specified in `old_inputs` and their descendants
-        # down by `depth` levesl
-        infos = client.fetch('bundles', params={'specs': old_inputs, 'depth': depth})
-    infos = {b['uuid']: b for b in infos}  # uuid -> bundle info
-
-    def get_self_and_ancestors(bundle_uuids):
-        # Traverse up ancestors by at most `depth` levels and returns
-        # the set of all bundles visited, as well as updating the `info`
-        # dictionary along the way.
-        result = bundle_uuids
-        visited = set()
-        for _ in range(depth):
-            next_bundle_uuids = []
-            for bundle_uuid in bundle_uuids:
-                if bundle_uuid in visited:
-                    continue
-
-                # Add to infos if not there yet
-                if bundle_uuid not in infos:
-                    infos[bundle_uuid] = client.fetch('bundles', bundle_uuid)
-
-                # Append all of the parents to the next batch of bundles to look at
-                info = infos[bundle_uuid]
-                for dep in info['dependencies']:
-                    parent_uuid = dep['parent_uuid']
-                    if parent_uuid not in infos:
-                        next_bundle_uuids.append(parent_uuid)
-
-                # Mark this bundle as visited
-                visited.add(bundle_uuid)
-
-            # Prepend to the running list of all bundles
-            result = next_bundle_uuids + result
-
-            # Swap in the next batch of bundles for next iteration
-            bundle_uuids = next_bundle_uuids
-        return result
-
-    all_bundle_uuids = get_self_and_ancestors(list(infos.keys()))
+        # down by `depth` levels, along with their ancestors
+        params = {'specs': old_inputs, 'depth': ancestor_depth, 'descendant_depth': depth}
+    infos = client.fetch('bundles', 'ancestors', params=params)
+    # uuid -> bundle info, from the bundles (and descendants) to their most distant ancestors
+    infos = {b['uuid']: b for b in infos}
 
     # Now go recursively create the bundles.
     old_to_new = {}  # old_uuid -> new_uuid
@@ -243,7 +293,7 @@ def mimic_bundles(
     else:
         # Don't have a particular output we're targetting, so just create
         # new versions of all the uuids.
-        for uuid in all_bundle_uuids:
+        for uuid in infos:
             recurse(uuid)
 
     # Add to worksheet
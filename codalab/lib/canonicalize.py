@@ -47,57 +47,61 @@ def _parse_relative_bundle_spec(bundle_spec):
     raise UsageError('Invalid bundle_spec: %s' % bundle_spec)
 
 
-def get_bundle_uuid(model, user, worksheet_uuid, bundle_spec):
+def _split_bundle_spec(bundle_spec):
     """
-    Resolve a string bundle_spec to a bundle uuid.
-    Types of specifications:
-    - uuid: should be unique.
-    - name[^[<index>]: there might be many uuids with this name.
-    - ^[<index>], where index is the i-th (1-based) most recent element on the current worksheet.
-    Specification can also be prefixed with a base worksheet spec and a slash:
-    - <worksheet_spec>/<bundle_spec>
+    Parse bundle spec "[<worksheet_spec>/]<bundle_spec>" into (worksheet_spec, bundle_spec), where
+    worksheet_spec is None if there is no worksheet spec.
     """
     bundle_spec = bundle_spec.strip()
-    user_id = user and user.user_id
     if not bundle_spec:
         raise UsageError('Tried to expand empty bundle_spec!')
 
     if '/' in bundle_spec:  # <worksheet_spec>/<bundle_spec>
-        # Shift to new worksheet
         worksheet_spec, bundle_spec = bundle_spec.split('/', 1)
-        worksheet_uuid = get_worksheet_uuid(model, user, worksheet_uuid, worksheet_spec)
+        return worksheet_spec, bundle_spec
+    return None, bundle_spec
 
-    if spec_util.UUID_REGEX.match(bundle_spec):
-        return bundle_spec
-    elif spec_util.UUID_PREFIX_REGEX.match(bundle_spec):
-        bundle_uuids = model.get_bundle_uuids(
-            {'uuid': LikeQuery(bundle_spec + '%'), 'user_id': user_id}, max_results=2
-        )
+
+def _make_bundle_query(bundle_spec, worksheet_uuid, user_id):
+    """
+    Returns (conditions, max_results, bundle_spec, reverse_index), where conditions and max_results
+    are the arguments of the model.get_bundle_uuids call that resolves the bundle spec (a uuid
+    prefix, name or index), and bundle_spec and reverse_index are those to pass to
+    _select_bundle_uuid with its results. reverse_index is None for uuid prefixes.
+    """
+    if spec_util.UUID_PREFIX_REGEX.match(bundle_spec):
+        conditions = {'uuid': LikeQuery(bundle_spec + '%'), 'user_id': user_id}
+        return conditions, 2, bundle_spec, None
+
+    bundle_spec, reverse_index = _parse_relative_bundle_spec(bundle_spec)
+    if bundle_spec:
+        bundle_spec = bundle_spec.replace(
+            '.*', '%'
+        )  # Convert regular expression syntax to SQL syntax
+        if '%' in bundle_spec:
+            bundle_spec_query = LikeQuery(bundle_spec)
+        else:
+            bundle_spec_query = bundle_spec
+    else:
+        bundle_spec_query = None
+
+    # query results are ordered from newest to old
+    conditions = {'name': bundle_spec_query, 'worksheet_uuid': worksheet_uuid, 'user_id': user_id}
+    return conditions, reverse_index, bundle_spec, reverse_index
+
+
+def _select_bundle_uuid(bundle_spec, reverse_index, bundle_uuids):
+    """
+    Returns the uuid that the bundle spec resolves to among the results of its query, see
+    _make_bundle_query.
+    """
+    if reverse_index is None:
         if len(bundle_uuids) == 0:
             raise NotFoundError('uuid prefix %s doesn\'t match any bundles' % bundle_spec)
         elif len(bundle_uuids) == 1:
             return bundle_uuids[0]
         else:
             raise UsageError('uuid prefix %s more than one bundle' % bundle_spec)
-    else:
-        bundle_spec, reverse_index = _parse_relative_bundle_spec(bundle_spec)
-
-        if bundle_spec:
-            bundle_spec = bundle_spec.replace(
-                '.*', '%'
-            )  # Convert regular expression syntax to SQL syntax
-            if '%' in bundle_spec:
-                bundle_spec_query = LikeQuery(bundle_spec)
-            else:
-                bundle_spec_query = bundle_spec
-        else:
-            bundle_spec_query = None
-
-        # query results are ordered from newest to old
-        bundle_uuids = model.get_bundle_uuids(
-            {'name': bundle_spec_query, 'worksheet_uuid': worksheet_uuid, 'user_id': user_id},
-            max_results=reverse_index,
-        )
 
     # Take the last bundle
     if reverse_index <= 0 or reverse_index > len(bundle_uuids):
@@ -116,11 +120,83 @@ def get_bundle_uuid(model, user, worksheet_uuid, bundle_spec):
     return bundle_uuids[reverse_index - 1]
 
 
+def get_bundle_uuid(model, user, worksheet_uuid, bundle_spec):
+    """
+    Resolve a string bundle_spec to a bundle uuid.
+    Types of specifications:
+    - uuid: should be unique.
+    - name[^[<index>]: there might be many uuids with this name.
+    - ^[<index>], where index is the i-th (1-based) most recent element on the current worksheet.
+    Specification can also be prefixed with a base worksheet spec and a slash:
+    - <worksheet_spec>/<bundle_spec>
+    """
+    user_id = user and user.user_id
+    worksheet_spec, bundle_spec = _split_bundle_spec(bundle_spec)
+    if worksheet_spec is not None:
+        # Shift to new worksheet
+        worksheet_uuid = get_worksheet_uuid(model, user, worksheet_uuid, worksheet_spec)
+
+    if spec_util.UUID_REGEX.match(bundle_spec):
+        return bundle_spec
+    conditions, max_results, bundle_spec, reverse_index = _make_bundle_query(
+        bundle_spec, worksheet_uuid, user_id
+    )
+    bundle_uuids = model.get_bundle_uuids(conditions, max_results)
+    return _select_bundle_uuid(bundle_spec, reverse_index, bundle_uuids)
+
+
 def get_bundle_uuids(model, user, worksheet_uuid, bundle_specs):
     """
-    Convenience function for resolving more than one bundle spec in one call.
+    Resolve a list of bundle specs to the list of their uuids, as get_bundle_uuid does with each.
+    Uuids are resolved without any query, and the uuid prefixes, names and indices of all the
+    specs with a single query, so that the number of queries doesn't grow with the number of specs.
+    Each distinct worksheet spec is resolved once.
+    Raises the error that get_bundle_uuid raises for the first spec that can't be resolved.
     """
-    return [get_bundle_uuid(model, user, worksheet_uuid, spec) for spec in bundle_specs]
+    user_id = user and user.user_id
+    # worksheet_spec -> uuid, or the error raised when resolving it
+    worksheet_uuids = {}
+    # For each spec: its uuid, the error raised when parsing it, or the arguments of its query
+    results = []
+    for bundle_spec in bundle_specs:
+        try:
+            spec_worksheet_uuid = worksheet_uuid
+            worksheet_spec, bundle_spec = _split_bundle_spec(bundle_spec)
+            if worksheet_spec is not None:
+                if worksheet_spec not in worksheet_uuids:
+                    try:
+                        worksheet_uuids[worksheet_spec] = get_worksheet_uuid(
+                            model, user, worksheet_uuid, worksheet_spec
+                        )
+                    except UsageError as e:
+                        worksheet_uuids[worksheet_spec] = e
+                spec_worksheet_uuid = worksheet_uuids[worksheet_spec]
+                if isinstance(spec_worksheet_uuid, UsageError):
+                    raise spec_worksheet_uuid
+
+            if spec_util.UUID_REGEX.match(bundle_spec):
+                results.append(bundle_spec)
+                continue
+            query = _make_bundle_query(bundle_spec, spec_worksheet_uuid, user_id)
+            conditions = query[0]
+            if 'name' in conditions and not conditions['name'] and not conditions['worksheet_uuid']:
+                # Raised by model.get_bundle_uuids
+                raise UsageError('Nothing is specified')
+            results.append(query)
+        except UsageError as e:
+            results.append(e)
+
+    queries = [result for result in results if isinstance(result, tuple)]
+    query_results = iter(model.batch_get_bundle_uuids([query[:2] for query in queries]))
+    bundle_uuids = []
+    for result in results:
+        if isinstance(result, UsageError):
+            raise result
+        if isinstance(result, tuple):
+            _, _, bundle_spec, reverse_index = result
+            result = _select_bundle_uuid(bundle_spec, reverse_index, next(query_results))
+        bundle_uuids.append(result)
+    return bundle_uuids
 
 
 def get_worksheet_uuid(model, user, base_worksheet_uuid, worksheet_spec):
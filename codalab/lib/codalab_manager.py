@@ -41,12 +41,14 @@ from urllib.parse import urlparse
 
 from codalab.client.json_api_client import JsonApiClient
 from codalab.common import CODALAB_VERSION, PermissionError, UsageError
+from codalab.lib.archive_cache import ArchiveCache
 from codalab.lib.bundle_store import MultiDiskBundleStore
 from codalab.lib.crypt_util import get_random_string
 from codalab.lib.download_manager import DownloadManager
 from codalab.lib.emailer import SMTPEmailer, ConsoleEmailer
 from codalab.lib.print_util import pretty_print_json
 from codalab.lib.upload_manager import UploadManager
+from codalab.lib.worker_channel import WorkerChannel
 from codalab.lib import formatting
 from codalab.model.worker_model import WorkerModel
 
@@ -355,9 +357,45 @@ class CodaLabManager(object):
     def upload_manager(self):
         return UploadManager(self.model(), self.bundle_store())
 
+    @cached
+    def worker_channel(self):
+        """
+        Returns the WorkerChannel over which read requests are sent to the workers, or None if the
+        worker_channel server setting isn't true. Each worker channel holds a thread of the server
+        while it is open, so workers are sent their read requests with their checkins by default.
+        At most worker_channel_max_streams channels are open at a time in each server process.
+        """
+        if not self.config['server'].get('worker_channel', False):
+            return None
+        return WorkerChannel(
+            self.worker_socket_dir,
+            self.config['server'].get('worker_channel_max_streams', WorkerChannel.MAX_STREAMS),
+        )
+
     @cached
     def download_manager(self):
-        return DownloadManager(self.model(), self.worker_model(), self.bundle_store())
+        return DownloadManager(
+            self.model(),
+            self.worker_model(),
+            self.bundle_store(),
+            self.archive_cache(),
+            self.worker_channel(),
+        )
+
+    @cached
+    def archive_cache(self):
+        """
+        Returns the ArchiveCache of the archives of bundle directories downloaded from the server,
+        or None if the archive_cache_size server setting is 0. Archives are stored in the
+        directory given by the archive_cache_dir server setting, by default in the CodaLab home.
+        """
+        max_bytes = formatting.parse_size(self.config['server'].get('archive_cache_size', '10g'))
+        if max_bytes <= 0:
+            return None
+        cache_dir = self.config['server'].get(
+            'archive_cache_dir', os.path.join(self.codalab_home, 'archive_cache')
+        )
+        return ArchiveCache(cache_dir, max_bytes)
 
     @cached
     def rest_oauth_handler(self):
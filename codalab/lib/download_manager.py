@@ -1,8 +1,10 @@
 import logging
 import os
 from contextlib import closing
+from io import BytesIO
 
 from codalab.common import http_error_to_exception, precondition, UsageError, NotFoundError
+from codalab.lib.worker_channel import WorkerChannelUnavailable
 from codalab.worker import download_util
 from codalab.worker import file_util
 from codalab.worker.bundle_state import State
@@ -41,10 +43,23 @@ class DownloadManager(object):
     responsible for doing all required permissions checks.
     """
 
-    def __init__(self, bundle_model, worker_model, bundle_store):
+    # Seconds to wait for the reply of a worker to a read request
+    WORKER_REPLY_TIMEOUT = 60
+
+    def __init__(
+        self, bundle_model, worker_model, bundle_store, archive_cache=None, worker_channel=None
+    ):
+        """
+        :param archive_cache: ArchiveCache of the archives of the directories of bundles in a
+            final state, or None to archive them on every download.
+        :param worker_channel: WorkerChannel over which read requests are sent to the workers
+            that have one open, or None to send all of them with the checkins of the workers.
+        """
         self._bundle_model = bundle_model
         self._worker_model = worker_model
         self._bundle_store = bundle_store
+        self._archive_cache = archive_cache
+        self._worker_channel = worker_channel
 
     @retry_if_no_longer_running
     def get_target_info(self, target, depth):
@@ -115,31 +130,28 @@ class DownloadManager(object):
             # information on directory contents, and 2) the logic of hiding
             # the dependency paths doesn't need to be re-implemented here.
             worker = self._bundle_model.get_bundle_worker(target.bundle_uuid)
-            response_socket_id = self._worker_model.allocate_socket(
-                worker['user_id'], worker['worker_id']
-            )
-            try:
-                read_args = {'type': 'get_target_info', 'depth': depth}
-                self._send_read_message(worker, response_socket_id, target, read_args)
-                with closing(self._worker_model.start_listening(response_socket_id)) as sock:
-                    result = self._worker_model.get_json_message(sock, 60)
-                if result is None:  # dead workers are a fact of life now
-                    logging.info('Unable to reach worker, bundle state {}'.format(bundle_state))
-                    raise NotFoundError(
-                        'Unable to reach worker of running bundle with bundle state {}'.format(
-                            bundle_state
-                        )
+            read_args = {'type': 'get_target_info', 'depth': depth}
+            reply = self._read_on_channel(worker, target, read_args)
+            if reply is not None:
+                result, fileobj = reply
+                fileobj.close()
+            else:
+                result = self._get_read_response_message(worker, target, read_args)
+            if result is None:  # dead workers are a fact of life now
+                logging.info('Unable to reach worker, bundle state {}'.format(bundle_state))
+                raise NotFoundError(
+                    'Unable to reach worker of running bundle with bundle state {}'.format(
+                        bundle_state
                     )
-                elif 'error_code' in result:
-                    raise http_error_to_exception(result['error_code'], result['error_message'])
-                target_info = result['target_info']
-                # Deserialize dict response sent over JSON
-                target_info['resolved_target'] = download_util.BundleTarget.from_dict(
-                    target_info['resolved_target']
                 )
-                return target_info
-            finally:
-                self._worker_model.deallocate_socket(response_socket_id)
+            elif 'error_code' in result:
+                raise http_error_to_exception(result['error_code'], result['error_message'])
+            target_info = result['target_info']
+            # Deserialize dict response sent over JSON
+            target_info['resolved_target'] = download_util.BundleTarget.from_dict(
+                target_info['resolved_target']
+            )
+            return target_info
 
     @retry_if_no_longer_running
     def stream_tarred_gzipped_directory(self, target):
@@ -158,7 +170,25 @@ class DownloadManager(object):
             )
         elif bundle_state != State.RUNNING:
             directory_path = self._get_target_path(target)
-            return file_util.tar_gzip_directory(directory_path)
+            data_hash = None
+            if self._archive_cache is not None and bundle_state in State.FINAL_STATES:
+                # The contents of bundles in a final state never change
+                _, data_hash = self._bundle_model.get_bundle_states_and_data_hashes(
+                    [target.bundle_uuid]
+                )[target.bundle_uuid]
+            if data_hash is None:
+                return file_util.tar_gzip_directory(directory_path)
+            key = self._archive_cache.get_key(
+                target.bundle_uuid, target.subpath, data_hash, self._archive_cache.TAR_GZ
+            )
+            fileobj = self._archive_cache.get(key)
+            if fileobj is None:
+                proc = file_util.open_tar_gzip_directory(directory_path)
+                # Only complete archives are cached: tar can fail partway through the directory
+                fileobj = self._archive_cache.tee(
+                    key, proc.stdout, is_complete=lambda: proc.wait() == 0
+                )
+            return fileobj
         else:
             # stream_tarred_gzipped_directory calls are sent to the worker even
             # on a shared filesystem since
@@ -167,11 +197,14 @@ class DownloadManager(object):
             # 2) the logic of hiding
             #   the dependency paths doesn't need to be re-implemented here.
             worker = self._bundle_model.get_bundle_worker(target.bundle_uuid)
+            read_args = {'type': 'stream_directory'}
+            reply = self._read_on_channel(worker, target, read_args)
+            if reply is not None:
+                return reply[1]
             response_socket_id = self._worker_model.allocate_socket(
                 worker['user_id'], worker['worker_id']
             )
             try:
-                read_args = {'type': 'stream_directory'}
                 self._send_read_message(worker, response_socket_id, target, read_args)
                 fileobj = self._get_read_response_stream(response_socket_id)
                 return Deallocating(fileobj, self._worker_model, response_socket_id)
@@ -193,11 +226,17 @@ class DownloadManager(object):
                 return open(file_path, 'rb')
         else:
             worker = self._bundle_model.get_bundle_worker(target.bundle_uuid)
+            read_args = {'type': 'stream_file'}
+            reply = self._read_on_channel(worker, target, read_args)
+            if reply is not None:
+                fileobj = reply[1]
+                if not gzipped:
+                    fileobj = file_util.un_gzip_stream(fileobj)
+                return fileobj
             response_socket_id = self._worker_model.allocate_socket(
                 worker['user_id'], worker['worker_id']
             )
             try:
-                read_args = {'type': 'stream_file'}
                 self._send_read_message(worker, response_socket_id, target, read_args)
                 fileobj = self._get_read_response_stream(response_socket_id)
                 if not gzipped:
@@ -221,21 +260,37 @@ class DownloadManager(object):
             return bytestring
         else:
             worker = self._bundle_model.get_bundle_worker(target.bundle_uuid)
-            response_socket_id = self._worker_model.allocate_socket(
-                worker['user_id'], worker['worker_id']
-            )
-            try:
-                read_args = {'type': 'read_file_section', 'offset': offset, 'length': length}
-                self._send_read_message(worker, response_socket_id, target, read_args)
-                bytestring = self._get_read_response(response_socket_id)
-            finally:
-                self._worker_model.deallocate_socket(response_socket_id)
+            read_args = {'type': 'read_file_section', 'offset': offset, 'length': length}
+            bytestring = self._read_bytes_from_worker(worker, target, read_args)
 
             # Note: all data from the worker is gzipped (see `local_reader.py`).
             if not gzipped:
                 bytestring = file_util.un_gzip_bytestring(bytestring)
             return bytestring
 
+    @retry_if_no_longer_running
+    def stream_file_section(self, target, offset, length, gzipped):
+        """
+        Returns a file-like object reading length bytes of the file at the given path in the
+        bundle. The section is gzipped if gzipped is True. Otherwise, sections of files available
+        locally are returned as FileSections, which the server can send without copying them.
+        """
+        if not gzipped and self._is_available_locally(target):
+            return FileSection(self._get_target_path(target), offset, length)
+        return BytesIO(self.read_file_section(target, offset, length, gzipped))
+
+    @retry_if_no_longer_running
+    def read_file_sections(self, target, sections):
+        """
+        Reads the given (offset, length) sections of the file at the given path in the bundle.
+        Returns a list of bytes.
+        """
+        if self._is_available_locally(target):
+            return file_util.read_file_sections(self._get_target_path(target), sections)
+        return [
+            self.read_file_section(target, offset, length, False) for offset, length in sections
+        ]
+
     @retry_if_no_longer_running
     def summarize_file(
         self, target, num_head_lines, num_tail_lines, max_line_length, truncation_text, gzipped
@@ -258,21 +313,14 @@ class DownloadManager(object):
             return bytestring
         else:
             worker = self._bundle_model.get_bundle_worker(target.bundle_uuid)
-            response_socket_id = self._worker_model.allocate_socket(
-                worker['user_id'], worker['worker_id']
-            )
-            try:
-                read_args = {
-                    'type': 'summarize_file',
-                    'num_head_lines': num_head_lines,
-                    'num_tail_lines': num_tail_lines,
-                    'max_line_length': max_line_length,
-                    'truncation_text': truncation_text,
-                }
-                self._send_read_message(worker, response_socket_id, target, read_args)
-                bytestring = self._get_read_response(response_socket_id)
-            finally:
-                self._worker_model.deallocate_socket(response_socket_id)
+            read_args = {
+                'type': 'summarize_file',
+                'num_head_lines': num_head_lines,
+                'num_tail_lines': num_tail_lines,
+                'max_line_length': max_line_length,
+                'truncation_text': truncation_text,
+            }
+            bytestring = self._read_bytes_from_worker(worker, target, read_args)
 
             # Note: all data from the worker is gzipped (see `local_reader.py`).
             if not gzipped:
@@ -310,6 +358,66 @@ class DownloadManager(object):
         except download_util.PathException as e:
             raise UsageError(str(e))
 
+    def _read_on_channel(self, worker, target, read_args):
+        """
+        Sends the read request over the channel of the worker. Returns the header of the reply and
+        a file-like object reading its data, or None if the worker has no channel open.
+        Raises NotFoundError if the worker doesn't reply, like the reads sent with the checkins.
+        """
+        if self._worker_channel is None:
+            return None
+        request = {
+            'type': 'read',
+            'uuid': target.bundle_uuid,
+            'path': target.subpath,
+            'read_args': read_args,
+        }
+        try:
+            header, fileobj = self._worker_channel.request(
+                worker['user_id'], worker['worker_id'], request, self.WORKER_REPLY_TIMEOUT
+            )
+        except WorkerChannelUnavailable:
+            return None
+        if header is None:  # dead workers are a fact of life now
+            logging.info('Unable to reach worker over its channel')
+            raise NotFoundError('Unable to reach worker of running bundle')
+        if 'error_code' in header:
+            fileobj.close()
+            raise http_error_to_exception(header['error_code'], header['error_message'])
+        return header, fileobj
+
+    def _read_bytes_from_worker(self, worker, target, read_args):
+        """
+        Returns the data of the reply of the worker to the read request.
+        """
+        reply = self._read_on_channel(worker, target, read_args)
+        if reply is not None:
+            with closing(reply[1]) as fileobj:
+                return fileobj.read()
+        response_socket_id = self._worker_model.allocate_socket(
+            worker['user_id'], worker['worker_id']
+        )
+        try:
+            self._send_read_message(worker, response_socket_id, target, read_args)
+            return self._get_read_response(response_socket_id)
+        finally:
+            self._worker_model.deallocate_socket(response_socket_id)
+
+    def _get_read_response_message(self, worker, target, read_args):
+        """
+        Sends the read request with the next checkin of the worker, and returns the single JSON
+        message of the reply, or None if the worker doesn't reply.
+        """
+        response_socket_id = self._worker_model.allocate_socket(
+            worker['user_id'], worker['worker_id']
+        )
+        try:
+            self._send_read_message(worker, response_socket_id, target, read_args)
+            with closing(self._worker_model.start_listening(response_socket_id)) as sock:
+                return self._worker_model.get_json_message(sock, self.WORKER_REPLY_TIMEOUT)
+        finally:
+            self._worker_model.deallocate_socket(response_socket_id)
+
     def _send_read_message(self, worker, response_socket_id, target, read_args):
         message = {
             'type': 'read',
@@ -370,3 +478,30 @@ class Deallocating(object):
     def close(self):
         self._fileobj.close()
         self._worker_model.deallocate_socket(self._socket_id)
+
+
+class FileSection(object):
+    """
+    File-like object reading length bytes of a file from an offset. The file descriptor is
+    positioned at the offset, so that servers can send the section with sendfile given its length.
+    """
+
+    def __init__(self, file_path, offset, length):
+        self._fileobj = open(file_path, 'rb')
+        size = os.fstat(self._fileobj.fileno()).st_size
+        self.length = max(0, min(length, size - offset))
+        self._fileobj.seek(min(offset, size))
+        self._remaining = self.length
+
+    def read(self, num_bytes=-1):
+        if num_bytes is None or num_bytes < 0 or num_bytes > self._remaining:
+            num_bytes = self._remaining
+        data = self._fileobj.read(num_bytes)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._fileobj.fileno()
+
+    def close(self):
+        self._fileobj.close()
@@ -0,0 +1,145 @@
+"""
+genpath_cache
+Caches the parsed contents of the files displayed by genpaths (e.g. /stats:train/acc) on
+worksheets, so that tables showing the same files don't read and parse them again on every
+request.
+
+Only files of bundles in a final state are cached: their contents never change, so entries are
+keyed by the bundle uuid, the subpath of the file and the data hash of the bundle, and never need
+to be invalidated. Parsed contents are stored as JSON, so that they are copied in and out of the
+cache, and contents that don't survive a round trip through JSON (e.g. YAML dates) aren't cached.
+
+Entries are kept in a process-local LRU, and optionally in a directory shared by the processes
+(and hosts, if the directory is on a shared file system) of the server.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class GenpathCache(object):
+    """
+    Bounded cache of parsed genpath files. All methods are thread-safe.
+    """
+
+    # Maximum number of entries kept in memory
+    MAX_ENTRIES = 16384
+    # Maximum total size of the entries kept in memory, as serialized to JSON
+    MAX_BYTES = 64 * 1024 * 1024
+    # Maximum number of entries kept in cache_dir, least recently used ones are deleted first
+    MAX_DISK_ENTRIES = 1000000
+    # Number of entries written to cache_dir between checks of its number of entries
+    PRUNE_INTERVAL = 1000
+
+    def __init__(
+        self,
+        max_entries=MAX_ENTRIES,
+        max_bytes=MAX_BYTES,
+        cache_dir=None,
+        max_disk_entries=MAX_DISK_ENTRIES,
+    ):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._cache_dir = cache_dir
+        self._max_disk_entries = max_disk_entries
+        self._num_disk_writes = 0
+        # key -> contents serialized to JSON
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(bundle_uuid, subpath, data_hash, max_lines):
+        """
+        Returns the key of the contents of the given file of a bundle, parsed from its first
+        max_lines lines.
+        """
+        contents = json.dumps([bundle_uuid, subpath, data_hash, max_lines])
+        return hashlib.sha1(contents.encode()).hexdigest()
+
+    def get(self, key, default=None):
+        """
+        Returns a copy of the contents cached under key, or default.
+        """
+        with self._lock:
+            serialized = self._entries.pop(key, None)
+            if serialized is not None:
+                self._entries[key] = serialized
+        if serialized is None and self._cache_dir is not None:
+            path = self._get_path(key)
+            try:
+                with open(path) as f:
+                    serialized = f.read()
+                # Entries are pruned by last access time
+                os.utime(path)
+            except (IOError, OSError):
+                return default
+            self._put_entry(key, serialized)
+        if serialized is None:
+            return default
+        return json.loads(serialized)
+
+    def put(self, key, contents):
+        try:
+            serialized = json.dumps(contents)
+        except (TypeError, ValueError):
+            return
+        if json.loads(serialized) != contents:
+            return
+        self._put_entry(key, serialized)
+        if self._cache_dir is not None:
+            try:
+                # Write to a temporary file first, so that other processes never read a partial
+                # entry
+                fd, temp_path = tempfile.mkstemp(dir=self._cache_dir)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(serialized)
+                os.replace(temp_path, self._get_path(key))
+            except (IOError, OSError):
+                logger.exception('Cannot write genpath cache entry %s', key)
+            with self._lock:
+                self._num_disk_writes += 1
+                should_prune = self._num_disk_writes % self.PRUNE_INTERVAL == 0
+            if should_prune:
+                self._prune_disk_entries()
+
+    def _put_entry(self, key, serialized):
+        if len(serialized) > self._max_bytes:
+            return
+        with self._lock:
+            old_serialized = self._entries.pop(key, None)
+            if old_serialized is not None:
+                self._size -= len(old_serialized)
+            self._entries[key] = serialized
+            self._size += len(serialized)
+            while len(self._entries) > self._max_entries or self._size > self._max_bytes:
+                _, evicted_serialized = self._entries.popitem(last=False)
+                self._size -= len(evicted_serialized)
+
+    def _prune_disk_entries(self):
+        """
+        Deletes the least recently used entries of cache_dir, down to 90% of max_disk_entries,
+        if it has more than max_disk_entries.
+        """
+        try:
+            entries = [entry for entry in os.scandir(self._cache_dir) if entry.is_file()]
+            if len(entries) <= self._max_disk_entries:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[: len(entries) - int(self._max_disk_entries * 0.9)]:
+                os.remove(entry.path)
+        except (IOError, OSError):
+            # Other processes might be pruning at the same time
+            logger.exception('Cannot prune genpath cache entries')
+
+    def _get_path(self, key):
+        return os.path.join(self._cache_dir, key + '.json')
@@ -0,0 +1,285 @@
+"""
+worker_channel
+Channels over which the server sends the read requests of running bundles (target infos, file
+streams, file sections and summaries) to the workers running them.
+
+Each worker keeps one stream open to the server (GET /workers/<worker_id>/channel), on which the
+server writes the requests for that worker as lines of JSON, each tagged with a request id, as
+soon as they are made. Many requests can be outstanding on a stream at once: the worker serves
+them concurrently and replies to each one separately, with its request id, in any order.
+
+Requests don't need to wait for the next checkin of the worker, and don't allocate worker socket
+rows in the database. Workers that don't open a stream are still sent their read requests with
+their checkins, through the sockets of the WorkerModel. Since each stream holds a thread of the
+server, the number of streams open at a time in each process is bounded: workers that can't open
+one keep being sent their read requests with their checkins.
+
+The server runs several processes, so the process serving the stream of a worker is generally not
+the one handling a request or a reply. The processes meet through Unix domain sockets in the
+worker socket directory:
+- the process serving the stream of a worker listens on a socket named after the worker, which
+  the processes making requests connect to in order to hand it a request;
+- the process making a request listens on a socket named after the worker and the request id,
+  which the process handling the reply of the worker connects to in order to send the reply.
+"""
+
+from contextlib import closing
+import hashlib
+from io import BytesIO
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerChannelUnavailable(Exception):
+    """
+    Raised when a request is made to a worker that has no stream open, or when a stream can't be
+    opened.
+    """
+
+
+class WorkerChannel(object):
+    """
+    Server side of the worker channels, shared by the processes of the server through the socket
+    directory. All methods are thread-safe.
+    """
+
+    # Maximum number of streams open at a time in a process
+    MAX_STREAMS = 16
+    # Seconds a stream stays open. The worker opens a new stream when it ends. Streams are bounded
+    # in time since each one holds a thread of the server.
+    STREAM_TIMEOUT = 60
+    # Seconds between two heartbeats (empty lines) on a stream, which detect closed streams
+    HEARTBEAT_INTERVAL = 10
+    # Seconds to wait for the stream of a worker to be reopened when making a request
+    CONNECT_TIMEOUT = 2
+    # Seconds to wait for a request to be written to the stream of a worker
+    DELIVERY_TIMEOUT = 10
+    # Maximum number of requests waiting to be written to the stream of a worker
+    MAX_PENDING_REQUESTS = 128
+    # Number of bytes sent at a time when forwarding the data of a reply
+    CHUNK_SIZE = 64 * 1024
+
+    ACK = b'a'
+
+    def __init__(self, socket_dir, max_streams=MAX_STREAMS):
+        self._socket_dir = socket_dir
+        self._streams = threading.BoundedSemaphore(max_streams)
+
+    def stream_requests(self, user_id, worker_id, timeout=None):
+        """
+        Returns a generator of the requests made to the worker for timeout seconds (STREAM_TIMEOUT
+        by default), as lines of JSON, and of heartbeats. Feeds the stream of the worker.
+
+        Raises WorkerChannelUnavailable if max_streams streams are already open in this process.
+        """
+        if timeout is None:
+            timeout = self.STREAM_TIMEOUT
+        if not self._streams.acquire(blocking=False):
+            raise WorkerChannelUnavailable('Too many channels open')
+        try:
+            sock = self._listen(
+                self._get_channel_path(user_id, worker_id), self.MAX_PENDING_REQUESTS
+            )
+        except Exception:
+            self._streams.release()
+            raise
+        return self._stream_requests(sock, timeout)
+
+    def _stream_requests(self, sock, timeout):
+        try:
+            # Lets the worker know that the stream is open
+            yield b'\n'
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                sock.settimeout(min(remaining, self.HEARTBEAT_INTERVAL))
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    yield b'\n'
+                    continue
+                with closing(conn):
+                    conn.settimeout(self.DELIVERY_TIMEOUT)
+                    try:
+                        with closing(conn.makefile('rb')) as fileobj:
+                            line = fileobj.readline()
+                    except socket.error:
+                        continue
+                    if not line.endswith(b'\n'):
+                        continue
+                    yield line
+                    try:
+                        conn.sendall(self.ACK)
+                    except socket.error:
+                        pass
+        finally:
+            # The socket file is left in place, so that requests made while the worker reopens
+            # its stream wait for the new stream.
+            sock.close()
+            self._streams.release()
+
+    def request(self, user_id, worker_id, request, timeout):
+        """
+        Sends the request, a dict, to the worker. Returns the header of the reply, a dict, and a
+        file-like object reading the data of the reply, which must be closed. Returns (None, None)
+        if the worker doesn't reply within timeout seconds.
+
+        Raises WorkerChannelUnavailable if the worker has no stream open.
+        """
+        request_id = uuid4().hex
+        reply_path = self._get_reply_path(user_id, worker_id, request_id)
+        reply_sock = self._listen(reply_path, 1)
+        try:
+            line = (json.dumps(dict(request, id=request_id)) + '\n').encode()
+            self._deliver(self._get_channel_path(user_id, worker_id), line)
+            reply_sock.settimeout(timeout)
+            try:
+                conn, _ = reply_sock.accept()
+            except socket.timeout:
+                return None, None
+            conn.settimeout(None)  # Need to remove timeout before makefile.
+            fileobj = conn.makefile('rb')
+            conn.close()
+            try:
+                header = json.loads(fileobj.readline().decode())
+            except ValueError:
+                fileobj.close()
+                return None, None
+            return header, fileobj
+        finally:
+            reply_sock.close()
+            self._remove(reply_path)
+
+    def send_reply(self, user_id, worker_id, request_id, header, fileobj=None):
+        """
+        Sends the reply of the worker to the request with request_id: the header, a dict, and the
+        contents of fileobj, if any. Returns False if the request isn't waiting for a reply.
+        """
+        with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+            try:
+                sock.connect(self._get_reply_path(user_id, worker_id, request_id))
+            except socket.error:
+                return False
+            sock.sendall((json.dumps(header) + '\n').encode())
+            if fileobj is not None:
+                while True:
+                    data = fileobj.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    sock.sendall(data)
+        return True
+
+    def _deliver(self, channel_path, line):
+        """
+        Hands the request line to the process serving the stream of the worker, and waits for it
+        to be written to the stream.
+        """
+        deadline = time.time() + self.CONNECT_TIMEOUT
+        while True:
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+                sock.settimeout(self.DELIVERY_TIMEOUT)
+                try:
+                    sock.connect(channel_path)
+                except FileNotFoundError:
+                    raise WorkerChannelUnavailable('The worker has no channel open')
+                except socket.error:
+                    # The stream ended, the worker might be reopening it
+                    if time.time() >= deadline:
+                        raise WorkerChannelUnavailable('The channel of the worker is closed')
+                    time.sleep(0.01)
+                    continue
+                try:
+                    sock.sendall(line)
+                    if sock.recv(len(self.ACK)) == self.ACK:
+                        return
+                except socket.error:
+                    pass
+                raise WorkerChannelUnavailable('The channel of the worker closed')
+
+    def _listen(self, path, backlog):
+        self._remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(backlog)
+        return sock
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _get_channel_path(self, user_id, worker_id):
+        return self._get_path('channel', user_id, worker_id)
+
+    def _get_reply_path(self, user_id, worker_id, request_id):
+        # Named after the worker, so that a worker can't reply to the requests of another worker
+        return self._get_path('reply', user_id, worker_id, request_id)
+
+    def _get_path(self, prefix, *key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self._socket_dir, '%s-%s' % (prefix, digest))
+
+
+class LocalWorkerChannel(object):
+    """
+    In-process stand-in for WorkerChannel, with the same request and send_reply methods, which
+    hands the requests to the handlers of the connected workers instead of streaming them. Used
+    in tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._replies = {}
+
+    def connect(self, user_id, worker_id, handler):
+        """
+        Opens the channel of the worker: handler(request) is called with each request made to
+        the worker, and must reply with send_reply without blocking the caller.
+        """
+        with self._lock:
+            self._handlers[(user_id, worker_id)] = handler
+
+    def disconnect(self, user_id, worker_id):
+        with self._lock:
+            self._handlers.pop((user_id, worker_id), None)
+
+    def request(self, user_id, worker_id, request, timeout):
+        request_id = uuid4().hex
+        key = (user_id, worker_id, request_id)
+        replies = queue.Queue(1)
+        with self._lock:
+            handler = self._handlers.get((user_id, worker_id))
+            if handler is None:
+                raise WorkerChannelUnavailable('The worker has no channel open')
+            self._replies[key] = replies
+        try:
+            handler(dict(request, id=request_id))
+            try:
+                header, data = replies.get(timeout=timeout)
+            except queue.Empty:
+                return None, None
+            return header, BytesIO(data)
+        finally:
+            with self._lock:
+                del self._replies[key]
+
+    def send_reply(self, user_id, worker_id, request_id, header, fileobj=None):
+        with self._lock:
+            replies = self._replies.get((user_id, worker_id, request_id))
+        if replies is None:
+            return False
+        replies.put((header, fileobj.read() if fileobj is not None else b''))
+        return True
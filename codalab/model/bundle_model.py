@@ -2,18 +2,23 @@
 BundleModel is a wrapper around database calls to save and load bundle metadata.
 """
 
+import base64
 import collections
+from contextlib import contextmanager
 import datetime
+import itertools
 import os
 import re
+import threading
 import time
 import logging
 import json
+import operator
 
 from dateutil import parser
 from uuid import uuid4
 
-from sqlalchemy import and_, or_, not_, select, union, desc, func
+from sqlalchemy import and_, or_, not_, select, union, union_all, desc, func
 from sqlalchemy.sql.expression import literal, true
 
 from codalab.bundles import get_bundle_subclass
@@ -25,6 +30,7 @@ from codalab.model.tables import (
     bundle as cl_bundle,
     bundle_dependency as cl_bundle_dependency,
     bundle_metadata as cl_bundle_metadata,
+    bundle_search as cl_bundle_search,
     group as cl_group,
     group_bundle_permission as cl_group_bundle_permission,
     group_object_permission as cl_group_worksheet_permission,
@@ -43,12 +49,14 @@ from codalab.model.tables import (
     oauth2_client,
     oauth2_token,
     oauth2_auth_code,
+    search_token as cl_search_token,
     worker as cl_worker,
     worker_run as cl_worker_run,
     db_metadata,
 )
-from codalab.objects.worksheet import item_sort_key, Worksheet
+from codalab.objects.worksheet import Worksheet, WORKSHEET_ITEM_SORT_KEY_GAP
 from codalab.objects.oauth2 import OAuth2AuthCode, OAuth2Client, OAuth2Token
+from codalab.objects.permission import PermissionResolver
 from codalab.objects.user import User
 from codalab.objects.dependency import Dependency
 from codalab.rest.util import get_group_info
@@ -59,6 +67,18 @@ logger = logging.getLogger(__name__)
 SEARCH_KEYWORD_REGEX = re.compile('^([\.\w/]*)=(.*)$')
 SEARCH_RESULTS_LIMIT = 10
 
+# Metadata keys that have a typed, indexed copy in the bundle_search table
+SEARCH_FIELDS = [
+    column.name for column in cl_bundle_search.columns if column.name not in ('id', 'bundle_uuid')
+]
+
+# Fields of bundles and worksheets whose words are indexed in the search_token table for keyword
+# searches -> weight of a match on one of their words when ranking results
+BUNDLE_TOKEN_FIELDS = {'name': 4, 'tags': 2, 'description': 1}
+WORKSHEET_TOKEN_FIELDS = {'name': 4, 'title': 2, 'tags': 2}
+SEARCH_TOKEN_REGEX = re.compile('[a-z0-9]+')
+SEARCH_TOKEN_LENGTH = cl_search_token.c.token.type.length
+
 
 def str_key_dict(row):
     """
@@ -70,7 +90,137 @@ def str_key_dict(row):
     return dict((str(k), v) for k, v in row.items())
 
 
+def get_search_values(metadata, keys=SEARCH_FIELDS):
+    """
+    Returns the values of the given search fields of a bundle's Metadata, converted to the types of
+    the bundle_search columns. Values that are missing or cannot be converted are None.
+    """
+    values = {}
+    for key in keys:
+        value = getattr(metadata, key, None)
+        try:
+            values[key] = None if value is None else cl_bundle_search.c[key].type.python_type(value)
+        except (TypeError, ValueError):
+            values[key] = None
+    return values
+
+
+def parse_search_value(key, value):
+    """
+    Converts the value of a search keyword on a search field to the type of its bundle_search
+    column. Returns None if the value cannot be searched on the column (e.g. a LIKE pattern on a
+    numeric column), in which case the search should go through bundle_metadata instead.
+    """
+    python_type = cl_bundle_search.c[key].type.python_type
+    if python_type is str or value in ('.sort', '.sort-', '.sum'):
+        return value
+    values = value if isinstance(value, list) else [value]
+    if any('%' in v for v in values):
+        return None
+    try:
+        values = [python_type(v) for v in values]
+    except ValueError:
+        return None
+    return values if isinstance(value, list) else values[0]
+
+
+def get_search_tokens(text):
+    """
+    Returns the set of lowercased words of text (a string or a list of strings, e.g. tags), as
+    they are indexed in the search_token table.
+    """
+    if not text:
+        return set()
+    if isinstance(text, (list, tuple)):
+        text = ' '.join(str(value) for value in text if value)
+    return {token[:SEARCH_TOKEN_LENGTH] for token in SEARCH_TOKEN_REGEX.findall(str(text).lower())}
+
+
+def get_search_token_rows(object_type, uuid, values, weights):
+    """
+    Returns the search_token rows of the given fields (field -> text) of a bundle or worksheet.
+    """
+    return [
+        {
+            'object_type': object_type,
+            'object_uuid': uuid,
+            'field': field,
+            'token': token,
+            'weight': weights[field],
+        }
+        for field, text in values.items()
+        for token in sorted(get_search_tokens(text))
+    ]
+
+
+def make_keyword_condition(object_type, uuid_field, value):
+    """
+    Returns a condition matching the bundles or worksheets (identified by uuid_field) having, for
+    each word of value, an indexed word starting with it, along with an expression ranking them
+    by the weights of the words they matched. Returns (None, None) if value contains no word.
+    """
+    conditions, token_conditions = [], []
+    for token in sorted(get_search_tokens(value)):
+        # Prefix match written as a range so that it uses the index on every database
+        upper_bound = token[:-1] + chr(ord(token[-1]) + 1)
+        token_condition = and_(
+            cl_search_token.c.token >= token, cl_search_token.c.token < upper_bound
+        )
+        token_conditions.append(token_condition)
+        conditions.append(
+            uuid_field.in_(
+                select([cl_search_token.c.object_uuid]).where(
+                    and_(cl_search_token.c.object_type == object_type, token_condition)
+                )
+            )
+        )
+    if not conditions:
+        return None, None
+    rank = (
+        select([func.coalesce(func.sum(cl_search_token.c.weight), 0)])
+        .where(
+            and_(
+                cl_search_token.c.object_uuid == uuid_field,
+                cl_search_token.c.object_type == object_type,
+                or_(*token_conditions),
+            )
+        )
+        .as_scalar()
+    )
+    return and_(*conditions), rank
+
+
+def encode_search_cursor(position):
+    """
+    Returns the opaque cursor given to clients for a position (dict) in search results.
+    """
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_search_cursor(cursor, key):
+    """
+    Returns the position encoded in a cursor returned by encode_search_cursor, or None for the
+    empty cursor (first page). Raises UsageError if the position doesn't have the given key (e.g.
+    the cursor comes from a search with different keywords).
+    """
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeError):
+        raise UsageError('Invalid cursor: %s' % cursor)
+    if not isinstance(position, dict) or key not in position:
+        raise UsageError('Invalid cursor for this search: %s' % cursor)
+    return position
+
+
 class BundleModel(object):
+    # Interval, in seconds, at which wait_for_bundle_state_changes checks the states of bundles
+    BUNDLE_STATE_POLL_INTERVAL = 1.0
+    # Maximum number of subqueries combined with UNION in a query (SQLite rejects compound
+    # SELECTs of more than 500 terms)
+    MAX_UNION_SUBQUERIES = 400
+
     def __init__(self, engine, default_user_info, root_user_id, system_user_id):
         """
         Initialize a BundleModel with the given SQLAlchemy engine.
@@ -80,6 +230,11 @@ class BundleModel(object):
         self.root_user_id = root_user_id
         self.system_user_id = system_user_id
         self.public_group_uuid = ''
+        # PermissionResolver of the current thread, see cache_permissions
+        self._permission_resolvers = threading.local()
+        # Notified when bundles change state in this process, see wait_for_bundle_state_changes
+        self._bundle_state_changed = threading.Condition()
+        self._bundle_state_version = 0
         self.create_tables()
 
     # ==========================================================================
@@ -222,6 +377,21 @@ class BundleModel(object):
     def get_worksheet_owner_ids(self, uuids):
         return self.get_owner_ids(cl_worksheet, uuids)
 
+    def get_worksheet_names_and_owner_ids(self, uuids):
+        """
+        Fetch the names and owners of the worksheets with the given uuids.
+        Return {uuid: (name, owner_id), ...}
+        """
+        if len(uuids) == 0:
+            return {}
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                select([cl_worksheet.c.uuid, cl_worksheet.c.name, cl_worksheet.c.owner_id]).where(
+                    cl_worksheet.c.uuid.in_(uuids)
+                )
+            ).fetchall()
+            return dict((row.uuid, (row.name, row.owner_id)) for row in rows)
+
     def get_bundle_worker(self, uuid):
         """
         Returns information about the worker that the given bundle is running
@@ -248,6 +418,19 @@ class BundleModel(object):
                 'socket_id': worker_row.socket_id,
             }
 
+    def get_bundle_workers(self, uuids):
+        """
+        Returns {uuid: (user_id, worker_id)} identifying the workers that the bundles with the
+        given uuids are running on. Bundles that are not running are omitted.
+        """
+        with self.engine.begin() as conn:
+            rows = conn.execute(
+                select(
+                    [cl_worker_run.c.run_uuid, cl_worker_run.c.user_id, cl_worker_run.c.worker_id]
+                ).where(cl_worker_run.c.run_uuid.in_(uuids))
+            ).fetchall()
+        return {row.run_uuid: (row.user_id, row.worker_id) for row in rows}
+
     def get_children_uuids(self, uuids):
         """
         Get all bundles that depend on the bundle with the given uuids.
@@ -264,6 +447,24 @@ class BundleModel(object):
             result[row.parent_uuid].append(row.child_uuid)
         return result
 
+    def get_children_names_and_owner_ids(self, uuids):
+        """
+        Get all bundles that depend on the bundles with the given uuids, along with their names
+        and owners.
+        Return {parent_uuid: [(child_uuid, child_name, child_owner_id), ...], ...}
+        """
+        parent2children = self.get_children_uuids(uuids)
+        child_uuids = list(set(uuid for l in parent2children.values() for uuid in l))
+        owner_ids = self.get_bundle_owner_ids(child_uuids)
+        names = self.get_bundle_names(child_uuids)
+        return {
+            parent_uuid: [
+                (child_uuid, names.get(child_uuid), owner_ids.get(child_uuid))
+                for child_uuid in children
+            ]
+            for parent_uuid, children in parent2children.items()
+        }
+
     def get_host_worksheet_uuids(self, bundle_uuids, max_worksheets):
         """
         Get up to n host_worksheet uuids per bundle uuid. n of 0 will return an empty dictionary.
@@ -313,28 +514,130 @@ class BundleModel(object):
             result[uuid] = list(set(result[uuid]))
         return result
 
+    def get_staged_run_docker_images(self, owner_id=None):
+        """
+        Get the requested Docker image and number of GPUs of the STAGED run bundles, optionally
+        restricted to the bundles owned by owner_id.
+        Return [{'request_docker_image': ..., 'request_gpus': ...}, ...], with None for metadata
+        that isn't set.
+        """
+        clause = and_(
+            cl_bundle.c.state == State.STAGED,
+            cl_bundle.c.bundle_type == RunBundle.BUNDLE_TYPE,
+            cl_bundle_metadata.c.metadata_key.in_(['request_docker_image', 'request_gpus']),
+        )
+        if owner_id is not None:
+            clause = and_(clause, cl_bundle.c.owner_id == owner_id)
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                select(
+                    [
+                        cl_bundle.c.uuid,
+                        cl_bundle_metadata.c.metadata_key,
+                        cl_bundle_metadata.c.metadata_value,
+                    ]
+                )
+                .select_from(
+                    cl_bundle.join(
+                        cl_bundle_metadata, cl_bundle.c.uuid == cl_bundle_metadata.c.bundle_uuid
+                    )
+                )
+                .where(clause)
+            ).fetchall()
+        result = collections.defaultdict(
+            lambda: {'request_docker_image': None, 'request_gpus': None}
+        )
+        for row in rows:
+            result[row.uuid][row.metadata_key] = row.metadata_value
+        return list(result.values())
+
     def get_self_and_descendants(self, uuids, depth):
         """
         Get all bundles that depend on bundles with the given uuids.
         depth = 1 gets only children
+        Return [uuid, ...], the given uuids first, then the descendants from the closest ones.
+        """
+        return self._get_self_and_lineage(
+            uuids, depth, cl_bundle_dependency.c.parent_uuid, cl_bundle_dependency.c.child_uuid
+        )
+
+    def get_self_and_ancestors(self, uuids, depth):
+        """
+        Get all bundles that bundles with the given uuids depend on. Ancestors might not exist
+        since bundles can depend on bundles not (yet) in the system.
+        depth = 1 gets only parents
+        Return [uuid, ...], the given uuids first, then the ancestors from the closest ones.
+        """
+        return self._get_self_and_lineage(
+            uuids, depth, cl_bundle_dependency.c.child_uuid, cl_bundle_dependency.c.parent_uuid
+        )
+
+    def _get_self_and_lineage(self, uuids, depth, from_column, to_column):
+        """
+        Helper: Get the given uuids followed by the uuids reachable from them by following at most
+        depth dependencies of bundle_dependency from from_column to to_column, from the closest
+        ones. Uses a single recursive query if the database supports it, and one query per level
+        otherwise.
         """
-        frontier = uuids
-        visited = list(frontier)
-        while len(frontier) > 0 and depth > 0:
-            # Get children of all nodes in frontier
-            result = self.get_children_uuids(frontier)
-            new_frontier = []
-            for l in result.values():
-                for uuid in l:
-                    if uuid in visited:
-                        continue
-                    new_frontier.append(uuid)
-                    visited.append(uuid)
-            frontier = new_frontier
-            depth -= 1
-        return visited
-
-    def search_bundles(self, user_id, keywords):
+        result = list(collections.OrderedDict.fromkeys(uuids))
+        if len(result) == 0 or depth <= 0:
+            return result
+        visited = set(result)
+        with self.engine.begin() as connection:
+            if self._supports_recursive_queries(connection):
+                lineage = (
+                    select([to_column.label('uuid'), literal(1).label('depth')])
+                    .where(from_column.in_(result))
+                    .cte('lineage', recursive=True)
+                )
+                # UNION (rather than UNION ALL) keeps each (uuid, depth) once, so that the number
+                # of rows doesn't grow with the number of paths between bundles.
+                lineage = lineage.union(
+                    select([to_column, lineage.c.depth + 1]).where(
+                        and_(from_column == lineage.c.uuid, lineage.c.depth < depth)
+                    )
+                )
+                min_depth = func.min(lineage.c.depth).label('min_depth')
+                rows = connection.execute(
+                    select([lineage.c.uuid, min_depth]).group_by(lineage.c.uuid).order_by(min_depth)
+                ).fetchall()
+                result.extend(row.uuid for row in rows if row.uuid not in visited)
+                return result
+
+            frontier = result
+            while len(frontier) > 0 and depth > 0:
+                rows = connection.execute(
+                    select([to_column.label('uuid')]).where(from_column.in_(frontier))
+                ).fetchall()
+                frontier = []
+                for row in rows:
+                    if row.uuid not in visited:
+                        visited.add(row.uuid)
+                        frontier.append(row.uuid)
+                result.extend(frontier)
+                depth -= 1
+        return result
+
+    @staticmethod
+    def _supports_recursive_queries(connection):
+        """
+        Return whether the database supports recursive common table expressions (SQLite 3.8.3+,
+        MySQL 8+ and MariaDB 10.2.2+).
+        """
+        version = tuple(connection.dialect.server_version_info or ())
+        if connection.dialect.name == 'sqlite':
+            return version >= (3, 8, 3)
+        if connection.dialect.name == 'mysql':
+            if 'MariaDB' in version:
+                # Strip the 5.5.5- prefix that MariaDB might report for compatibility
+                numbers = tuple(n for n in version if isinstance(n, int))
+                if numbers[:3] == (5, 5, 5) and len(numbers) > 3:
+                    numbers = numbers[3:]
+                return numbers >= (10, 2, 2)
+            return version >= (8,)
+        return False
+
+    def search_bundles(self, user_id, keywords, cursor=None):
         """
         Returns a bundle search result dict where:
             result: list of bundle uuids matching search criteria in order
@@ -358,8 +661,16 @@ class BundleModel(object):
         - .sort: sort in increasing order
         - .sort-: sort by decreasing order
         - .sum: add up the numbers
-        Bare keywords: sugar for uuid_name=.*<word>.*
+        Bare keywords: sugar for uuid_name=<word>, which matches bundles whose uuid starts with
+        <word> or that have words starting with each word of <word> in their name, description
+        or tags (ranked by relevance unless sorted otherwise). Keywords containing patterns (.*)
+        match substrings of the uuid and name instead.
         Search only bundles which are readable by user_id.
+        cursor: if not None, paginate the results: pass '' to get the first page (of .limit
+        bundles), then the next_cursor of the result to get the next page. When possible (no sort,
+        or a sort on a bundle_search field or the id), pages are fetched by keyset, so that
+        fetching a page doesn't get slower the further it is in the results. next_cursor is None on
+        the last page.
         """
         clauses = []
         offset = 0
@@ -367,8 +678,10 @@ class BundleModel(object):
         format_func = None
         count = False
         sort_key = [None]
+        sort_field = [None]  # (field, descending) of the sort, used for keyset pagination
         sum_key = [None]
         aux_fields = []  # Fields (e.g., sorting) that we need to include in the query
+        ranks = []  # Relevance of the bundles to each keyword matched with search_token
 
         # Number nested subqueries
         subquery_index = [0]
@@ -377,19 +690,25 @@ class BundleModel(object):
             subquery_index[0] += 1
             return clause.alias('q' + str(subquery_index[0]))
 
-        def is_numeric(key):
-            return key != 'name'
+        def is_numeric(key, field):
+            # Only the untyped values of bundle_metadata need to be cast to be sorted as numbers
+            return field is cl_bundle_metadata.c.metadata_value and key != 'name'
+
+        # Join constraint with the bundle_search table
+        search_join = cl_bundle.c.uuid == cl_bundle_search.c.bundle_uuid
 
         def make_condition(key, field, value):
             # Special
             if value == '.sort':
                 aux_fields.append(field)
-                if is_numeric(key):
+                sort_field[0] = (field, False)
+                if is_numeric(key, field):
                     field = field * 1
                 sort_key[0] = field
             elif value == '.sort-':
                 aux_fields.append(field)
-                if is_numeric(key):
+                sort_field[0] = (field, True)
+                if is_numeric(key, field):
                     field = field * 1
                 sort_key[0] = desc(field)
             elif value == '.sum':
@@ -398,7 +717,7 @@ class BundleModel(object):
                 # Ordinary value
                 if isinstance(value, list):
                     return field.in_(value)
-                if '%' in value:
+                if isinstance(value, str) and '%' in value:
                     return field.like(value)
                 return field == value
             return None
@@ -526,41 +845,32 @@ class BundleModel(object):
                         alias(select([cl_worksheet_item.c.bundle_uuid]).where(condition))
                     )
             elif key in ('.before', '.after'):
-                target_datetime = parser.isoparse(value)
-
-                subclause = None
+                target_timestamp = int(parser.isoparse(value).timestamp())
                 if key == '.before':
-                    subclause = cl_bundle_metadata.c.metadata_value <= int(
-                        target_datetime.timestamp()
-                    )
-                if key == '.after':
-                    subclause = cl_bundle_metadata.c.metadata_value >= int(
-                        target_datetime.timestamp()
-                    )
-
-                clause = cl_bundle.c.uuid.in_(
-                    alias(
-                        select([cl_bundle_metadata.c.bundle_uuid]).where(
-                            and_(cl_bundle_metadata.c.metadata_key == 'created', subclause)
-                        )
-                    )
-                )
+                    subclause = cl_bundle_search.c.created <= target_timestamp
+                else:
+                    subclause = cl_bundle_search.c.created >= target_timestamp
+                clause = and_(search_join, subclause)
             elif key == 'uuid_name':  # Search uuid and name by default
-                clause = []
-                clause.append(cl_bundle.c.uuid.like('%' + value + '%'))
-                clause.append(
-                    cl_bundle.c.uuid.in_(
-                        alias(
-                            select([cl_bundle_metadata.c.bundle_uuid]).where(
-                                and_(
-                                    cl_bundle_metadata.c.metadata_key == 'name',
-                                    cl_bundle_metadata.c.metadata_value.like('%' + value + '%'),
+                condition, rank = (None, None)
+                if '%' not in value:
+                    condition, rank = make_keyword_condition('bundle', cl_bundle.c.uuid, value)
+                if condition is not None:
+                    # Match uuid prefixes and words of the name, description and tags
+                    clause = or_(cl_bundle.c.uuid.like(value + '%'), condition)
+                    ranks.append(rank)
+                else:
+                    # Patterns can't be matched with the search_token index
+                    clause = or_(
+                        cl_bundle.c.uuid.like('%' + value + '%'),
+                        cl_bundle.c.uuid.in_(
+                            alias(
+                                select([cl_bundle_search.c.bundle_uuid]).where(
+                                    cl_bundle_search.c.name.like('%' + value + '%')
                                 )
                             )
-                        )
+                        ),
                     )
-                )
-                clause = or_(*clause)
             elif key == '':  # Match any field
                 clause = []
                 clause.append(cl_bundle.c.uuid.like('%' + value + '%'))
@@ -575,6 +885,14 @@ class BundleModel(object):
                     )
                 )
                 clause = or_(*clause)
+            # Metadata with a typed copy in bundle_search
+            elif key in SEARCH_FIELDS and parse_search_value(key, value) is not None:
+                field = cl_bundle_search.c[key]
+                condition = make_condition(key, field, parse_search_value(key, value))
+                if condition is None:  # top-level: only bundles that have this metadata
+                    clause = and_(search_join, field.isnot(None))
+                else:
+                    clause = and_(search_join, condition)
             # Otherwise, assume metadata.
             else:
                 condition = make_condition(key, cl_bundle_metadata.c.metadata_value, value)
@@ -619,6 +937,49 @@ class BundleModel(object):
             )
             clause = and_(clause, or_(access_via_owner, access_via_group))
 
+        # Rank bundles matching keywords by relevance unless sorted otherwise
+        if ranks and sort_key[0] is None and sum_key[0] is None and not count:
+            rank = sum(ranks[1:], ranks[0]).label('search_rank')
+            aux_fields.append(rank)
+            sort_key[0] = desc(rank)
+
+        # Pagination
+        paginate = cursor is not None and sum_key[0] is None and not count
+        keyset = None  # (field, descending) to fetch pages by
+        if paginate:
+            limit = SEARCH_RESULTS_LIMIT if limit is None else limit
+            if sort_key[0] is None:
+                keyset = (cl_bundle.c.id, False)
+            elif sort_field[0] is not None and (
+                sort_field[0][0] is cl_bundle.c.id or sort_field[0][0].table is cl_bundle_search
+            ):
+                keyset = sort_field[0]
+            if keyset is not None:
+                field, descending = keyset
+                aux_fields.append(cl_bundle.c.id)
+                position = decode_search_cursor(cursor, 'id')
+                if position is not None:
+                    # Continue right after the last bundle of the previous page, in the order of
+                    # the sort field and then of the id.
+                    after = operator.lt if descending else operator.gt
+                    condition = after(cl_bundle.c.id, position['id'])
+                    if field is not cl_bundle.c.id:
+                        condition = or_(
+                            after(field, position['value']),
+                            and_(field == position['value'], condition),
+                        )
+                    clause = and_(clause, condition)
+                    offset = 0
+                order_by = [field] if field is cl_bundle.c.id else [field, cl_bundle.c.id]
+                sort_key[0] = [desc(field) if descending else field for field in order_by]
+            else:
+                position = decode_search_cursor(cursor, 'offset')
+                if position is not None:
+                    offset = position['offset']
+                # Break ties by id so that pages don't overlap
+                aux_fields.append(cl_bundle.c.id)
+                sort_key[0] = [sort_key[0], cl_bundle.c.id]
+
         # Aggregate (sum)
         if sum_key[0] is not None:
             # Construct a table with only the uuid and the num (and make sure it's distinct!)
@@ -633,17 +994,37 @@ class BundleModel(object):
                 .distinct()
                 .where(clause)
                 .offset(offset)
-                .limit(limit)
+                # Fetch an extra bundle to know whether there is a next page
+                .limit(limit + 1 if paginate else limit)
             )
 
         # Sort
-        if sort_key[0] is not None:
+        if isinstance(sort_key[0], list):
+            query = query.order_by(*sort_key[0])
+        elif sort_key[0] is not None:
             query = query.order_by(sort_key[0])
 
         # Count
         if count:
             query = alias(query).count()
 
+        if paginate:
+            with self.engine.begin() as connection:
+                rows = connection.execute(query).fetchall()
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                if keyset is not None:
+                    last_row = rows[-1]
+                    next_position = {'id': last_row[cl_bundle.c.id]}
+                    if keyset[0] is not cl_bundle.c.id:
+                        next_position['value'] = last_row[keyset[0]]
+                else:
+                    next_position = {'offset': offset + limit}
+                next_cursor = encode_search_cursor(next_position)
+            result = [row[0] for row in rows]
+            return {'result': result, 'is_aggregate': False, 'next_cursor': next_cursor}
+
         result = self._execute_query(query)
         if count or sum_key[0] is not None:  # Just returning a single number
             result = worksheet_util.apply_func(format_func, result[0])
@@ -655,17 +1036,55 @@ class BundleModel(object):
         Returns a list of bundle_uuids that have match the conditions.
         Possible conditions on bundles: uuid, name, worksheet_uuid
         """
+        return self._execute_query(self._make_bundle_uuids_query(conditions, max_results))
+
+    def batch_get_bundle_uuids(self, queries):
+        """
+        Same as calling get_bundle_uuids with each (conditions, max_results) of queries, but in a
+        single query per MAX_UNION_SUBQUERIES queries. Returns the list of the results of each.
+        """
+        if not queries:
+            return []
+        subqueries = []
+        for i, (conditions, max_results) in enumerate(queries):
+            query = self._make_bundle_uuids_query(conditions, max_results).alias()
+            uuid_column, id_column = list(query.c)
+            subqueries.append(
+                select(
+                    [
+                        literal(i).label('query_index'),
+                        uuid_column.label('uuid'),
+                        id_column.label('sort_id'),
+                    ]
+                ).select_from(query)
+            )
+        results = [[] for _ in queries]
+        with self.engine.begin() as connection:
+            for start in range(0, len(subqueries), self.MAX_UNION_SUBQUERIES):
+                query = union_all(*subqueries[start : start + self.MAX_UNION_SUBQUERIES]).alias()
+                rows = connection.execute(
+                    select([query.c.query_index, query.c.uuid]).order_by(
+                        query.c.query_index, query.c.sort_id.desc()
+                    )
+                ).fetchall()
+                for row in rows:
+                    results[row.query_index].append(row.uuid)
+        return results
+
+    def _make_bundle_uuids_query(self, conditions, max_results):
+        """
+        Returns the query of get_bundle_uuids, which selects the uuids of the matching bundles and
+        the id they are ordered by in descending order.
+        """
         if 'uuid' in conditions:
             # Match the uuid only
             clause = self.make_clause(cl_bundle.c.uuid, conditions['uuid'])
-            query = select([cl_bundle.c.uuid]).where(clause)
+            query = select([cl_bundle.c.uuid, cl_bundle.c.id]).where(clause)
+            query = query.order_by(cl_bundle.c.id.desc()).limit(max_results)
         elif 'name' in conditions:
             # Select name
             if conditions['name']:
-                clause = and_(
-                    cl_bundle_metadata.c.metadata_key == 'name',
-                    self.make_clause(cl_bundle_metadata.c.metadata_value, conditions['name']),
-                )
+                clause = self.make_clause(cl_bundle_search.c.name, conditions['name'])
             else:
                 clause = true()
 
@@ -680,8 +1099,8 @@ class BundleModel(object):
                 )
                 clause = and_(clause, cl_worksheet_item.c.bundle_uuid.isnot(None))
                 join = cl_worksheet_item.outerjoin(
-                    cl_bundle_metadata,
-                    cl_worksheet_item.c.bundle_uuid == cl_bundle_metadata.c.bundle_uuid,
+                    cl_bundle_search,
+                    cl_worksheet_item.c.bundle_uuid == cl_bundle_search.c.bundle_uuid,
                 )
                 query = (
                     select([cl_worksheet_item.c.bundle_uuid, cl_worksheet_item.c.id])
@@ -694,11 +1113,11 @@ class BundleModel(object):
                 if not conditions['name']:
                     raise UsageError('Nothing is specified')
                 # Select from all bundles
-                clause = and_(clause, cl_bundle.c.uuid == cl_bundle_metadata.c.bundle_uuid)  # Join
-                query = select([cl_bundle.c.uuid]).where(clause)
+                clause = and_(clause, cl_bundle.c.uuid == cl_bundle_search.c.bundle_uuid)  # Join
+                query = select([cl_bundle.c.uuid, cl_bundle.c.id]).where(clause)
                 query = query.order_by(cl_bundle.c.id.desc()).limit(max_results)
 
-        return self._execute_query(query)
+        return query
 
     def get_memoized_bundles(self, user_id, command, dependencies):
         """
@@ -818,6 +1237,38 @@ class BundleModel(object):
         ]
         return bundles
 
+    def batch_get_bundle_info_rows(self, uuids):
+        """
+        Fetch the rows needed to build the infos of the bundles with the given uuids, without
+        constructing Bundle objects (see bundle_util.bundle_rows_to_bundle_infos).
+        Return (bundle_rows, dependency_rows, metadata_rows, parent_names), where parent_names
+        maps the uuids of the parents of the bundles that are not among uuids to their names.
+        """
+        if len(uuids) == 0:
+            return [], [], [], {}
+        with self.engine.begin() as connection:
+            bundle_rows = connection.execute(
+                cl_bundle.select().where(cl_bundle.c.uuid.in_(uuids)).order_by(cl_bundle.c.id)
+            ).fetchall()
+            dependency_rows = connection.execute(
+                cl_bundle_dependency.select()
+                .where(cl_bundle_dependency.c.child_uuid.in_(uuids))
+                .order_by(cl_bundle_dependency.c.id)
+            ).fetchall()
+            metadata_rows = connection.execute(
+                select(
+                    [
+                        cl_bundle_metadata.c.bundle_uuid,
+                        cl_bundle_metadata.c.metadata_key,
+                        cl_bundle_metadata.c.metadata_value,
+                    ]
+                ).where(cl_bundle_metadata.c.bundle_uuid.in_(uuids))
+            ).fetchall()
+        uuids = set(uuids)
+        parent_uuids = set(row.parent_uuid for row in dependency_rows) - uuids
+        parent_names = self.get_bundle_names(list(parent_uuids)) if parent_uuids else {}
+        return bundle_rows, dependency_rows, metadata_rows, parent_names
+
     # ==========================================================================
     # Server-side bundle state machine methods
     # ==========================================================================
@@ -1094,8 +1545,118 @@ class BundleModel(object):
             result = connection.execute(cl_bundle.insert().values(bundle_value))
             self.do_multirow_insert(connection, cl_bundle_dependency, dependency_values)
             self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+            connection.execute(
+                cl_bundle_search.insert().values(
+                    dict(get_search_values(bundle.metadata), bundle_uuid=bundle.uuid)
+                )
+            )
+            self._update_search_tokens(
+                connection,
+                'bundle',
+                bundle.uuid,
+                {key: getattr(bundle.metadata, key, None) for key in BUNDLE_TOKEN_FIELDS},
+            )
             bundle.id = result.lastrowid
 
+    def save_bundles(self, bundles, worksheet_uuid=None, after_sort_key=None, group_permissions=[]):
+        """
+        Save new bundles in a single transaction, with one multi-row insert per table, which is
+        much faster than calling save_bundle on each of them. Unlike save_bundle, doesn't set the
+        ids of the Bundle objects. Returns the sort key of the last worksheet item added, or None.
+
+        :param worksheet_uuid: uuid of a worksheet to add the bundles to, as consecutive items
+            after the item with after_sort_key (after all the items by default), or None
+        :param group_permissions: list of {'group_uuid': ..., 'permission': ...} to grant on each
+            of the bundles
+        """
+        bundle_values = []
+        dependency_values = []
+        metadata_values = []
+        search_values = []
+        search_token_values = []
+        permission_values = []
+        for bundle in bundles:
+            bundle.validate()
+            bundle_value = bundle.to_dict(strict=False)
+            dependency_values.extend(bundle_value.pop('dependencies'))
+            metadata_values.extend(bundle_value.pop('metadata'))
+            bundle_values.append(bundle_value)
+            search_values.append(dict(get_search_values(bundle.metadata), bundle_uuid=bundle.uuid))
+            search_token_values.extend(
+                get_search_token_rows(
+                    'bundle',
+                    bundle.uuid,
+                    {key: getattr(bundle.metadata, key, None) for key in BUNDLE_TOKEN_FIELDS},
+                    BUNDLE_TOKEN_FIELDS,
+                )
+            )
+            permission_values.extend(
+                {
+                    'group_uuid': p['group_uuid'],
+                    'object_uuid': bundle.uuid,
+                    'permission': p['permission'],
+                }
+                for p in group_permissions
+                if p['permission'] > GROUP_OBJECT_PERMISSION_NONE
+            )
+
+        with self.engine.begin() as connection:
+            # Rows of a multi-row insert must have the same columns, and the ids of the bundles
+            # follow the order of the bundles.
+            for _, values in itertools.groupby(bundle_values, key=lambda value: sorted(value)):
+                self.do_multirow_insert(connection, cl_bundle, list(values))
+            self.do_multirow_insert(connection, cl_bundle_dependency, dependency_values)
+            self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+            self.do_multirow_insert(connection, cl_bundle_search, search_values)
+            self.do_multirow_insert(connection, cl_search_token, search_token_values)
+            self.do_multirow_insert(connection, cl_group_bundle_permission, permission_values)
+            if worksheet_uuid is None:
+                return None
+            sort_keys = self._insert_worksheet_items(
+                connection,
+                worksheet_uuid,
+                [worksheet_util.bundle_item(bundle.uuid) for bundle in bundles],
+                after_sort_key,
+            )
+            return sort_keys[-1] if sort_keys else after_sort_key
+
+    def _update_search_values(self, connection, bundle, keys):
+        """
+        Brings the given search fields of the bundle_search row of the bundle up to date with its
+        in-memory metadata.
+        """
+        result = connection.execute(
+            cl_bundle_search.update()
+            .where(cl_bundle_search.c.bundle_uuid == bundle.uuid)
+            .values(get_search_values(bundle.metadata, keys))
+        )
+        if result.rowcount == 0:
+            # The bundle doesn't have a row yet (e.g. it predates the bundle_search table).
+            connection.execute(
+                cl_bundle_search.insert().values(
+                    dict(get_search_values(bundle.metadata), bundle_uuid=bundle.uuid)
+                )
+            )
+
+    def _update_search_tokens(self, connection, object_type, uuid, values):
+        """
+        Replaces the words indexed in the search_token table for the given fields (field -> text)
+        of a bundle or worksheet.
+        """
+        weights = BUNDLE_TOKEN_FIELDS if object_type == 'bundle' else WORKSHEET_TOKEN_FIELDS
+        connection.execute(
+            cl_search_token.delete().where(
+                and_(
+                    cl_search_token.c.object_uuid == uuid,
+                    cl_search_token.c.object_type == object_type,
+                    cl_search_token.c.field.in_(list(values)),
+                )
+            )
+        )
+        self.do_multirow_insert(
+            connection, cl_search_token, get_search_token_rows(object_type, uuid, values, weights)
+        )
+
     def update_bundle(self, bundle, update, connection=None, delete=False):
         """
         For each key-value pair in the update dictionary, add or update key-value pair. Note
@@ -1125,6 +1686,14 @@ class BundleModel(object):
         # Delete metadata keys from metadata_update dictionary
         for key in metadata_delete_keys:
             del metadata_update[key]
+        search_update_keys = [
+            key for key in list(metadata_update) + metadata_delete_keys if key in SEARCH_FIELDS
+        ]
+        token_update_keys = [
+            key
+            for key in list(metadata_update) + metadata_delete_keys
+            if key in BUNDLE_TOKEN_FIELDS
+        ]
 
         bundle.validate()
         # Construct clauses and update lists for updating certain bundle columns.
@@ -1156,6 +1725,15 @@ class BundleModel(object):
                     self.do_multirow_insert(connection, cl_bundle_metadata, metadata_update_values)
                 if metadata_delete_keys:
                     connection.execute(cl_bundle_metadata.delete().where(metadata_delete_clause))
+                if search_update_keys:
+                    self._update_search_values(connection, bundle, search_update_keys)
+                if token_update_keys:
+                    self._update_search_tokens(
+                        connection,
+                        'bundle',
+                        bundle.uuid,
+                        {key: getattr(bundle.metadata, key, None) for key in token_update_keys},
+                    )
             except UnicodeError:
                 raise UsageError("Invalid character detected; use ascii characters only.")
 
@@ -1164,6 +1742,10 @@ class BundleModel(object):
         else:
             with self.engine.begin() as connection:
                 do_update(connection)
+        if 'state' in update:
+            with self._bundle_state_changed:
+                self._bundle_state_version += 1
+                self._bundle_state_changed.notify_all()
 
     def get_bundle_dependencies(self, uuid):
         with self.engine.begin() as connection:
@@ -1190,6 +1772,74 @@ class BundleModel(object):
             ).fetchall()
             return dict((r.uuid, r.state) for r in rows)
 
+    def get_bundle_state_infos(self, uuids):
+        """
+        Return {uuid: {'state': ..., 'run_status': ..., 'last_updated': ...}, ...} for the bundles
+        that exist, with a single query on the uuid and state index of bundle and the bundle_search
+        row of each bundle. run_status and last_updated are None for bundles other than runs.
+        """
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                select(
+                    [
+                        cl_bundle.c.uuid,
+                        cl_bundle.c.state,
+                        cl_bundle_search.c.run_status,
+                        cl_bundle_search.c.last_updated,
+                    ]
+                )
+                .select_from(
+                    cl_bundle.outerjoin(
+                        cl_bundle_search, cl_bundle.c.uuid == cl_bundle_search.c.bundle_uuid
+                    )
+                )
+                .where(cl_bundle.c.uuid.in_(uuids))
+            ).fetchall()
+        return {
+            row.uuid: {
+                'state': row.state,
+                'run_status': row.run_status,
+                'last_updated': row.last_updated,
+            }
+            for row in rows
+        }
+
+    def wait_for_bundle_state_changes(self, states, timeout):
+        """
+        Waits until the state of any of the bundles differs from the given {uuid: state, ...}, or
+        for timeout seconds, and returns their current {uuid: state, ...} (without the bundles
+        that don't exist).
+
+        State changes made by this process (e.g. on the checkins of workers received by this
+        server process) wake waiters up right away. Those made by other processes (e.g. the bundle
+        manager) are seen within BUNDLE_STATE_POLL_INTERVAL seconds, by querying the states only.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self._bundle_state_changed:
+                version = self._bundle_state_version
+            current_states = self.get_bundle_states(list(states))
+            remaining = deadline - time.time()
+            if remaining <= 0 or any(
+                current_states.get(uuid) != state for uuid, state in states.items()
+            ):
+                return current_states
+            with self._bundle_state_changed:
+                if self._bundle_state_version == version:
+                    self._bundle_state_changed.wait(min(remaining, self.BUNDLE_STATE_POLL_INTERVAL))
+
+    def get_bundle_states_and_data_hashes(self, uuids):
+        """
+        Return {uuid: (state, data_hash), ...}
+        """
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                select([cl_bundle.c.uuid, cl_bundle.c.state, cl_bundle.c.data_hash]).where(
+                    cl_bundle.c.uuid.in_(uuids)
+                )
+            ).fetchall()
+            return dict((r.uuid, (r.state, r.data_hash)) for r in rows)
+
     def delete_bundles(self, uuids):
         """
         Delete bundles with the given uuids.
@@ -1208,6 +1858,17 @@ class BundleModel(object):
             connection.execute(
                 cl_bundle_metadata.delete().where(cl_bundle_metadata.c.bundle_uuid.in_(uuids))
             )
+            connection.execute(
+                cl_bundle_search.delete().where(cl_bundle_search.c.bundle_uuid.in_(uuids))
+            )
+            connection.execute(
+                cl_search_token.delete().where(
+                    and_(
+                        cl_search_token.c.object_uuid.in_(uuids),
+                        cl_search_token.c.object_type == 'bundle',
+                    )
+                )
+            )
             connection.execute(
                 cl_bundle_dependency.delete().where(cl_bundle_dependency.c.child_uuid.in_(uuids))
             )
@@ -1270,7 +1931,9 @@ class BundleModel(object):
             # Fetch the items of all the worksheets
             if fetch_items:
                 item_rows = connection.execute(
-                    cl_worksheet_item.select().where(cl_worksheet_item.c.worksheet_uuid.in_(uuids))
+                    cl_worksheet_item.select()
+                    .where(cl_worksheet_item.c.worksheet_uuid.in_(uuids))
+                    .order_by(cl_worksheet_item.c.sort_key, cl_worksheet_item.c.id)
                 ).fetchall()
 
         # Make a dictionary for each worksheet with both its main row and its items.
@@ -1285,14 +1948,47 @@ class BundleModel(object):
         if fetch_items:
             for value in worksheet_values.values():
                 value['items'] = []
-            for item_row in sorted(item_rows, key=item_sort_key):
+            for item_row in item_rows:
                 if item_row.worksheet_uuid not in worksheet_values:
                     raise IntegrityError('Got item %s without worksheet' % (item_row,))
-                item_row = dict(item_row)
-                item_row['value'] = self.decode_str(item_row['value'])
-                worksheet_values[item_row['worksheet_uuid']]['items'].append(item_row)
+                worksheet_values[item_row.worksheet_uuid]['items'].append(
+                    self._worksheet_item_row_to_dict(item_row)
+                )
         return [Worksheet(value) for value in worksheet_values.values()]
 
+    def get_worksheet_items(self, worksheet_uuid, offset=0, limit=None):
+        """
+        Get the items of the worksheet with the given uuid in order, skipping the first offset
+        items and returning at most limit items (all of them if limit is None), so that large
+        worksheets can be fetched a range of items at a time.
+        Return [item dict, ...], as in the items of the worksheets of batch_get_worksheets.
+        """
+        query = (
+            cl_worksheet_item.select()
+            .where(cl_worksheet_item.c.worksheet_uuid == worksheet_uuid)
+            .order_by(cl_worksheet_item.c.sort_key, cl_worksheet_item.c.id)
+            .offset(offset)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        with self.engine.begin() as connection:
+            item_rows = connection.execute(query).fetchall()
+        return [self._worksheet_item_row_to_dict(item_row) for item_row in item_rows]
+
+    def get_worksheet_item_count(self, worksheet_uuid):
+        """
+        Get the number of items of the worksheet with the given uuid.
+        """
+        with self.engine.begin() as connection:
+            return connection.execute(
+                select([func.count()]).where(cl_worksheet_item.c.worksheet_uuid == worksheet_uuid)
+            ).scalar()
+
+    def _worksheet_item_row_to_dict(self, item_row):
+        item = dict(item_row)
+        item['value'] = self.decode_str(item['value'])
+        return item
+
     def search_worksheets(self, user_id, keywords):
         """
         Return a list of row dicts, one per worksheet. These dicts do NOT contain
@@ -1303,7 +1999,8 @@ class BundleModel(object):
         clauses = []
         offset = 0
         limit = SEARCH_RESULTS_LIMIT
-        sort_key = [cl_worksheet.c.name]
+        sort_key = [None]
+        ranks = []  # Relevance of the worksheets to each keyword matched with search_token
 
         # Number nested subqueries
         subquery_index = [0]
@@ -1322,7 +2019,7 @@ class BundleModel(object):
                 # Ordinary value
                 if isinstance(value, list):
                     return field.in_(value)
-                if '%' in value:
+                if isinstance(value, str) and '%' in value:
                     return field.like(value)
                 return field == value
             return None
@@ -1420,11 +2117,22 @@ class BundleModel(object):
                         alias(select([cl_worksheet_tag.c.worksheet_uuid]).where(condition))
                     )
             elif key == 'uuid_name_title':  # Search uuid and name by default
-                clause = or_(
-                    cl_worksheet.c.uuid.like('%' + value + '%'),
-                    cl_worksheet.c.name.like('%' + value + '%'),
-                    cl_worksheet.c.title.like('%' + value + '%'),
-                )
+                condition, rank = (None, None)
+                if '%' not in value:
+                    condition, rank = make_keyword_condition(
+                        'worksheet', cl_worksheet.c.uuid, value
+                    )
+                if condition is not None:
+                    # Match uuid prefixes and words of the name, title and tags
+                    clause = or_(cl_worksheet.c.uuid.like(value + '%'), condition)
+                    ranks.append(rank)
+                else:
+                    # Patterns can't be matched with the search_token index
+                    clause = or_(
+                        cl_worksheet.c.uuid.like('%' + value + '%'),
+                        cl_worksheet.c.name.like('%' + value + '%'),
+                        cl_worksheet.c.title.like('%' + value + '%'),
+                    )
             elif key == '':  # Match any field
                 clause = []
                 clause.append(cl_worksheet.c.uuid.like('%' + value + '%'))
@@ -1476,11 +2184,23 @@ class BundleModel(object):
             cl_worksheet.c.frozen,
             cl_worksheet.c.owner_id,
         ]
-        query = select(cols_to_select).distinct().where(clause).offset(offset).limit(limit)
-
         # Sort
-        if sort_key[0] is not None:
-            query = query.order_by(sort_key[0])
+        order_by = [sort_key[0]]
+        if sort_key[0] is None:
+            order_by = [cl_worksheet.c.name]
+            if ranks:
+                # Rank worksheets matching keywords by relevance first
+                rank = sum(ranks[1:], ranks[0]).label('search_rank')
+                cols_to_select.append(rank)
+                order_by.insert(0, desc(rank))
+        query = (
+            select(cols_to_select)
+            .distinct()
+            .where(clause)
+            .order_by(*order_by)
+            .offset(offset)
+            .limit(limit)
+        )
 
         with self.engine.begin() as connection:
             rows = connection.execute(query).fetchall()
@@ -1497,6 +2217,7 @@ class BundleModel(object):
         row_dicts = []
         for row in rows:
             row = str_key_dict(row)
+            row.pop('search_rank', None)
             row['group_permissions'] = uuid_group_permissions[row['uuid']]
             if row['title']:
                 row['title'] = self.decode_str(row['title'])
@@ -1516,6 +2237,13 @@ class BundleModel(object):
         worksheet_value.pop('last_item_id')
         with self.engine.begin() as connection:
             result = connection.execute(cl_worksheet.insert().values(worksheet_value))
+            # Tags are only saved by update_worksheet_metadata
+            self._update_search_tokens(
+                connection,
+                'worksheet',
+                worksheet.uuid,
+                {'name': worksheet.name, 'title': worksheet.title},
+            )
             worksheet.id = result.lastrowid
 
     def add_worksheet_items(self, worksheet_uuid, items, after_sort_key=None, replace=[]):
@@ -1529,60 +2257,71 @@ class BundleModel(object):
                 connection.execute(
                     cl_worksheet_item.delete().where(cl_worksheet_item.c.id.in_(replace))
                 )
-            if len(items) == 0:
-                # Nothing to insert, return
-                return
-            if after_sort_key is not None:
-                after_sort_key = int(after_sort_key)
-                # Shift existing items' sort_keys for items that originally came after
-                # the after_sort_key
-                offset = len(items)
-                clause = and_(
-                    cl_worksheet_item.c.worksheet_uuid == worksheet_uuid,
-                    or_(
-                        cl_worksheet_item.c.sort_key > after_sort_key,
-                        and_(
-                            cl_worksheet_item.c.sort_key == None,
-                            cl_worksheet_item.c.id > after_sort_key,
-                        ),
-                    ),
+            self._insert_worksheet_items(connection, worksheet_uuid, items, after_sort_key)
+
+    def _insert_worksheet_items(self, connection, worksheet_uuid, items, after_sort_key):
+        """
+        Helper: Insert worksheet items *items* to the position *after_sort_key* to the worksheet.
+        Returns the sort keys of the new items.
+        """
+        if len(items) == 0:
+            # Nothing to insert, return
+            return []
+        sort_keys = self._allocate_item_sort_keys(
+            connection, worksheet_uuid, len(items), after_sort_key
+        )
+        # Insert new items
+        items_to_insert = [
+            {
+                'worksheet_uuid': worksheet_uuid,
+                'bundle_uuid': bundle_uuid,
+                'subworksheet_uuid': subworksheet_uuid,
+                'value': self.encode_str(value),
+                'type': type,
+                'sort_key': sort_key,
+            }
+            for sort_key, (bundle_uuid, subworksheet_uuid, value, type) in zip(sort_keys, items)
+        ]
+        self.do_multirow_insert(connection, cl_worksheet_item, items_to_insert)
+        return sort_keys
+
+    @staticmethod
+    def _allocate_item_sort_keys(connection, worksheet_uuid, num_items, after_sort_key=None):
+        """
+        Helper: Return the sort keys of num_items new items of a worksheet, to be placed after the
+        items with sort key after_sort_key, or after all the items if after_sort_key is None.
+        See codalab.objects.worksheet for the sort_key protocol.
+        """
+        worksheet_clause = cl_worksheet_item.c.worksheet_uuid == worksheet_uuid
+        if after_sort_key is None:
+            last_sort_key = connection.execute(
+                select([func.max(cl_worksheet_item.c.sort_key)]).where(worksheet_clause)
+            ).scalar()
+            after_sort_key = last_sort_key or 0
+            next_sort_key = None
+        else:
+            after_sort_key = int(after_sort_key)
+            after_clause = and_(worksheet_clause, cl_worksheet_item.c.sort_key > after_sort_key)
+            next_sort_key = connection.execute(
+                select([func.min(cl_worksheet_item.c.sort_key)]).where(after_clause)
+            ).scalar()
+            if next_sort_key is not None and next_sort_key - after_sort_key <= num_items:
+                # Not enough room in the gap before the next item: shift the sort keys of the
+                # items after the new ones. This only happens once the gaps between the sort keys
+                # have been split repeatedly at the same position.
+                shift = WORKSHEET_ITEM_SORT_KEY_GAP * (num_items + 1)
+                connection.execute(
+                    cl_worksheet_item.update()
+                    .where(after_clause)
+                    .values(sort_key=cl_worksheet_item.c.sort_key + shift)
                 )
-                query = select(['*']).where(clause)
-                # Get result in a list
-                after_items = [item for item in connection.execute(query)]
-                if (
-                    len(after_items) > 0
-                    and min(item_sort_key(item) for item in after_items) - after_sort_key <= offset
-                ):
-                    # Shift the keys of the original items if the gap between after_sort_key
-                    # and the next smallest key is not sufficient for inserting items.
-                    # In actuality, delete these items and re-insert.
-                    connection.execute(cl_worksheet_item.delete().where(clause))
-                    new_after_items = [
-                        {
-                            'worksheet_uuid': item.worksheet_uuid,
-                            'bundle_uuid': item.bundle_uuid,
-                            'subworksheet_uuid': item.subworksheet_uuid,
-                            'value': item.value,
-                            'type': item.type,
-                            'sort_key': item_sort_key(item) + offset,
-                        }
-                        for item in after_items
-                    ]
-                    self.do_multirow_insert(connection, cl_worksheet_item, new_after_items)
-            # Insert new items
-            items_to_insert = [
-                {
-                    'worksheet_uuid': worksheet_uuid,
-                    'bundle_uuid': bundle_uuid,
-                    'subworksheet_uuid': subworksheet_uuid,
-                    'value': self.encode_str(value),
-                    'type': type,
-                    'sort_key': after_sort_key + idx + 1 if after_sort_key is not None else None,
-                }
-                for idx, (bundle_uuid, subworksheet_uuid, value, type) in enumerate(items)
-            ]
-            self.do_multirow_insert(connection, cl_worksheet_item, items_to_insert)
+                next_sort_key += shift
+        if next_sort_key is None:
+            step = WORKSHEET_ITEM_SORT_KEY_GAP
+        else:
+            # Split the gap evenly, so that items can be inserted again on either side
+            step = (next_sort_key - after_sort_key) // (num_items + 1)
+        return [after_sort_key + step * (i + 1) for i in range(num_items)]
 
     def add_shadow_worksheet_items(self, old_bundle_uuid, new_bundle_uuid):
         """
@@ -1642,11 +2381,6 @@ class BundleModel(object):
             cl_worksheet_item.c.worksheet_uuid == worksheet_uuid,
             cl_worksheet_item.c.id <= last_item_id,
         )
-        # See codalab.objects.worksheet for an explanation of the sort_key protocol.
-        # We need to produce sort keys here that are strictly upper-bounded by the
-        # last known item id in this worksheet, and which monotonically increase.
-        # The expression last_item_id + i - len(new_items) works. It can produce
-        # negative sort keys, but that's fine.
         new_item_values = [
             {
                 'worksheet_uuid': worksheet_uuid,
@@ -1654,11 +2388,27 @@ class BundleModel(object):
                 'subworksheet_uuid': subworksheet_uuid,
                 'value': self.encode_str(value),
                 'type': item_type,
-                'sort_key': (last_item_id + i - len(new_items)),
             }
-            for (i, (bundle_uuid, subworksheet_uuid, value, item_type)) in enumerate(new_items)
+            for (bundle_uuid, subworksheet_uuid, value, item_type) in new_items
         ]
         with self.engine.begin() as connection:
+            # See codalab.objects.worksheet for an explanation of the sort_key protocol.
+            # The new items come before the items added since the worksheet was retrieved,
+            # which have ids greater than last_item_id.
+            next_sort_key = connection.execute(
+                select([func.min(cl_worksheet_item.c.sort_key)]).where(
+                    and_(
+                        cl_worksheet_item.c.worksheet_uuid == worksheet_uuid,
+                        cl_worksheet_item.c.id > last_item_id,
+                    )
+                )
+            ).scalar()
+            if next_sort_key is None:
+                next_sort_key = WORKSHEET_ITEM_SORT_KEY_GAP * (len(new_items) + 1)
+            for i, value in enumerate(new_item_values):
+                value['sort_key'] = next_sort_key - WORKSHEET_ITEM_SORT_KEY_GAP * (
+                    len(new_items) - i
+                )
             result = connection.execute(cl_worksheet_item.delete().where(clause))
             message = 'Found extra items for worksheet %s' % (worksheet_uuid,)
             precondition(result.rowcount <= length, message)
@@ -1676,10 +2426,13 @@ class BundleModel(object):
             worksheet.frozen = info['frozen']
         if 'owner_id' in info:
             worksheet.owner_id = info['owner_id']
+        token_values = {key: info[key] for key in WORKSHEET_TOKEN_FIELDS if key in info}
         if 'title' in info:
             info['title'] = self.encode_str(info['title'])
         worksheet.validate()
         with self.engine.begin() as connection:
+            if token_values:
+                self._update_search_tokens(connection, 'worksheet', worksheet.uuid, token_values)
             if 'tags' in info:
                 # Delete old tags
                 connection.execute(
@@ -1721,6 +2474,14 @@ class BundleModel(object):
             connection.execute(
                 cl_worksheet_tag.delete().where(cl_worksheet_tag.c.worksheet_uuid == worksheet_uuid)
             )
+            connection.execute(
+                cl_search_token.delete().where(
+                    and_(
+                        cl_search_token.c.object_uuid == worksheet_uuid,
+                        cl_search_token.c.object_type == 'worksheet',
+                    )
+                )
+            )
             connection.execute(cl_worksheet.delete().where(cl_worksheet.c.uuid == worksheet_uuid))
 
     # ===========================================================================
@@ -1836,6 +2597,7 @@ class BundleModel(object):
         """
         Delete the group with the given uuid.
         """
+        self._forget_permissions()
         with self.engine.begin() as connection:
             connection.execute(
                 cl_group_bundle_permission.delete().where(
@@ -1855,6 +2617,7 @@ class BundleModel(object):
         Add user as a member of a group.
         """
         row = {'group_uuid': group_uuid, 'user_id': user_id, 'is_admin': is_admin}
+        self._forget_permissions()
         with self.engine.begin() as connection:
             result = connection.execute(cl_user_group.insert().values(row))
             row['id'] = result.lastrowid
@@ -1864,6 +2627,7 @@ class BundleModel(object):
         """
         Add user as a member of a group.
         """
+        self._forget_permissions()
         with self.engine.begin() as connection:
             connection.execute(
                 cl_user_group.delete()
@@ -1913,6 +2677,7 @@ class BundleModel(object):
         :param object_uuid: uuid of object (bundle or worksheet) on which to set permission
         :param new_permission: new permission integer
         """
+        self._forget_permissions(object_uuid)
         with self.engine.begin() as connection:
             row = connection.execute(
                 table.select()
@@ -2014,6 +2779,55 @@ class BundleModel(object):
     def get_group_worksheet_permissions(self, user_id, worksheet_uuid):
         return self.get_group_permissions(cl_group_worksheet_permission, user_id, worksheet_uuid)
 
+    def get_max_group_permissions(self, table, group_uuids, object_uuids):
+        """
+        Return map from object_uuid to the highest permission granted to any of the given groups
+        on the object. Objects on which none of the groups has a permission are omitted.
+        """
+        if not group_uuids or not object_uuids:
+            return {}
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                select([table.c.object_uuid, func.max(table.c.permission)])
+                .where(
+                    and_(table.c.group_uuid.in_(group_uuids), table.c.object_uuid.in_(object_uuids))
+                )
+                .group_by(table.c.object_uuid)
+            ).fetchall()
+        return {object_uuid: permission for object_uuid, permission in rows}
+
+    @contextmanager
+    def cache_permissions(self):
+        """
+        Within this context, the groups of users and the permissions granted through them are
+        memoized for the current thread, e.g. for the duration of a request. Changes to group
+        memberships and permissions made through this model within the context are taken into
+        account.
+        """
+        self._permission_resolvers.resolver = PermissionResolver(self)
+        try:
+            yield
+        finally:
+            self._permission_resolvers.resolver = None
+
+    def _get_permission_resolver(self):
+        resolver = getattr(self._permission_resolvers, 'resolver', None)
+        # Outside of cache_permissions, nothing is memoized across calls
+        return resolver or PermissionResolver(self)
+
+    def _forget_permissions(self, object_uuid=None):
+        """
+        Drop the permissions memoized for the current thread on the given object, or all of them
+        (along with groups of users) if object_uuid is None.
+        """
+        resolver = getattr(self._permission_resolvers, 'resolver', None)
+        if resolver is None:
+            return
+        if object_uuid is None:
+            resolver.forget_all()
+        else:
+            resolver.forget_object(object_uuid)
+
     def get_user_permissions(self, table, user_id, object_uuids, owner_ids):
         """
         Gets the set of permissions granted to the given user on the given objects.
@@ -2037,14 +2851,11 @@ class BundleModel(object):
                 remaining_object_uuids.append(object_uuid)
 
         if len(remaining_object_uuids) > 0:
-            result = self.batch_get_group_permissions(table, user_id, remaining_object_uuids)
-            user_groups = self._get_user_groups(user_id)
-            for object_uuid, permissions in result.items():
-                for row in permissions:
-                    if row['group_uuid'] in user_groups:
-                        object_permissions[object_uuid] = max(
-                            object_permissions[object_uuid], row['permission']
-                        )
+            object_permissions.update(
+                self._get_permission_resolver().get_group_permissions(
+                    table, user_id, remaining_object_uuids
+                )
+            )
         return object_permissions
 
     def get_user_bundle_permissions(self, user_id, bundle_uuids, owner_ids):
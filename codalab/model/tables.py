@@ -38,6 +38,8 @@ bundle = Table(
     UniqueConstraint('uuid', name='uix_1'),
     Index('bundle_data_hash_index', 'data_hash'),
     Index('state_index', 'state'),  # Needed for the bundle manager.
+    # Covers the lookups of the states of bundles by uuid.
+    Index('bundle_uuid_state_index', 'uuid', 'state'),
 )
 
 # Includes things like name, description, etc.
@@ -51,6 +53,53 @@ bundle_metadata = Table(
     Index('metadata_kv_index', 'metadata_key', 'metadata_value', mysql_length=63),
 )
 
+# Typed copies of the metadata values that bundles are most often searched and sorted by, with one
+# row per bundle, so that these searches can use indices instead of going through bundle_metadata.
+# Maintained by BundleModel whenever the metadata of a bundle is written.
+bundle_search = Table(
+    'bundle_search',
+    db_metadata,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('bundle_uuid', String(63), ForeignKey(bundle.c.uuid), nullable=False),
+    Column('name', Text, nullable=True),
+    Column('created', BigInteger, nullable=True),
+    Column('data_size', BigInteger, nullable=True),
+    Column('time', Float, nullable=True),
+    Column('request_cpus', Integer, nullable=True),
+    Column('request_gpus', Integer, nullable=True),
+    Column('request_priority', Integer, nullable=True),
+    Column('request_queue', Text, nullable=True),
+    Column('request_docker_image', Text, nullable=True),
+    Column('run_status', Text, nullable=True),
+    Column('last_updated', BigInteger, nullable=True),
+    UniqueConstraint('bundle_uuid', name='uix_1'),
+    Index('bundle_search_name_index', 'name', mysql_length=63),
+    Index('bundle_search_created_index', 'created'),
+    Index('bundle_search_data_size_index', 'data_size'),
+    Index('bundle_search_time_index', 'time'),
+    Index('bundle_search_request_cpus_index', 'request_cpus'),
+    Index('bundle_search_request_gpus_index', 'request_gpus'),
+    Index('bundle_search_request_priority_index', 'request_priority'),
+    Index('bundle_search_request_queue_index', 'request_queue', mysql_length=63),
+    Index('bundle_search_request_docker_image_index', 'request_docker_image', mysql_length=63),
+    Index('bundle_search_last_updated_index', 'last_updated'),
+)
+
+# Inverted index of the words in the names, titles, descriptions and tags of bundles and
+# worksheets, used to answer keyword searches without scanning these fields.
+search_token = Table(
+    'search_token',
+    db_metadata,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('object_type', String(16), nullable=False),  # bundle or worksheet
+    Column('object_uuid', String(63), nullable=False),
+    Column('field', String(63), nullable=False),  # Field of the object the word comes from
+    Column('token', String(63), nullable=False),  # Lowercased word
+    Column('weight', Integer, nullable=False),  # Relevance of a match on this word for ranking
+    Index('search_token_token_index', 'object_type', 'token'),
+    Index('search_token_object_uuid_index', 'object_uuid'),
+)
+
 # For each child_uuid, we have: key = child_path, target = (parent_uuid, parent_path)
 bundle_dependency = Table(
     'bundle_dependency',
@@ -62,6 +111,9 @@ bundle_dependency = Table(
     # dependencies to bundles not (yet) in the system.
     Column('parent_uuid', String(63), nullable=False),
     Column('parent_path', Text, nullable=False),
+    # Needed to follow the lineage of bundles.
+    Index('bundle_dependency_child_uuid_index', 'child_uuid'),
+    Index('bundle_dependency_parent_uuid_index', 'parent_uuid'),
 )
 
 # The worksheet table does not have many columns now, but it will eventually
@@ -101,8 +153,10 @@ worksheet_item = Table(
     Column('subworksheet_uuid', String(63), nullable=True),
     Column('value', Text, nullable=False),  # TODO: make this nullable
     Column('type', String(20), nullable=False),
-    Column('sort_key', Integer, nullable=True),
+    # See codalab.objects.worksheet for the sort_key protocol.
+    Column('sort_key', BigInteger, nullable=True),
     Index('worksheet_item_worksheet_uuid_index', 'worksheet_uuid'),
+    Index('worksheet_item_worksheet_uuid_sort_key_index', 'worksheet_uuid', 'sort_key'),
     Index('worksheet_item_bundle_uuid_index', 'bundle_uuid'),
     Index('worksheet_item_subworksheet_uuid_index', 'subworksheet_uuid'),
 )
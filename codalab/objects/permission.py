@@ -75,6 +75,69 @@ def get_single_group(model, group_spec, search_fn):
     return groups[0]
 
 
+############################################################
+# Resolving permissions
+
+
+class PermissionResolver(object):
+    '''
+    Resolves the permissions granted to users on bundles and worksheets through their groups,
+    memoizing the groups of each user and the permission of each (user, object) pair.
+    A resolver is meant to live for the duration of a single request (see
+    BundleModel.cache_permissions), so that the many permission checks done while handling a
+    request (e.g. interpreting a worksheet) don't query the same rows again. Not thread-safe.
+    '''
+
+    def __init__(self, model):
+        self._model = model
+        # user_id -> list of uuids of the groups of the user
+        self._user_groups = {}
+        # (table name, user_id, object_uuid) -> highest permission granted through a group
+        self._group_permissions = {}
+
+    def get_user_groups(self, user_id):
+        if user_id not in self._user_groups:
+            self._user_groups[user_id] = self._model._get_user_groups(user_id)
+        return self._user_groups[user_id]
+
+    def get_group_permissions(self, table, user_id, object_uuids):
+        '''
+        Return map from object_uuid to the highest permission granted to the user on the object
+        through one of the groups of the user.
+        '''
+        missing_uuids = [
+            object_uuid
+            for object_uuid in object_uuids
+            if (table.name, user_id, object_uuid) not in self._group_permissions
+        ]
+        if missing_uuids:
+            permissions = self._model.get_max_group_permissions(
+                table, self.get_user_groups(user_id), missing_uuids
+            )
+            for object_uuid in missing_uuids:
+                self._group_permissions[table.name, user_id, object_uuid] = permissions.get(
+                    object_uuid, GROUP_OBJECT_PERMISSION_NONE
+                )
+        return {
+            object_uuid: self._group_permissions[table.name, user_id, object_uuid]
+            for object_uuid in object_uuids
+        }
+
+    def forget_object(self, object_uuid):
+        '''
+        Drop the memoized permissions on an object whose group permissions changed.
+        '''
+        for key in [key for key in self._group_permissions if key[2] == object_uuid]:
+            del self._group_permissions[key]
+
+    def forget_all(self):
+        '''
+        Drop everything memoized, e.g. after group memberships changed.
+        '''
+        self._user_groups.clear()
+        self._group_permissions.clear()
+
+
 ############################################################
 # Checking permissions
 
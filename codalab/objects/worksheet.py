@@ -11,14 +11,18 @@ from codalab.lib import spec_util
 from codalab.model.orm_object import ORMObject
 
 
-# We will keep worksheet items sorted in the database by maintining a sort_key
-# for each item that was batch-added to a worksheet by a call to update_worksheet_items.
-# These sort keys will be strictly upper-bounded by the maximum id at the time
-# at which the edit was BEGUN. This ensures that any worksheet items appended to
-# the sheet between the time the edit was begun and committed will have ids
-# greater than the maximum sort key.
-def item_sort_key(item):
-    return item['id'] if item['sort_key'] is None else item['sort_key']
+# Worksheet items are kept sorted in the database by (sort_key, id). Every item
+# gets a sort_key when it is added: items appended to a worksheet get the largest
+# sort_key of the worksheet plus WORKSHEET_ITEM_SORT_KEY_GAP, and items inserted
+# after another item split the gap between its sort_key and the next one, so that
+# adding items never rewrites the other items of the worksheet (the sort keys of
+# the items after a gap are only shifted once the gap is exhausted). Items with
+# equal sort keys (e.g. appended concurrently) are ordered by id.
+# Replacing the items of a worksheet by a call to update_worksheet_items gives
+# the new items sort keys smaller than those of the items added to the worksheet
+# between the time the edit was BEGUN and committed, which have ids greater than
+# the last item id at that time.
+WORKSHEET_ITEM_SORT_KEY_GAP = 1024
 
 
 class Worksheet(ORMObject):
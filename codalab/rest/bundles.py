@@ -1,17 +1,24 @@
+import base64
 import http.client
+import json
 import logging
 import mimetypes
 import os
 import re
+import stat
 import sys
+import threading
 import time
 from io import BytesIO
 from http.client import HTTPResponse
+from uuid import uuid4
 
 from bottle import abort, get, post, put, delete, local, request, response
+from marshmallow import ValidationError
 from codalab.bundles import get_bundle_subclass, UploadedBundle
-from codalab.common import precondition, UsageError, NotFoundError
+from codalab.common import CODALAB_VERSION, precondition, UsageError, NotFoundError
 from codalab.lib import canonicalize, spec_util, worksheet_util
+from codalab.lib.download_manager import FileSection
 from codalab.lib.server_util import (
     bottle_patch as patch,
     json_api_include,
@@ -41,6 +48,33 @@ from codalab.worker.download_util import BundleTarget
 
 logger = logging.getLogger(__name__)
 
+# Number of bundles serialized at a time in streamed (NDJSON) responses
+STREAM_BATCH_SIZE = 100
+
+# Default and maximum number of seconds that GET /bundles/<uuid>/updates waits for updates
+UPDATES_TIMEOUT = 30
+MAX_UPDATES_TIMEOUT = 60
+# Interval, in seconds, at which GET /bundles/<uuid>/updates checks followed files for new contents
+UPDATES_FILE_POLL_INTERVAL = 2.0
+# Maximum number of bytes of each followed file returned by GET /bundles/<uuid>/updates
+UPDATES_READ_LENGTH = 64 * 1024
+# Maximum number of GET /bundles/<uuid>/updates requests of a server process waiting for updates
+# at the same time, since each one holds a thread of the server. The other requests return right
+# away and tell the client to poll again after UPDATES_RETRY_AFTER seconds.
+MAX_UPDATES_WAITERS = 10
+UPDATES_RETRY_AFTER = 5
+# Maximum number of bundles whose states are fetched by a POST /bundles/states request
+MAX_BUNDLE_STATES = 10000
+# Maximum number of ranges of a GET /bundles/<uuid>/contents/blob/ request
+MAX_BYTE_RANGES = 64
+# Maximum total size of the ranges of a GET /bundles/<uuid>/contents/blob/ request with several
+# ranges, since the sections of the file are read in memory
+MAX_BYTE_RANGES_SIZE = 64 * 1024 * 1024
+# Number of bundles saved per transaction by POST /bundles/ndjson
+CREATE_BUNDLES_BATCH_SIZE = 1000
+
+updates_waiters = threading.BoundedSemaphore(MAX_UPDATES_WAITERS)
+
 
 @get('/bundles/<uuid:re:%s>' % spec_util.UUID_STR)
 def _fetch_bundle(uuid):
@@ -87,6 +121,14 @@ def _fetch_bundles():
         - `.floating              ` : Match bundles that aren't on any worksheet.
         - `.count                 ` : Count the number of bundles.
         - `.limit=10              ` : Limit the number of results to the top 10.
+     - `cursor`: Paginate the search results by `.limit` bundles (10 by default). Pass an empty
+       cursor to get the first page, then the `next_cursor` of the `meta` of the response to get
+       the next page. `next_cursor` is null on the last page. Unlike `.offset`, the cost of
+       fetching a page doesn't grow with its position in the results when the results are not
+       sorted, or sorted by id or by an indexed metadata field (e.g. `created`, `size`, `time`).
+     - `stream`: `1` to respond with newline-delimited JSON (application/x-ndjson) rather than a
+       single document. Each line is a document (as described below) of the next batch of bundles,
+       serialized while the response is sent. Default is `0`.
      - `include_display_metadata`: `1` to include additional metadata helpful
        for displaying the bundle info, `0` to omit them. Default is `0`.
      - `include`: comma-separated list of related resources to include, such as "owner"
@@ -118,16 +160,21 @@ def _fetch_bundles():
     descendant_depth = query_get_type(int, 'depth', None)
     command = query_get_type(str, 'command', '')
     dependencies = query_get_type(str, 'dependencies', '[]')
+    cursor = request.query.get('cursor')
+    stream = query_get_bool('stream', default=False)
+    meta = {}
 
     if keywords:
         # Handle search keywords
         keywords = resolve_owner_in_keywords(keywords)
-        search_result = local.model.search_bundles(request.user.user_id, keywords)
+        search_result = local.model.search_bundles(request.user.user_id, keywords, cursor=cursor)
         # Return simple dict if scalar result (e.g. .sum or .count queries)
         if search_result['is_aggregate']:
             return json_api_meta({}, {'result': search_result['result']})
         # If not aggregate this is a list
         bundle_uuids = search_result['result']
+        if cursor is not None:
+            meta['next_cursor'] = search_result['next_cursor']
     elif specs:
         # Resolve bundle specs
         bundle_uuids = canonicalize.get_bundle_uuids(
@@ -145,10 +192,68 @@ def _fetch_bundles():
     if descendant_depth is not None:
         bundle_uuids = local.model.get_self_and_descendants(bundle_uuids, depth=descendant_depth)
 
-    return build_bundles_document(bundle_uuids)
+    if stream:
+        return stream_bundles_documents(bundle_uuids, meta)
+    return json_api_meta(build_bundles_document(bundle_uuids), meta)
+
+
+@get('/bundles/ancestors')
+def _fetch_bundle_ancestors():
+    """
+    Fetch bundles along with their ancestors, i.e. the bundles they depend on directly or
+    indirectly, so that the lineage of bundles (e.g. to plan `cl mimic`) is fetched in a single
+    request.
+
+    Query parameters:
+
+     - `worksheet`: UUID of the base worksheet. Required when fetching by specs.
+     - `specs`: Bundle spec of bundle to fetch, as in `GET /bundles`. May be provided multiples
+        times to fetch multiple bundle specs.
+     - `depth`: number of levels of ancestors to fetch. Default is 1 (only parents).
+     - `descendant_depth`: also fetch the descendants of the bundles down to this depth, along
+        with their ancestors. Default is 0 (no descendants).
+     - `include_display_metadata`, `include`: as in `GET /bundles`.
+
+    Bundles are returned from the given bundles (and their descendants) to the most distant
+    ancestors. Ancestors that don't exist are omitted, since bundles can depend on bundles not
+    (yet) in the system.
+    """
+    specs = query_get_list('specs')
+    worksheet_uuid = request.query.get('worksheet')
+    ancestor_depth = query_get_type(int, 'depth', 1)
+    descendant_depth = query_get_type(int, 'descendant_depth', 0)
+    if not specs:
+        abort(http.client.BAD_REQUEST, "Request must include 'specs' query parameter")
+    if ancestor_depth < 0 or descendant_depth < 0:
+        abort(http.client.BAD_REQUEST, "Depths must be non-negative")
+
+    bundle_uuids = canonicalize.get_bundle_uuids(local.model, request.user, worksheet_uuid, specs)
+    bundle_uuids = local.model.get_self_and_descendants(bundle_uuids, depth=descendant_depth)
+    bundle_uuids = local.model.get_self_and_ancestors(bundle_uuids, depth=ancestor_depth)
+    return build_bundles_document(bundle_uuids, ignore_not_found=True)
+
+
+def stream_bundles_documents(bundle_uuids, meta):
+    """
+    Returns a newline-delimited JSON response body made of the documents of successive batches of
+    STREAM_BATCH_SIZE bundles, each with the given meta. Batches are only built as the response is
+    sent, so that the infos of all the bundles are never in memory at once.
+    """
+    meta = dict(meta, version=CODALAB_VERSION)
+    response.content_type = 'application/x-ndjson'
+
+    def generate():
+        for start in range(0, max(len(bundle_uuids), 1), STREAM_BATCH_SIZE):
+            # The response has started: skip bundles deleted in the meantime rather than failing
+            document = build_bundles_document(
+                bundle_uuids[start : start + STREAM_BATCH_SIZE], ignore_not_found=True
+            )
+            yield (json.dumps(json_api_meta(document, meta)) + '\n').encode()
 
+    return generate()
 
-def build_bundles_document(bundle_uuids):
+
+def build_bundles_document(bundle_uuids, ignore_not_found=False):
     include_set = query_get_json_api_include_set(
         supported={'owner', 'group_permissions', 'children', 'host_worksheets'}
     )
@@ -158,11 +263,11 @@ def build_bundles_document(bundle_uuids):
         get_children='children' in include_set,
         get_permissions='group_permissions' in include_set,
         get_host_worksheets='host_worksheets' in include_set,
-        ignore_not_found=False,
+        ignore_not_found=ignore_not_found,
     )
 
     # Create list of bundles in original order
-    bundles = [bundles_dict[uuid] for uuid in bundle_uuids]
+    bundles = [bundles_dict[uuid] for uuid in bundle_uuids if uuid in bundles_dict]
 
     # Build response document
     document = BundleSchema(many=True).dump(bundles).data
@@ -243,28 +348,13 @@ def _create_bundles():
     worksheet_util.check_worksheet_not_frozen(worksheet)
     request.user.check_quota(need_time=True, need_disk=True)
 
+    wait_for_upload = query_get_bool('wait_for_upload', False)
     created_uuids = []
     for bundle in bundles:
-        # Prep bundle info for saving into database
-        # Unfortunately cannot use the `construct` methods because they don't
-        # provide a uniform interface for constructing bundles for all types
-        # Hopefully this can all be unified after REST migration is complete
-        bundle_uuid = bundle.setdefault('uuid', spec_util.generate_uuid())
-        created_uuids.append(bundle_uuid)
-        bundle_class = get_bundle_subclass(bundle['bundle_type'])
-        bundle['owner_id'] = request.user.user_id
-
-        if issubclass(bundle_class, UploadedBundle) or query_get_bool('wait_for_upload', False):
-            bundle['state'] = State.UPLOADING
-        else:
-            bundle['state'] = State.CREATED
-        bundle['is_anonymous'] = worksheet.is_anonymous  # inherit worksheet anonymity
-        bundle.setdefault('metadata', {})['created'] = int(time.time())
-        for dep in bundle.setdefault('dependencies', []):
-            dep['child_uuid'] = bundle_uuid
-
         # Create bundle object
-        bundle = bundle_class(bundle, strict=False)
+        bundle = build_new_bundle(bundle, worksheet, wait_for_upload)
+        bundle_uuid = bundle.uuid
+        created_uuids.append(bundle_uuid)
 
         # Save bundle into model
         local.model.save_bundle(bundle)
@@ -303,6 +393,153 @@ def _create_bundles():
     return BundleSchema(many=True).dump(bundles).data
 
 
+@post('/bundles/ndjson', apply=AuthenticatedPlugin())
+def _create_bundles_ndjson():
+    """
+    Bulk create bundles from newline-delimited JSON, for creating many bundles at once (e.g. the
+    runs of a sweep). Each line of the request body is the JSON API resource object of a bundle,
+    with the fields accepted by POST /bundles, e.g.:
+    ```
+    {"type": "bundles", "attributes": {"bundle_type": "run", "command": ..., "metadata": {...}}}
+    ```
+
+    Bundles are validated and saved CREATE_BUNDLES_BATCH_SIZE at a time, each batch in a single
+    transaction. The response is newline-delimited JSON too, with a line {"id": uuid} for each
+    created bundle, sent as soon as its batch is saved. If a line of the request is invalid, the
+    response ends with a line {"error": message, "line": line number}, and the bundles of that
+    line's batch and of the following lines are not created. If a batch can't be saved, the
+    response ends with a line {"error": message}.
+
+    Query parameters: same as POST /bundles, except that `shadow` is not supported.
+    """
+    worksheet_uuid = request.query.get('worksheet')
+    after_sort_key = request.query.get('after_sort_key')
+    detached = query_get_bool('detached', default=False)
+    wait_for_upload = query_get_bool('wait_for_upload', False)
+    if worksheet_uuid is None:
+        abort(
+            http.client.BAD_REQUEST,
+            "Parent worksheet id must be specified as" "'worksheet' query parameter",
+        )
+
+    # Check for all necessary permissions
+    worksheet = local.model.get_worksheet(worksheet_uuid, fetch_items=False)
+    check_worksheet_has_all_permission(local.model, request.user, worksheet)
+    worksheet_util.check_worksheet_not_frozen(worksheet)
+    request.user.check_quota(need_time=True, need_disk=True)
+
+    # Inherit worksheet permissions
+    group_permissions = local.model.get_group_worksheet_permissions(
+        request.user.user_id, worksheet_uuid
+    )
+    schema = BundleSchema(strict=True, dump_only=BUNDLE_CREATE_RESTRICTED_FIELDS)
+    body = request.body
+
+    def create_bundles():
+        bundles = []
+        for line_number, line in enumerate(body, 1):
+            if line.strip():
+                try:
+                    fields = schema.load({'data': json.loads(line.decode())}).data
+                    if 'bundle_type' not in fields:
+                        raise UsageError('Bundle type must be specified.')
+                    bundle = build_new_bundle(fields, worksheet, wait_for_upload)
+                    bundle.validate()
+                except ValidationError as e:
+                    yield ndjson_line(
+                        {'error': format_validation_error(e.messages), 'line': line_number}
+                    )
+                    return
+                except Exception as e:
+                    # The response has started, so errors are reported on their line
+                    if not isinstance(e, (ValueError, TypeError, UsageError)):
+                        logger.exception('Invalid bundle on line %d', line_number)
+                    yield ndjson_line({'error': str(e), 'line': line_number})
+                    return
+                bundles.append(bundle)
+            if len(bundles) == CREATE_BUNDLES_BATCH_SIZE:
+                output, saved = save_bundles(bundles)
+                yield output
+                if not saved:
+                    return
+                bundles = []
+        if bundles:
+            yield save_bundles(bundles)[0]
+
+    def save_bundles(bundles):
+        """
+        Saves a batch of bundles. Returns the lines of the response, and whether the bundles
+        were saved.
+        """
+        nonlocal after_sort_key
+        try:
+            after_sort_key = local.model.save_bundles(
+                bundles,
+                worksheet_uuid=None if detached else worksheet_uuid,
+                after_sort_key=after_sort_key,
+                group_permissions=group_permissions,
+            )
+        except Exception as e:
+            # The response has started, so errors can't be reported with the status code
+            logger.exception('Cannot create bundles')
+            return ndjson_line({'error': str(e)}), False
+        return b''.join(ndjson_line({'id': bundle.uuid}) for bundle in bundles), True
+
+    response.content_type = 'application/x-ndjson'
+    return create_bundles()
+
+
+def ndjson_line(value):
+    return (json.dumps(value) + '\n').encode()
+
+
+def format_validation_error(messages):
+    """
+    Returns the message of a marshmallow ValidationError, given its messages: the details of its
+    JSON API errors, or the messages of its fields (e.g. {'_schema': [...]}) otherwise.
+    """
+    if isinstance(messages, dict) and isinstance(messages.get('errors'), list):
+        return '\n'.join(
+            error['detail'] if isinstance(error, dict) and 'detail' in error else str(error)
+            for error in messages['errors']
+        )
+    if isinstance(messages, dict):
+        return '\n'.join(
+            '%s: %s' % (field, format_validation_error(field_messages))
+            if field != '_schema'
+            else format_validation_error(field_messages)
+            for field, field_messages in messages.items()
+        )
+    if isinstance(messages, list):
+        return '\n'.join(format_validation_error(message) for message in messages)
+    return str(messages)
+
+
+def build_new_bundle(bundle, worksheet, wait_for_upload):
+    """
+    Returns the Bundle object of a new bundle, given its deserialized fields, owned by the
+    authenticated user and inheriting the anonymity of the parent worksheet.
+    """
+    # Prep bundle info for saving into database
+    # Unfortunately cannot use the `construct` methods because they don't
+    # provide a uniform interface for constructing bundles for all types
+    # Hopefully this can all be unified after REST migration is complete
+    bundle_uuid = bundle.setdefault('uuid', spec_util.generate_uuid())
+    bundle_class = get_bundle_subclass(bundle['bundle_type'])
+    bundle['owner_id'] = request.user.user_id
+
+    if issubclass(bundle_class, UploadedBundle) or wait_for_upload:
+        bundle['state'] = State.UPLOADING
+    else:
+        bundle['state'] = State.CREATED
+    bundle['is_anonymous'] = worksheet.is_anonymous  # inherit worksheet anonymity
+    bundle.setdefault('metadata', {})['created'] = int(time.time())
+    for dep in bundle.setdefault('dependencies', []):
+        dep['child_uuid'] = bundle_uuid
+
+    return bundle_class(bundle, strict=False)
+
+
 @patch('/bundles', apply=AuthenticatedPlugin())
 def _update_bundles():
     """
@@ -377,6 +614,146 @@ def _set_bundle_permissions():
     return BundlePermissionSchema(many=True).dump(new_permissions).data
 
 
+@post('/bundles/states')
+def _fetch_bundle_states():
+    """
+    Fetch the states of many bundles at once, e.g. to wait for the runs of a sweep. Only the
+    state, run status and last update time of each bundle are returned, which are read from
+    indexes, so this is much cheaper than fetching the bundles with `GET /bundles`.
+
+    Request body (up to 10000 uuids):
+    ```
+    {
+      "uuids": ["0x...", ...]
+    }
+    ```
+
+    Response format:
+    ```
+    {
+      "data": {
+          "<uuid>": {
+              "state": "<state of the bundle>",
+              "run_status": "<run status of the bundle, or null>",
+              "last_updated": <time of the last update of the run, or null>
+          },
+          ...
+      }
+    }
+    ```
+    Bundles that don't exist are omitted.
+    """
+    uuids = (request.json or {}).get('uuids')
+    if not isinstance(uuids, list) or not all(
+        isinstance(uuid, str) and spec_util.UUID_REGEX.match(uuid) for uuid in uuids
+    ):
+        abort(http.client.BAD_REQUEST, "Request must include a list of bundle uuids in 'uuids'")
+    if len(uuids) > MAX_BUNDLE_STATES:
+        abort(
+            http.client.BAD_REQUEST,
+            "Request must include at most %d bundle uuids" % MAX_BUNDLE_STATES,
+        )
+
+    states = local.model.get_bundle_state_infos(uuids)
+    check_bundles_have_read_permission(local.model, request.user, list(states))
+    return {'data': states}
+
+
+@get('/bundles/<uuid:re:%s>/updates' % spec_util.UUID_STR)
+def _fetch_bundle_updates(uuid):
+    """
+    Long-poll for the updates of a bundle: waits until its state differs from the state last seen
+    by the client, or until any of the followed files has new contents, and returns them. Used to
+    follow runs (e.g. `cl wait --tail`) without polling the bundle and its files.
+
+    Query parameters:
+    - `state`: state of the bundle last seen by the client. If omitted, the response is returned
+      right away.
+    - `subpath`: subpath of a file of the bundle to follow. May be provided multiple times.
+    - `offset`: offset from which to read the file of the `subpath` at the same position.
+    - `timeout`: maximum number of seconds to wait, at most 60. Default is 30.
+
+    Response format:
+    ```
+    {
+      "data": {
+          "state": "<state of the bundle>",
+          "files": [
+              {
+                "subpath": "<subpath of the file>",
+                "offset": <offset of the contents>,
+                "contents": "<base64-encoded contents from the offset, up to 64 KiB>"
+              },
+              ...
+          ],
+          "retry_after": <seconds>
+      }
+    }
+    ```
+    The contents of files that don't exist yet are empty. `retry_after` is only present if the
+    server is too busy to wait for updates: the request returned right away, without updates, and
+    the client should wait that many seconds before asking again.
+    """
+    known_state = request.query.get('state')
+    subpaths = query_get_list('subpath')
+    try:
+        offsets = [int(offset) for offset in query_get_list('offset')]
+    except ValueError:
+        abort(http.client.BAD_REQUEST, "Offsets must be integers")
+    if len(offsets) != len(subpaths):
+        abort(http.client.BAD_REQUEST, "Each subpath must have an offset")
+    timeout = min(max(query_get_type(float, 'timeout', UPDATES_TIMEOUT), 0), MAX_UPDATES_TIMEOUT)
+    check_bundles_have_read_permission(local.model, request.user, [uuid])
+
+    deadline = time.time() + timeout
+    state = local.model.get_bundle_state(uuid)
+    data = {}
+    waiting = False
+    try:
+        while True:
+            files = read_followed_files(uuid, state, subpaths, offsets)
+            remaining = deadline - time.time()
+            if state != known_state or any(f['contents'] for f in files) or remaining <= 0:
+                break
+            if not waiting:
+                waiting = updates_waiters.acquire(blocking=False)
+                if not waiting:
+                    data['retry_after'] = UPDATES_RETRY_AFTER
+                    break
+            # Files are checked periodically, state changes are waited for
+            if subpaths:
+                remaining = min(remaining, UPDATES_FILE_POLL_INTERVAL)
+            state = local.model.wait_for_bundle_state_changes({uuid: state}, remaining).get(uuid)
+            if state is None:
+                abort(http.client.NOT_FOUND, 'Could not find bundle with uuid %s' % uuid)
+    finally:
+        if waiting:
+            updates_waiters.release()
+
+    return {'data': dict(data, state=state, files=files)}
+
+
+def read_followed_files(uuid, state, subpaths, offsets):
+    """
+    Returns the `files` of the response of GET /bundles/<uuid>/updates: the contents of the files
+    at the given subpaths of the bundle from the given offsets, if the bundle is running or done.
+    """
+    files = []
+    for subpath, offset in zip(subpaths, offsets):
+        contents = b''
+        if state == State.RUNNING or state in State.FINAL_STATES:
+            try:
+                contents = local.download_manager.read_file_section(
+                    BundleTarget(uuid, subpath), offset, UPDATES_READ_LENGTH, False
+                )
+            except NotFoundError:
+                pass
+        files.append(
+            {'subpath': subpath, 'offset': offset, 'contents': base64.b64encode(contents).decode()}
+        )
+    return files
+
+
 @get('/bundles/<uuid:re:%s>/contents/info/' % spec_util.UUID_STR, name='fetch_bundle_contents_info')
 @get(
     '/bundles/<uuid:re:%s>/contents/info/<path:path>' % spec_util.UUID_STR,
@@ -535,6 +912,11 @@ def _fetch_bundle_contents_blob(uuid, path=''):
     HTTP Request headers:
     - `Range: bytes=<start>-<end>`: fetch bytes from the range
       `[<start>, <end>)`.
+    - `Range: bytes=<start>-<end>,<start>-<end>,...`: fetch bytes from several
+      ranges of a file at once. The response is a `multipart/byteranges`
+      document with a part per non-empty range, identified by its
+      `Content-Range` header, and is never gzipped. At most 64 ranges, of
+      at most 64 MiB in total, are supported.
     - `Accept-Encoding: <encoding>`: indicate that the client can accept
       encoding `<encoding>`. Currently only `gzip` encoding is supported.
 
@@ -550,6 +932,7 @@ def _fetch_bundle_contents_blob(uuid, path=''):
     - `Content-Disposition: inline; filename=<bundle name or target filename>`
     - `Content-Type: <guess of mimetype based on file extension>`
     - `Content-Encoding: [gzip|identity]`
+    - `Content-Length: <size of the response>`, when known
     - `Target-Type: file`
 
     HTTP Response headers (for directories):
@@ -558,7 +941,7 @@ def _fetch_bundle_contents_blob(uuid, path=''):
     - `Content-Encoding: identity`
     - `Target-Type: directory`
     """
-    byte_range = get_request_range()
+    byte_ranges = get_request_ranges()
     head_lines = query_get_type(int, 'head', default=0)
     tail_lines = query_get_type(int, 'tail', default=0)
     truncation_text = query_get_type(str, 'truncation_text', default='')
@@ -586,7 +969,7 @@ def _fetch_bundle_contents_blob(uuid, path=''):
         filename = target_info['name']
 
     if target_info['type'] == 'directory':
-        if byte_range:
+        if byte_ranges:
             abort(http.client.BAD_REQUEST, 'Range not supported for directory blobs.')
         if head_lines or tail_lines:
             abort(http.client.BAD_REQUEST, 'Head and tail not supported for directory blobs.')
@@ -612,11 +995,33 @@ def _fetch_bundle_contents_blob(uuid, path=''):
         if encoding is not None:
             mimetype = 'application/octet-stream'
 
-        if byte_range and (head_lines or tail_lines):
+        if byte_ranges and (head_lines or tail_lines):
             abort(http.client.BAD_REQUEST, 'Head and range not supported on the same request.')
-        elif byte_range:
-            start, end = byte_range
-            fileobj = local.download_manager.read_file_section(
+        elif byte_ranges and len(byte_ranges) > 1:
+            # Sections past the end of the file are empty
+            size = sum(
+                max(min(end, target_info['size'] - 1) - start + 1, 0) for start, end in byte_ranges
+            )
+            if size > MAX_BYTE_RANGES_SIZE:
+                abort(
+                    http.client.BAD_REQUEST,
+                    "Ranges of at most %d bytes in total are supported." % MAX_BYTE_RANGES_SIZE,
+                )
+            gzipped_stream = False
+            sections = local.download_manager.read_file_sections(
+                target, [(start, end - start + 1) for start, end in byte_ranges]
+            )
+            boundary = uuid4().hex
+            fileobj = BytesIO(
+                build_byteranges_document(
+                    byte_ranges, sections, target_info['size'], mimetype or 'text/plain', boundary
+                )
+            )
+            mimetype = 'multipart/byteranges; boundary=' + boundary
+            response.status = http.client.PARTIAL_CONTENT
+        elif byte_ranges:
+            start, end = byte_ranges[0]
+            fileobj = local.download_manager.stream_file_section(
                 target, start, end - start + 1, gzipped_stream
             )
         elif head_lines or tail_lines:
@@ -639,6 +1044,11 @@ def _fetch_bundle_contents_blob(uuid, path=''):
     else:
         response.set_header('Content-Disposition', 'attachment; filename="%s"' % filename)
     response.set_header('Target-Type', target_info['type'])
+    # Regular files (e.g. cached archives and sections of files) are sent by the server with
+    # sendfile when their length is known.
+    length = get_response_length(fileobj)
+    if length is not None:
+        response.set_header('Content-Length', str(length))
 
     return fileobj
 
@@ -756,22 +1166,66 @@ def _update_bundle_contents_blob(uuid):
 #############################################################
 
 
-def get_request_range():
+def get_response_length(fileobj):
+    """
+    Returns the number of bytes that fileobj reads if it's known, i.e. for file sections,
+    in-memory contents and regular files, or None (e.g. for pipes and streams from workers).
+    """
+    if isinstance(fileobj, FileSection):
+        return fileobj.length
+    if isinstance(fileobj, BytesIO):
+        return len(fileobj.getbuffer())
+    try:
+        st = os.fstat(fileobj.fileno())
+        if stat.S_ISREG(st.st_mode):
+            return st.st_size - fileobj.tell()
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+
+def build_byteranges_document(byte_ranges, sections, size, content_type, boundary):
+    """
+    Returns the body of a multipart/byteranges response with the given sections of a file of the
+    given size, read from the given (start, end) byte ranges. Empty sections are omitted.
+    """
+    parts = []
+    for (start, _), section in zip(byte_ranges, sections):
+        if not section:
+            continue
+        parts.append(
+            (
+                '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                % (boundary, content_type, start, start + len(section) - 1, size)
+            ).encode()
+        )
+        parts.append(section)
+        parts.append(b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode())
+    return b''.join(parts)
+
+
+def get_request_ranges():
     """
     Parses header of the form:
-        Range: bytes=START-END
-    into tuple:
-        (int(START), int(END))
+        Range: bytes=START-END[,START-END...]
+    into list of tuples:
+        [(int(START), int(END)), ...]
     """
     if 'Range' not in request.headers:
         return None
 
-    m = re.match(r'bytes=(\d+)-(\d+)', request.headers['Range'].strip())
+    m = re.match(r'bytes=(\d+-\d+(\s*,\s*\d+-\d+)*)$', request.headers['Range'].strip())
     if m is None:
-        abort(http.client.BAD_REQUEST, "Range must be 'bytes=START-END'.")
-
-    start, end = m.groups()
-    return int(start), int(end)
+        abort(http.client.BAD_REQUEST, "Range must be 'bytes=START-END[,START-END...]'.")
+
+    byte_ranges = []
+    for byte_range in m.group(1).split(','):
+        start, end = byte_range.strip().split('-')
+        byte_ranges.append((int(start), int(end)))
+    if len(byte_ranges) > MAX_BYTE_RANGES:
+        abort(http.client.BAD_REQUEST, "At most %d ranges are supported." % MAX_BYTE_RANGES)
+    return byte_ranges
 
 
 def request_accepts_gzip_encoding():
@@ -10,6 +10,7 @@ worksheet_util does not make any calls to the model, they are kind of just like
 static helper functions.
 """
 import base64
+import hashlib
 import types
 from contextlib import closing
 from itertools import chain
@@ -18,10 +19,14 @@ import sys
 import requests
 import urllib.request, urllib.parse, urllib.error
 import yaml
-from bottle import get, post, local, request, abort, httplib
+from bottle import get, post, local, request, response, abort, httplib
 
 from codalab.common import UsageError, NotFoundError
 from codalab.lib import formatting, spec_util
+from codalab.lib.batch_reader import BatchReader
+from codalab.lib.block_cache import BlockCache, get_block_key
+from codalab.lib.genpath_cache import GenpathCache
+from codalab.lib.server_util import query_get_type
 from codalab.lib.worksheet_util import (
     TYPE_DIRECTIVE,
     format_metadata,
@@ -37,7 +42,7 @@ from codalab.lib.worksheet_util import (
     get_command,
 )
 from codalab.model.tables import GROUP_OBJECT_PERMISSION_ALL
-from codalab.objects.permission import permission_str
+from codalab.objects.permission import check_bundles_have_read_permission, permission_str
 from codalab.rest import util as rest_util
 from codalab.rest.worksheets import get_worksheet_info, search_worksheets
 from codalab.rest.worksheet_block_schemas import (
@@ -46,6 +51,7 @@ from codalab.rest.worksheet_block_schemas import (
     FetchStatusCodes,
     FetchStatusSchema,
 )
+from codalab.worker.bundle_state import State
 from codalab.worker.download_util import BundleTarget
 
 
@@ -223,6 +229,11 @@ def fetch_interpreted_worksheet(uuid):
     This endpoint can be called with &brief=1 in order to give an abbreviated version,
     which does not resolve searches or wsearches.
 
+    To render large worksheets lazily, pass &item_offset=N and/or &item_limit=M to only
+    interpret the M items of the worksheet following the first N ones. The source, blocks,
+    raw_to_block and block_to_raw then only cover these items, and num_items is the total
+    number of items of the worksheet.
+
     To return an interpreted worksheet that only resolves a particular search/wsearch,
     pass in the search query to the "directive" argument. The value for this argument
     must be a search/wsearch query -- for example, &directive=search 0x .limit=100
@@ -234,7 +245,18 @@ def fetch_interpreted_worksheet(uuid):
     print(directive)
     search_results = []
 
-    worksheet_info = get_worksheet_info(uuid, fetch_items=True, fetch_permissions=True)
+    item_offset = query_get_type(int, 'item_offset', 0)
+    item_limit = query_get_type(int, 'item_limit', None)
+    if item_offset < 0 or (item_limit is not None and item_limit < 0):
+        abort(httplib.BAD_REQUEST, 'item_offset and item_limit must be non-negative')
+
+    worksheet_info = get_worksheet_info(
+        uuid,
+        fetch_items=True,
+        fetch_permissions=True,
+        item_offset=item_offset,
+        item_limit=item_limit,
+    )
 
     # Shim in additional data for the frontend
     worksheet_info['items'] = resolve_items_into_infos(worksheet_info['items'])
@@ -344,8 +366,26 @@ def fetch_interpreted_worksheet(uuid):
     # Frontend doesn't use individual 'items' for now
     del worksheet_info['items']
     if bundle_uuids:
-        return {'blocks': worksheet_info['blocks']}
-    return worksheet_info
+        return respond_with_etag({'blocks': worksheet_info['blocks']})
+    return respond_with_etag(worksheet_info)
+
+
+def respond_with_etag(result):
+    """
+    Sets the ETag of the response to a digest of result, and returns result, or an empty
+    304 Not Modified response if the client already has that version of the result (i.e. its
+    ETag is in the If-None-Match header of the request). Clients that poll a worksheet thus
+    only download it again when it changed.
+    """
+    contents = json.dumps(result, sort_keys=True, default=str)
+    etag = '"%s"' % hashlib.sha1(contents.encode()).hexdigest()
+    response.set_header('ETag', etag)
+    # Have browsers revalidate their cached copy on every request
+    response.set_header('Cache-Control', 'no-cache')
+    if etag in request.headers.get('If-None-Match', ''):
+        response.status = 304
+        return ''
+    return result
 
 
 #############################################################
@@ -389,9 +429,93 @@ def head_target(target, max_num_lines):
     return lines
 
 
+def resolve_file_targets(targets):
+    """
+    Return {target: resolved_target} for the given targets that are files,
+    where resolved_target is the target the file is actually found at (e.g. in
+    a dependency of the bundle).
+
+    :param targets: A collection of worker.download_util.BundleTarget
+    """
+    if not targets:
+        return {}
+    check_bundles_have_read_permission(
+        local.model, request.user, list(set(target.bundle_uuid for target in targets))
+    )
+    target_infos = batch_reader.get_target_infos(local.model, local.download_manager, targets)
+
+    # Targets might resolve to files of dependencies, which need to be readable too
+    resolved_targets = {
+        target: target_info['resolved_target']
+        for target, target_info in target_infos.items()
+        if target_info is not None and target_info['type'] == 'file'
+    }
+    dependency_uuids = set(
+        resolved_target.bundle_uuid
+        for target, resolved_target in resolved_targets.items()
+        if resolved_target.bundle_uuid != target.bundle_uuid
+    )
+    if dependency_uuids:
+        check_bundles_have_read_permission(local.model, request.user, list(dependency_uuids))
+    return resolved_targets
+
+
+def head_targets(targets, max_num_lines):
+    """
+    Return {target: lines} with the first max_num_lines of each of the given
+    targets as a list of strings, or None if the target isn't a file.
+
+    Unlike head_target, targets are resolved first, and all the files are read
+    at once by batch_reader, so that a table or graph showing many files of
+    many bundles doesn't read them one at a time.
+
+    :param targets: A collection of worker.download_util.BundleTarget
+    :param max_num_lines: max number of lines to fetch per target
+    """
+    resolved_targets = resolve_file_targets(set(targets))
+    contents = batch_reader.head_targets(
+        local.model,
+        local.download_manager,
+        set(resolved_targets.values()),
+        max_num_lines,
+        MAX_BYTES_PER_LINE,
+    )
+    return {target: contents.get(resolved_targets.get(target)) for target in targets}
+
+
+# Reads the files of the genpaths of tables and graphs, see head_targets
+batch_reader = BatchReader()
+
+# Parsed files of genpaths, see read_genpath_targets and get_genpath_cache
+genpath_cache = None
+
+
+def get_genpath_cache():
+    """
+    Return the GenpathCache of this process, which also stores its entries in
+    the directory given by the genpath_cache_dir server setting, if any.
+    """
+    global genpath_cache
+    if genpath_cache is None:
+        genpath_cache = GenpathCache(cache_dir=local.config['server'].get('genpath_cache_dir'))
+    return genpath_cache
+
+
 # Default number of lines to pull for each display mode.
 DEFAULT_GRAPH_MAX_LINES = 100
 
+# Modes of the blocks whose resolution reads bundle contents, and is thus worth caching
+CACHED_BLOCK_MODES = (
+    BlockModes.record_block,
+    BlockModes.table_block,
+    BlockModes.contents_block,
+    BlockModes.image_block,
+    BlockModes.graph_block,
+)
+
+# Resolved blocks of this process, see resolve_interpreted_blocks
+block_cache = BlockCache()
+
 
 def resolve_interpreted_blocks(interpreted_blocks, brief):
     """
@@ -411,6 +535,15 @@ def resolve_interpreted_blocks(interpreted_blocks, brief):
             continue
         mode = block['mode']
 
+        cache_key = None
+        if mode in CACHED_BLOCK_MODES:
+            cache_key = get_block_key(block, brief)
+            if cache_key is not None:
+                cached_block = block_cache.get(cache_key)
+                if cached_block is not None:
+                    interpreted_blocks[block_index] = cached_block
+                    continue
+
         try:
             # Replace data with a resolved version.
             if mode in (BlockModes.markup_block, BlockModes.placeholder_block):
@@ -468,17 +601,16 @@ def resolve_interpreted_blocks(interpreted_blocks, brief):
             elif mode == BlockModes.graph_block:
                 # data = list of {'target': ...}
                 # Add a 'points' field that contains the contents of the target.
-                for info in block['trajectories']:
-                    target = BundleTarget(info['bundle_uuid'], info['target_genpath'])
-                    try:
-                        target_info = rest_util.get_target_info(target, 0)
-                    except NotFoundError as e:
-                        continue
-                    if target_info['type'] == 'file':
-                        contents = head_target(target_info['resolved_target'], block['max_lines'])
+                targets = [
+                    BundleTarget(info['bundle_uuid'], info['target_genpath'])
+                    for info in block['trajectories']
+                ]
+                contents = head_targets(targets, block['max_lines'])
+                for info, target in zip(block['trajectories'], targets):
+                    if contents.get(target) is not None:
                         # Assume TSV file without header for now, just return each line as a row
                         info['points'] = points = []
-                        for line in contents:
+                        for line in contents[target]:
                             row = line.split('\t')
                             points.append(row)
             elif mode == BlockModes.subworksheets_block:
@@ -497,6 +629,9 @@ def resolve_interpreted_blocks(interpreted_blocks, brief):
             set_error_data(block_index, "Unexpected error interpreting item")
 
         block['is_refined'] = True
+        # Errors may be transient, so only successfully resolved blocks are cached
+        if cache_key is not None and interpreted_blocks[block_index] is block:
+            block_cache.put(cache_key, block)
 
     return interpreted_blocks
 
@@ -585,28 +720,27 @@ def interpret_file_genpaths(requests):
     Helper function.
     requests: list of (bundle_uuid, genpath, post-processing-func)
     Return responses: corresponding list of strings
+
+    All the files are read at once, see head_targets.
     """
-    target_cache = {}
-    responses = []
+    # (target, key, post) for each request
+    parsed_requests = []
     for (bundle_uuid, genpath, post) in requests:
-        value = interpret_file_genpath(target_cache, bundle_uuid, genpath, post)
-        responses.append(value)
-    return responses
+        subpath, key = parse_file_genpath(genpath)
+        parsed_requests.append((BundleTarget(bundle_uuid, subpath), key, post))
+    target_cache = read_genpath_targets(set(target for target, _, _ in parsed_requests))
+    return [
+        get_genpath_value(target_cache.get(target), key, post)
+        for target, key, post in parsed_requests
+    ]
 
 
-def interpret_file_genpath(target_cache, bundle_uuid, genpath, post):
+def parse_file_genpath(genpath):
     """
-    |cache| is a mapping from target (bundle_uuid, subpath) to the info map,
-    which is to be read/written to avoid reading/parsing the same file many
-    times.
     |genpath| specifies the subpath and various fields (e.g., for
     /stats:train/errorRate, subpath = 'stats', key = 'train/errorRate').
-    |post| function to apply to the resulting value.
-    Return the string value.
+    Return (subpath, key), where key is None if the whole file is requested.
     """
-    MAX_LINES = 10000  # Maximum number of lines we need to read from a file.
-
-    # Load the file
     if not is_file_genpath(genpath):
         raise UsageError('Not file genpath: %s' % genpath)
     genpath = genpath[1:]
@@ -614,45 +748,86 @@ def interpret_file_genpath(target_cache, bundle_uuid, genpath, post):
         subpath, key = genpath.split(':')
     else:
         subpath, key = genpath, None
+    return subpath, key
+
+
+def read_genpath_targets(targets):
+    """
+    Read and parse the given targets.
+    Return a mapping from target (bundle_uuid, subpath) to the info map (see
+    parse_genpath_file), or None if the target isn't a file that can be read.
+
+    Files of bundles in a final state never change, so their info maps are
+    cached across requests.
+    """
+    MAX_LINES = 10000  # Maximum number of lines we need to read from a file.
 
-    target = BundleTarget(bundle_uuid, subpath)
-    if target not in target_cache:
-        info = None
+    resolved_targets = resolve_file_targets(targets)
+    files = set(resolved_targets.values())
+    bundle_states = local.model.get_bundle_states_and_data_hashes(
+        list(set(target.bundle_uuid for target in files))
+    )
+    cache = get_genpath_cache()
+    infos = {}  # resolved target -> info map
+    cache_keys = {}  # resolved target -> key of its info map in the cache
+    for target in files:
+        state, data_hash = bundle_states.get(target.bundle_uuid, (None, None))
+        if state in State.FINAL_STATES:
+            cache_keys[target] = GenpathCache.get_key(
+                target.bundle_uuid, target.subpath, data_hash, MAX_LINES
+            )
+            info = cache.get(cache_keys[target])
+            if info is not None:
+                infos[target] = info
+
+    contents = batch_reader.head_targets(
+        local.model, local.download_manager, files.difference(infos), MAX_LINES, MAX_BYTES_PER_LINE
+    )
+    for target, lines in contents.items():
+        infos[target] = parse_genpath_file(lines)
+        if target in cache_keys and infos[target] is not None:
+            cache.put(cache_keys[target], infos[target])
+    return {target: infos.get(resolved_targets.get(target)) for target in targets}
+
+
+def parse_genpath_file(contents):
+    """
+    Try to interpret the structure of a file by looking inside it.
+    |contents| is the list of lines of the file, or None if it can't be read.
+    Return the info map, or None.
+    """
+    if contents is None:
+        return None
+    if len(contents) == 0:
+        return ''
+    if all('\t' in x for x in contents):
+        # Tab-separated file (key\tvalue\nkey\tvalue...)
+        info = {}
+        for x in contents:
+            kv = x.strip().split("\t", 1)
+            if len(kv) == 2:
+                info[kv[0]] = kv[1]
+        return info
+    try:
+        # JSON file
+        return json.loads(''.join(contents))
+    except (TypeError, ValueError):
         try:
-            target_info = rest_util.get_target_info(target, 0)
-            if target_info['type'] == 'file':
-                contents = head_target(target_info['resolved_target'], MAX_LINES)
-
-                if len(contents) == 0:
-                    info = ''
-                elif all('\t' in x for x in contents):
-                    # Tab-separated file (key\tvalue\nkey\tvalue...)
-                    info = {}
-                    for x in contents:
-                        kv = x.strip().split("\t", 1)
-                        if len(kv) == 2:
-                            info[kv[0]] = kv[1]
-                else:
-                    try:
-                        # JSON file
-                        info = json.loads(''.join(contents))
-                    except (TypeError, ValueError):
-                        try:
-                            # YAML file
-                            # Use safe_load because yaml.load() could execute
-                            # arbitrary Python code
-                            info = yaml.safe_load(''.join(contents))
-                        except yaml.YAMLError:
-                            # Plain text file
-                            info = ''.join(contents)
-        except NotFoundError:
-            pass
-
-        # Try to interpret the structure of the file by looking inside it.
-        target_cache[target] = info
-
-    # Traverse the info object.
-    info = target_cache.get(target, None)
+            # YAML file
+            # Use safe_load because yaml.load() could execute
+            # arbitrary Python code
+            return yaml.safe_load(''.join(contents))
+        except yaml.YAMLError:
+            # Plain text file
+            return ''.join(contents)
+
+
+def get_genpath_value(info, key, post):
+    """
+    Traverse the |info| map of a file along |key| (e.g., 'train/errorRate'),
+    and apply the |post| function to the resulting value.
+    Return the string value.
+    """
     if key is not None and info is not None:
         for k in key.split('/'):
             if isinstance(info, dict):
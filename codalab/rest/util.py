@@ -68,13 +68,12 @@ def get_bundle_infos(
         model = local.model
     if len(uuids) == 0:
         return {}
-    bundles = model.batch_get_bundles(uuid=uuids)
-    bundle_infos = {
-        bundle.uuid: bundle_util.bundle_to_bundle_info(model, bundle) for bundle in bundles
-    }
+    bundle_infos = bundle_util.bundle_rows_to_bundle_infos(*model.batch_get_bundle_info_rows(uuids))
 
     # Implement permissions policies
-    perms = _get_user_bundle_permissions(model, uuids)
+    perms = model.get_user_bundle_permissions(
+        request.user.user_id, uuids, {uuid: info['owner_id'] for uuid, info in bundle_infos.items()}
+    )
     readable = {u for u, perm in perms.items() if perm >= GROUP_OBJECT_PERMISSION_READ}
     anonymous = {
         u
@@ -103,20 +102,23 @@ def get_bundle_infos(
         bundle['permission'] = perms[uuid]
 
     if get_children:
-        parent2children = model.get_children_uuids(readable)
+        parent2children = model.get_children_names_and_owner_ids(readable)
 
         # Gather all children bundle uuids and fetch permissions
-        child_uuids = [uuid for l in parent2children.values() for uuid in l]
-        child_perms = _get_user_bundle_permissions(model, child_uuids)
-
-        # Lookup bundle names
-        child_names = model.get_bundle_names(child_uuids)
+        child_owner_ids = {
+            child_uuid: owner_id
+            for children in parent2children.values()
+            for child_uuid, _, owner_id in children
+        }
+        child_perms = model.get_user_bundle_permissions(
+            request.user.user_id, list(child_owner_ids), child_owner_ids
+        )
 
         # Set children infos
         for parent_uuid, children in parent2children.items():
             bundle_infos[parent_uuid]['children'] = [
-                {'uuid': child_uuid, 'metadata': {'name': child_names[child_uuid]}}
-                for child_uuid in children
+                {'uuid': child_uuid, 'metadata': {'name': child_name}}
+                for child_uuid, child_name, _ in children
                 if child_perms[child_uuid] >= GROUP_OBJECT_PERMISSION_READ
             ]
 
@@ -172,32 +174,18 @@ def get_bundle_infos(
     return bundle_infos
 
 
-def _get_user_bundle_permissions(model, uuids):
-    return model.get_user_bundle_permissions(
-        request.user.user_id, uuids, model.get_bundle_owner_ids(uuids)
-    )
-
-
 def _get_readable_worksheet_names(model, worksheet_uuids):
     # Returns a dictionary of readable worksheet uuid's as keys and corresponding names as values
-    readable_worksheet_uuids = _filter_readable_worksheet_uuids(model, worksheet_uuids)
-    return dict(
-        (worksheet.uuid, worksheet.name)
-        for worksheet in model.batch_get_worksheets(
-            fetch_items=False, uuid=readable_worksheet_uuids
-        )
-    )
-
-
-def _filter_readable_worksheet_uuids(model, worksheet_uuids):
-    # Returns a set of worksheet uuid's the user has read permission for
+    worksheets = model.get_worksheet_names_and_owner_ids(list(set(worksheet_uuids)))
     worksheet_permissions = model.get_user_worksheet_permissions(
-        request.user.user_id, worksheet_uuids, model.get_worksheet_owner_ids(worksheet_uuids)
+        request.user.user_id,
+        list(worksheets),
+        {uuid: owner_id for uuid, (_, owner_id) in worksheets.items()},
     )
-    return set(
-        uuid
-        for uuid, permission in worksheet_permissions.items()
-        if permission >= GROUP_OBJECT_PERMISSION_READ
+    return dict(
+        (uuid, name)
+        for uuid, (name, _) in worksheets.items()
+        if worksheet_permissions[uuid] >= GROUP_OBJECT_PERMISSION_READ
     )
 
 
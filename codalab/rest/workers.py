@@ -1,6 +1,7 @@
 from __future__ import (
     absolute_import,
 )  # Without this line "from worker.worker import VERSION" doesn't work.
+from collections import Counter
 from contextlib import closing
 import http.client
 import json
@@ -9,6 +10,7 @@ from datetime import datetime
 from bottle import abort, get, local, post, put, request, response
 
 from codalab.lib import spec_util
+from codalab.lib.worker_channel import WorkerChannelUnavailable
 from codalab.objects.permission import check_bundle_have_run_permission
 from codalab.server.authenticated_plugin import AuthenticatedPlugin
 from codalab.worker.bundle_state import BundleCheckinState
@@ -88,18 +90,64 @@ def reply_data(worker_id, socket_id):
 
     The contents of the second message go in the body of the HTTP request.
     """
+    header_message = get_header_message()
+    check_reply_permission(worker_id, socket_id)
+    local.worker_model.send_json_message(socket_id, header_message, 60, autoretry=False)
+    local.worker_model.send_stream(socket_id, request["wsgi.input"], 60)
+
+
+@get("/workers/<worker_id>/channel", name="worker_channel", apply=AuthenticatedPlugin())
+def channel(worker_id):
+    """
+    Opens the channel of the worker: streams the read requests made to the worker, as lines of
+    JSON with a request ID, as soon as they are made. Empty lines are heartbeats. The stream ends
+    after WorkerChannel.STREAM_TIMEOUT seconds, and the worker is expected to open a new one.
+
+    The worker replies to each request with POST /workers/<worker_id>/channel/<request_id>.
+
+    Returns 404 if worker channels aren't enabled on the server, and 503 if the server has too many
+    channels open. The worker is then sent its read requests with its checkins.
+    """
+    if local.worker_channel is None:
+        abort(http.client.NOT_FOUND, "Worker channels are not enabled.")
+    try:
+        requests = local.worker_channel.stream_requests(request.user.user_id, worker_id)
+    except WorkerChannelUnavailable as e:
+        abort(http.client.SERVICE_UNAVAILABLE, str(e))
+    response.content_type = "application/x-ndjson"
+    return requests
+
+
+@post(
+    "/workers/<worker_id>/channel/<request_id:re:[0-9a-f]{32}>",
+    name="worker_channel_reply",
+    apply=AuthenticatedPlugin(),
+)
+def channel_reply(worker_id, request_id):
+    """
+    Replies to the request with the given ID made over the channel of the worker. The header of
+    the reply is parsed from the header_message query parameter, which should be in JSON format.
+    The data of the reply, if any, goes in the body of the HTTP request.
+    """
+    header_message = get_header_message()
+    if local.worker_channel is None or not local.worker_channel.send_reply(
+        request.user.user_id, worker_id, request_id, header_message, request["wsgi.input"]
+    ):
+        abort(http.client.NOT_FOUND, "No request %s waiting for a reply." % request_id)
+
+
+def get_header_message():
+    """
+    Returns the header message of a reply, parsed from the header_message query parameter.
+    """
     if "header_message" not in request.query:
         abort(http.client.BAD_REQUEST, "Missing header message.")
 
     try:
-        header_message = json.loads(request.query.header_message)
+        return json.loads(request.query.header_message)
     except ValueError:
         abort(http.client.BAD_REQUEST, "Header message should be in JSON format.")
 
-    check_reply_permission(worker_id, socket_id)
-    local.worker_model.send_json_message(socket_id, header_message, 60, autoretry=False)
-    local.worker_model.send_stream(socket_id, request["wsgi.input"], 60)
-
 
 def check_run_permission(bundle):
     """
@@ -155,3 +203,39 @@ def workers_info():
         worker["gpus_in_use"] = sum(bundle.metadata.request_gpus for bundle in running_bundles)
 
     return {"data": workers}
+
+
+@get("/workers/images", name="workers_images", apply=AuthenticatedPlugin())
+def workers_images():
+    """
+    Returns the Docker images requested by the staged run bundles, most requested first, so that
+    workers can prefetch them before the bundles get scheduled. Runs that don't request an image
+    are counted towards the default CPU or GPU image.
+
+    Query parameters:
+    - `limit`: maximum number of images to return. Default is 10.
+    """
+    limit = request.query.get('limit', 10, type=int)
+    owner_id = None
+    if request.user.user_id != local.model.root_user_id:
+        # Workers owned by a user only run the bundles of that user.
+        owner_id = request.user.user_id
+
+    workers_config = local.config.get('workers', {})
+    counts = Counter()
+    for run in local.model.get_staged_run_docker_images(owner_id=owner_id):
+        docker_image = run['request_docker_image']
+        if not docker_image:
+            if run['request_gpus'] and int(run['request_gpus']) > 0:
+                docker_image = workers_config.get('default_gpu_image')
+            else:
+                docker_image = workers_config.get('default_cpu_image')
+        if not docker_image:
+            continue
+        if ':' not in docker_image:
+            docker_image += ':latest'
+        counts[docker_image] += 1
+
+    return {
+        "data": [{"image": image, "count": count} for image, count in counts.most_common(limit)]
+    }
@@ -312,11 +312,16 @@ def get_worksheets_landing():
 #############################################################
 
 
-def get_worksheet_info(uuid, fetch_items=False, fetch_permissions=True):
+def get_worksheet_info(
+    uuid, fetch_items=False, fetch_permissions=True, item_offset=0, item_limit=None
+):
     """
     The returned info object contains items which are (bundle_info, subworksheet_info, value_obj, type).
+    When fetching items, only the items in the range given by item_offset and item_limit are
+    fetched, and num_items is the total number of items of the worksheet.
     """
-    worksheet = local.model.get_worksheet(uuid, fetch_items=fetch_items)
+    fetch_item_range = fetch_items and (item_offset > 0 or item_limit is not None)
+    worksheet = local.model.get_worksheet(uuid, fetch_items=fetch_items and not fetch_item_range)
     check_worksheet_has_read_permission(local.model, request.user, worksheet)
     permission = local.model.get_user_worksheet_permissions(
         request.user.user_id, [worksheet.uuid], {worksheet.uuid: worksheet.owner_id}
@@ -325,6 +330,11 @@ def get_worksheet_info(uuid, fetch_items=False, fetch_permissions=True):
     # Create the info by starting out with the metadata.
     result = worksheet.to_dict()
     result['permission'] = permission
+    if fetch_item_range:
+        result['items'] = local.model.get_worksheet_items(uuid, item_offset, item_limit)
+        result['num_items'] = local.model.get_worksheet_item_count(uuid)
+    elif fetch_items:
+        result['num_items'] = len(result['items'])
     is_anonymous = permission < GROUP_OBJECT_PERMISSION_READ or (
         worksheet.is_anonymous and not permission >= GROUP_OBJECT_PERMISSION_ALL
     )
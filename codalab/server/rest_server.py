@@ -64,12 +64,15 @@ class SaveEnvironmentPlugin(object):
             # objects are created after forking.
             local.model = self.manager.model()
             local.worker_model = self.manager.worker_model()
+            local.worker_channel = self.manager.worker_channel()
             local.upload_manager = self.manager.upload_manager()
             local.download_manager = self.manager.download_manager()
             local.bundle_store = self.manager.bundle_store()
             local.config = self.manager.config
             local.emailer = self.manager.emailer
-            return callback(*args, **kwargs)
+            # Memoize the permissions checked while handling the request
+            with local.model.cache_permissions():
+                return callback(*args, **kwargs)
 
         return wrapper
 
@@ -7,6 +7,7 @@ import threading
 import time
 import urllib.request, urllib.parse, urllib.error
 
+from .http_transport import HttpTransport
 from .rest_client import RestClient, RestClientException
 from .file_util import tar_gzip_directory
 from codalab.common import ensure_str
@@ -64,6 +65,10 @@ class BundleServiceClient(RestClient):
     Methods for calling the bundle service.
     """
 
+    # Seconds to wait for data on the channel of the worker before giving up on it. The server
+    # sends a heartbeat every 10 seconds.
+    CHANNEL_READ_TIMEOUT = 20
+
     def __init__(self, base_url, username, password):
         self._username = username
         self._password = password
@@ -74,6 +79,8 @@ class BundleServiceClient(RestClient):
 
         base_url += '/rest'
         super(BundleServiceClient, self).__init__(base_url)
+        # The channel is read with a timeout, so that a lost connection is noticed
+        self._channel_transport = HttpTransport(timeout=self.CHANNEL_READ_TIMEOUT)
         try:
             self._authorize()
         except BundleServiceException as ex:
@@ -97,12 +104,16 @@ class BundleServiceClient(RestClient):
             'Content-Type': 'application/x-www-form-urlencoded',
             'X-Requested-With': 'XMLHttpRequest',
         }
-        request = urllib.request.Request(
-            self._base_url + '/oauth2/token',
-            data=urllib.parse.urlencode(request_data).encode('utf-8'),
+        # Not sent with _make_request, which gets an access token
+        request_url = self._base_url + '/oauth2/token'
+        response = self._transport.request(
+            'POST',
+            request_url,
+            body=urllib.parse.urlencode(request_data).encode('utf-8'),
             headers=headers,
         )
-        with closing(urllib.request.urlopen(request)) as response:
+        self._check_response(request_url, response)
+        with closing(response):
             response_data = response.read().decode()
         try:
             token = json.loads(response_data)
@@ -142,6 +153,34 @@ class BundleServiceClient(RestClient):
         else:
             self._upload_with_chunked_encoding(method, url, query_params, fileobj_or_bytestring)
 
+    @wrap_exception('Unable to open channel with bundle service')
+    def open_channel(self, worker_id):
+        """
+        Returns a file-like object reading the lines of JSON of the read requests made to the
+        worker, and empty lines as heartbeats. Reads raise socket.timeout if no data is received
+        for CHANNEL_READ_TIMEOUT seconds.
+        """
+        return self._make_request(
+            'GET',
+            self._worker_url_prefix(worker_id) + '/channel',
+            return_response=True,
+            transport=self._channel_transport,
+        )
+
+    @wrap_exception('Unable to reply to request from bundle service')
+    def channel_reply(self, worker_id, request_id, header_message, fileobj_or_bytestring=None):
+        method = 'POST'
+        url = self._worker_url_prefix(worker_id) + '/channel/' + request_id
+        query_params = {'header_message': json.dumps(header_message)}
+        if fileobj_or_bytestring is None or isinstance(fileobj_or_bytestring, bytes):
+            self._make_request(
+                method, url, query_params, headers={}, data=fileobj_or_bytestring or b''
+            )
+        elif isinstance(fileobj_or_bytestring, str):
+            raise Exception('Expected bytes, got string')
+        else:
+            self._upload_with_chunked_encoding(method, url, query_params, fileobj_or_bytestring)
+
     @wrap_exception('Unable to start bundle in bundle service')
     def start_bundle(self, worker_id, uuid, request_data):
         return self._make_request(
@@ -159,6 +198,14 @@ class BundleServiceClient(RestClient):
                 progress_callback=progress_callback,
             )
 
+    @wrap_exception('Unable to get popular images from bundle service')
+    def get_popular_images(self, limit):
+        """
+        Returns [{'image': ..., 'count': ...}, ...], the Docker images requested by the most staged
+        run bundles.
+        """
+        return self._make_request('GET', '/workers/images', query_params={'limit': limit})['data']
+
     @wrap_exception('Unable to get worker code')
     def get_code(self):
         return self._make_request(
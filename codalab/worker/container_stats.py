@@ -0,0 +1,288 @@
+"""
+container_stats
+Samples CPU and memory usage of run containers directly from their cgroups.
+
+A single sampler thread serves all the runs of a worker. It keeps the cgroup stat files of each
+tracked container open and re-reads them every SAMPLE_INTERVAL seconds, so that the run state
+machine only has to look up the latest snapshot instead of hitting the filesystem and the Docker
+API on every transition. Both the cgroup v1 (per-controller hierarchies) and the cgroup v2
+(unified hierarchy) layouts are supported.
+"""
+
+from collections import namedtuple
+import logging
+import os
+import threading
+import time
+import traceback
+
+import codalab.worker.docker_utils as docker_utils
+
+logger = logging.getLogger(__name__)
+
+# Latest usage snapshot of a container.
+ContainerStats = namedtuple(
+    'ContainerStats',
+    [
+        'time_user',  # float: CPU seconds spent in user mode
+        'time_system',  # float: CPU seconds spent in kernel mode
+        'memory',  # int: current memory usage in bytes
+        'max_memory',  # int: peak memory usage in bytes
+        'start_time',  # Optional[float]: container start time (seconds since epoch)
+    ],
+)
+
+EMPTY_STATS = ContainerStats(time_user=0, time_system=0, memory=0, max_memory=0, start_time=None)
+
+CGROUP_ROOTS = ['/sys/fs/cgroup', '/cgroup']
+
+# cgroup v1 reports CPU times in USER_HZ, which is 100 on all the platforms Docker supports.
+USER_HZ = 100.0
+
+
+def get_cgroup_root(candidates=CGROUP_ROOTS):
+    """
+    Returns the first existing cgroup mount point among candidates, or None if there is none
+    (e.g. on Mac).
+    """
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_cgroup_v2(cgroup_root):
+    """
+    Returns whether the cgroup mount at cgroup_root is a unified (v2) hierarchy.
+    """
+    return os.path.exists(os.path.join(cgroup_root, 'cgroup.controllers'))
+
+
+def _container_cgroup_dirs(hierarchy_root, container_id):
+    """
+    Returns the possible cgroup directories of a Docker container under hierarchy_root, for both
+    the cgroupfs and the systemd cgroup drivers.
+    """
+    return [
+        os.path.join(hierarchy_root, 'docker', container_id),
+        os.path.join(hierarchy_root, 'system.slice', 'docker-%s.scope' % container_id),
+    ]
+
+
+def _find_file(dirs, filename):
+    for directory in dirs:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _parse_key_values(contents):
+    """
+    Parses the contents of a flat keyed cgroup file ("<key> <value>" per line).
+    """
+    values = {}
+    for line in contents.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            values[parts[0]] = int(parts[1])
+    return values
+
+
+class ContainerCgroup(object):
+    """
+    Keeps the cgroup stat files of a single container open and reads them on demand.
+    Files that don't exist (e.g. memory.peak on kernels older than 5.19) are skipped.
+    """
+
+    def __init__(self, cgroup_root, container_id):
+        self.version = 2 if is_cgroup_v2(cgroup_root) else 1
+        self._fds = {}
+        if self.version == 2:
+            dirs = _container_cgroup_dirs(cgroup_root, container_id)
+            paths = {
+                'cpu': _find_file(dirs, 'cpu.stat'),
+                'memory': _find_file(dirs, 'memory.current'),
+                'max_memory': _find_file(dirs, 'memory.peak'),
+            }
+        else:
+            cpu_dirs = _container_cgroup_dirs(os.path.join(cgroup_root, 'cpuacct'), container_id)
+            memory_dirs = _container_cgroup_dirs(os.path.join(cgroup_root, 'memory'), container_id)
+            paths = {
+                'cpu': _find_file(cpu_dirs, 'cpuacct.stat'),
+                'memory': _find_file(memory_dirs, 'memory.usage_in_bytes'),
+                'max_memory': _find_file(memory_dirs, 'memory.max_usage_in_bytes'),
+            }
+        for key, path in paths.items():
+            if path is None:
+                continue
+            try:
+                self._fds[key] = os.open(path, os.O_RDONLY)
+            except OSError:
+                logger.debug('Cannot open cgroup file %s', path)
+
+    @property
+    def found(self):
+        """True if at least one stat file of the container could be opened."""
+        return bool(self._fds)
+
+    def _read(self, key):
+        fd = self._fds.get(key)
+        if fd is None:
+            return None
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 4096).decode()
+
+    def read(self):
+        """
+        Returns a dict with the current 'time_user', 'time_system', 'memory' and 'max_memory'
+        values of the container. Values that cannot be read are left out.
+        """
+        stats = {}
+        cpu = self._read('cpu')
+        if cpu is not None:
+            values = _parse_key_values(cpu)
+            if self.version == 2:
+                if 'user_usec' in values:
+                    stats['time_user'] = values['user_usec'] / 1e6
+                if 'system_usec' in values:
+                    stats['time_system'] = values['system_usec'] / 1e6
+            else:
+                if 'user' in values:
+                    stats['time_user'] = values['user'] / USER_HZ
+                if 'system' in values:
+                    stats['time_system'] = values['system'] / USER_HZ
+        for key in ('memory', 'max_memory'):
+            value = self._read(key)
+            if value is not None and value.strip().isdigit():
+                stats[key] = int(value)
+        return stats
+
+    def close(self):
+        for fd in self._fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._fds = {}
+
+
+class ContainerStatsSampler(object):
+    """
+    Samples the cgroup stats of all tracked containers on a background thread and keeps
+    the peak memory usage observed between reads.
+
+    Usage:
+        sampler.track(uuid, container)   # idempotent, call on every transition
+        stats = sampler.get(uuid)        # cheap, returns the latest ContainerStats
+        sampler.untrack(uuid)            # when the container is gone
+    """
+
+    # Number of seconds between two samples of the same container
+    SAMPLE_INTERVAL = 0.5
+
+    def __init__(self, cgroup_root=None, sample_interval=SAMPLE_INTERVAL):
+        self._cgroup_root = cgroup_root or get_cgroup_root()
+        self._sample_interval = sample_interval
+        # uuid -> {'container': Container, 'cgroup': Optional[ContainerCgroup], 'stats': ContainerStats}
+        self._tracked = {}
+        self._lock = threading.RLock()
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        logger.info('Starting container stats sampler')
+
+        def loop(self):
+            while not self._stop:
+                try:
+                    self.sample()
+                except Exception:
+                    traceback.print_exc()
+                time.sleep(self._sample_interval)
+
+        self._thread = threading.Thread(target=loop, args=[self])
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        logger.info('Stopping container stats sampler')
+        self._stop = True
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            for entry in self._tracked.values():
+                if entry['cgroup']:
+                    entry['cgroup'].close()
+            self._tracked = {}
+        logger.info('Stopped container stats sampler')
+
+    def track(self, uuid, container):
+        """
+        Starts sampling the given container for the run with uuid, if not already doing so.
+        """
+        with self._lock:
+            entry = self._tracked.get(uuid)
+            if entry is not None and entry['container'].id == container.id:
+                return
+            if entry is not None and entry['cgroup']:
+                entry['cgroup'].close()
+            self._tracked[uuid] = {'container': container, 'cgroup': None, 'stats': EMPTY_STATS}
+
+    def untrack(self, uuid):
+        """
+        Stops sampling the container of the run with uuid and closes its cgroup files.
+        """
+        with self._lock:
+            entry = self._tracked.pop(uuid, None)
+        if entry is not None and entry['cgroup']:
+            entry['cgroup'].close()
+
+    def get(self, uuid):
+        """
+        Returns the latest ContainerStats of the run with uuid (EMPTY_STATS if not sampled yet).
+        """
+        with self._lock:
+            entry = self._tracked.get(uuid)
+            return entry['stats'] if entry is not None else EMPTY_STATS
+
+    def sample(self):
+        """
+        Reads the current stats of every tracked container and updates their snapshots.
+        """
+        with self._lock:
+            entries = list(self._tracked.items())
+        for uuid, entry in entries:
+            stats = entry['stats']
+            if stats.start_time is None:
+                try:
+                    stats = stats._replace(
+                        start_time=docker_utils.get_container_start_time(entry['container'])
+                    )
+                except docker_utils.DockerException as e:
+                    logger.debug('Cannot get start time of container for run %s: %s', uuid, e)
+            if entry['cgroup'] is None and self._cgroup_root is not None:
+                # The cgroup of a container may show up shortly after the container is started,
+                # so keep trying until its files are found.
+                cgroup = ContainerCgroup(self._cgroup_root, entry['container'].id)
+                with self._lock:
+                    if cgroup.found and self._tracked.get(uuid) is entry:
+                        entry['cgroup'] = cgroup
+                    else:
+                        cgroup.close()
+            if entry['cgroup'] is not None:
+                try:
+                    values = entry['cgroup'].read()
+                except OSError:
+                    # The container is gone, keep the last values around until untracked.
+                    values = {}
+                memory = values.get('memory', stats.memory)
+                stats = stats._replace(
+                    time_user=values.get('time_user', stats.time_user),
+                    time_system=values.get('time_system', stats.time_system),
+                    memory=memory,
+                    max_memory=max(stats.max_memory, memory, values.get('max_memory', 0)),
+                )
+            with self._lock:
+                if self._tracked.get(uuid) is entry:
+                    entry['stats'] = stats
@@ -0,0 +1,337 @@
+"""
+disk_usage
+Keeps track of the disk usage of the bundle directories of all the runs of a worker.
+
+Rather than walking every bundle directory in a loop, a single tracker thread maintains the size
+of every entry of each tracked directory. The directory is walked once when it starts being
+tracked, and from then on only the paths reported as changed by filesystem notifications
+(inotify on Linux, through watchdog) are re-examined. If notifications cannot be set up for a
+directory (e.g. watchdog is not installed or the inotify watch limit is reached), the tracker
+falls back to periodically walking that directory, spending at most ~10% of its time doing so.
+
+Notifications can be lost: watchdog silently drops the event inotify sends when its queue
+overflows. So watched directories are walked again after any burst of changes large enough to
+overflow the queue, and every RECONCILE_INTERVAL seconds in any case, to correct any drift.
+"""
+
+from collections import namedtuple
+import logging
+import os
+import threading
+import time
+import traceback
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+logger = logging.getLogger(__name__)
+
+
+def _get_max_queued_events():
+    """
+    Returns the number of events an inotify queue holds before overflowing.
+    """
+    try:
+        with open('/proc/sys/fs/inotify/max_queued_events') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 16384
+
+
+# Disk usage of a run: bytes used by its bundle directory and whether its disk limit is exceeded
+DiskUsage = namedtuple('DiskUsage', ['disk_utilization', 'limit_exceeded'])
+
+EMPTY_USAGE = DiskUsage(disk_utilization=0, limit_exceeded=False)
+
+
+class _DirtyPathHandler(FileSystemEventHandler):
+    """
+    Records the paths reported by filesystem notifications for a tracked directory.
+    """
+
+    def __init__(self, tracked_dir):
+        self._tracked_dir = tracked_dir
+
+    def on_any_event(self, event):
+        self._tracked_dir.mark_dirty(event.src_path)
+        dest_path = getattr(event, 'dest_path', None)
+        if dest_path:
+            self._tracked_dir.mark_dirty(dest_path)
+
+
+class TrackedDirectory(object):
+    """
+    Size accounting for a single directory tree. Sizes are computed like
+    file_util.get_path_size: the lstat size of every entry, without following symlinks.
+    """
+
+    # Number of changed paths after which the tree is walked again rather than updated, since
+    # notifications might have been lost to an overflow of the inotify queue
+    MAX_DIRTY_PATHS = _get_max_queued_events()
+
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = limit
+        self.total = 0
+        # Total as of the end of the last walk or update, so partial results are never reported
+        self.reported_total = 0
+        # path -> size of every entry in the tree
+        self._sizes = {}
+        # path of every directory in the tree -> paths of its children, used to drop whole
+        # subtrees on removal
+        self._children = {}
+        self._dirty = set()
+        self._needs_walk = False
+        self._dirty_lock = threading.Lock()
+        self.watch = None
+        self.next_walk_time = 0
+
+    @property
+    def usage(self):
+        return DiskUsage(
+            disk_utilization=self.reported_total,
+            limit_exceeded=bool(self.limit) and self.reported_total > self.limit,
+        )
+
+    def mark_dirty(self, path):
+        with self._dirty_lock:
+            if self._needs_walk:
+                return
+            self._dirty.add(path)
+            if len(self._dirty) > self.MAX_DIRTY_PATHS:
+                self._needs_walk = True
+                self._dirty = set()
+
+    @property
+    def needs_walk(self):
+        """
+        Whether so many paths changed since the last update that the tree must be walked again.
+        """
+        with self._dirty_lock:
+            return self._needs_walk
+
+    def walk(self):
+        """
+        Recomputes the sizes of all the entries in the tree from scratch.
+        """
+        self._sizes = {}
+        self._children = {}
+        self.total = 0
+        with self._dirty_lock:
+            self._dirty = set()
+            self._needs_walk = False
+        self._add_tree(self.path)
+        self.reported_total = self.total
+
+    def update(self):
+        """
+        Re-examines the paths that changed since the last update.
+        """
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        for path in sorted(dirty):
+            self._update_path(path)
+        self.reported_total = self.total
+
+    def _set_size(self, path, size):
+        self.total += size - self._sizes.get(path, 0)
+        self._sizes[path] = size
+
+    def _add_tree(self, path):
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            return
+        self._set_size(path, stat.st_size)
+        parent_children = self._children.get(os.path.dirname(path))
+        if parent_children is not None:
+            parent_children.add(path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            self._children[path] = set()
+            try:
+                children = os.listdir(path)
+            except OSError:
+                return
+            for child in children:
+                self._add_tree(os.path.join(path, child))
+
+    def _remove_tree(self, path):
+        self.total -= self._sizes.pop(path, 0)
+        parent_children = self._children.get(os.path.dirname(path))
+        if parent_children is not None:
+            parent_children.discard(path)
+        for child in self._children.pop(path, ()):
+            self._remove_tree(child)
+
+    def _update_path(self, path):
+        if path != self.path and not path.startswith(self.path + os.sep):
+            return
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            self._remove_tree(path)
+            return
+        if path in self._sizes and (path in self._children) == os.path.isdir(path):
+            self._set_size(path, stat.st_size)
+        else:
+            # New entry (or an entry replaced by one of another type): account for its whole tree,
+            # since a directory moved into the tree doesn't report events for its contents.
+            self._remove_tree(path)
+            self._add_tree(path)
+
+
+class DiskUsageTracker(object):
+    """
+    Tracks the disk usage of the bundle directories of all runs on a single thread.
+
+    Usage:
+        tracker.track(uuid, bundle_path, disk_limit)  # idempotent, call on every transition
+        usage = tracker.get(uuid)                     # cheap, returns the latest DiskUsage
+        tracker.untrack(uuid)                         # when the run is done
+    """
+
+    # Number of seconds between two updates of the tracked directories
+    UPDATE_INTERVAL = 1.0
+    # Number of seconds between two walks of a watched directory, which correct the sizes of the
+    # entries whose notifications were lost
+    RECONCILE_INTERVAL = 10 * 60
+
+    def __init__(self, use_notifications=True, update_interval=UPDATE_INTERVAL):
+        self._update_interval = update_interval
+        self._observer = None
+        if use_notifications and Observer is not None:
+            self._observer = Observer()
+            self._observer.daemon = True
+        # uuid -> TrackedDirectory
+        self._tracked = {}
+        self._lock = threading.RLock()
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        logger.info('Starting disk usage tracker')
+        if self._observer is not None:
+            self._observer.start()
+
+        def loop(self):
+            while not self._stop:
+                try:
+                    self.update()
+                except Exception:
+                    traceback.print_exc()
+                time.sleep(self._update_interval)
+
+        self._thread = threading.Thread(target=loop, args=[self])
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        logger.info('Stopping disk usage tracker')
+        self._stop = True
+        if self._thread:
+            self._thread.join()
+        if self._observer is not None and self._observer.is_alive():
+            self._observer.stop()
+            self._observer.join()
+        logger.info('Stopped disk usage tracker')
+
+    def track(self, uuid, path, limit=None):
+        """
+        Starts tracking the disk usage of path for the run with uuid, if not already doing so.
+        The initial walk of the directory happens on the tracker thread.
+        """
+        with self._lock:
+            if uuid in self._tracked and self._tracked[uuid].path == path:
+                self._tracked[uuid].limit = limit
+                return
+            self._untrack(uuid)
+            self._tracked[uuid] = TrackedDirectory(path, limit)
+
+    def untrack(self, uuid):
+        with self._lock:
+            self._untrack(uuid)
+
+    def _untrack(self, uuid):
+        tracked_dir = self._tracked.pop(uuid, None)
+        if tracked_dir is not None:
+            self._unwatch(tracked_dir)
+
+    def get(self, uuid):
+        """
+        Returns the latest DiskUsage of the run with uuid (EMPTY_USAGE if not computed yet).
+        """
+        with self._lock:
+            tracked_dir = self._tracked.get(uuid)
+            return tracked_dir.usage if tracked_dir is not None else EMPTY_USAGE
+
+    def _watch(self, tracked_dir):
+        """
+        Sets up filesystem notifications for tracked_dir. Returns whether it succeeded.
+        """
+        if self._observer is None:
+            return False
+        try:
+            tracked_dir.watch = self._observer.schedule(
+                _DirtyPathHandler(tracked_dir), tracked_dir.path, recursive=True
+            )
+            return True
+        except Exception as e:
+            logger.warning(
+                'Cannot watch %s for changes, falling back to walking it: %s', tracked_dir.path, e
+            )
+            return False
+
+    def _unwatch(self, tracked_dir):
+        if tracked_dir.watch is None:
+            return
+        try:
+            self._observer.unschedule(tracked_dir.watch)
+        except Exception:
+            logger.debug('Cannot unschedule watch for %s', tracked_dir.path)
+        tracked_dir.watch = None
+
+    def update(self):
+        """
+        Brings the disk usage of every tracked directory up to date.
+        """
+        with self._lock:
+            tracked_dirs = list(self._tracked.items())
+        # Walks and updates happen without holding the lock, so that reading the latest usage
+        # never waits on the filesystem.
+        for uuid, tracked_dir in tracked_dirs:
+            now = time.time()
+            if tracked_dir.watch is not None:
+                if now < tracked_dir.next_walk_time and not tracked_dir.needs_walk:
+                    tracked_dir.update()
+                    continue
+                # Notifications keep being recorded during the walk, so none is missed
+                tracked_dir.walk()
+                tracked_dir.next_walk_time = self._get_next_walk_time(now, self.RECONCILE_INTERVAL)
+                continue
+            if now < tracked_dir.next_walk_time:
+                continue
+            # Watch before walking so that no change made during the walk is missed
+            watched = os.path.isdir(tracked_dir.path) and self._watch(tracked_dir)
+            with self._lock:
+                if self._tracked.get(uuid) is not tracked_dir:
+                    # Untracked in the meantime, don't leak the watch
+                    self._unwatch(tracked_dir)
+                    continue
+            tracked_dir.walk()
+            tracked_dir.next_walk_time = self._get_next_walk_time(
+                now, self.RECONCILE_INTERVAL if watched else 1.0
+            )
+
+    @staticmethod
+    def _get_next_walk_time(start_time, min_interval):
+        """
+        Returns when to walk again a directory whose walk started at start_time.
+        """
+        # To ensure that we don't hammer the disk for this computation when
+        # there are lots of files, we run it at most 10% of the time.
+        now = time.time()
+        return now + max((now - start_time) * 10, min_interval)
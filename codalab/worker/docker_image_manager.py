@@ -1,4 +1,6 @@
-from collections import namedtuple
+from collections import Counter, namedtuple
+import hashlib
+import os
 import threading
 import time
 import traceback
@@ -24,16 +26,46 @@ ImageCacheEntry = namedtuple(
 )
 
 
+def get_chain_ids(diff_ids):
+    """
+    Returns the chain IDs of the layers of an image given the diff IDs of its layers (the
+    RootFS.Layers field of the image), following the OCI image spec. The chain ID of a layer
+    identifies it together with all the layers below it, and is the key of the layer in Docker's
+    layer database.
+    """
+    chain_ids = []
+    for diff_id in diff_ids:
+        if chain_ids:
+            diff_id = (
+                'sha256:' + hashlib.sha256((chain_ids[-1] + ' ' + diff_id).encode()).hexdigest()
+            )
+        chain_ids.append(diff_id)
+    return chain_ids
+
+
 class DockerImageManager:
 
     CACHE_TAG = 'codalab-image-cache/last-used'
 
-    def __init__(self, commit_file, max_image_cache_size, max_image_size):
+    # Number of seconds between two prefetches of the popular images
+    PREFETCH_INTERVAL = 60
+
+    def __init__(
+        self,
+        commit_file,
+        max_image_cache_size,
+        max_image_size,
+        bundle_service=None,
+        prefetch_images=0,
+    ):
         """
         Initializes a DockerImageManager
         :param commit_file: String path to where the state file should be committed
         :param max_image_cache_size: Total size in bytes that the image cache can use
         :param max_image_size: Total size in bytes that the image can have
+        :param bundle_service: BundleServiceClient used to get the images to prefetch
+        :param prefetch_images: Number of the images most requested by staged bundles to prefetch
+            (0 to disable prefetching)
         """
         self._state_committer = JsonStateCommitter(commit_file)  # type: JsonStateCommitter
         self._docker = docker.from_env()  # type: DockerClient
@@ -43,9 +75,18 @@ class DockerImageManager:
         self._max_image_cache_size = max_image_cache_size
         self._max_image_size = max_image_size
 
+        self._bundle_service = bundle_service
+        self._prefetch_images = prefetch_images
+        # Images that couldn't be prefetched, not retried until the worker restarts
+        self._prefetch_failures = set()
+        # Chain ID -> size in bytes of the layers seen so far
+        self._layer_sizes = {}
+        self._layerdb_dir = None
+
         self._stop = False
         self._sleep_secs = 10
         self._cleanup_thread = None
+        self._prefetch_thread = None
 
     def start(self):
         logger.info("Starting docker image manager")
@@ -63,6 +104,23 @@ class DockerImageManager:
             self._cleanup_thread = threading.Thread(target=cleanup_loop, args=[self])
             self._cleanup_thread.start()
 
+        if self._bundle_service and self._prefetch_images:
+
+            def prefetch_loop(self):
+                while not self._stop:
+                    try:
+                        self._prefetch()
+                    except Exception:
+                        traceback.print_exc()
+                    # Sleep in short increments so that stopping isn't delayed
+                    for _ in range(self.PREFETCH_INTERVAL):
+                        if self._stop:
+                            break
+                        time.sleep(1)
+
+            self._prefetch_thread = threading.Thread(target=prefetch_loop, args=[self])
+            self._prefetch_thread.start()
+
     def stop(self):
         logger.info("Stopping docker image manager")
         self._stop = True
@@ -71,27 +129,78 @@ class DockerImageManager:
         if self._cleanup_thread:
             logger.debug("Stopping docker image manager: stop the cleanup thread")
             self._cleanup_thread.join()
+        if self._prefetch_thread:
+            logger.debug("Stopping docker image manager: stop the prefetch thread")
+            self._prefetch_thread.join()
         logger.info("Stopped docker image manager")
 
+    def _get_layer_size(self, chain_id):
+        """
+        Returns the size in bytes of the layer with the given chain ID, read from Docker's layer
+        database, or None if it cannot be read (e.g. the worker doesn't have access to the Docker
+        root directory, or the storage driver doesn't keep a layer database).
+        """
+        if chain_id in self._layer_sizes:
+            return self._layer_sizes[chain_id]
+        if self._layerdb_dir is None:
+            try:
+                info = self._docker.info()
+                self._layerdb_dir = os.path.join(
+                    info['DockerRootDir'], 'image', info['Driver'], 'layerdb', 'sha256'
+                )
+            except Exception as e:
+                logger.debug('Cannot find the Docker layer database: %s', e)
+                return None
+        try:
+            with open(os.path.join(self._layerdb_dir, chain_id.split(':')[-1], 'size')) as f:
+                size = int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+        # Layers are immutable, so their sizes can be cached forever
+        self._layer_sizes[chain_id] = size
+        return size
+
+    def _get_image_layers(self, image):
+        """
+        Returns a dict mapping the ID of each layer of the image to its size in bytes.
+        If the layer sizes are not available, the whole image is accounted for as a single layer
+        of size VirtualSize, which overcounts the layers shared between images.
+        """
+        layers = {}
+        for chain_id in get_chain_ids(image.attrs.get('RootFS', {}).get('Layers') or []):
+            size = self._get_layer_size(chain_id)
+            if size is None:
+                return {image.id: float(image.attrs['VirtualSize'])}
+            layers[chain_id] = size
+        return layers
+
+    def _get_cache_usage(self):
+        """
+        Returns the cached images, a dict mapping the ID of each of them to its layers (as returned
+        by _get_image_layers) and the total size of the union of their layers, i.e. the disk space
+        that the image cache actually uses.
+        """
+        images = self._docker.images.list(self.CACHE_TAG)
+        image_layers = {image.id: self._get_image_layers(image) for image in images}
+        layer_sizes = {}
+        for layers in image_layers.values():
+            layer_sizes.update(layers)
+        return images, image_layers, sum(layer_sizes.values())
+
     def _get_cache_use(self):
-        return sum(
-            float(image.attrs['VirtualSize']) for image in self._docker.images.list(self.CACHE_TAG)
-        )
+        return self._get_cache_usage()[2]
 
     def _cleanup(self):
         """
         Prunes the image cache for runs.
         1. Only care about images we (this DockerImageManager) downloaded and know about.
-        2. We also try to prune any dangling docker images on the system.
-        3. We use sum of VirtualSize's, which is an upper bound on the disk use of our images:
-            in case no images share any intermediate layers, this will be the real disk use,
-            however if images share layers, the virtual size will count that layer's size for each
-            image that uses it, even though it's stored only once in the disk. The 'Size' field
-            accounts for the marginal size each image adds on top of the shared layers, but summing
-            those is not accurate either since the shared base layers need to be counted once to get
-            the total size. (i.e. summing marginal sizes would give us a lower bound on the total disk
-            use of images). Calling df gives us an accurate disk use of ALL the images on the machine
-            but because of (1) we don't want to use that.
+        2. The disk use of the cache is the total size of the union of the layers of our images,
+           so layers shared between images are only counted once.
+        3. Images are removed in LRU order, skipping the ones that wouldn't free any layer since all
+           their layers are shared with other cached images. The cache use is then decremented by the
+           size of the layers that are no longer used by any cached image, without listing the
+           images again. Layers shared with images outside of the cache are not freed by Docker, so
+           this can overestimate the space reclaimed by a removal; the next cleanup corrects for it.
         """
         # Sort the image cache in LRU order
         def last_used(image):
@@ -99,48 +208,91 @@ class DockerImageManager:
                 if tag.split(":")[0] == self.CACHE_TAG:
                     return float(tag.split(":")[1])
 
-        cache_use = self._get_cache_use()
-        if cache_use > self._max_image_cache_size:
+        all_images, image_layers, cache_use = self._get_cache_usage()
+        if cache_use <= self._max_image_cache_size:
+            return
+        logger.info(
+            'Disk use (%s) > max cache size (%s): starting image pruning',
+            cache_use,
+            self._max_image_cache_size,
+        )
+        # Number of cached images using each layer
+        layer_refs = Counter(layer for layers in image_layers.values() for layer in layers)
+
+        def freed_bytes(image):
+            return sum(
+                size for layer, size in image_layers[image.id].items() if layer_refs[layer] == 1
+            )
+
+        candidates = sorted(all_images, key=last_used)
+        logger.info("Cached docker images: {}".format(candidates))
+        while cache_use > self._max_image_cache_size and candidates:
+            image = next((image for image in candidates if freed_bytes(image) > 0), candidates[0])
+            candidates.remove(image)
+            image_tag = (
+                image.attrs['RepoTags'][-1] if len(image.attrs['RepoTags']) > 0 else '<none>'
+            )
             logger.info(
-                'Disk use (%s) > max cache size (%s): starting image pruning',
+                'Disk use (%s) > max cache size (%s), pruning image: %s (frees %s)',
                 cache_use,
                 self._max_image_cache_size,
+                image_tag,
+                size_str(freed_bytes(image)),
             )
-            all_images = self._docker.images.list(self.CACHE_TAG)
-            all_images_sorted = sorted(all_images, key=last_used)
-            logger.info("Cached docker images: {}".format(all_images_sorted))
-            for image in all_images_sorted:
-                # We re-list all the images to get an updated total size since we may have deleted some
-                cache_use = self._get_cache_use()
-                if cache_use > self._max_image_cache_size:
-                    image_tag = (
-                        image.attrs['RepoTags'][-1]
-                        if len(image.attrs['RepoTags']) > 0
-                        else '<none>'
-                    )
-                    logger.info(
-                        'Disk use (%s) > max cache size (%s), pruning image: %s',
-                        cache_use,
-                        self._max_image_cache_size,
-                        image_tag,
-                    )
-                    try:
-                        self._docker.images.remove(image.id, force=True)
-                    except docker.errors.APIError as err:
-                        # Two types of 409 Client Error can be thrown here:
-                        # 1. 409 Client Error: Conflict ("conflict: unable to delete <image_id> (cannot be forced)")
-                        #   This happens when an image either has a running container or has multiple child dependents.
-                        # 2. 409 Client Error: Conflict ("conflict: unable to delete <image_id> (must be forced)")
-                        #   This happens when an image is referenced in multiple repositories.
-                        # We can only remove images in 2rd case using force=True, but not the 1st case. So after we
-                        # try to remove the image using force=True, if it failed, then this indicates that we were
-                        # trying to remove images in 1st case. Since we can't do much for images in 1st case, we
-                        # just continue with our lives, hoping it will get deleted once it's no longer in use and
-                        # the cache becomes full again
-                        logger.error(
-                            "Cannot forcibly remove image %s from cache: %s", image_tag, err
-                        )
-            logger.debug("Stopping docker image manager cleanup")
+            try:
+                self._docker.images.remove(image.id, force=True)
+            except docker.errors.APIError as err:
+                # Two types of 409 Client Error can be thrown here:
+                # 1. 409 Client Error: Conflict ("conflict: unable to delete <image_id> (cannot be forced)")
+                #   This happens when an image either has a running container or has multiple child dependents.
+                # 2. 409 Client Error: Conflict ("conflict: unable to delete <image_id> (must be forced)")
+                #   This happens when an image is referenced in multiple repositories.
+                # We can only remove images in 2rd case using force=True, but not the 1st case. So after we
+                # try to remove the image using force=True, if it failed, then this indicates that we were
+                # trying to remove images in 1st case. Since we can't do much for images in 1st case, we
+                # just continue with our lives, hoping it will get deleted once it's no longer in use and
+                # the cache becomes full again
+                logger.error("Cannot forcibly remove image %s from cache: %s", image_tag, err)
+                continue
+            for layer, size in image_layers[image.id].items():
+                layer_refs[layer] -= 1
+                if layer_refs[layer] == 0:
+                    cache_use -= size
+        logger.debug("Stopping docker image manager cleanup")
+
+    def _prefetch(self):
+        """
+        Pulls the Docker images requested by the most staged bundles ahead of time, as long as the
+        image cache has room for them, so that runs don't have to wait for them while preparing.
+        """
+        for entry in self._bundle_service.get_popular_images(self._prefetch_images):
+            if self._stop:
+                return
+            image_spec = entry['image']
+            if image_spec in self._prefetch_failures:
+                continue
+            if image_spec not in self._downloading:
+                try:
+                    self._docker.images.get(image_spec)
+                    continue
+                except docker.errors.ImageNotFound:
+                    pass
+                if (
+                    self._max_image_cache_size
+                    and self._get_cache_use() >= self._max_image_cache_size
+                ):
+                    return
+                logger.info(
+                    'Prefetching Docker image %s, requested by %d staged bundles',
+                    image_spec,
+                    entry['count'],
+                )
+            # Also called for images being downloaded, so that they get tagged for the image cache
+            # once the download is over.
+            state = self.get(image_spec)
+            if state.stage == DependencyStage.FAILED:
+                logger.info('Cannot prefetch Docker image %s: %s', image_spec, state.message)
+                self._prefetch_failures.add(image_spec)
 
     def get(self, image_spec):
         """
@@ -9,8 +9,7 @@ created if not.
 import logging
 import os
 import docker
-from dateutil import parser, tz
-import datetime
+from dateutil import parser
 import re
 import requests
 
@@ -19,7 +18,6 @@ MIN_API_VERSION = '1.17'
 NVIDIA_RUNTIME = 'nvidia'
 DEFAULT_RUNTIME = 'runc'
 DEFAULT_TIMEOUT = 720
-DEFAULT_CONTAINER_RUNNING_TIME = 0
 # Docker Registry HTTP API v2 URI prefix
 URI_PREFIX = 'https://hub.docker.com/v2/repositories/'
 
@@ -201,45 +199,6 @@ def get_bundle_container_volume_binds(bundle_path, docker_bundle_path, dependenc
     return binds
 
 
-@wrap_exception("Can't get container stats")
-def get_container_stats(container):
-    # We don't use the stats API since it doesn't seem to be reliable, and
-    # is definitely slow. This doesn't work on Mac.
-    cgroup = None
-    for path in ['/sys/fs/cgroup', '/cgroup']:
-        if os.path.exists(path):
-            cgroup = path
-            break
-    if cgroup is None:
-        return {}
-
-    stats = {}
-
-    # Get CPU usage
-    try:
-        cpu_path = os.path.join(cgroup, 'cpuacct/docker', container.id, 'cpuacct.stat')
-        with open(cpu_path) as f:
-            for line in f:
-                key, value = line.split(' ')
-                # Convert jiffies to seconds
-                if key == 'user':
-                    stats['time_user'] = int(value) / 100.0
-                elif key == 'system':
-                    stats['time_system'] = int(value) / 100.0
-    except Exception:
-        pass
-
-    # Get memory usage
-    try:
-        memory_path = os.path.join(cgroup, 'memory/docker', container.id, 'memory.usage_in_bytes')
-        with open(memory_path) as f:
-            stats['memory'] = int(f.read())
-    except Exception:
-        pass
-
-    return stats
-
-
 @wrap_exception('Unable to check Docker API for container')
 def container_exists(container):
     try:
@@ -274,29 +233,30 @@ def check_finished(container):
     return (False, None, None)
 
 
-@wrap_exception('Unable to check Docker container running time')
-def get_container_running_time(container):
-    # This usually happens when container gets accidentally removed or deleted
+@wrap_exception('Unable to check Docker container start time')
+def get_container_start_time(container):
+    """
+    Returns the time the container was started at, in seconds since the epoch.
+    """
+    container = client.containers.get(container.id)
+    # Docker reports the start time in ISO format. We currently use dateutil.parser.isoparse to
+    # parse it. In Python3.7 or above, the built-in function datetime.fromisoformat() can be used to
+    # parse ISO formatted datetime string directly.
+    return parser.isoparse(container.attrs['State']['StartedAt']).timestamp()
+
+
+@wrap_exception('Unable to check Docker container finish time')
+def get_container_finish_time(container):
+    """
+    Returns the time the container exited at, in seconds since the epoch, or None if the container
+    hasn't exited (or doesn't exist).
+    """
     if container is None:
-        return DEFAULT_CONTAINER_RUNNING_TIME
-    # Get the current container
+        return None
     container = client.containers.get(container.id)
-    # Load this container from the server again and update attributes with the new data.
-    container.reload()
-    # Calculate the start_time of the current container
-    start_time = container.attrs['State']['StartedAt']
-    # Calculate the end_time of the current container. If 'Status' of the current container is not 'exited',
-    # then using the current time as end_time
-    end_time = (
-        container.attrs['State']['FinishedAt']
-        if container.attrs['State']['Status'] == 'exited'
-        else str(datetime.datetime.now(tz.tzutc()))
-    )
-    # Docker reports both the start_time and the end_time in ISO format. We currently use dateutil.parser.isoparse to
-    # parse them. In Python3.7 or above, the built-in function datetime.fromisoformat() can be used to parse ISO
-    # formatted datetime string directly.
-    container_running_time = parser.isoparse(end_time) - parser.isoparse(start_time)
-    return container_running_time.total_seconds()
+    if container.attrs['State']['Status'] != 'exited':
+        return None
+    return parser.isoparse(container.attrs['State']['FinishedAt']).timestamp()
 
 
 @wrap_exception('Unable to get image size without pulling from Docker Hub')
@@ -1,6 +1,7 @@
 from contextlib import closing
 from io import BytesIO
 import gzip
+import mmap
 import os
 import shutil
 import subprocess
@@ -34,6 +35,21 @@ def tar_gzip_directory(
     Returns a file-like object containing a tarred and gzipped archive of the
     given directory.
 
+    See open_tar_gzip_directory for the arguments.
+    """
+    return open_tar_gzip_directory(
+        directory_path, follow_symlinks, exclude_patterns, exclude_names, ignore_file
+    ).stdout
+
+
+def open_tar_gzip_directory(
+    directory_path, follow_symlinks=False, exclude_patterns=[], exclude_names=[], ignore_file=None
+):
+    """
+    Returns the process writing a tarred and gzipped archive of the given
+    directory to its stdout. The archive is complete if the process exits
+    with status 0.
+
     follow_symlinks: Whether symbolic links should be followed.
     exclude_names: Any top-level directory entries with names in exclude_names
                    are not included.
@@ -67,8 +83,7 @@ def tar_gzip_directory(
     args.append('.')
 
     try:
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-        return proc.stdout
+        return subprocess.Popen(args, stdout=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
         raise IOError(e.output)
 
@@ -211,6 +226,19 @@ def read_file_section(file_path, offset, length):
         return fileobj.read(length)
 
 
+def read_file_sections(file_path, sections):
+    """
+    Reads the given (offset, length) sections of the given file.
+    The file is mapped in memory, so that only the pages of the sections are read.
+    Return a list of bytes.
+    """
+    with open(file_path, 'rb') as fileobj:
+        if os.fstat(fileobj.fileno()).st_size == 0:
+            return [b''] * len(sections)
+        with closing(mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)) as mapped:
+            return [mapped[offset : offset + length] for offset, length in sections]
+
+
 def summarize_file(file_path, num_head_lines, num_tail_lines, max_line_length, truncation_text):
     """
     Summarizes the file at the given path, returning a string containing the
@@ -0,0 +1,294 @@
+"""
+HttpTransport sends HTTP requests over pools of persistent (keep-alive) connections, one pool per
+host, so that successive requests to the same server don't each pay for a TCP (and TLS) handshake.
+A transport is shared by all the threads of a client: connections are taken out of their pool for
+the duration of a request, and put back once its response has been read.
+
+Like urllib.request.urlopen, requests go through the proxies configured by the http_proxy,
+https_proxy and no_proxy environment variables (or the system settings): HTTPS requests through a
+CONNECT tunnel, and HTTP requests by sending the full URL to the proxy.
+"""
+import base64
+import http.client
+import logging
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+
+class HttpTransport(object):
+    """
+    Thread-safe HTTP client with per-host pools of keep-alive connections and retries with
+    exponential backoff.
+    """
+
+    # Methods of the requests that are sent again if their response wasn't received
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+    # Statuses of the responses to idempotent requests that are retried
+    RETRY_STATUSES = frozenset([502, 503, 504])
+    REDIRECT_STATUSES = frozenset([301, 302, 303, 307, 308])
+    MAX_REDIRECTS = 5
+    # Errors of requests sent over a connection that the server closed while it was idle
+    STALE_CONNECTION_ERRORS = (ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+    def __init__(
+        self, max_idle_connections_per_host=8, max_retries=3, backoff_factor=0.5, timeout=None
+    ):
+        """
+        :param max_idle_connections_per_host: number of connections kept open per host between
+            requests. Threads that send requests concurrently to the same host open additional
+            connections, which are closed after their request if the pool is full.
+        :param max_retries: number of times requests are retried on connection errors and on
+            502, 503 and 504 responses to idempotent requests.
+        :param backoff_factor: the n-th retry is sent after backoff_factor * 2 ** (n - 1) seconds.
+        :param timeout: timeout of blocking socket operations, in seconds, or None for the
+            default timeout.
+        """
+        self._max_idle_connections_per_host = max_idle_connections_per_host
+        self._max_retries = max_retries
+        self._backoff_factor = backoff_factor
+        self._timeout = timeout
+        # (scheme, netloc) -> [idle connection, ...], the most recently used last
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, encode_chunked=False):
+        """
+        Sends a request and returns its response, a PooledResponse.
+        Responses are never errors: callers check their status.
+
+        :param body: None, bytes, or an iterable of bytes (e.g. a generator), which is sent with
+            chunked transfer encoding if encode_chunked is True. Requests with an iterable body
+            are never retried, since their body can't be sent again.
+        :param headers: dict of headers
+        :raises: http.client.HTTPException or OSError once retries are exhausted
+        """
+        headers = headers or {}
+        for _ in range(self.MAX_REDIRECTS):
+            response = self._request_with_retries(method, url, body, headers, encode_chunked)
+            location = response.getheader('Location')
+            if (
+                response.status not in self.REDIRECT_STATUSES
+                or method not in ('GET', 'HEAD')
+                or not location
+            ):
+                return response
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+        return self._request_with_retries(method, url, body, headers, encode_chunked)
+
+    def close(self):
+        """
+        Closes the idle connections of all the pools.
+        """
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for connections in pools.values():
+            for connection in connections:
+                connection.close()
+
+    def _request_with_retries(self, method, url, body, headers, encode_chunked):
+        parsed_url = urllib.parse.urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.netloc)
+        path = urllib.parse.urlunsplit(('', '', parsed_url.path or '/', parsed_url.query, ''))
+        proxy = self._get_proxy(key)
+        if proxy is not None and parsed_url.scheme == 'http':
+            path = urllib.parse.urlunsplit(key + (parsed_url.path or '/', parsed_url.query, ''))
+            headers = dict(headers, **proxy[2])
+        can_resend = body is None or isinstance(body, bytes)
+        num_retries = 0
+        while True:
+            connection, reused = self._get_connection(key, proxy)
+            sent = False
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                # The server might receive the request from here on
+                sent = True
+                connection.request(
+                    method, path, body=body, headers=headers, encode_chunked=encode_chunked
+                )
+                response = connection.getresponse()
+            except Exception as e:
+                connection.close()
+                if not isinstance(e, (http.client.HTTPException, OSError)) or not can_resend:
+                    raise
+                if reused and isinstance(e, self.STALE_CONNECTION_ERRORS):
+                    # The server closed the connection while it was idle: send the request again
+                    # on another connection right away.
+                    continue
+                if (not sent or method in self.IDEMPOTENT_METHODS) and self._should_retry(
+                    num_retries
+                ):
+                    logger.info('Retrying %s %s after error: %s', method, url, e)
+                    num_retries += 1
+                    continue
+                raise
+
+            response = PooledResponse(self, key, connection, response)
+            if (
+                response.status in self.RETRY_STATUSES
+                and method in self.IDEMPOTENT_METHODS
+                and can_resend
+                and self._should_retry(num_retries)
+            ):
+                logger.info('Retrying %s %s after status %d', method, url, response.status)
+                response.read()
+                response.close()
+                num_retries += 1
+                continue
+            return response
+
+    def _should_retry(self, num_retries):
+        """
+        Returns whether a request that was already retried num_retries times should be retried
+        again, after waiting for the backoff time if so.
+        """
+        if num_retries >= self._max_retries:
+            return False
+        time.sleep(self._backoff_factor * 2 ** num_retries)
+        return True
+
+    def _get_connection(self, key, proxy=None):
+        """
+        Returns (connection, reused), an idle connection of the pool of the given host if there is
+        one (reused is True), or a new connection to that host, through the proxy returned by
+        _get_proxy if any.
+        """
+        with self._lock:
+            connections = self._pools.get(key)
+            if connections:
+                return connections.pop(), True
+        scheme, netloc = key
+        kwargs = {} if self._timeout is None else {'timeout': self._timeout}
+        if proxy is not None:
+            proxy_host, proxy_port, proxy_headers = proxy
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(proxy_host, proxy_port, **kwargs)
+                connection.set_tunnel(netloc, headers=proxy_headers)
+                return connection, False
+            return http.client.HTTPConnection(proxy_host, proxy_port, **kwargs), False
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, **kwargs), False
+        return http.client.HTTPConnection(netloc, **kwargs), False
+
+    @staticmethod
+    def _get_proxy(key):
+        """
+        Returns (host, port, headers) of the proxy to go through to reach the given host, or None
+        to connect to it directly. The headers authenticate with the proxy.
+        """
+        scheme, netloc = key
+        proxy_url = urllib.request.getproxies().get(scheme)
+        if not proxy_url or urllib.request.proxy_bypass(netloc):
+            return None
+        if '://' not in proxy_url:
+            proxy_url = 'http://' + proxy_url
+        proxy_url = urllib.parse.urlsplit(proxy_url)
+        headers = {}
+        if proxy_url.username is not None:
+            credentials = '%s:%s' % (
+                urllib.parse.unquote(proxy_url.username),
+                urllib.parse.unquote(proxy_url.password or ''),
+            )
+            headers['Proxy-Authorization'] = (
+                'Basic ' + base64.b64encode(credentials.encode()).decode()
+            )
+        return proxy_url.hostname, proxy_url.port, headers
+
+    def _release_connection(self, key, connection, response):
+        """
+        Puts the connection of a response that was read in full back into the pool of its host,
+        or closes it if it can't be reused.
+        """
+        if response.will_close:
+            connection.close()
+            return
+        with self._lock:
+            connections = self._pools.setdefault(key, [])
+            if len(connections) < self._max_idle_connections_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+class PooledResponse(object):
+    """
+    File-like response to a request of HttpTransport. Its connection is put back into the pool
+    once its body has been read in full, or closed if the response is closed before that.
+    """
+
+    def __init__(self, transport, key, connection, response):
+        self._transport = transport
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._released = False
+        self._release_if_read()
+
+    @property
+    def status(self):
+        return self._response.status
+
+    @property
+    def reason(self):
+        return self._response.reason
+
+    @property
+    def headers(self):
+        return self._response.headers
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self._release_if_read()
+        return data
+
+    def readline(self, limit=-1):
+        line = self._response.readline(limit)
+        if self._response.length == 0 or (not line and limit != 0):
+            # Unlike read, readline doesn't close the response at the end of its body
+            self._response.read()
+        self._release_if_read()
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        if self._released:
+            return
+        if self._response.isclosed():
+            self._release_if_read()
+        else:
+            # The rest of the body is still to be received on the connection
+            self._released = True
+            self._response.close()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _release_if_read(self):
+        if not self._released and self._response.isclosed():
+            self._released = True
+            self._transport._release_connection(self._key, self._connection, self._response)
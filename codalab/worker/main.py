@@ -88,6 +88,15 @@ def parse_args():
         'the requested image will not be downloaded. '
         'The bundle depends on this image will fail accordingly.',
     )
+    parser.add_argument(
+        '--prefetch-images',
+        type=int,
+        metavar='N',
+        default=0,
+        help='Pull the N Docker images requested by the most staged bundles '
+        'ahead of time, while the image cache has room for them. '
+        'Images are not prefetched if this option is not specified.',
+    )
     parser.add_argument(
         '--max-memory',
         type=parse_size,
@@ -147,6 +156,12 @@ def parse_args():
         default=sys.maxsize,
         help='The worker quits after this many jobs assigned to this worker',
     )
+    parser.add_argument(
+        '--serial-run-transitions',
+        action='store_true',
+        help='Transition runs one after the other in between checkins with the server, '
+        'instead of transitioning each run and checking in concurrently.',
+    )
     return parser.parse_args()
 
 
@@ -217,6 +232,8 @@ def main():
         os.path.join(args.work_dir, 'images-state.json'),
         args.max_image_cache_size,
         args.max_image_size,
+        bundle_service=bundle_service,
+        prefetch_images=args.prefetch_images,
     )
 
     worker = Worker(
@@ -240,6 +257,7 @@ def main():
         docker_network_prefix=args.network_prefix,
         pass_down_termination=args.pass_down_termination,
         delete_work_dir_on_exit=args.delete_work_dir_on_exit,
+        serial_run_transitions=args.serial_run_transitions,
     )
 
     # Register a signal handler to ensure safe shutdown.
@@ -0,0 +1,159 @@
+"""
+read_cache
+Caches the files of runs that are read repeatedly while users follow the logs of a run (e.g. with
+`cl wait --tail` or the web UI polling stdout).
+
+Each cached file keeps the last TAIL_SIZE bytes of the file in memory. Since logs are only
+appended to, bringing that tail up to date only reads the bytes written since the last read, and
+reads of recent sections of the file are served from memory. Summaries (head and tail lines) are
+memoized, already gzipped, for the current version of the file (its inode, size and modification
+time), so that any number of viewers polling a log that didn't change only cost a stat.
+"""
+
+from collections import namedtuple, OrderedDict
+import os
+import threading
+
+# Identifies the contents of a file: any write to the file changes its size or modification time.
+FileVersion = namedtuple('FileVersion', ['inode', 'size', 'mtime'])
+
+
+def get_file_version(path):
+    stat = os.stat(path)
+    return FileVersion(inode=stat.st_ino, size=stat.st_size, mtime=stat.st_mtime_ns)
+
+
+class CachedFile(object):
+    """
+    Cached tail and summaries of a single file. All methods are thread-safe.
+    """
+
+    # Number of bytes at the end of the file kept in memory
+    TAIL_SIZE = 256 * 1024
+    # Number of bytes at the end of the cached tail that are read again when the file grows, to
+    # detect files that were rewritten rather than appended to.
+    OVERLAP_SIZE = 64
+
+    def __init__(self, path):
+        self.path = path
+        self._version = None
+        self._tail = b''
+        self._tail_start = 0
+        # Summary arguments -> gzipped summary of the current version of the file
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _tail_end(self):
+        return self._tail_start + len(self._tail)
+
+    def _refresh(self):
+        """
+        Brings the cached tail up to date with the file, reading only what was appended since the
+        last refresh whenever possible, and never more than the new tail. Raises OSError if the
+        file cannot be read.
+        """
+        version = get_file_version(self.path)
+        if version == self._version:
+            return
+        self._summaries = {}
+        with open(self.path, 'rb') as fileobj:
+            data = None
+            if (
+                self._version is not None
+                and version.inode == self._version.inode
+                and self._tail_end < version.size <= self._tail_end + self.TAIL_SIZE
+            ):
+                # Re-read the end of the cached tail along with the appended bytes to make sure
+                # the file was only appended to.
+                start = max(self._tail_end - self.OVERLAP_SIZE, self._tail_start)
+                fileobj.seek(start, os.SEEK_SET)
+                data = fileobj.read(version.size - start)
+                overlap = self._tail[start - self._tail_start :]
+                if data[: len(overlap)] == overlap:
+                    data = data[len(overlap) :]
+                    start = self._tail_end
+                else:
+                    data = None
+            if data is None:
+                start = max(version.size - self.TAIL_SIZE, 0)
+                fileobj.seek(start, os.SEEK_SET)
+                data = fileobj.read(version.size - start)
+                self._tail = b''
+        self._tail = (self._tail + data)[-self.TAIL_SIZE :]
+        self._tail_start = start + len(data) - len(self._tail)
+        self._version = version
+
+    def read_section(self, offset, length):
+        """
+        Returns length bytes of the file starting at offset, or None if that section is not cached
+        (in which case the caller should read it from the file). Raises OSError if the file
+        cannot be read.
+        """
+        with self._lock:
+            self._refresh()
+            if offset >= self._tail_end:
+                return b''
+            if offset < self._tail_start:
+                return None
+            start = offset - self._tail_start
+            return self._tail[start : start + length]
+
+    def get_summary(self, key, summarize_fn):
+        """
+        Returns the summary of the file for the given key, calling summarize_fn to compute it if
+        it isn't cached for the current version of the file.
+        """
+        with self._lock:
+            try:
+                self._refresh()
+            except OSError:
+                # Let summarize_fn deal with missing files
+                return summarize_fn()
+            if key not in self._summaries:
+                summary = summarize_fn()
+                try:
+                    if get_file_version(self.path) != self._version:
+                        # The file changed while being summarized
+                        return summary
+                except OSError:
+                    return summary
+                self._summaries[key] = summary
+            return self._summaries[key]
+
+
+class ReadCache(object):
+    """
+    Bounded LRU cache of the files read from the bundles of the runs of a worker.
+    """
+
+    # Maximum number of files cached across all runs
+    MAX_FILES = 64
+
+    def __init__(self, max_files=MAX_FILES):
+        self._max_files = max_files
+        # (uuid, path) -> CachedFile
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uuid, path):
+        """
+        Returns the CachedFile for the file at path in the bundle of the run with uuid.
+        """
+        key = (uuid, path)
+        with self._lock:
+            cached_file = self._files.pop(key, None)
+            if cached_file is None:
+                cached_file = CachedFile(path)
+            self._files[key] = cached_file
+            while len(self._files) > self._max_files:
+                self._files.popitem(last=False)
+            return cached_file
+
+    def forget_run(self, uuid):
+        """
+        Drops the cached files of the run with uuid.
+        """
+        with self._lock:
+            for key in [key for key in self._files if key[0] == uuid]:
+                del self._files[key]
@@ -1,5 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 import http.client
+import logging
 import os
 import threading
 
@@ -12,10 +14,28 @@ from codalab.worker.file_util import (
     summarize_file,
     tar_gzip_directory,
 )
+from codalab.worker.read_cache import ReadCache
+
+logger = logging.getLogger(__name__)
 
 
 class Reader(object):
+    """
+    Serves the read requests of the server on the files of the runs of a worker.
+
+    The reads that return a small payload (target info, file sections and summaries) are handled
+    by a fixed pool of READ_THREADS threads, using a ReadCache of the files being followed, so
+    that many users polling the logs of runs neither create a thread per request nor re-read the
+    logs from disk. Streaming whole files and directories can take arbitrarily long, so each
+    stream still gets its own thread.
+    """
+
+    # Number of threads serving the small reads
+    READ_THREADS = 8
+
     def __init__(self):
+        self.read_cache = ReadCache()
+        self._executor = ThreadPoolExecutor(max_workers=self.READ_THREADS)
         self.read_handlers = {
             'get_target_info': self.get_target_info,
             'stream_directory': self.stream_directory,
@@ -35,9 +55,58 @@ class Reader(object):
             reply(err)
 
     def stop(self):
+        self._executor.shutdown(wait=True)
         for thread in self.read_threads:
             thread.join()
 
+    def forget_run(self, uuid):
+        """
+        Drops the cached files of the run with uuid, once the worker is done with the run.
+        """
+        self.read_cache.forget_run(uuid)
+
+    def _get_final_path(self, run_state, path, reply_fn):
+        """
+        Returns the real filesystem path to the path in the bundle, or None after replying with an
+        http error if there's no such path.
+        """
+        try:
+            return get_target_path(run_state.bundle_path, BundleTarget(run_state.bundle.uuid, path))
+        except PathException as e:
+            reply_fn((http.client.NOT_FOUND, str(e)), None, None)
+            return None
+
+    def _submit(self, reply_fn, fn, *args):
+        """
+        Calls fn(*args) on one of the threads of the pool. If it fails, replies with an http
+        error.
+        """
+
+        def pooled_fn():
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception('Error serving read request')
+                try:
+                    reply_fn((http.client.INTERNAL_SERVER_ERROR, str(e)), None, None)
+                except Exception:
+                    logger.exception('Cannot reply to read request')
+
+        self._executor.submit(pooled_fn)
+
+    def _pooled_read(self, run_state, path, read_fn, reply_fn):
+        """
+        Given a run state, a path, a read function and a reply function, calls read_fn on the
+        computed final path on one of the threads of the pool
+        """
+
+        def pooled_read_fn():
+            final_path = self._get_final_path(run_state, path, reply_fn)
+            if final_path is not None:
+                read_fn(final_path)
+
+        self._submit(reply_fn, pooled_read_fn)
+
     def _threaded_read(self, run_state, path, stream_fn, reply_fn):
         """
         Given a run state, a path, a stream function and a reply function,
@@ -45,20 +114,21 @@ class Reader(object):
             - In case of error, invokes reply_fn with an http error
             - Otherwise starts a thread calling stream_fn on the computed final path
         """
-        try:
-            final_path = get_target_path(
-                run_state.bundle_path, BundleTarget(run_state.bundle.uuid, path)
-            )
-        except PathException as e:
-            reply_fn((http.client.NOT_FOUND, str(e)), None, None)
+        final_path = self._get_final_path(run_state, path, reply_fn)
+        if final_path is None:
+            return
         read_thread = threading.Thread(target=stream_fn, args=[final_path])
         read_thread.start()
         self.read_threads.append(read_thread)
 
     def get_target_info(self, run_state, path, args, reply_fn):
         """
-        Return target_info of path in bundle as a message on the reply_fn
+        Return target_info of path in bundle as a message on the reply_fn, using a thread of the
+        pool
         """
+        self._submit(reply_fn, self._get_target_info, run_state, path, args, reply_fn)
+
+    def _get_target_info(self, run_state, path, args, reply_fn):
         target_info = None
         dep_paths = set([dep.child_path for dep in run_state.bundle.dependencies])
 
@@ -116,34 +186,46 @@ class Reader(object):
     def read_file_section(self, run_state, path, args, reply_fn):
         """
         Read the section of file at path of length args['length'] starting at
-        args['offset'] (bytes) using a separate thread
+        args['offset'] (bytes) using a thread of the pool. Recent sections of
+        the file are served from the read cache.
         """
 
-        def read_file_section_thread(final_path):
-            bytestring = gzip_bytestring(
-                read_file_section(final_path, args['offset'], args['length'])
-            )
-            reply_fn(None, {}, bytestring)
+        def read_file_section_fn(final_path):
+            cached_file = self.read_cache.get(run_state.bundle.uuid, final_path)
+            section = cached_file.read_section(args['offset'], args['length'])
+            if section is None:
+                section = read_file_section(final_path, args['offset'], args['length'])
+            reply_fn(None, {}, gzip_bytestring(section))
 
-        self._threaded_read(run_state, path, read_file_section_thread, reply_fn)
+        self._pooled_read(run_state, path, read_file_section_fn, reply_fn)
 
     def summarize_file(self, run_state, path, args, reply_fn):
         """
         Summarize the file including args['num_head_lines'] and
         args['num_tail_lines'] but limited with args['max_line_length'] using
-        args['truncation_text'] on a separate thread
-        """
-
-        def summarize_file_thread(final_path):
-            bytestring = gzip_bytestring(
-                summarize_file(
-                    final_path,
-                    args['num_head_lines'],
-                    args['num_tail_lines'],
-                    args['max_line_length'],
-                    args['truncation_text'],
-                ).encode()
+        args['truncation_text'] on a thread of the pool. The gzipped summary is
+        cached until the file changes.
+        """
+
+        def summarize_file_fn(final_path):
+            def summarize():
+                return gzip_bytestring(
+                    summarize_file(
+                        final_path,
+                        args['num_head_lines'],
+                        args['num_tail_lines'],
+                        args['max_line_length'],
+                        args['truncation_text'],
+                    ).encode()
+                )
+
+            key = (
+                args['num_head_lines'],
+                args['num_tail_lines'],
+                args['max_line_length'],
+                args['truncation_text'],
             )
-            reply_fn(None, {}, bytestring)
+            cached_file = self.read_cache.get(run_state.bundle.uuid, final_path)
+            reply_fn(None, {}, cached_file.get_summary(key, summarize))
 
-        self._threaded_read(run_state, path, summarize_file_thread, reply_fn)
+        self._pooled_read(run_state, path, summarize_file_fn, reply_fn)
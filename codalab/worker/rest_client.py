@@ -1,10 +1,10 @@
 from contextlib import closing
-from io import StringIO
-import http.client
+from io import BytesIO
 import json
 import urllib.request, urllib.parse, urllib.error
 
 from .file_util import un_gzip_stream
+from .http_transport import HttpTransport
 
 
 class RestClientException(Exception):
@@ -29,8 +29,10 @@ class RestClient(object):
     """
     _extra_headers = {}
 
-    def __init__(self, base_url):
+    def __init__(self, base_url, transport=None):
         self._base_url = base_url
+        # Pools of keep-alive connections shared by all the threads using this client
+        self._transport = transport or HttpTransport()
 
     def _get_access_token(self):
         """
@@ -39,21 +41,10 @@ class RestClient(object):
         """
         raise NotImplementedError
 
-    def _make_request(
-        self,
-        method,
-        path,
-        query_params=None,
-        headers=None,
-        data=None,
-        return_response=False,
-        authorized=True,
-    ):
+    def _prepare_request(self, path, query_params, headers, data, authorized):
         """
-        `data` can be one of the following:
-        - bytes
-        - string (text/plain)
-        - dict (application/json)
+        Returns the path (including the query string), headers and body of a request.
+        See _make_request for the supported types of `data`.
         """
         # Set headers
         if headers is None:
@@ -78,34 +69,71 @@ class RestClient(object):
         # Set path
         if query_params is not None:
             path = path + '?' + urllib.parse.urlencode(query_params)
+        return path, headers, data
+
+    def _make_request(
+        self,
+        method,
+        path,
+        query_params=None,
+        headers=None,
+        data=None,
+        return_response=False,
+        authorized=True,
+        transport=None,
+    ):
+        """
+        `data` can be one of the following:
+        - bytes
+        - string (text/plain)
+        - dict (application/json)
+
+        Requests are sent over the connections of the transport (the transport of the client by
+        default), which are kept open and reused by the following requests.
+        """
+        path, headers, data = self._prepare_request(path, query_params, headers, data, authorized)
         request_url = self._base_url + path
 
         # Make the actual request
-        request = urllib.request.Request(request_url, data=data, headers=headers)
-        request.get_method = lambda: method
+        transport = transport or self._transport
+        response = transport.request(method, request_url, body=data, headers=headers)
+        self._check_response(request_url, response)
         if return_response:
             # Return a file-like object containing the contents of the response
             # body, transparently decoding gzip streams if indicated by the
             # Content-Encoding header.
-            response = urllib.request.urlopen(request)
             encoding = response.headers.get('Content-Encoding')
             if not encoding or encoding == 'identity':
                 return response
             elif encoding == 'gzip':
                 return un_gzip_stream(response)
             else:
+                response.close()
                 raise RestClientException('Unsupported Content-Encoding: ' + encoding, False)
-        with closing(urllib.request.urlopen(request)) as response:
+        with closing(response):
             # If the response is a JSON document, as indicated by the
             # Content-Type header, try to deserialize it and return the result.
             # Otherwise, just ignore the response body and return None.
+            response_data = response.read()
             if response.headers.get('Content-Type') == 'application/json':
-                response_data = response.read().decode()
+                response_data = response_data.decode()
                 try:
                     return json.loads(response_data)
                 except ValueError:
                     raise RestClientException('Invalid JSON: ' + response_data, False)
 
+    @staticmethod
+    def _check_response(url, response):
+        """
+        Raises urllib.error.HTTPError if the response is an error, as urllib.request.urlopen does.
+        """
+        if response.status >= 400:
+            with closing(response):
+                body = response.read()
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.headers, BytesIO(body)
+            )
+
     def _upload_with_chunked_encoding(
         self, method, url, query_params, fileobj, progress_callback=None
     ):
@@ -118,49 +146,33 @@ class RestClient(object):
         runs to completion
         """
         CHUNK_SIZE = 16 * 1024
-        # Start the request.
-        parsed_base_url = urllib.parse.urlparse(self._base_url)
-        path = url + '?' + urllib.parse.urlencode(query_params)
-        if parsed_base_url.scheme == 'http':
-            conn = http.client.HTTPConnection(parsed_base_url.netloc)
-        else:
-            conn = http.client.HTTPSConnection(parsed_base_url.netloc)
-        with closing(conn):
-            conn.putrequest(method, parsed_base_url.path + path)
-
-            # Set headers.
-            headers = {
-                'Authorization': 'Bearer ' + self._get_access_token(),
-                'Transfer-Encoding': 'chunked',
-                'X-Requested-With': 'XMLHttpRequest',
-            }
-            headers.update(self._extra_headers)
-            for header_name, header_value in headers.items():
-                conn.putheader(header_name, header_value)
-            conn.endheaders()
-
-            # Use chunked transfer encoding to send the data through.
+        request_url = self._base_url + url + '?' + urllib.parse.urlencode(query_params)
+
+        # Set headers.
+        headers = {
+            'Authorization': 'Bearer ' + self._get_access_token(),
+            'Transfer-Encoding': 'chunked',
+            'X-Requested-With': 'XMLHttpRequest',
+        }
+        headers.update(self._extra_headers)
+
+        def read_chunks():
             bytes_uploaded = 0
             while True:
                 to_send = fileobj.read(CHUNK_SIZE)
                 if not to_send:
                     break
-                conn.send(b'%X\r\n%s\r\n' % (len(to_send), to_send))
+                yield to_send
                 bytes_uploaded += len(to_send)
                 if progress_callback is not None:
                     should_resume = progress_callback(bytes_uploaded)
                     if not should_resume:
                         raise Exception('Upload aborted by client')
-            conn.send(b'0\r\n\r\n')
-
-            # Read the response.
-            response = conn.getresponse()
-            if response.status != 200:
-                # Low-level httplib module doesn't throw HTTPError
-                raise urllib.error.HTTPError(
-                    self._base_url + path,
-                    response.status,
-                    response.reason,
-                    dict(response.getheaders()),
-                    StringIO(response.read().decode()),
-                )
+
+        # Use chunked transfer encoding to send the data through.
+        response = self._transport.request(
+            method, request_url, body=read_chunks(), headers=headers, encode_chunked=True
+        )
+        self._check_response(request_url, response)
+        with closing(response):
+            response.read()
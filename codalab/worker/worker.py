@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import json
 import logging
 import os
 import shutil
@@ -19,6 +22,8 @@ from .download_util import BUNDLE_NO_LONGER_RUNNING_MESSAGE
 from .state_committer import JsonStateCommitter
 from .bundle_state import BundleInfo, RunResources, BundleCheckinState
 from .worker_run_state import RunStateMachine, RunStage, RunState
+from .container_stats import ContainerStatsSampler
+from .disk_usage import DiskUsageTracker
 from .reader import Reader
 
 logger = logging.getLogger(__name__)
@@ -43,6 +48,10 @@ class Worker:
     BUNDLE_DIR_WAIT_NUM_TRIES = 120
     # Number of seconds to sleep if checking in with server fails two times in a row
     CHECKIN_COOLDOWN = 5
+    # Number of threads transitioning runs when runs are processed concurrently
+    RUN_TRANSITION_THREADS = 16
+    # Number of seconds between two passes over the runs when runs are processed concurrently
+    PROCESS_RUNS_INTERVAL = 0.5
 
     def __init__(
         self,
@@ -68,6 +77,9 @@ class Worker:
         pass_down_termination=False,  # type: bool
         # A flag indicating if the work_dir will be deleted when the worker exits.
         delete_work_dir_on_exit=False,  # type: bool
+        # A flag indicating if runs are transitioned one after the other in the main loop, in
+        # between checkins, instead of concurrently with each other and with checkins.
+        serial_run_transitions=False,  # type: bool
     ):
         self.image_manager = image_manager
         self.dependency_manager = dependency_manager
@@ -106,6 +118,24 @@ class Worker:
         self.last_time_ran = None  # type: Optional[bool]
 
         self.runs = {}  # type: Dict[str, RunState]
+        self.serial_run_transitions = serial_run_transitions
+        # Guards self.runs, which is shared by the main loop, the checkin thread and the run
+        # transition threads when runs are processed concurrently.
+        self._runs_lock = threading.RLock()
+        # Held while transitioning a run out of PREPARING, so that resources assigned to a run are
+        # seen by the next run being prepared.
+        self._preparing_lock = threading.Lock()
+        self._run_transition_executor = None  # type: Optional[ThreadPoolExecutor]
+        # uuid -> Future of the in-flight transition of the run
+        self._transitioning = {}  # type: Dict[str, Future]
+        # uuid -> RunState fields changed by the server during the in-flight transition of the run
+        self._pending_run_changes = {}  # type: Dict[str, Dict[str, Any]]
+        # Cleared while the main loop backs off after an exception, so that the checkin thread
+        # doesn't take new runs that wouldn't be transitioned in the meantime.
+        self._checkins_allowed = threading.Event()
+        self._checkins_allowed.set()
+        self.container_stats_sampler = ContainerStatsSampler()
+        self.disk_usage_tracker = DiskUsageTracker()
         self.init_docker_networks(docker_network_prefix)
         self.run_state_manager = RunStateMachine(
             docker_image_manager=self.image_manager,
@@ -117,6 +147,8 @@ class Worker:
             upload_bundle_callback=self.upload_bundle_contents,
             assign_cpu_and_gpu_sets_fn=self.assign_cpu_and_gpu_sets,
             shared_file_system=self.shared_file_system,
+            container_stats_sampler=self.container_stats_sampler,
+            disk_usage_tracker=self.disk_usage_tracker,
         )
 
     def init_docker_networks(self, docker_network_prefix):
@@ -140,12 +172,13 @@ class Worker:
 
     def save_state(self):
         # Remove complex container objects from state before serializing, these can be retrieved
-        runs = {
-            uuid: state._replace(
-                container=None, bundle=state.bundle.as_dict, resources=state.resources.as_dict
-            )
-            for uuid, state in self.runs.items()
-        }
+        with self._runs_lock:
+            runs = {
+                uuid: state._replace(
+                    container=None, bundle=state.bundle.as_dict, resources=state.resources.as_dict
+                )
+                for uuid, state in self.runs.items()
+            }
         self.state_committer.commit(runs)
 
     def load_state(self):
@@ -192,8 +225,23 @@ class Worker:
         """Return whether we ran anything."""
         self.load_state()
         self.image_manager.start()
+        self.container_stats_sampler.start()
+        self.disk_usage_tracker.start()
         if not self.shared_file_system:
             self.dependency_manager.start()
+        channel_thread = threading.Thread(target=self.channel_loop)
+        channel_thread.start()
+        if self.serial_run_transitions:
+            self.run_serially()
+        else:
+            self.run_concurrently()
+        channel_thread.join()
+        self.cleanup()
+
+    def run_serially(self):
+        """
+        Main loop that transitions all runs, then checks in with the server, one step at a time.
+        """
         while not self.terminate:
             try:
                 self.process_runs()
@@ -209,7 +257,104 @@ class Worker:
                 # Sleep for a long time so we don't keep on failing.
                 logger.error('Sleeping for 1 hour due to exception...please help me!')
                 time.sleep(1 * 60 * 60)
-        self.cleanup()
+
+    def run_concurrently(self):
+        """
+        Main loop in which each run is transitioned on its own thread and checkins happen on a
+        separate thread, so that a slow run transition (e.g. a Docker API call) delays neither
+        the other runs nor the checkins.
+        """
+        self._run_transition_executor = ThreadPoolExecutor(max_workers=self.RUN_TRANSITION_THREADS)
+        checkin_thread = threading.Thread(target=self.checkin_loop)
+        checkin_thread.start()
+        while not self.terminate:
+            try:
+                self.process_runs()
+                self.save_state()
+                if self.terminate_and_restage:
+                    # Make sure the server hears about the restaged bundles before stopping
+                    self.checkin()
+                self.check_termination()
+                self.save_state()
+                if self.check_idle_stop() or self.check_num_runs_stop():
+                    self.terminate = True
+                time.sleep(self.PROCESS_RUNS_INTERVAL)
+            except Exception:
+                # Stop checking in too, as when runs are transitioned serially
+                self._checkins_allowed.clear()
+                self.last_checkin_successful = False
+                traceback.print_exc()
+                # Sleep for a long time so we don't keep on failing.
+                logger.error('Sleeping for 1 hour due to exception...please help me!')
+                time.sleep(1 * 60 * 60)
+                self._checkins_allowed.set()
+        checkin_thread.join()
+        self._run_transition_executor.shutdown(wait=True)
+        self._run_transition_executor = None
+
+    def checkin_loop(self):
+        """
+        Checks in with the server until the worker terminates. Checkins are paced by the server,
+        which waits for a message for the worker before replying.
+        """
+        while not self.terminate:
+            if not self._checkins_allowed.wait(self.CHECKIN_COOLDOWN):
+                continue
+            try:
+                self.checkin()
+            except Exception:
+                self.last_checkin_successful = False
+                traceback.print_exc()
+                time.sleep(self.CHECKIN_COOLDOWN)
+
+    def channel_loop(self):
+        """
+        Keeps a channel open with the server until the worker terminates, and serves the read
+        requests made over it as they come, instead of with the checkins.
+        """
+        while not self.terminate:
+            try:
+                with contextlib.closing(self.bundle_service.open_channel(self.id)) as requests:
+                    for line in requests:
+                        if self.terminate:
+                            break
+                        if not line.strip():
+                            continue
+                        try:
+                            self.handle_channel_request(json.loads(line.decode()))
+                        except Exception:
+                            logger.exception("Cannot serve request on channel: %s", line)
+            except BundleServiceException as ex:
+                if ex.client_error:
+                    logger.warning("Cannot open channel, reads will be served on checkins: %s", ex)
+                    return
+                # Also raised when the server has too many channels open
+                logger.error("Channel with server closed: %s", ex)
+                time.sleep(self.CHECKIN_COOLDOWN)
+            except socket.timeout:
+                # No heartbeat received, the connection to the server is lost
+                logger.warning("Channel with server timed out, reopening it")
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.CHECKIN_COOLDOWN)
+
+    def handle_channel_request(self, request):
+        """
+        Serves a read request made over the channel. The read runs asynchronously, and its reply
+        is sent with the request ID.
+        """
+
+        def reply(err, message={}, data=None):
+            if err:
+                message = {'error_code': err[0], 'error_message': err[1]}
+                data = None
+            self.bundle_service.channel_reply(self.id, request['id'], message, data)
+
+        logger.debug('Received request on channel: %s', request)
+        if request['type'] != 'read':
+            logger.warning("Unrecognized request type on channel: %s", request['type'])
+        else:
+            self.read_with_reply(request['uuid'], request['path'], request['read_args'], reply)
 
     def cleanup(self):
         """
@@ -221,6 +366,9 @@ class Worker:
         if not self.shared_file_system:
             self.dependency_manager.stop()
         self.run_state_manager.stop()
+        self.container_stats_sampler.stop()
+        self.disk_usage_tracker.stop()
+        self.reader.stop()
         self.save_state()
         if self.delete_work_dir_on_exit:
             shutil.rmtree(self.work_dir)
@@ -256,11 +404,12 @@ class Worker:
                 self.terminate = True
                 # Reset the current runs to exclude bundles in terminal states
                 # before save state one last time to worker-state.json
-                self.runs = {
-                    uuid: run_state
-                    for uuid, run_state in self.runs.items()
-                    if run_state.stage not in [RunStage.FINISHED, RunStage.RESTAGED]
-                }
+                with self._runs_lock:
+                    self.runs = {
+                        uuid: run_state
+                        for uuid, run_state in self.runs.items()
+                        if run_state.stage not in [RunStage.FINISHED, RunStage.RESTAGED]
+                    }
 
     def restage_bundles(self):
         """
@@ -269,11 +418,12 @@ class Worker:
         """
         restaged_bundles = []
         terminal_stages = [RunStage.FINISHED, RunStage.RESTAGED]
-        for uuid in self.runs:
-            run_state = self.runs[uuid]
-            if run_state.stage not in terminal_stages:
-                self.restage_bundle(uuid)
-                restaged_bundles.append(uuid)
+        with self._runs_lock:
+            for uuid in self.runs:
+                run_state = self.runs[uuid]
+                if run_state.stage not in terminal_stages:
+                    self.restage_bundle(uuid)
+                    restaged_bundles.append(uuid)
         if len(restaged_bundles) > 0:
             logger.info(
                 "Sending bundles back to the staged state: {}.".format(','.join(restaged_bundles))
@@ -331,7 +481,12 @@ class Worker:
             self.last_checkin_successful = False
             response = None
         # Stop processing any new runs received from server
-        if not response or self.terminate_and_restage or self.terminate:
+        if (
+            not response
+            or self.terminate_and_restage
+            or self.terminate
+            or not self._checkins_allowed.is_set()
+        ):
             return
         action_type = response['type']
         logger.debug('Received %s message: %s', action_type, response)
@@ -340,6 +495,8 @@ class Worker:
         else:
             uuid = response['uuid']
             socket_id = response.get('socket_id', None)
+            # The run can still be dropped by process_runs after this test, so the actions below
+            # handle missing runs too.
             if uuid not in self.runs:
                 if action_type in ['read', 'netcat']:
                     self.read_run_missing(socket_id)
@@ -360,17 +517,22 @@ class Worker:
     def process_runs(self):
         """ Transition each run then filter out finished runs """
         # 1. transition all runs
-        for uuid in self.runs:
-            run_state = self.runs[uuid]
-            self.runs[uuid] = self.run_state_manager.transition(run_state)
+        if self.serial_run_transitions:
+            for uuid in self.runs:
+                run_state = self.runs[uuid]
+                self.runs[uuid] = self.run_state_manager.transition(run_state)
+        else:
+            self.start_run_transitions()
 
         # 2. filter out finished runs and clean up containers
-        finished_container_ids = [
-            run.container
-            for run in self.runs.values()
-            if (run.stage == RunStage.FINISHED or run.stage == RunStage.FINALIZING)
-            and run.container_id is not None
-        ]
+        with self._runs_lock:
+            finished_container_ids = [
+                run.container
+                for uuid, run in self.runs.items()
+                if (run.stage == RunStage.FINISHED or run.stage == RunStage.FINALIZING)
+                and run.container_id is not None
+                and uuid not in self._transitioning
+            ]
         for container_id in finished_container_ids:
             try:
                 container = self.docker.containers.get(container_id)
@@ -379,11 +541,59 @@ class Worker:
                 pass
 
         # 3. reset runs for the current worker
-        self.runs = {
-            uuid: run_state
-            for uuid, run_state in self.runs.items()
-            if run_state.stage != RunStage.FINISHED
-        }
+        with self._runs_lock:
+            runs = {
+                uuid: run_state
+                for uuid, run_state in self.runs.items()
+                if run_state.stage != RunStage.FINISHED or uuid in self._transitioning
+            }
+            for uuid in set(self.runs) - set(runs):
+                self.reader.forget_run(uuid)
+            self.runs = runs
+
+    def start_run_transitions(self):
+        """
+        Submits a transition for each run that isn't already being transitioned. Re-raises the
+        exception of any transition that failed, just like transitioning serially would.
+        """
+        with self._runs_lock:
+            for uuid, future in list(self._transitioning.items()):
+                if future.done():
+                    del self._transitioning[uuid]
+                    future.result()
+            for uuid, run_state in self.runs.items():
+                if uuid not in self._transitioning and run_state.stage != RunStage.FINISHED:
+                    self._transitioning[uuid] = self._run_transition_executor.submit(
+                        self.transition_run, uuid
+                    )
+
+    def transition_run(self, uuid):
+        """
+        Transitions the run with uuid, then re-applies the changes the server made to the run
+        (e.g. kill, mark_finalized) while it was being transitioned.
+        """
+        with self._runs_lock:
+            run_state = self.runs[uuid]
+        lock = (
+            self._preparing_lock if run_state.stage == RunStage.PREPARING else contextlib.suppress()
+        )
+        with lock:
+            run_state = self.run_state_manager.transition(run_state)
+            with self._runs_lock:
+                changes = self._pending_run_changes.pop(uuid, {})
+                self.runs[uuid] = run_state._replace(**changes)
+
+    def update_run(self, uuid, **changes):
+        """
+        Updates fields of the run with uuid, making sure the changes survive an in-flight
+        transition of the run. Does nothing if the run is gone.
+        """
+        with self._runs_lock:
+            if uuid not in self.runs:
+                return
+            self.runs[uuid] = self.runs[uuid]._replace(**changes)
+            if uuid in self._transitioning:
+                self._pending_run_changes.setdefault(uuid, {}).update(changes)
 
     def assign_cpu_and_gpu_sets(self, request_cpus, request_gpus):
         """
@@ -402,10 +612,11 @@ class Worker:
         """
         cpuset, gpuset = set(map(str, self.cpuset)), set(map(str, self.gpuset))
 
-        for run_state in self.runs.values():
-            if run_state.stage == RunStage.RUNNING:
-                cpuset -= run_state.cpuset
-                gpuset -= run_state.gpuset
+        with self._runs_lock:
+            for run_state in self.runs.values():
+                if run_state.stage == RunStage.RUNNING:
+                    cpuset -= run_state.cpuset
+                    gpuset -= run_state.gpuset
 
         if len(cpuset) < request_cpus:
             raise Exception(
@@ -428,6 +639,8 @@ class Worker:
         """
         Returns a list of all the runs managed by this RunManager
         """
+        with self._runs_lock:
+            runs = list(self.runs.values())
         return [
             BundleCheckinState(
                 uuid=run_state.bundle.uuid,
@@ -442,7 +655,7 @@ class Worker:
                 exitcode=run_state.exitcode,
                 failure_message=run_state.failure_message,
             )
-            for run_state in self.runs.values()
+            for run_state in runs
         ]
 
     @property
@@ -503,7 +716,7 @@ class Worker:
                 if self.shared_file_system
                 else os.path.join(self.local_bundles_dir, bundle.uuid)
             )
-            self.runs[bundle.uuid] = RunState(
+            run_state = RunState(
                 stage=RunStage.PREPARING,
                 run_status='',
                 bundle=bundle,
@@ -530,6 +743,8 @@ class Worker:
                 finalized=False,
                 is_restaged=False,
             )
+            with self._runs_lock:
+                self.runs[bundle.uuid] = run_state
             # Increment the number of runs that have been successfully started on this worker
             self.num_runs += 1
         else:
@@ -542,26 +757,33 @@ class Worker:
         """
         Marks the run as killed so that the next time its state is processed it is terminated.
         """
-        self.runs[uuid] = self.runs[uuid]._replace(kill_message='Kill requested', is_killed=True)
+        self.update_run(uuid, kill_message='Kill requested', is_killed=True)
 
     def restage_bundle(self, uuid):
         """
         Marks the run as restaged so that it can be sent back to the STAGED state before the worker is terminated.
         """
-        self.runs[uuid] = self.runs[uuid]._replace(is_restaged=True)
+        self.update_run(uuid, is_restaged=True)
 
     def mark_finalized(self, uuid):
         """
         Marks the run with uuid as finalized so it might be purged from the worker state
         """
-        self.runs[uuid] = self.runs[uuid]._replace(finalized=True)
+        self.update_run(uuid, finalized=True)
 
     def read(self, socket_id, uuid, path, args):
         def reply(err, message={}, data=None):
             self.bundle_service_reply(socket_id, err, message, data)
 
+        self.read_with_reply(uuid, path, args, reply)
+
+    def read_with_reply(self, uuid, path, args, reply):
         try:
-            run_state = self.runs[uuid]
+            with self._runs_lock:
+                run_state = self.runs.get(uuid)
+            if run_state is None:
+                reply((http.client.INTERNAL_SERVER_ERROR, BUNDLE_NO_LONGER_RUNNING_MESSAGE))
+                return
             self.reader.read(run_state, path, args, reply)
         except BundleServiceException:
             traceback.print_exc()
@@ -613,7 +835,10 @@ class Worker:
         threading.Thread(target=netcat_fn).start()
 
     def write(self, uuid, path, string):
-        run_state = self.runs[uuid]
+        with self._runs_lock:
+            run_state = self.runs.get(uuid)
+        if run_state is None:
+            return
         if os.path.normpath(path) in set(dep.child_path for dep in run_state.bundle.dependencies):
             return
 
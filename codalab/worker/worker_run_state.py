@@ -12,7 +12,7 @@ from collections import namedtuple
 from pathlib import Path
 
 from codalab.lib.formatting import size_str, duration_str
-from codalab.worker.file_util import remove_path, get_path_size, path_is_parent
+from codalab.worker.file_util import remove_path, path_is_parent
 from codalab.worker.bundle_state import State, DependencyKey
 from codalab.worker.fsm import DependencyStage, StateTransitioner
 from codalab.worker.worker_thread import ThreadDict
@@ -133,6 +133,8 @@ class RunStateMachine(StateTransitioner):
         upload_bundle_callback,  # Function to call to upload bundle results to the server
         assign_cpu_and_gpu_sets_fn,  # Function to call to assign CPU and GPU resources to each run
         shared_file_system,  # If True, bundle mount is shared with server
+        container_stats_sampler,  # Component to get CPU and memory usage of run containers from
+        disk_usage_tracker,  # Component to get disk usage of run bundle directories from
     ):
         super(RunStateMachine, self).__init__()
         self.add_transition(RunStage.PREPARING, self._transition_from_PREPARING)
@@ -151,19 +153,15 @@ class RunStateMachine(StateTransitioner):
         self.docker_runtime = docker_runtime
         # bundle.uuid -> {'thread': Thread, 'run_status': str}
         self.uploading = ThreadDict(fields={'run_status': 'Upload started', 'success': False})
-        # bundle.uuid -> {'thread': Thread, 'disk_utilization': int, 'running': bool}
-        self.disk_utilization = ThreadDict(
-            fields={'disk_utilization': 0, 'running': True, 'lock': None}
-        )
         self.upload_bundle_callback = upload_bundle_callback
         self.assign_cpu_and_gpu_sets_fn = assign_cpu_and_gpu_sets_fn
         self.shared_file_system = shared_file_system
-        self.paths_to_remove = []
+        self.container_stats_sampler = container_stats_sampler
+        self.disk_usage_tracker = disk_usage_tracker
+        # bundle.uuid -> paths of the dependencies mounted in the bundle directory
+        self.paths_to_remove = {}
 
     def stop(self):
-        for uuid in self.disk_utilization.keys():
-            self.disk_utilization[uuid]['running'] = False
-        self.disk_utilization.stop()
         self.uploading.stop()
 
     def _transition_from_PREPARING(self, run_state):
@@ -272,6 +270,7 @@ class RunStateMachine(StateTransitioner):
 
         # 2) Set up symlinks
         docker_dependencies = []
+        paths_to_remove = self.paths_to_remove.setdefault(run_state.bundle.uuid, [])
         docker_dependencies_path = (
             RunStateMachine._ROOT
             + run_state.bundle.uuid
@@ -294,7 +293,7 @@ class RunStateMachine(StateTransitioner):
                             parent_path=os.path.join(dependency_path, child),
                         )
                     )
-                    self.paths_to_remove.append(child_path)
+                    paths_to_remove.append(child_path)
             else:
                 to_mount.append(
                     DependencyToMount(
@@ -306,10 +305,10 @@ class RunStateMachine(StateTransitioner):
 
                 first_element_of_path = Path(dep.child_path).parts[0]
                 if first_element_of_path == RunStateMachine._ROOT:
-                    self.paths_to_remove.append(full_child_path)
+                    paths_to_remove.append(full_child_path)
                 else:
                     # child_path can be a nested path, so later remove everything from the first element of the path
-                    self.paths_to_remove.append(
+                    paths_to_remove.append(
                         os.path.join(run_state.bundle_path, first_element_of_path)
                     )
 
@@ -392,24 +391,33 @@ class RunStateMachine(StateTransitioner):
         def check_resource_utilization(run_state):
             kill_messages = []
 
-            run_stats = docker_utils.get_container_stats(run_state.container)
+            run_stats = self.container_stats_sampler.get(run_state.bundle.uuid)
 
             run_state = run_state._replace(
-                max_memory=max(run_state.max_memory, run_stats.get('memory', 0))
-            )
-            run_state = run_state._replace(
-                disk_utilization=self.disk_utilization[run_state.bundle.uuid]['disk_utilization']
+                max_memory=max(run_state.max_memory, run_stats.max_memory)
             )
-
-            container_time_total = docker_utils.get_container_running_time(run_state.container)
+            disk_usage = self.disk_usage_tracker.get(run_state.bundle.uuid)
+            run_state = run_state._replace(disk_utilization=disk_usage.disk_utilization)
+
+            # Until the sampler has looked up the container start time, keep the previous value
+            container_time_total = run_state.container_time_total
+            if run_stats.start_time is not None:
+                end_time = None
+                if run_state.finished:
+                    # Don't count the time since the container exited
+                    try:
+                        end_time = docker_utils.get_container_finish_time(run_state.container)
+                    except docker_utils.DockerException as e:
+                        logger.debug(
+                            'Cannot get finish time of container for run %s: %s',
+                            run_state.bundle.uuid,
+                            e,
+                        )
+                container_time_total = (end_time or time.time()) - run_stats.start_time
             run_state = run_state._replace(
                 container_time_total=container_time_total,
-                container_time_user=run_stats.get(
-                    'container_time_user', run_state.container_time_user
-                ),
-                container_time_system=run_stats.get(
-                    'container_time_system', run_state.container_time_system
-                ),
+                container_time_user=run_stats.time_user or run_state.container_time_user,
+                container_time_system=run_stats.time_system or run_state.container_time_system,
             )
 
             if run_state.resources.time and container_time_total > run_state.resources.time:
@@ -423,7 +431,7 @@ class RunStateMachine(StateTransitioner):
                     'Memory limit %s exceeded.' % size_str(run_state.resources.memory)
                 )
 
-            if run_state.resources.disk and run_state.disk_utilization > run_state.resources.disk:
+            if disk_usage.limit_exceeded:
                 kill_messages.append(
                     'Disk limit %sb exceeded.' % size_str(run_state.resources.disk)
                 )
@@ -432,27 +440,11 @@ class RunStateMachine(StateTransitioner):
                 run_state = run_state._replace(kill_message=' '.join(kill_messages), is_killed=True)
             return run_state
 
-        def check_disk_utilization():
-            running = True
-            while running:
-                start_time = time.time()
-                try:
-                    disk_utilization = get_path_size(run_state.bundle_path)
-                    self.disk_utilization[run_state.bundle.uuid][
-                        'disk_utilization'
-                    ] = disk_utilization
-                    running = self.disk_utilization[run_state.bundle.uuid]['running']
-                except Exception:
-                    logger.error(traceback.format_exc())
-                end_time = time.time()
-
-                # To ensure that we don't hammer the disk for this computation when
-                # there are lots of files, we run it at most 10% of the time.
-                time.sleep(max((end_time - start_time) * 10, 1.0))
-
-        self.disk_utilization.add_if_new(
-            run_state.bundle.uuid, threading.Thread(target=check_disk_utilization, args=[])
+        self.disk_usage_tracker.track(
+            run_state.bundle.uuid, run_state.bundle_path, run_state.resources.disk
         )
+        if run_state.container is not None:
+            self.container_stats_sampler.track(run_state.bundle.uuid, run_state.container)
         run_state = check_and_report_finished(run_state)
         run_state = check_resource_utilization(run_state)
 
@@ -464,8 +456,8 @@ class RunStateMachine(StateTransitioner):
                     finished, _, _ = docker_utils.check_finished(run_state.container)
                     if not finished:
                         logger.error(traceback.format_exc())
-            self.disk_utilization[run_state.bundle.uuid]['running'] = False
-            self.disk_utilization.remove(run_state.bundle.uuid)
+            self.disk_usage_tracker.untrack(run_state.bundle.uuid)
+            self.container_stats_sampler.untrack(run_state.bundle.uuid)
             return run_state._replace(stage=RunStage.CLEANING_UP)
         if run_state.finished:
             logger.debug(
@@ -474,8 +466,8 @@ class RunStateMachine(StateTransitioner):
                 run_state.exitcode,
                 run_state.failure_message,
             )
-            self.disk_utilization[run_state.bundle.uuid]['running'] = False
-            self.disk_utilization.remove(run_state.bundle.uuid)
+            self.disk_usage_tracker.untrack(run_state.bundle.uuid)
+            self.container_stats_sampler.untrack(run_state.bundle.uuid)
             return run_state._replace(stage=RunStage.CLEANING_UP, run_status='Uploading results')
         else:
             return run_state
@@ -520,9 +512,8 @@ class RunStateMachine(StateTransitioner):
                 self.dependency_manager.release(run_state.bundle.uuid, dep_key)
 
         # Clean up dependencies paths
-        for path in self.paths_to_remove:
+        for path in self.paths_to_remove.pop(run_state.bundle.uuid, []):
             remove_path_no_fail(path)
-        self.paths_to_remove = []
 
         if run_state.is_restaged:
             return run_state._replace(stage=RunStage.RESTAGED)
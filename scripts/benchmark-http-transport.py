@@ -0,0 +1,119 @@
+"""
+Benchmarks sending small requests with the REST clients (worker.rest_client.RestClient).
+
+A local stand-in for the REST server answers every request with a small JSON document over HTTP/1.1
+keep-alive connections. Requests are sent by several threads sharing one client, the way the
+worker sends its checkins and replies:
+
+    python scripts/benchmark-http-transport.py --num-requests 2000 --num-threads 4
+
+The throughput and number of connections opened with the pooled connections of HttpTransport are
+reported along with those of urllib.request.urlopen, which is how requests used to be sent. The
+stand-in server is local: with a remote server, and TLS, each connection saved saves more time.
+"""
+import sys
+
+sys.path.append('.')
+
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import socket
+import socketserver
+import threading
+import time
+import urllib.request
+
+from codalab.worker.http_transport import HttpTransport
+from codalab.worker.rest_client import RestClient
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer needs Python 3.7
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super(Handler, self).setup()
+        # Headers and bodies are written separately: don't delay the bodies
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.num_connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'data': {'type': 'reply', 'id': 1}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Client(RestClient):
+    def _get_access_token(self):
+        return 'token'
+
+
+class UrlopenClient(Client):
+    """
+    Sends its requests with urllib.request.urlopen, which opens a connection per request.
+    """
+
+    def _make_request(self, method, path, query_params=None, headers=None, data=None):
+        path, headers, data = self._prepare_request(path, query_params, headers, data, True)
+        request = urllib.request.Request(self._base_url + path, data=data, headers=headers)
+        request.get_method = lambda: method
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode())
+
+
+def measure(client, num_requests, num_threads):
+    """
+    Returns the time taken by num_threads threads sharing the client to send num_requests requests.
+    """
+
+    def send_requests():
+        for _ in range(num_requests // num_threads):
+            client._make_request('POST', '/workers/0x1/reply/1', data={'type': 'reply'})
+
+    threads = [threading.Thread(target=send_requests) for _ in range(num_threads)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--num-requests', type=int, default=2000)
+    parser.add_argument('--num-threads', type=int, default=4)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d/rest' % server.server_address[1]
+
+    print('%-20s %12s %12s' % ('', 'requests/s', 'connections'))
+    for name, client in [
+        ('urlopen', UrlopenClient(base_url)),
+        ('HttpTransport', Client(base_url, HttpTransport())),
+    ]:
+        server.num_connections = 0
+        duration = measure(client, args.num_requests, args.num_threads)
+        print('%-20s %12.0f %12d' % (name, args.num_requests / duration, server.num_connections))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
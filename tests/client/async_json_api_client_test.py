@@ -0,0 +1,98 @@
+import asyncio
+from io import BytesIO
+import threading
+import time
+import unittest
+
+from codalab.client.async_json_api_client import AsyncJsonApiClient
+from codalab.common import NotFoundError
+from codalab.worker.bundle_state import State
+
+
+class FakeJsonApiClient(object):
+    """
+    Fake of the JsonApiClient methods used by AsyncJsonApiClient, which records the number of
+    concurrent calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_calls = 0
+        self.num_running = 0
+        self.max_running = 0
+        self.states = {}
+
+    def call(self):
+        with self.lock:
+            self.num_calls += 1
+            self.num_running += 1
+            self.max_running = max(self.max_running, self.num_running)
+        time.sleep(0.01)
+        with self.lock:
+            self.num_running -= 1
+
+    def create(self, resource_type, data, params=None):
+        self.call()
+        result = []
+        for info in data:
+            with self.lock:
+                uuid = '0x%032x' % len(self.states)
+                self.states[uuid] = [State.CREATED, State.RUNNING, State.READY]
+            result.append(dict(info, id=uuid))
+        return result
+
+    def fetch_bundle_states(self, bundle_uuids):
+        self.call()
+        return {
+            uuid: {
+                'state': self.states[uuid].pop(0) if len(self.states[uuid]) > 1 else 'ready',
+                'run_status': None,
+                'last_updated': None,
+            }
+            for uuid in bundle_uuids
+            if uuid in self.states
+        }
+
+    def fetch_contents_blob(self, target, range_=None, head=None, tail=None):
+        return BytesIO(b'contents')
+
+
+class AsyncJsonApiClientTest(unittest.TestCase):
+    def setUp(self):
+        self.fake_client = FakeJsonApiClient()
+        self.client = AsyncJsonApiClient(self.fake_client, max_concurrency=3)
+        self.client.BATCH_SIZE = 10
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+
+    def test_create_and_wait_bundles(self):
+        infos = [{'bundle_type': 'run', 'metadata': {'name': 'run%d' % i}} for i in range(95)]
+        created = self.loop.run_until_complete(self.client.create_bundles(infos))
+        self.assertEqual([info['metadata'] for info in created], [i['metadata'] for i in infos])
+        self.assertEqual(self.fake_client.num_calls, 10)
+        self.assertEqual(self.fake_client.max_running, 3)
+
+        uuids = [info['id'] for info in created]
+        states = self.loop.run_until_complete(self.client.wait_bundles(uuids, poll_interval=0))
+        self.assertEqual(states, {uuid: State.READY for uuid in uuids})
+        # Three rounds of 10 batched requests
+        self.assertEqual(self.fake_client.num_calls, 40)
+        self.assertEqual(self.fake_client.max_running, 3)
+
+    def test_wait_missing_bundles(self):
+        created = self.loop.run_until_complete(self.client.create_bundles([{}]))
+        with self.assertRaisesRegex(NotFoundError, '0x1'):
+            self.loop.run_until_complete(
+                self.client.wait_bundles([created[0]['id'], '0x1'], poll_interval=0)
+            )
+
+    def test_fetch_contents_blob(self):
+        self.client.CHUNK_SIZE = 3
+
+        async def read():
+            return [chunk async for chunk in self.client.fetch_contents_blob(None)]
+
+        self.assertEqual(self.loop.run_until_complete(read()), [b'con', b'ten', b'ts'])
@@ -1,14 +1,19 @@
 """
 Unit tests for the static methods of the JsonApiClient
 """
+from io import BytesIO
+import json
+import mock
 import unittest
 
 from codalab.client.json_api_client import (
     EmptyJsonApiRelationship,
     JsonApiClient,
     JsonApiRelationship,
+    parse_byteranges_document,
 )
-from codalab.common import PreconditionViolation
+from codalab.common import NotFoundError, PreconditionViolation, UsageError
+from codalab.rest.bundles import build_byteranges_document
 
 
 class JsonApiClientTest(unittest.TestCase):
@@ -131,3 +136,84 @@ class JsonApiClientTest(unittest.TestCase):
             client.fetch_one(2)
         with self.assertRaises(PreconditionViolation):
             client.fetch_one(10)
+
+    def test_fetch_iter(self):
+        def document(ids, next_cursor):
+            return {
+                'data': [{'type': 'bundles', 'id': id_} for id_ in ids],
+                'meta': {'next_cursor': next_cursor},
+            }
+
+        pages = {
+            '': [document(['1', '2'], 'second'), document(['3'], 'second')],
+            'second': [document(['4'], None)],
+        }
+        cursors = []
+
+        def fetch_stream(resource_type, params):
+            cursors.append(params['cursor'])
+            lines = [json.dumps(doc) + '\n' for doc in pages[params['cursor']]]
+            return BytesIO(''.join(lines).encode())
+
+        self.client._fetch_stream = fetch_stream
+        results = self.client.fetch_iter('bundles', params={'keywords': ['.mine']})
+        self.assertEqual([result['id'] for result in results], ['1', '2', '3', '4'])
+        self.assertEqual(cursors, ['', 'second'])
+
+    def test_create_bundles_ndjson(self):
+        requests = []
+
+        def make_request(method, path, query_params, headers, data, return_response):
+            requests.append(data)
+            return BytesIO(response)
+
+        self.client._make_request = make_request
+        infos = [{'bundle_type': 'run', 'command': 'echo %d' % i} for i in range(2)]
+        response = b'{"id": "0x1"}\n\n{"id": "0x2"}\n'
+        self.assertEqual(self.client.create_bundles_ndjson(infos), ['0x1', '0x2'])
+        # One resource object per line
+        self.assertEqual(
+            [json.loads(line)['attributes'] for line in requests[0].splitlines()], infos
+        )
+
+        response = b'{"id": "0x1"}\n{"error": "Invalid command", "line": 2}\n'
+        with self.assertRaisesRegex(UsageError, 'line 2: Invalid command.*1 bundles created'):
+            self.client.create_bundles_ndjson(infos)
+
+    def test_wait_all(self):
+        def info(state, last_updated=None):
+            return {'state': state, 'run_status': None, 'last_updated': last_updated}
+
+        responses = [
+            {'a': info('running', 1), 'b': info('staged')},
+            {'a': info('running', 1), 'b': info('staged')},
+            {'a': info('running', 1), 'b': info('ready')},
+            {'a': info('ready', 2)},
+        ]
+        requested = []
+
+        def fetch_bundle_states(uuids):
+            requested.append(uuids)
+            return responses.pop(0)
+
+        self.client.fetch_bundle_states = fetch_bundle_states
+        with mock.patch('time.sleep') as sleep:
+            states = self.client.wait_all(['a', 'b'], min_interval=1, max_interval=10, backoff=2)
+        self.assertEqual(states, {'a': info('ready', 2), 'b': info('ready')})
+        # Only the bundles not done yet are polled
+        self.assertEqual(requested, [['a', 'b'], ['a', 'b'], ['a', 'b'], ['a']])
+        # The interval grows while nothing changes, and is reset by changes
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [1, 2, 1])
+
+        self.client.fetch_bundle_states = lambda uuids: {}
+        with self.assertRaises(NotFoundError):
+            self.client.wait_all(['c'])
+
+    def test_byteranges_document(self):
+        byte_ranges = [(0, 3), (10, 19), (100, 109), (4, 5)]
+        # The sections can contain the boundary
+        sections = [b'--ab', b'\r\n--ab--\r\n', b'', b'cd']
+        document = build_byteranges_document(byte_ranges, sections, 12, 'text/plain', 'ab')
+        self.assertEqual(
+            parse_byteranges_document(document, 'ab'), {0: b'--ab', 10: sections[1], 4: b'cd'}
+        )
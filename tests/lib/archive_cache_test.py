@@ -0,0 +1,129 @@
+from io import BytesIO
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import mock
+
+from codalab.lib.archive_cache import ArchiveCache
+from codalab.lib.download_manager import DownloadManager
+from codalab.worker import file_util
+from codalab.worker.bundle_state import State
+from codalab.worker.download_util import BundleTarget
+
+
+class ArchiveCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ArchiveCache(self.cache_dir, 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_key(self):
+        key = ArchiveCache.get_key('0x1', 'data', '0xabc', ArchiveCache.TAR_GZ)
+        self.assertEqual(key, ArchiveCache.get_key('0x1', 'data', '0xabc', ArchiveCache.TAR_GZ))
+        self.assertNotEqual(key, ArchiveCache.get_key('0x1', 'data', '0xdef', ArchiveCache.TAR_GZ))
+        self.assertNotEqual(key, ArchiveCache.get_key('0x1', 'data', '0xabc', 'tar.bz2'))
+
+    def test_tee(self):
+        self.assertIsNone(self.cache.get('a'))
+        fileobj = self.cache.tee('a', BytesIO(b'archive'))
+        self.assertEqual(fileobj.read(3), b'arc')
+        # Not cached until read to the end
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(fileobj.read(), b'hive')
+        self.assertEqual(fileobj.read(), b'')
+        fileobj.close()
+        with self.cache.get('a') as cached:
+            self.assertEqual(cached.read(), b'archive')
+
+    def test_tee_closed_early(self):
+        fileobj = self.cache.tee('a', BytesIO(b'archive'))
+        fileobj.read(3)
+        fileobj.close()
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_tee_incomplete(self):
+        fileobj = self.cache.tee('a', BytesIO(b'archive'), is_complete=lambda: False)
+        self.assertEqual(fileobj.read(), b'archive')
+        fileobj.close()
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_prune(self):
+        self.cache.PRUNE_INTERVAL = 0
+        for i, key in enumerate(['a', 'b', 'c']):
+            self.cache.tee(key, BytesIO(b'x' * 40)).read()
+            os.utime(os.path.join(self.cache_dir, key), (i, i))
+        # a was used least recently
+        self.cache.tee('d', BytesIO(b'x' * 10)).read()
+        self.assertIsNone(self.cache.get('a'))
+        for key in ['b', 'c', 'd']:
+            self.assertIsNotNone(self.cache.get(key))
+
+
+class DownloadManagerArchiveCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bundle_path = os.path.join(self.temp_dir, 'bundle')
+        os.makedirs(os.path.join(self.bundle_path, 'data'))
+        with open(os.path.join(self.bundle_path, 'data', 'file'), 'w') as f:
+            f.write('contents')
+        self.bundle_model = mock.Mock()
+        self.bundle_model.get_bundle_states_and_data_hashes.return_value = {'0x1': (None, '0xa')}
+        bundle_store = mock.Mock()
+        bundle_store.get_bundle_location.return_value = self.bundle_path
+        self.download_manager = DownloadManager(
+            self.bundle_model,
+            None,
+            bundle_store,
+            ArchiveCache(os.path.join(self.temp_dir, 'cache'), 1000000),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def download_contents(self):
+        with mock.patch(
+            'codalab.worker.file_util.open_tar_gzip_directory', wraps=self.open_tar_gzip_directory
+        ):
+            fileobj = self.download_manager.stream_tarred_gzipped_directory(
+                BundleTarget('0x1', 'data')
+            )
+            contents = fileobj.read()
+            fileobj.close()
+        return contents
+
+    def download(self):
+        with tarfile.open(fileobj=BytesIO(self.download_contents()), mode='r:gz') as tar:
+            return tar.extractfile('./file').read()
+
+    def test_archive_cached_for_final_states(self):
+        self.open_tar_gzip_directory = mock.Mock(wraps=file_util.open_tar_gzip_directory)
+        self.bundle_model.get_bundle_state.return_value = State.READY
+        self.assertEqual(self.download(), b'contents')
+        self.assertEqual(self.download(), b'contents')
+        self.assertEqual(self.open_tar_gzip_directory.call_count, 1)
+
+        # Archives of bundles that can still change aren't cached
+        self.bundle_model.get_bundle_state.return_value = State.UPLOADING
+        self.download()
+        self.download()
+        self.assertEqual(self.open_tar_gzip_directory.call_count, 3)
+
+    def test_failed_archive_not_cached(self):
+        def open_tar_gzip_directory(directory_path):
+            # tar fails partway through the directory
+            return subprocess.Popen(['sh', '-c', 'printf partial; exit 2'], stdout=subprocess.PIPE)
+
+        self.open_tar_gzip_directory = mock.Mock(side_effect=open_tar_gzip_directory)
+        self.bundle_model.get_bundle_state.return_value = State.READY
+        self.assertEqual(self.download_contents(), b'partial')
+        self.assertEqual(self.download_contents(), b'partial')
+        self.assertEqual(self.open_tar_gzip_directory.call_count, 2)
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'cache')), [])
@@ -0,0 +1,150 @@
+import threading
+import time
+import unittest
+
+from codalab.common import NotFoundError
+from codalab.lib.batch_reader import BatchReader
+from codalab.worker.download_util import BundleTarget
+
+
+class FakeBundleModel(object):
+    def __init__(self, workers):
+        self.workers = workers
+
+    def get_bundle_workers(self, uuids):
+        return {uuid: self.workers[uuid] for uuid in uuids if uuid in self.workers}
+
+
+class FakeDownloadManager(object):
+    """
+    Serves bundles whose files are given as {bundle_uuid: {subpath: contents}}, where a subpath
+    might point into a dependency {bundle_uuid: {subpath: target}}.
+    """
+
+    def __init__(self, files, dependencies={}, read_delay=0):
+        self.files = files
+        self.dependencies = dependencies
+        self.read_delay = read_delay
+        self.get_target_info_calls = []
+        self.lock = threading.Lock()
+        self.num_reads = 0
+        self.max_num_reads = 0
+
+    def get_target_info(self, target, depth):
+        self.get_target_info_calls.append((target.bundle_uuid, target.subpath, depth))
+        dependency = self.dependencies.get(target.bundle_uuid, {}).get(target.subpath)
+        if dependency is not None:
+            return self.get_target_info(dependency, depth)
+        files = self.files.get(target.bundle_uuid, {})
+        if target.subpath in files:
+            return {'name': target.subpath, 'type': 'file', 'resolved_target': target}
+        if target.subpath == '':
+            info = {'name': '', 'type': 'directory', 'resolved_target': target}
+            if depth > 0:
+                info['contents'] = [
+                    {'name': subpath, 'type': 'file'} for subpath in files if '/' not in subpath
+                ]
+            return info
+        raise NotFoundError(target.subpath)
+
+    def summarize_file(
+        self, target, num_head_lines, num_tail_lines, max_line_length, truncation_text, gzipped
+    ):
+        with self.lock:
+            self.num_reads += 1
+            self.max_num_reads = max(self.max_num_reads, self.num_reads)
+        try:
+            time.sleep(self.read_delay)
+            contents = self.files.get(target.bundle_uuid, {}).get(target.subpath)
+            if contents is None:
+                raise NotFoundError(target.subpath)
+            return '\n'.join(contents.split('\n')[:num_head_lines]).encode()
+        finally:
+            with self.lock:
+                self.num_reads -= 1
+
+
+class BatchReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.reader = BatchReader(max_threads=8, max_reads_per_worker=2)
+
+    def test_get_target_infos(self):
+        download_manager = FakeDownloadManager(
+            {'0x1': {'stats': 'a\t1', 'options': 'b\t2'}, '0x2': {'stats': 'a\t3'}},
+            {'0x1': {'data': BundleTarget('0x2', 'stats')}},
+        )
+        targets = [
+            BundleTarget('0x1', 'stats'),
+            BundleTarget('0x1', 'options'),
+            BundleTarget('0x1', 'data'),
+            BundleTarget('0x1', 'missing'),
+            BundleTarget('0x2', 'stats'),
+        ]
+        infos = self.reader.get_target_infos(FakeBundleModel({}), download_manager, targets)
+        self.assertEqual(infos[targets[0]]['type'], 'file')
+        self.assertEqual(infos[targets[0]]['resolved_target'], targets[0])
+        self.assertEqual(infos[targets[1]]['resolved_target'], targets[1])
+        # Paths into dependencies aren't listed, and are resolved one at a time
+        self.assertEqual(infos[targets[2]]['resolved_target'], BundleTarget('0x2', 'stats'))
+        self.assertIsNone(infos[targets[3]])
+        self.assertEqual(infos[targets[4]]['resolved_target'], targets[4])
+        # The files of 0x1 are resolved with one listing of the bundle
+        calls_0x1 = [call for call in download_manager.get_target_info_calls if call[0] == '0x1']
+        self.assertEqual(
+            sorted(calls_0x1), [('0x1', '', 1), ('0x1', 'data', 0), ('0x1', 'missing', 0)]
+        )
+
+    def test_head_targets(self):
+        download_manager = FakeDownloadManager({'0x1': {'stats': 'a\t1\nb\t2\nc\t3'}})
+        targets = [BundleTarget('0x1', 'stats'), BundleTarget('0x1', 'missing')]
+        contents = self.reader.head_targets(FakeBundleModel({}), download_manager, targets, 2, 1024)
+        self.assertEqual(contents, {targets[0]: ['a\t1\n', 'b\t2'], targets[1]: None})
+
+    def test_reads_per_worker(self):
+        files = {'0x%d' % i: {'stats': 'a\t%d' % i} for i in range(8)}
+        download_manager = FakeDownloadManager(files, read_delay=0.05)
+        bundle_model = FakeBundleModel({uuid: ('0', 'worker') for uuid in files})
+        targets = [BundleTarget(uuid, 'stats') for uuid in files]
+        contents = self.reader.head_targets(bundle_model, download_manager, targets, 10, 1024)
+        self.assertEqual(len(contents), 8)
+        self.assertEqual(download_manager.max_num_reads, 2)
+
+    def test_slow_worker_does_not_hold_threads(self):
+        reader = BatchReader(max_threads=3, max_reads_per_worker=1)
+        files = {'0x%d' % i: {'stats': 'a\t%d' % i} for i in range(10)}
+        download_manager = FakeDownloadManager(files)
+        # The bundles of the first worker are read until released
+        slow_uuids = ['0x%d' % i for i in range(8)]
+        release = threading.Event()
+        summarize_file = download_manager.summarize_file
+
+        def slow_summarize_file(target, *args, **kwargs):
+            if target.bundle_uuid in slow_uuids:
+                release.wait(5)
+            return summarize_file(target, *args, **kwargs)
+
+        download_manager.summarize_file = slow_summarize_file
+        workers = {uuid: ('0', 'slow' if uuid in slow_uuids else 'fast') for uuid in files}
+        bundle_model = FakeBundleModel(workers)
+        slow_contents = []
+        thread = threading.Thread(
+            target=lambda: slow_contents.append(
+                reader.head_targets(
+                    bundle_model,
+                    download_manager,
+                    [BundleTarget(uuid, 'stats') for uuid in slow_uuids],
+                    10,
+                    1024,
+                )
+            )
+        )
+        thread.start()
+        # The bundles of the other worker are read while the first worker is slow
+        fast_targets = [BundleTarget('0x8', 'stats'), BundleTarget('0x9', 'stats')]
+        contents = reader.head_targets(bundle_model, download_manager, fast_targets, 10, 1024)
+        self.assertFalse(release.is_set())
+        self.assertEqual(contents, {fast_targets[0]: ['a\t8'], fast_targets[1]: ['a\t9']})
+        release.set()
+        thread.join()
+        self.assertEqual(len(slow_contents[0]), 8)
+        self.assertEqual(reader._worker_tasks, {})
@@ -0,0 +1,56 @@
+import unittest
+
+from codalab.lib.block_cache import BlockCache, get_block_key
+from codalab.worker.bundle_state import State
+
+
+def table_block(*states):
+    return {
+        'mode': 'table',
+        'bundles_spec': {
+            'bundle_infos': [{'uuid': '0x%d' % i, 'state': state} for i, state in enumerate(states)]
+        },
+        'rows': [],
+    }
+
+
+class BlockCacheTest(unittest.TestCase):
+    def test_block_key(self):
+        key = get_block_key(table_block(State.READY, State.FAILED), brief=False)
+        self.assertIsNotNone(key)
+        self.assertEqual(key, get_block_key(table_block(State.READY, State.FAILED), brief=False))
+        self.assertNotEqual(key, get_block_key(table_block(State.READY, State.FAILED), brief=True))
+        self.assertNotEqual(key, get_block_key(table_block(State.READY, State.READY), brief=False))
+        # The contents of running bundles can change without their infos changing
+        self.assertIsNone(get_block_key(table_block(State.READY, State.RUNNING), brief=False))
+        self.assertIsNone(get_block_key({'mode': 'markup_block', 'text': ''}, brief=False))
+
+    def test_get_returns_copies(self):
+        cache = BlockCache()
+        block = {'rows': [{'a': 1}]}
+        cache.put('key', block)
+        block['rows'].append({'a': 2})
+        cached_block = cache.get('key')
+        self.assertEqual(cached_block, {'rows': [{'a': 1}]})
+        cached_block['rows'].clear()
+        self.assertEqual(cache.get('key'), {'rows': [{'a': 1}]})
+        self.assertIsNone(cache.get('other'))
+
+    def test_lru(self):
+        cache = BlockCache(max_blocks=2)
+        cache.put('first', {})
+        cache.put('second', {})
+        cache.get('first')
+        cache.put('third', {})
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('first'), {})
+
+    def test_max_bytes(self):
+        cache = BlockCache(max_bytes=100)
+        cache.put('first', {'text': 'x' * 40})
+        cache.put('second', {'text': 'x' * 40})
+        self.assertIsNone(cache.get('first'))
+        # Blocks larger than the cache are not cached at all
+        cache.put('large', {'text': 'x' * 100})
+        self.assertIsNone(cache.get('large'))
+        self.assertIsNotNone(cache.get('second'))
@@ -1,5 +1,8 @@
+from io import StringIO
+import mock
 import unittest
 from codalab.lib.bundle_cli import BundleCLI
+from codalab.worker.download_util import BundleTarget
 
 
 class BundleCliTest(unittest.TestCase):
@@ -26,3 +29,52 @@ class BundleCliTest(unittest.TestCase):
         expected_result = ['cl', 'run', "echo 'hello world!'"]
         actual_result = self.bundle_cli.collapse_bare_command(argv)
         self.assertEqual(actual_result, expected_result)
+
+
+class FollowTargetsTest(unittest.TestCase):
+    def test_follow_targets(self):
+        uuid = '0x' + '1' * 32
+        updates = [
+            {'state': 'running', 'files': []},
+            {'state': 'running', 'files': [{'contents': b'hello '}]},
+            {'state': 'ready', 'files': [{'contents': b'world'}]},
+            {'state': 'ready', 'files': [{'contents': b''}]},
+        ]
+        client = mock.Mock()
+        client.fetch_contents_info.return_value = {
+            'type': 'file',
+            'size': 0,
+            'resolved_target': BundleTarget(uuid, 'stdout'),
+        }
+        client.fetch_bundle_updates.side_effect = updates
+        cli = BundleCLI.__new__(BundleCLI)
+        cli.stdout = StringIO()
+        self.assertEqual(cli.follow_targets(client, uuid, ['stdout'], from_start=True), 'ready')
+        self.assertEqual(cli.stdout.getvalue(), 'hello world')
+        # The state and contents of the bundle are fetched with the updates only
+        self.assertEqual(
+            [c[0][:3] for c in client.fetch_bundle_updates.call_args_list],
+            [
+                (uuid, None, []),
+                (uuid, 'running', [('stdout', 0)]),
+                (uuid, 'running', [('stdout', 6)]),
+                (uuid, 'ready', [('stdout', 11)]),
+            ],
+        )
+        client.fetch.assert_not_called()
+
+    def test_follow_targets_retry_after(self):
+        uuid = '0x' + '1' * 32
+        client = mock.Mock()
+        client.fetch_bundle_updates.side_effect = [
+            {'state': 'running', 'files': []},
+            {'state': 'running', 'files': [], 'retry_after': 5},
+            {'state': 'ready', 'files': []},
+            {'state': 'ready', 'files': []},
+        ]
+        cli = BundleCLI.__new__(BundleCLI)
+        cli.stdout = StringIO()
+        with mock.patch('time.sleep') as sleep:
+            self.assertEqual(cli.follow_targets(client, uuid, []), 'ready')
+        # The client waits before asking again when the server is too busy to wait
+        sleep.assert_called_once_with(5)
@@ -0,0 +1,113 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+from codalab.lib.bundle_fuse import ByteRangeReader, DiskChunkCache
+
+
+class FakeClient(object):
+    """
+    Serves the contents of files from memory, and records the requests and byte ranges fetched.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.ranges = []
+
+    def fetch_contents_blob_ranges(self, target, ranges):
+        with self.lock:
+            self.num_requests += 1
+            self.ranges.extend((target.subpath, range_) for range_ in ranges)
+        return [self.files[target.subpath][start : end + 1] for start, end in ranges]
+
+
+class ByteRangeReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.contents = bytes(range(256)) * 4
+        self.client = FakeClient({'/file': self.contents})
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_reader(self, **kwargs):
+        reader = ByteRangeReader(self.client, '0x1', chunk_size=100, **kwargs)
+        self.addCleanup(reader.close)
+        return reader
+
+    def read_sequentially(self, reader, length=50):
+        data = b''
+        for offset in range(0, len(self.contents), length):
+            data += reader.read('/file', length, offset, len(self.contents))
+        return data
+
+    def test_read(self):
+        reader = self.create_reader(max_read_ahead=0)
+        self.assertEqual(reader.read('/file', 150, 75), self.contents[75:225])
+        self.assertEqual(reader.read('/file', 100, 1000), self.contents[1000:])
+        # Full chunks are cached, the partial last chunk isn't
+        self.assertEqual(reader.read('/file', 10, 120), self.contents[120:130])
+        reader.read('/file', 10, 1010)
+        self.assertEqual(
+            self.client.ranges,
+            [('/file', (0, 99)), ('/file', (100, 199)), ('/file', (200, 299))]
+            + [('/file', (1000, 1099))] * 2,
+        )
+        # The chunks missing for a read are fetched with one request
+        self.assertEqual(self.client.num_requests, 3)
+
+    def test_read_ahead(self):
+        reader = self.create_reader(max_read_ahead=4)
+        self.client.files['/file'] = self.contents = self.contents[:1000]
+        self.assertEqual(self.read_sequentially(reader), self.contents)
+        # Every chunk is fetched once, and no further than the end of the file
+        self.assertEqual(
+            sorted(self.client.ranges), [('/file', (i, i + 99)) for i in range(0, 1000, 100)]
+        )
+        # Chunks read ahead are fetched together
+        self.assertLess(self.client.num_requests, 10)
+
+    def test_no_read_ahead_on_random_reads(self):
+        reader = self.create_reader(max_read_ahead=4)
+        for offset in [500, 100, 800, 300]:
+            reader.read('/file', 10, offset, len(self.contents))
+        self.assertEqual(len(self.client.ranges), 4)
+
+    def test_immutable_disk_cache(self):
+        disk_cache = DiskChunkCache(self.temp_dir, 10000)
+        reader = self.create_reader(immutable=True, disk_cache=disk_cache, max_read_ahead=0)
+        self.assertEqual(self.read_sequentially(reader), self.contents)
+        self.assertEqual(len(self.client.ranges), 11)
+
+        # Another mount reads the chunks, including the partial last one, from the disk
+        reader = self.create_reader(
+            immutable=True, disk_cache=DiskChunkCache(self.temp_dir, 10000), max_read_ahead=0
+        )
+        self.assertEqual(self.read_sequentially(reader), self.contents)
+        self.assertEqual(len(self.client.ranges), 11)
+
+
+class DiskChunkCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_eviction(self):
+        cache = DiskChunkCache(self.temp_dir, 25)
+        cache.put('a', b'a' * 10)
+        cache.put('b', b'b' * 10)
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        # b is the least recently used
+        cache.put('c', b'c' * 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        self.assertEqual(cache.get('c'), b'c' * 10)
+
+        # The cache is bounded when it's opened again with a smaller size
+        cache = DiskChunkCache(self.temp_dir, 15)
+        self.assertEqual(len([key for key in 'ac' if cache.get(key) is not None]), 1)
@@ -0,0 +1,78 @@
+import unittest
+
+from codalab.lib.bundle_util import mimic_bundles
+
+
+class FakeClient(object):
+    """
+    Serves GET /bundles/ancestors from a graph of bundles, given as {uuid: [parent uuid, ...]}.
+    """
+
+    def __init__(self, parents):
+        self.parents = parents
+        self.requests = []
+
+    def fetch(self, resource, resource_id=None, params=None):
+        assert (resource, resource_id) == ('bundles', 'ancestors')
+        self.requests.append(params)
+        specs = params['specs']
+        uuids = list(specs) if isinstance(specs, list) else [specs]
+        for _ in range(params.get('descendant_depth', 0)):
+            uuids += [
+                uuid
+                for uuid, parents in self.parents.items()
+                if uuid not in uuids and any(parent in uuids for parent in parents)
+            ]
+        level = uuids
+        for _ in range(params['depth']):
+            level = [parent for uuid in level for parent in self.parents[uuid]]
+            uuids += [uuid for uuid in level if uuid not in uuids]
+        return [self.get_info(uuid) for uuid in uuids]
+
+    def get_info(self, uuid):
+        return {
+            'uuid': uuid,
+            'bundle_type': 'run',
+            'command': 'echo ' + uuid,
+            'metadata': {'name': uuid},
+            'dependencies': [
+                {'parent_uuid': parent, 'parent_path': '', 'child_uuid': uuid, 'child_path': parent}
+                for parent in self.parents[uuid]
+            ],
+        }
+
+
+class MimicBundlesTest(unittest.TestCase):
+    def setUp(self):
+        # d depends on c, which depends on b, which depends on a, which depends on x
+        self.client = FakeClient({'x': [], 'a': ['x'], 'b': ['a'], 'c': ['b'], 'd': ['c']})
+
+    def mimic(self, old_output, depth):
+        plan = mimic_bundles(
+            self.client,
+            old_inputs=['a'],
+            old_output=old_output,
+            new_inputs=['a2'],
+            new_output_name=None,
+            worksheet_uuid='0x1',
+            depth=depth,
+            shadow=False,
+            dry_run=True,
+        )
+        return [old_info['uuid'] for old_info, _ in plan]
+
+    def test_depth_from_output(self):
+        # The depth is the number of parents to look back from the output: a is 3 parents up
+        self.assertEqual(self.mimic('d', 3), ['b', 'c', 'd'])
+        self.assertEqual(self.client.requests[-1]['depth'], 2)
+        self.assertEqual(self.mimic('d', 2), [])
+        self.assertEqual(self.mimic('d', 0), [])
+        self.assertEqual(self.client.requests[-1]['depth'], 0)
+
+    def test_depth_from_inputs(self):
+        # The descendants of the inputs are mimicked down to depth
+        self.assertEqual(self.mimic(None, 2), ['b', 'c'])
+        self.assertEqual(
+            self.client.requests[-1], {'specs': ['a'], 'depth': 1, 'descendant_depth': 2}
+        )
+        self.assertEqual(self.mimic(None, 1), ['b'])
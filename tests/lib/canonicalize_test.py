@@ -2,8 +2,14 @@ import mock
 import os
 import unittest
 
-from codalab.common import UsageError
+from sqlalchemy import create_engine, event
+
+from codalab.bundles.dataset_bundle import DatasetBundle
+from codalab.common import NotFoundError, UsageError
 from codalab.lib import canonicalize, spec_util
+from codalab.lib.worksheet_util import bundle_item
+from codalab.model.bundle_model import BundleModel
+from codalab.objects.worksheet import Worksheet
 from codalab.worker.bundle_state import State
 
 
@@ -50,3 +56,85 @@ class CanonicalizeTest(unittest.TestCase):
                 model, user, worksheet_uuid, 'names have no exclamations!'
             ),
         )
+
+
+class GetBundleUuidsTest(unittest.TestCase):
+    def setUp(self):
+        self.model = BundleModel(create_engine('sqlite://'), {}, '0', '-1')
+        # Worksheet item values are stored as is in SQLite
+        self.model.encode_str = self.model.decode_str = lambda value: value
+        self.worksheet_uuid = self.create_worksheet('ws')
+        self.other_worksheet_uuid = self.create_worksheet('other')
+        self.uuids = {}
+        for name, worksheet_uuid in [
+            ('foo', self.worksheet_uuid),
+            ('bar', self.worksheet_uuid),
+            ('foo', self.worksheet_uuid),
+            ('baz', self.other_worksheet_uuid),
+        ]:
+            bundle = DatasetBundle.construct(
+                {'name': name, 'description': '', 'tags': [], 'license': '', 'source_url': ''},
+                owner_id='0',
+            )
+            bundle.is_anonymous = False
+            self.model.save_bundle(bundle)
+            self.model.add_worksheet_items(worksheet_uuid, [bundle_item(bundle.uuid)])
+            self.uuids.setdefault(name, []).append(bundle.uuid)
+
+    def create_worksheet(self, name):
+        worksheet = Worksheet({'name': name, 'title': None, 'frozen': None, 'items': []})
+        worksheet.owner_id = '0'
+        self.model.new_worksheet(worksheet)
+        return worksheet.uuid
+
+    def get_bundle_uuids(self, specs):
+        num_queries = [0]
+
+        def count_query(*args):
+            num_queries[0] += 1
+
+        event.listen(self.model.engine, 'before_cursor_execute', count_query)
+        try:
+            return canonicalize.get_bundle_uuids(self.model, None, self.worksheet_uuid, specs)
+        finally:
+            event.remove(self.model.engine, 'before_cursor_execute', count_query)
+            self.num_queries = num_queries[0]
+
+    def test_same_as_get_bundle_uuid(self):
+        specs = [
+            'foo',
+            'foo^2',
+            '^1',
+            '^3',
+            'ba.*',
+            self.uuids['bar'][0],
+            self.uuids['baz'][0][:10],
+            'other/baz',
+            'other/^1',
+        ]
+        expected = [
+            canonicalize.get_bundle_uuid(self.model, None, self.worksheet_uuid, spec)
+            for spec in specs
+        ]
+        self.assertEqual(expected[:2], [self.uuids['foo'][1], self.uuids['foo'][0]])
+        self.assertEqual(self.get_bundle_uuids(specs[:7]), expected[:7])
+        self.assertEqual(self.num_queries, 1)
+        self.assertEqual(self.get_bundle_uuids(specs), expected)
+        # The worksheet spec is resolved once however many specs it prefixes
+        num_queries = self.num_queries
+        self.assertEqual(self.get_bundle_uuids(specs * 3), expected * 3)
+        self.assertEqual(self.num_queries, num_queries)
+        self.assertEqual(self.get_bundle_uuids([]), [])
+
+    def test_errors(self):
+        # The error of the first spec that can't be resolved is raised
+        with self.assertRaisesRegex(NotFoundError, 'missing'):
+            self.get_bundle_uuids(['foo', 'missing', 'invalid!', 'foo^5'])
+        with self.assertRaisesRegex(UsageError, 'Invalid bundle_spec'):
+            self.get_bundle_uuids(['foo', 'invalid!', 'missing'])
+        with self.assertRaisesRegex(UsageError, 'index 5 out of bounds'):
+            self.get_bundle_uuids(['foo^5', 'missing_worksheet/foo'])
+        with self.assertRaisesRegex(NotFoundError, 'No worksheet found'):
+            self.get_bundle_uuids(['missing_worksheet/foo', 'foo^5'])
+        with self.assertRaisesRegex(UsageError, 'Nothing is specified'):
+            canonicalize.get_bundle_uuids(self.model, None, None, ['^1'])
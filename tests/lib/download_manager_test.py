@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from codalab.lib.download_manager import DownloadManager, FileSection
+from codalab.worker.bundle_state import State
+from codalab.worker.download_util import BundleTarget
+
+
+class DownloadManagerFileSectionTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.temp_dir, 'file'), 'wb') as f:
+            f.write(b'0123456789')
+        bundle_model = mock.Mock()
+        bundle_model.get_bundle_state.return_value = State.READY
+        bundle_store = mock.Mock()
+        bundle_store.get_bundle_location.return_value = self.temp_dir
+        self.download_manager = DownloadManager(bundle_model, None, bundle_store)
+        self.target = BundleTarget('0x1', 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_stream_file_section(self):
+        fileobj = self.download_manager.stream_file_section(self.target, 2, 5, False)
+        self.assertIsInstance(fileobj, FileSection)
+        self.assertEqual(fileobj.length, 5)
+        # The file descriptor is positioned at the offset, for sendfile
+        self.assertEqual(os.lseek(fileobj.fileno(), 0, os.SEEK_CUR), 2)
+        self.assertEqual(fileobj.read(3), b'234')
+        self.assertEqual(fileobj.read(), b'56')
+        self.assertEqual(fileobj.read(), b'')
+        fileobj.close()
+
+        # Past the end of the file
+        fileobj = self.download_manager.stream_file_section(self.target, 8, 5, False)
+        self.assertEqual((fileobj.length, fileobj.read()), (2, b'89'))
+        fileobj.close()
+
+    def test_read_file_sections(self):
+        self.assertEqual(
+            self.download_manager.read_file_sections(
+                self.target, [(0, 2), (5, 3), (9, 5), (20, 1)]
+            ),
+            [b'01', b'567', b'9', b''],
+        )
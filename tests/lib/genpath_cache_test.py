@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from codalab.lib.genpath_cache import GenpathCache
+
+
+class GenpathCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_key(self):
+        key = GenpathCache.get_key('0x1', 'stats', '0xabc', 100)
+        self.assertEqual(key, GenpathCache.get_key('0x1', 'stats', '0xabc', 100))
+        self.assertNotEqual(key, GenpathCache.get_key('0x1', 'stats', '0xdef', 100))
+        self.assertNotEqual(key, GenpathCache.get_key('0x1', 'stats', '0xabc', 10))
+
+    def test_get_put(self):
+        cache = GenpathCache()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.put('a', {'train': {'acc': 0.9}})
+        info = cache.get('a')
+        self.assertEqual(info, {'train': {'acc': 0.9}})
+        # Callers get copies of the cached contents
+        info['train']['acc'] = 0
+        self.assertEqual(cache.get('a'), {'train': {'acc': 0.9}})
+        # Contents that don't survive a round trip through JSON aren't cached
+        cache.put('b', {1: 'a'})
+        self.assertIsNone(cache.get('b'))
+
+    def test_lru(self):
+        cache = GenpathCache(max_entries=2)
+        cache.put('a', 'a')
+        cache.put('b', 'b')
+        cache.get('a')
+        cache.put('c', 'c')
+        self.assertEqual(cache.get('a'), 'a')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'c')
+
+    def test_max_bytes(self):
+        cache = GenpathCache(max_bytes=10)
+        cache.put('a', 'a' * 20)
+        self.assertIsNone(cache.get('a'))
+        cache.put('b', 'b' * 4)
+        cache.put('c', 'c' * 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'cccc')
+
+    def test_cache_dir(self):
+        cache = GenpathCache(max_entries=1, cache_dir=self.cache_dir)
+        cache.put('a', ['a'])
+        cache.put('b', ['b'])
+        # Entries evicted from memory are still on disk, and shared with other caches
+        self.assertEqual(cache.get('a'), ['a'])
+        self.assertEqual(GenpathCache(cache_dir=self.cache_dir).get('b'), ['b'])
+
+    def test_prune_cache_dir(self):
+        cache = GenpathCache(cache_dir=self.cache_dir, max_disk_entries=10)
+        cache.PRUNE_INTERVAL = 5
+        for i in range(20):
+            cache.put(str(i), i)
+            path = cache._get_path(str(i))
+            os.utime(path, (i, i))
+        # Pruned down to the 9 most recently used entries after 15 and 20 writes
+        self.assertEqual(len(os.listdir(self.cache_dir)), 9)
+        self.assertFalse(os.path.exists(cache._get_path('10')))
+        self.assertTrue(os.path.exists(cache._get_path('11')))
@@ -0,0 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+import threading
+import types
+import unittest
+
+import mock
+
+from codalab.common import NotFoundError
+from codalab.lib.download_manager import DownloadManager
+from codalab.lib.worker_channel import LocalWorkerChannel, WorkerChannel, WorkerChannelUnavailable
+from codalab.worker.bundle_state import State
+from codalab.worker.download_util import BundleTarget
+from codalab.worker.reader import Reader
+
+
+class WorkerChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.channel = WorkerChannel(self.socket_dir)
+        self.channel.HEARTBEAT_INTERVAL = 0.1
+
+    def tearDown(self):
+        shutil.rmtree(self.socket_dir)
+
+    def open_stream(self, timeout, handle_request):
+        """
+        Consumes the stream of worker w of user u on a thread, calling handle_request with each
+        request. Returns once the stream is open.
+        """
+        stream_open = threading.Event()
+
+        def stream():
+            for line in self.channel.stream_requests('u', 'w', timeout):
+                stream_open.set()
+                if line.strip():
+                    handle_request(json.loads(line.decode()))
+
+        thread = threading.Thread(target=stream)
+        thread.start()
+        self.addCleanup(thread.join)
+        stream_open.wait()
+
+    def serve(self, timeout):
+        """
+        Replies to each request on its own thread with the number in the request, after the delay
+        in the request.
+        """
+
+        def reply(request):
+            threading.Event().wait(request['delay'])
+            self.channel.send_reply(
+                'u', 'w', request['id'], {'n': request['n']}, BytesIO(b'x' * request['n'])
+            )
+
+        self.open_stream(
+            timeout, lambda request: threading.Thread(target=reply, args=[request]).start()
+        )
+
+    def request(self, n, delay=0):
+        header, fileobj = self.channel.request('u', 'w', {'n': n, 'delay': delay}, 5)
+        with fileobj:
+            return header['n'], fileobj.read()
+
+    def test_concurrent_requests(self):
+        self.serve(timeout=1)
+        # Earlier requests reply last
+        delays = [0.02 * (20 - n) for n in range(20)]
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            replies = list(executor.map(self.request, range(20), delays))
+        self.assertEqual(replies, [(n, b'x' * n) for n in range(20)])
+
+    def test_no_channel(self):
+        with self.assertRaises(WorkerChannelUnavailable):
+            self.request(1)
+        # The channel is closed once the stream ends
+        self.serve(timeout=0.2)
+        self.assertEqual(self.request(1), (1, b'x'))
+        self.channel.CONNECT_TIMEOUT = 0.5
+        threading.Event().wait(0.5)
+        with self.assertRaises(WorkerChannelUnavailable):
+            self.request(1)
+
+    def test_reply_timeout(self):
+        requests = []
+        self.open_stream(0.5, requests.append)
+        self.assertEqual(self.channel.request('u', 'w', {}, 0.1), (None, None))
+        self.assertFalse(self.channel.send_reply('u', 'w', requests[0]['id'], {}))
+
+    def test_max_streams(self):
+        self.channel = WorkerChannel(self.socket_dir, max_streams=1)
+        self.channel.HEARTBEAT_INTERVAL = 0.1
+        self.open_stream(0.3, lambda request: None)
+        with self.assertRaises(WorkerChannelUnavailable):
+            self.channel.stream_requests('u', 'w2')
+        # The stream is released once it ends
+        threading.Event().wait(0.5)
+        self.assertEqual(next(self.channel.stream_requests('u', 'w2', 0)), b'\n')
+
+    def test_reply_from_other_worker(self):
+        replied = []
+
+        def reply(request):
+            # Replies can only be sent by the worker the request was made to
+            replied.append(self.channel.send_reply('u', 'w2', request['id'], {'n': 2}))
+            replied.append(self.channel.send_reply('u2', 'w', request['id'], {'n': 2}))
+            self.channel.send_reply('u', 'w', request['id'], {'n': 1})
+
+        self.open_stream(0.5, reply)
+        self.assertEqual(self.request(1), (1, b''))
+        self.assertEqual(replied, [False, False])
+
+
+class DownloadManagerWorkerChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.bundle_path = tempfile.mkdtemp()
+        with open(os.path.join(self.bundle_path, 'stdout'), 'wb') as f:
+            f.write(b'line 1\nline 2\nline 3\n')
+        self.reader = Reader()
+        run_state = types.SimpleNamespace(
+            bundle_path=self.bundle_path, bundle=types.SimpleNamespace(uuid='0x1', dependencies=[])
+        )
+        self.channel = LocalWorkerChannel()
+
+        def handle_request(request):
+            def reply(err, message={}, data=None):
+                if err:
+                    message = {'error_code': err[0], 'error_message': err[1]}
+                    data = None
+                if isinstance(data, bytes):
+                    data = BytesIO(data)
+                self.channel.send_reply('u', 'w', request['id'], message, data)
+
+            self.reader.read(run_state, request['path'], request['read_args'], reply)
+
+        self.channel.connect('u', 'w', handle_request)
+        bundle_model = mock.Mock()
+        bundle_model.get_bundle_state.return_value = State.RUNNING
+        bundle_model.get_bundle_dependencies.return_value = []
+        bundle_model.get_bundle_worker.return_value = {
+            'user_id': 'u',
+            'worker_id': 'w',
+            'shared_file_system': False,
+        }
+        self.worker_model = mock.Mock()
+        self.download_manager = DownloadManager(
+            bundle_model, self.worker_model, None, worker_channel=self.channel
+        )
+
+    def tearDown(self):
+        self.reader.stop()
+        shutil.rmtree(self.bundle_path)
+
+    def test_reads(self):
+        target = BundleTarget('0x1', 'stdout')
+        info = self.download_manager.get_target_info(target, 0)
+        self.assertEqual((info['name'], info['size']), ('stdout', 21))
+        self.assertEqual(info['resolved_target'], target)
+        with self.assertRaises(NotFoundError):
+            self.download_manager.get_target_info(BundleTarget('0x1', 'missing'), 0)
+
+        with closing(self.download_manager.stream_file(target, False)) as fileobj:
+            self.assertEqual(fileobj.read(), b'line 1\nline 2\nline 3\n')
+        self.assertEqual(
+            self.download_manager.summarize_file(target, 1, 1, 100, '...\n', False),
+            b'line 1\n...\nline 3\n',
+        )
+
+        # Reads are served concurrently over the channel
+        def read_section(offset):
+            return self.download_manager.read_file_section(target, offset, 6, False)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            sections = list(executor.map(read_section, [0, 7, 14]))
+        self.assertEqual(sections, [b'line 1', b'line 2', b'line 3'])
+        # No worker sockets were allocated
+        self.worker_model.allocate_socket.assert_not_called()
+
+    def test_worker_not_replying(self):
+        self.channel.connect('u', 'w', lambda request: None)
+        self.download_manager.WORKER_REPLY_TIMEOUT = 0.1
+        with self.assertRaises(NotFoundError):
+            self.download_manager.get_target_info(BundleTarget('0x1', 'stdout'), 0)
+        with self.assertRaises(NotFoundError):
+            self.download_manager.read_file_section(BundleTarget('0x1', 'stdout'), 0, 6, False)
+        # The reads weren't sent with the checkins
+        self.worker_model.allocate_socket.assert_not_called()
@@ -1,9 +1,23 @@
 import mock
+import os
+import shutil
 from sqlalchemy import create_engine
 from sqlalchemy.engine.reflection import Inspector
+import tempfile
+import threading
+import time
 import unittest
 
+from codalab.bundles.dataset_bundle import DatasetBundle
+from codalab.bundles.run_bundle import RunBundle
+from codalab.lib import bundle_util
 from codalab.model.bundle_model import BundleModel, db_metadata
+from codalab.model.tables import (
+    bundle_dependency as cl_bundle_dependency,
+    group_bundle_permission as cl_group_bundle_permission,
+)
+from codalab.lib.worksheet_util import bundle_item, markup_item
+from codalab.objects.worksheet import Worksheet, WORKSHEET_ITEM_SORT_KEY_GAP
 
 
 def metadata_to_dicts(uuid, metadata):
@@ -79,3 +93,452 @@ class MockBundle(object):
         result = dict(self._fields)
         result['metadata'] = metadata_to_dicts(result['uuid'], result['metadata'])
         return result
+
+
+class BundleSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.model = BundleModel(create_engine('sqlite://'), {}, '0', '-1')
+
+    def create_bundle(self, name, data_size, description='', tags=[]):
+        bundle = DatasetBundle.construct(
+            {
+                'name': name,
+                'description': description,
+                'tags': tags,
+                'license': '',
+                'source_url': '',
+                'data_size': data_size,
+            },
+            owner_id='0',
+        )
+        bundle.is_anonymous = False
+        self.model.save_bundle(bundle)
+        return bundle
+
+    def search(self, *keywords):
+        return self.model.search_bundles('0', list(keywords))['result']
+
+    def test_search_fields(self):
+        foo = self.create_bundle('foo', 5)
+        bar = self.create_bundle('bar', 500)
+        foobar = self.create_bundle('foobar', 50)
+        self.assertEqual(self.search('name=foo'), [foo.uuid])
+        self.assertEqual(set(self.search('foo')), {foo.uuid, foobar.uuid})
+        # Sorted as numbers rather than strings
+        self.assertEqual(self.search('size=.sort-'), [bar.uuid, foobar.uuid, foo.uuid])
+        self.assertEqual(self.search('size=.sum'), 555)
+        self.assertEqual(self.search('data_size=5,50', '.count'), 2)
+        # Patterns on numeric fields go through bundle_metadata
+        self.assertEqual(set(self.search('data_size=5%')), {bar.uuid, foobar.uuid, foo.uuid})
+
+    def test_search_fields_maintained_on_write(self):
+        foo = self.create_bundle('foo', 5)
+        self.model.update_bundle(foo, {'metadata': {'name': 'baz', 'data_size': 7}})
+        self.assertEqual(self.search('name=foo'), [])
+        self.assertEqual(self.search('name=baz', 'data_size=7'), [foo.uuid])
+        self.assertEqual(
+            self.model.get_bundle_uuids({'name': 'baz', 'worksheet_uuid': None}, 10), [foo.uuid]
+        )
+        self.model.delete_bundles([foo.uuid])
+        self.assertEqual(self.search('.count'), 0)
+
+    def test_batch_get_bundle_uuids(self):
+        foo = self.create_bundle('foo', 5)
+        bar = self.create_bundle('bar', 5)
+        # More queries than SQLite allows terms in a compound SELECT
+        queries = [({'name': name, 'worksheet_uuid': None}, 10) for name in ['foo', 'bar']] * 400
+        results = self.model.batch_get_bundle_uuids(queries)
+        self.assertEqual(results, [[foo.uuid], [bar.uuid]] * 400)
+
+    def test_keyword_search(self):
+        mnist = self.create_bundle('mnist-train', 5, description='Train a CNN on digits')
+        cifar = self.create_bundle('cifar', 5, description='Images', tags=['mnist_like'])
+        other = self.create_bundle('other', 5, description='Compare MNIST and CIFAR models')
+        # Matches on names rank before matches on tags and descriptions
+        self.assertEqual(self.search('mnist'), [mnist.uuid, cifar.uuid, other.uuid])
+        self.assertEqual(self.search('MNI'), [mnist.uuid, cifar.uuid, other.uuid])
+        # Every word of a keyword has to match
+        self.assertEqual(self.search('mnist_train'), [mnist.uuid])
+        self.assertEqual(set(self.search('cifar', 'mnist')), {cifar.uuid, other.uuid})
+        self.assertEqual(self.search(mnist.uuid[:8]), [mnist.uuid])
+        # Patterns match substrings of names
+        self.assertEqual(self.search('.*ist-tr.*'), [mnist.uuid])
+
+        self.model.update_bundle(cifar, {'metadata': {'tags': []}})
+        self.assertEqual(self.search('mnist', '.count'), 2)
+        self.model.delete_bundles([mnist.uuid])
+        self.assertEqual(self.search('mnist'), [other.uuid])
+
+    def test_keyword_search_worksheets(self):
+        def create_worksheet(name):
+            worksheet = Worksheet({'name': name, 'title': None, 'frozen': None, 'items': []})
+            worksheet.owner_id = '0'
+            self.model.new_worksheet(worksheet)
+            return worksheet
+
+        def search(*keywords):
+            return [row['name'] for row in self.model.search_worksheets('0', list(keywords))]
+
+        results = create_worksheet('results')
+        create_worksheet('mnist-results')
+        create_worksheet('other')
+        self.model.update_worksheet_metadata(results, {'tags': ['mnist']})
+        self.assertEqual(search('mnist'), ['mnist-results', 'results'])
+        self.assertEqual(search('res'), ['mnist-results', 'results'])
+        self.assertEqual(search('mnist', 'name=.sort-'), ['results', 'mnist-results'])
+        self.model.delete_worksheet(results.uuid)
+        self.assertEqual(search('mnist'), ['mnist-results'])
+
+    def test_pagination(self):
+        bundles = [self.create_bundle('bundle%d' % i, size) for i, size in enumerate([3, 1, 3, 2])]
+
+        def pages(*keywords):
+            cursor, uuids = '', []
+            while cursor is not None:
+                result = self.model.search_bundles('0', ['.limit=3'] + list(keywords), cursor)
+                uuids.append(result['result'])
+                cursor = result['next_cursor']
+            return uuids
+
+        uuids = [bundle.uuid for bundle in bundles]
+        self.assertEqual(pages(), [uuids[:3], uuids[3:]])
+        # Ties of the sort field are broken by id, in the same order
+        self.assertEqual(pages('size=.sort-'), [[uuids[2], uuids[0], uuids[3]], [uuids[1]]])
+        self.assertEqual(pages('size=.sort', '.limit=2'), [[uuids[1], uuids[3]], uuids[0::2]])
+        # Sorts that can't be paginated by keyset are paginated by offset
+        self.assertEqual(sum(pages('bundle'), []), uuids)
+        self.assertEqual(pages('.limit=4'), [uuids])
+
+    def test_bundle_info_rows(self):
+        foo = self.create_bundle('foo', 5, tags=['a', 'b'])
+        bar = self.create_bundle('bar', 7)
+        metadata = {
+            spec.key: spec.default for spec in RunBundle.METADATA_SPECS if not spec.generated
+        }
+        metadata.update({'name': 'run', 'tags': ['c'], 'request_cpus': 2, 'time': 1.5})
+        run = RunBundle.construct(
+            [('foo', (foo.uuid, '')), ('bar', (bar.uuid, 'data'))],
+            'cat foo bar/data',
+            metadata,
+            owner_id='1',
+        )
+        run.is_anonymous = True
+        self.model.save_bundle(run)
+        uuids = [foo.uuid, bar.uuid, run.uuid]
+
+        infos = bundle_util.bundle_rows_to_bundle_infos(
+            *self.model.batch_get_bundle_info_rows(uuids)
+        )
+        expected_infos = {
+            bundle.uuid: bundle_util.bundle_to_bundle_info(self.model, bundle)
+            for bundle in self.model.batch_get_bundles(uuid=uuids)
+        }
+        # Same infos as built from Bundle objects, except that the arguments built from metadata
+        # of Bundle objects come in no particular order
+        for uuid in uuids:
+            self.assertEqual(
+                sorted((infos[uuid].pop('args') or '').split(' ')),
+                sorted((expected_infos[uuid].pop('args') or '').split(' ')),
+            )
+        self.assertEqual(infos, expected_infos)
+        self.assertEqual(
+            [dep['parent_name'] for dep in infos[run.uuid]['dependencies']], ['foo', 'bar']
+        )
+        self.assertEqual(
+            self.model.get_children_names_and_owner_ids([foo.uuid, run.uuid]),
+            {foo.uuid: [(run.uuid, 'run', '1')], run.uuid: []},
+        )
+
+
+class LineageTest(unittest.TestCase):
+    def setUp(self):
+        self.model = BundleModel(create_engine('sqlite://'), {}, '0', '-1')
+        # a -> b -> d -> e, a -> c -> d, and x (not in the system) -> c
+        edges = [('a', 'b'), ('a', 'c'), ('b', 'd'), ('c', 'd'), ('d', 'e'), ('x', 'c')]
+        with self.model.engine.begin() as connection:
+            self.model.do_multirow_insert(
+                connection,
+                cl_bundle_dependency,
+                [
+                    {
+                        'parent_uuid': parent,
+                        'parent_path': '',
+                        'child_uuid': child,
+                        'child_path': '',
+                    }
+                    for parent, child in edges
+                ],
+            )
+
+    def check_lineage(self):
+        descendants = self.model.get_self_and_descendants
+        self.assertEqual(descendants(['a'], 0), ['a'])
+        self.assertEqual(descendants(['a'], 1)[0], 'a')
+        self.assertEqual(sorted(descendants(['a'], 1)[1:]), ['b', 'c'])
+        self.assertEqual(descendants(['a'], 3)[3:], ['d', 'e'])
+        self.assertEqual(descendants(['d', 'a', 'd'], 10)[:2], ['d', 'a'])
+        self.assertEqual(sorted(descendants(['d', 'a'], 10)), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(descendants([], 10), [])
+
+        ancestors = self.model.get_self_and_ancestors
+        self.assertEqual(ancestors(['e'], 1), ['e', 'd'])
+        self.assertEqual(sorted(ancestors(['e'], 2)[2:]), ['b', 'c'])
+        self.assertEqual(sorted(ancestors(['e'], 3)[4:]), ['a', 'x'])
+        self.assertEqual(ancestors(['a'], 10), ['a'])
+
+    def test_recursive_queries(self):
+        with self.model.engine.begin() as connection:
+            self.assertTrue(self.model._supports_recursive_queries(connection))
+        # One query per call
+        with mock.patch.object(self.model.engine, 'begin', wraps=self.model.engine.begin) as begin:
+            self.check_lineage()
+            self.assertEqual(begin.call_count, 9)
+
+    def test_without_recursive_queries(self):
+        with mock.patch.object(BundleModel, '_supports_recursive_queries', return_value=False):
+            self.check_lineage()
+
+
+class WorksheetItemTest(unittest.TestCase):
+    def setUp(self):
+        self.model = BundleModel(create_engine('sqlite://'), {}, '0', '-1')
+        # Worksheet item values are stored as is in SQLite
+        self.model.encode_str = self.model.decode_str = lambda value: value
+        worksheet = Worksheet({'name': 'ws', 'title': None, 'frozen': None, 'items': []})
+        worksheet.owner_id = '0'
+        self.model.new_worksheet(worksheet)
+        self.uuid = worksheet.uuid
+
+    def add(self, values, after=None):
+        self.model.add_worksheet_items(
+            self.uuid, [markup_item(value) for value in values], after_sort_key=after
+        )
+
+    def get_items(self):
+        return self.model.get_worksheet(self.uuid, fetch_items=True).items
+
+    def get_values(self):
+        return [item['value'] for item in self.get_items()]
+
+    def get_sort_key(self, value):
+        return next(item['sort_key'] for item in self.get_items() if item['value'] == value)
+
+    def test_append(self):
+        self.add(['a', 'b'])
+        self.add(['c'])
+        self.assertEqual(self.get_values(), ['a', 'b', 'c'])
+        self.assertEqual(
+            [item['sort_key'] for item in self.get_items()],
+            [WORKSHEET_ITEM_SORT_KEY_GAP * i for i in [1, 2, 3]],
+        )
+
+    def test_insert(self):
+        self.add(['a', 'd'])
+        self.add(['b', 'c'], after=self.get_sort_key('a'))
+        self.add(['e'], after=self.get_sort_key('d'))
+        self.assertEqual(self.get_values(), ['a', 'b', 'c', 'd', 'e'])
+        ids = {item['value']: item['id'] for item in self.get_items()}
+        # Keep inserting after the same item until the gap is exhausted
+        for i in range(20):
+            self.add([str(i)], after=self.get_sort_key('a'))
+        self.assertEqual(
+            self.get_values(), ['a'] + [str(i) for i in reversed(range(20))] + list('bcde')
+        )
+        # Items are never reinserted
+        self.assertEqual(
+            {item['value']: item['id'] for item in self.get_items()},
+            dict(ids, **{str(i): ids['e'] + i + 1 for i in range(20)}),
+        )
+
+    def test_update_worksheet_items(self):
+        self.add(['a', 'b'])
+        worksheet = self.model.get_worksheet(self.uuid, fetch_items=True)
+        # Items appended while the worksheet is edited are kept after the new items
+        self.add(['c'])
+        self.model.update_worksheet_items(
+            self.uuid, worksheet.last_item_id, 2, [markup_item(value) for value in 'xyz']
+        )
+        self.assertEqual(self.get_values(), ['x', 'y', 'z', 'c'])
+        self.add(['d'])
+        self.add(['w'], after=self.get_sort_key('x') - 1)
+        self.assertEqual(self.get_values(), ['w', 'x', 'y', 'z', 'c', 'd'])
+
+    def test_get_worksheet_items(self):
+        self.add(['a', 'c'])
+        self.add(['b'], after=self.get_sort_key('a'))
+        self.assertEqual(self.model.get_worksheet_item_count(self.uuid), 3)
+        self.assertEqual(self.model.get_worksheet_items(self.uuid), self.get_items())
+
+        def get_values(offset, limit):
+            items = self.model.get_worksheet_items(self.uuid, offset, limit)
+            return [item['value'] for item in items]
+
+        self.assertEqual(get_values(0, 2), ['a', 'b'])
+        self.assertEqual(get_values(1, 5), ['b', 'c'])
+        self.assertEqual(get_values(2, None), ['c'])
+        self.assertEqual(get_values(3, 1), [])
+
+
+class SaveBundlesTest(unittest.TestCase):
+    def setUp(self):
+        self.model = BundleModel(create_engine('sqlite://'), {}, '0', '-1')
+        self.model.encode_str = self.model.decode_str = lambda value: value
+        worksheet = Worksheet({'name': 'ws', 'title': None, 'frozen': None, 'items': []})
+        worksheet.owner_id = '0'
+        self.model.new_worksheet(worksheet)
+        self.worksheet_uuid = worksheet.uuid
+
+    def create_run(self, name, targets=[], **metadata):
+        metadata = dict(
+            {spec.key: spec.default for spec in RunBundle.METADATA_SPECS if not spec.generated},
+            name=name,
+            **metadata,
+        )
+        run = RunBundle.construct(targets, 'echo', metadata, owner_id='0')
+        run.is_anonymous = False
+        return run
+
+    def get_bundle_uuids(self):
+        worksheet = self.model.get_worksheet(self.worksheet_uuid, fetch_items=True)
+        return [item['bundle_uuid'] for item in worksheet.items]
+
+    def test_save_bundles(self):
+        a = self.create_run('a', description='first')
+        b = self.create_run('b', targets=[('x', (a.uuid, 'out'))])
+        sort_key = self.model.save_bundles(
+            [a, b],
+            worksheet_uuid=self.worksheet_uuid,
+            group_permissions=[
+                {'group_uuid': 'g1', 'permission': 1},
+                {'group_uuid': 'g2', 'permission': 0},
+            ],
+        )
+        self.assertEqual(self.get_bundle_uuids(), [a.uuid, b.uuid])
+        self.assertEqual(sort_key, 2 * WORKSHEET_ITEM_SORT_KEY_GAP)
+
+        saved_b = self.model.get_bundle(b.uuid)
+        self.assertEqual(saved_b.metadata.name, 'b')
+        self.assertEqual(
+            [(dep.child_path, dep.parent_uuid) for dep in saved_b.dependencies], [('x', a.uuid)]
+        )
+        self.assertEqual(self.model.get_children_uuids([a.uuid]), {a.uuid: [b.uuid]})
+        self.assertEqual(self.model.get_bundle(a.uuid).metadata.description, 'first')
+        self.assertEqual(self.model.search_bundles('0', ['first'])['result'], [a.uuid])
+        self.assertEqual(
+            self.model.get_max_group_permissions(
+                cl_group_bundle_permission, ['g1', 'g2'], [a.uuid, b.uuid]
+            ),
+            {a.uuid: 1, b.uuid: 1},
+        )
+
+        # Later batches are inserted after the previous ones, and detached bundles aren't added
+        c = self.create_run('c')
+        self.model.add_worksheet_items(self.worksheet_uuid, [bundle_item(c.uuid)])
+        d = self.create_run('d')
+        sort_key = self.model.save_bundles([d], self.worksheet_uuid, after_sort_key=sort_key)
+        self.assertIsNone(self.model.save_bundles([c]))
+        worksheet = self.model.get_worksheet(self.worksheet_uuid, fetch_items=True)
+        self.assertEqual(self.get_bundle_uuids(), [a.uuid, b.uuid, d.uuid, c.uuid])
+        self.assertEqual(worksheet.items[2]['sort_key'], sort_key)
+
+
+class BundleStateTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # A file database, so that threads share it
+        engine = create_engine('sqlite:///' + os.path.join(self.temp_dir, 'bundle.db'))
+        self.model = BundleModel(engine, {}, '0', '-1')
+        self.bundle = DatasetBundle.construct(
+            {'name': 'foo', 'description': '', 'tags': [], 'license': '', 'source_url': ''},
+            owner_id='0',
+        )
+        self.bundle.is_anonymous = False
+        self.model.save_bundle(self.bundle)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_wait_for_bundle_state_changes(self):
+        uuid = self.bundle.uuid
+        states = self.model.wait_for_bundle_state_changes({uuid: 'running', '0x0': None}, 10)
+        self.assertEqual(states, {uuid: 'ready'})
+        # Timeout
+        self.assertEqual(self.model.wait_for_bundle_state_changes({uuid: 'ready'}, 0), states)
+
+    def test_state_change_wakes_up_waiters(self):
+        # Changes made by this process are seen without waiting for the next poll
+        self.model.BUNDLE_STATE_POLL_INTERVAL = 60
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(
+                self.model.wait_for_bundle_state_changes({self.bundle.uuid: 'ready'}, 60)
+            )
+        )
+        start_time = time.time()
+        thread.start()
+        time.sleep(0.1)
+        self.model.update_bundle(self.bundle, {'state': 'failed'})
+        thread.join()
+        self.assertEqual(result, [{self.bundle.uuid: 'failed'}])
+        self.assertLess(time.time() - start_time, 30)
+
+    def test_get_bundle_state_infos(self):
+        metadata = {
+            spec.key: spec.default for spec in RunBundle.METADATA_SPECS if not spec.generated
+        }
+        metadata['name'] = 'run'
+        run = RunBundle.construct([], 'echo', metadata, owner_id='0')
+        run.is_anonymous = False
+        self.model.save_bundle(run)
+        self.model.update_bundle(
+            run, {'state': 'running', 'metadata': {'run_status': 'Running', 'last_updated': 12}}
+        )
+        self.assertEqual(
+            self.model.get_bundle_state_infos([self.bundle.uuid, run.uuid, '0x0']),
+            {
+                self.bundle.uuid: {'state': 'ready', 'run_status': None, 'last_updated': None},
+                run.uuid: {'state': 'running', 'run_status': 'Running', 'last_updated': 12},
+            },
+        )
+
+
+class PermissionTest(unittest.TestCase):
+    def setUp(self):
+        self.model = BundleModel(create_engine('sqlite://'), {}, '0', '-1')
+        self.group_uuid = self.model.create_group(
+            {'name': 'group', 'owner_id': '0', 'user_defined': True}
+        )['uuid']
+        self.model.add_user_in_group('1', self.group_uuid, False)
+
+    def get_permissions(self, user_id, uuids):
+        return self.model.get_user_bundle_permissions(user_id, uuids, {uuid: '0' for uuid in uuids})
+
+    def test_permissions_through_groups(self):
+        self.model.set_group_bundle_permission(self.model.public_group_uuid, 'public', 1)
+        self.model.set_group_bundle_permission(self.model.public_group_uuid, 'shared', 1)
+        self.model.set_group_bundle_permission(self.group_uuid, 'shared', 2)
+        uuids = ['public', 'shared', 'private']
+        self.assertEqual(self.get_permissions('1', uuids), {'public': 1, 'shared': 2, 'private': 0})
+        self.assertEqual(self.get_permissions('2', uuids), {'public': 1, 'shared': 1, 'private': 0})
+        self.assertEqual(
+            self.get_permissions(None, uuids), {'public': 1, 'shared': 1, 'private': 0}
+        )
+        self.assertEqual(self.get_permissions('0', uuids), {'public': 2, 'shared': 2, 'private': 2})
+
+    def test_cache_permissions(self):
+        self.model.set_group_bundle_permission(self.group_uuid, 'shared', 1)
+        with mock.patch.object(
+            self.model, 'get_max_group_permissions', wraps=self.model.get_max_group_permissions
+        ) as get_max_group_permissions:
+            with self.model.cache_permissions():
+                self.assertEqual(self.get_permissions('1', ['shared']), {'shared': 1})
+                self.assertEqual(self.get_permissions('1', ['shared']), {'shared': 1})
+                self.assertEqual(get_max_group_permissions.call_count, 1)
+                # Changes are taken into account
+                self.model.set_group_bundle_permission(self.group_uuid, 'shared', 2)
+                self.assertEqual(self.get_permissions('1', ['shared']), {'shared': 2})
+                self.model.delete_user_in_group('1', self.group_uuid)
+                self.assertEqual(self.get_permissions('1', ['shared']), {'shared': 0})
+            self.get_permissions('1', ['shared'])
+            self.get_permissions('1', ['shared'])
+            self.assertEqual(get_max_group_permissions.call_count, 5)
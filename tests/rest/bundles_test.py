@@ -0,0 +1,210 @@
+from io import BytesIO, StringIO
+import json
+import threading
+import unittest
+
+from bottle import default_app, HTTPError, local, request, response
+import mock
+
+from codalab.rest import bundles
+from codalab.worker.bundle_state import State
+
+
+class FetchBundleUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        local.model = mock.Mock()
+        local.model.get_bundle_state.return_value = State.RUNNING
+        # Leave a fresh request for the other tests
+        self.addCleanup(request.bind, {})
+        patcher = mock.patch.object(bundles, 'check_bundles_have_read_permission')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(bundles, 'updates_waiters', threading.BoundedSemaphore(1))
+        self.waiters = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_updates(self, query_string):
+        request.bind({'QUERY_STRING': query_string})
+        request.user = mock.Mock(user_id='0')
+        return bundles._fetch_bundle_updates('0x1')['data']
+
+    def test_waits_for_state_change(self):
+        local.model.wait_for_bundle_state_changes.return_value = {'0x1': State.READY}
+        self.assertEqual(
+            self.fetch_updates('state=running&timeout=10'), {'state': State.READY, 'files': []}
+        )
+        local.model.wait_for_bundle_state_changes.assert_called_once()
+        # The waiter is released
+        self.assertTrue(self.waiters.acquire(blocking=False))
+
+    def test_too_many_waiters(self):
+        self.waiters.acquire()
+        self.assertEqual(
+            self.fetch_updates('state=running&timeout=10'),
+            {'state': State.RUNNING, 'files': [], 'retry_after': bundles.UPDATES_RETRY_AFTER},
+        )
+        local.model.wait_for_bundle_state_changes.assert_not_called()
+        # Requests that don't wait are served as usual
+        self.assertEqual(
+            self.fetch_updates('state=ready&timeout=10'), {'state': State.RUNNING, 'files': []}
+        )
+
+
+class FetchBundleContentsBlobTest(unittest.TestCase):
+    def setUp(self):
+        local.model = mock.Mock()
+        local.model.get_bundle.return_value.metadata.name = 'bundle'
+        local.download_manager = mock.Mock()
+        local.download_manager.get_target_info.side_effect = lambda target, depth: {
+            'resolved_target': target,
+            'name': 'file',
+            'type': 'file',
+            'size': 1000,
+        }
+        local.download_manager.read_file_sections.side_effect = lambda target, sections: [
+            b'x' * length for _, length in sections
+        ]
+        self.addCleanup(request.bind, {})
+        self.addCleanup(response.bind)
+        patcher = mock.patch.object(bundles, 'check_bundles_have_read_permission')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_ranges(self, byte_ranges):
+        request.bind({'HTTP_RANGE': byte_ranges})
+        request.user = mock.Mock(user_id='0')
+        return bundles._fetch_bundle_contents_blob('0x1', 'file')
+
+    def test_byte_ranges(self):
+        contents = self.fetch_ranges('bytes=0-9,500-509').read()
+        self.assertEqual(response.status_code, 206)
+        self.assertIn(b'Content-Range: bytes 500-509/1000\r\n\r\nxxxxxxxxxx', contents)
+
+    def test_byte_ranges_too_large(self):
+        with mock.patch.object(bundles, 'MAX_BYTE_RANGES_SIZE', 100):
+            with self.assertRaises(HTTPError) as cm:
+                self.fetch_ranges('bytes=0-99,0-99')
+            self.assertEqual(cm.exception.status_code, 400)
+            local.download_manager.read_file_sections.assert_not_called()
+            # Only the bytes within the file count
+            self.fetch_ranges('bytes=0-49,950-2000')
+
+
+class CreateBundlesNdjsonTest(unittest.TestCase):
+    def setUp(self):
+        local.model = mock.Mock()
+        local.model.get_worksheet.return_value.is_anonymous = False
+        local.model.get_group_worksheet_permissions.return_value = []
+        local.model.save_bundles.return_value = 'sort-key'
+        self.addCleanup(request.bind, {})
+        self.addCleanup(response.bind)
+        for name in ['check_worksheet_has_all_permission', 'worksheet_util']:
+            patcher = mock.patch.object(bundles, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, lines):
+        body = '\n'.join(lines).encode()
+        errors = StringIO()
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': '/bundles/ndjson',
+            'QUERY_STRING': 'worksheet=0x1',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': errors,
+            'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest',
+            'bottle.request.ext.user': mock.Mock(user_id='0'),
+        }
+        statuses = []
+        output = default_app()(
+            environ, lambda status, headers, exc_info=None: statuses.append(status)
+        )
+        contents = b''.join(output)
+        self.assertEqual(statuses, ['200 OK'], errors.getvalue())
+        return [json.loads(line) for line in contents.decode().splitlines()]
+
+    @staticmethod
+    def bundle_line(name, **attributes):
+        attributes.setdefault('bundle_type', 'make')
+        attributes.setdefault(
+            'metadata',
+            {'name': name, 'description': '', 'tags': [], 'allow_failed_dependencies': False},
+        )
+        return json.dumps({'type': 'bundles', 'attributes': attributes})
+
+    def test_valid_bundles(self):
+        lines = self.post([self.bundle_line('a'), '', self.bundle_line('b')])
+        self.assertEqual(len(lines), 2)
+        saved = local.model.save_bundles.call_args[0][0]
+        self.assertEqual(lines, [{'id': bundle.uuid} for bundle in saved])
+        self.assertEqual([bundle.metadata.name for bundle in saved], ['a', 'b'])
+
+    def test_invalid_lines(self):
+        for line in [
+            '[1]',
+            '1',
+            'not json',
+            '{"type": "bundles"}',
+            self.bundle_line('a', bundle_type='nope'),
+        ]:
+            result = self.post([self.bundle_line('a'), line])
+            self.assertEqual(list(result[0]), ['error', 'line'], line)
+            self.assertEqual(result[0]['line'], 2)
+        local.model.save_bundles.assert_not_called()
+
+    def test_invalid_line_after_batch(self):
+        with mock.patch.object(bundles, 'CREATE_BUNDLES_BATCH_SIZE', 2):
+            lines = self.post([self.bundle_line('a'), self.bundle_line('b'), '{"type": "bundles"}'])
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(list(lines[0]) + list(lines[1]), ['id', 'id'])
+        self.assertEqual(lines[2], {'error': 'Bundle type must be specified.', 'line': 3})
+
+    def test_format_validation_error(self):
+        self.assertEqual(
+            bundles.format_validation_error({'errors': [{'detail': 'a'}, {'detail': 'b'}]}), 'a\nb'
+        )
+        self.assertEqual(
+            bundles.format_validation_error({'_schema': ['Invalid input type.']}),
+            'Invalid input type.',
+        )
+        self.assertEqual(bundles.format_validation_error({'data': ['Missing.']}), 'data: Missing.')
+
+
+class FetchBundleAncestorsTest(unittest.TestCase):
+    def setUp(self):
+        local.model = mock.Mock()
+        local.model.get_self_and_descendants.side_effect = lambda uuids, depth: uuids + (
+            ['child'] if depth else []
+        )
+        local.model.get_self_and_ancestors.side_effect = lambda uuids, depth: uuids + ['parent']
+        self.addCleanup(request.bind, {})
+        patcher = mock.patch.object(bundles.canonicalize, 'get_bundle_uuids')
+        patcher.start().return_value = ['0x1']
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(bundles, 'build_bundles_document')
+        self.build_bundles_document = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_ancestors(self, query_string):
+        request.bind({'QUERY_STRING': query_string})
+        request.user = mock.Mock(user_id='0')
+        bundles._fetch_bundle_ancestors()
+        return self.build_bundles_document.call_args[0][0]
+
+    def test_depths(self):
+        # Only the parents by default
+        self.assertEqual(self.fetch_ancestors('specs=a'), ['0x1', 'parent'])
+        local.model.get_self_and_descendants.assert_called_with(['0x1'], depth=0)
+        local.model.get_self_and_ancestors.assert_called_with(['0x1'], depth=1)
+        # Ancestors are fetched down to depth levels from the bundles and their descendants
+        self.assertEqual(
+            self.fetch_ancestors('specs=a&depth=2&descendant_depth=3'), ['0x1', 'child', 'parent']
+        )
+        local.model.get_self_and_descendants.assert_called_with(['0x1'], depth=3)
+        local.model.get_self_and_ancestors.assert_called_with(['0x1', 'child'], depth=2)
+
+    def test_negative_depth(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.fetch_ancestors('specs=a&depth=-1')
+        self.assertEqual(cm.exception.status_code, 400)
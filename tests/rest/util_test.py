@@ -23,27 +23,23 @@ class UtilTest(unittest.TestCase):
 
         return side_effect
 
-    def _mock_bundle(self, uuid):
-        metadata_mock = Mock()
-        metadata_mock.to_dict.side_effect = lambda: dict()
+    def _mock_bundle_row(self, uuid):
         return Mock(
             uuid=uuid,
-            bundle_type=None,
+            bundle_type='dataset',
             owner_id=None,
             command=None,
             data_hash=None,
             state=None,
             is_anonymous=False,
-            metadata=metadata_mock,
-            dependencies=[],
         )
 
     def test_get_bundle_infos_single_worksheet(self):
         bundle_uuids = {'0x123', '0x234', '0x345'}
         worksheet_uuids = {'0x111', '0x222', '0x333', '0x444'}
         model = Mock()
-        model.batch_get_bundles.side_effect = self._mock_model_call(
-            bundle_uuids, [self._mock_bundle(uuid) for uuid in bundle_uuids]
+        model.batch_get_bundle_info_rows.side_effect = self._mock_model_call(
+            bundle_uuids, ([self._mock_bundle_row(uuid) for uuid in bundle_uuids], [], [], {})
         )
         bundle_permissions = {
             '0x123': GROUP_OBJECT_PERMISSION_ALL,
@@ -70,11 +66,14 @@ class UtilTest(unittest.TestCase):
         model.get_user_worksheet_permissions.side_effect = self._mock_model_call(
             worksheet_uuids, worksheet_permissions, 1
         )
-        worksheets = [Mock(uuid='0x111'), Mock(uuid='0x222')]
-        worksheets[0].configure_mock(name='ws1')
-        worksheets[1].configure_mock(name='ws2')
-        model.batch_get_worksheets.side_effect = self._mock_model_call(
-            {'0x111', '0x222'}, worksheets
+        model.get_worksheet_names_and_owner_ids.side_effect = self._mock_model_call(
+            worksheet_uuids,
+            {
+                '0x111': ('ws1', None),
+                '0x222': ('ws2', None),
+                '0x333': ('ws3', None),
+                '0x444': ('ws4', None),
+            },
         )
         infos = util.get_bundle_infos(
             bundle_uuids,
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from collections import namedtuple
+from unittest.mock import patch
+
+from codalab.worker.container_stats import ContainerCgroup, ContainerStatsSampler, EMPTY_STATS
+from codalab.worker.file_util import remove_path
+
+FakeContainer = namedtuple('FakeContainer', 'id')
+
+CONTAINER_ID = 'abcdef0123456789'
+
+
+def write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+class ContainerStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.cgroup_root = tempfile.mkdtemp()
+        self.addCleanup(lambda: remove_path(self.cgroup_root))
+        patcher = patch('codalab.worker.docker_utils.get_container_start_time', return_value=1000.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_v1_stats(self, user, system, memory, max_memory):
+        cpu_dir = os.path.join(self.cgroup_root, 'cpuacct', 'docker', CONTAINER_ID)
+        memory_dir = os.path.join(self.cgroup_root, 'memory', 'docker', CONTAINER_ID)
+        write_file(os.path.join(cpu_dir, 'cpuacct.stat'), 'user %d\nsystem %d\n' % (user, system))
+        write_file(os.path.join(memory_dir, 'memory.usage_in_bytes'), '%d\n' % memory)
+        write_file(os.path.join(memory_dir, 'memory.max_usage_in_bytes'), '%d\n' % max_memory)
+
+    def write_v2_stats(self, memory, peak=None):
+        write_file(os.path.join(self.cgroup_root, 'cgroup.controllers'), 'cpu memory\n')
+        container_dir = os.path.join(
+            self.cgroup_root, 'system.slice', 'docker-%s.scope' % CONTAINER_ID
+        )
+        write_file(
+            os.path.join(container_dir, 'cpu.stat'),
+            'usage_usec 3500000\nuser_usec 2500000\nsystem_usec 1000000\n',
+        )
+        write_file(os.path.join(container_dir, 'memory.current'), '%d\n' % memory)
+        if peak is not None:
+            write_file(os.path.join(container_dir, 'memory.peak'), '%d\n' % peak)
+
+    def test_cgroup_v1(self):
+        self.write_v1_stats(user=250, system=50, memory=100, max_memory=300)
+        cgroup = ContainerCgroup(self.cgroup_root, CONTAINER_ID)
+        self.addCleanup(cgroup.close)
+        self.assertEqual(cgroup.version, 1)
+        self.assertEqual(
+            cgroup.read(), {'time_user': 2.5, 'time_system': 0.5, 'memory': 100, 'max_memory': 300}
+        )
+
+    def test_cgroup_v2(self):
+        self.write_v2_stats(memory=100, peak=400)
+        cgroup = ContainerCgroup(self.cgroup_root, CONTAINER_ID)
+        self.addCleanup(cgroup.close)
+        self.assertEqual(cgroup.version, 2)
+        self.assertEqual(
+            cgroup.read(), {'time_user': 2.5, 'time_system': 1.0, 'memory': 100, 'max_memory': 400}
+        )
+
+    def test_cgroup_not_found(self):
+        cgroup = ContainerCgroup(self.cgroup_root, CONTAINER_ID)
+        self.assertFalse(cgroup.found)
+        self.assertEqual(cgroup.read(), {})
+
+    def test_sampler_keeps_peak(self):
+        """Memory spikes between two reads of the run state machine are not lost"""
+        self.write_v2_stats(memory=100)
+        sampler = ContainerStatsSampler(cgroup_root=self.cgroup_root)
+        self.addCleanup(sampler.stop)
+        self.assertEqual(sampler.get('uuid'), EMPTY_STATS)
+
+        sampler.track('uuid', FakeContainer(CONTAINER_ID))
+        sampler.sample()
+        self.write_v2_stats(memory=500)
+        sampler.sample()
+        self.write_v2_stats(memory=200)
+        sampler.sample()
+
+        stats = sampler.get('uuid')
+        self.assertEqual(stats.memory, 200)
+        self.assertEqual(stats.max_memory, 500)
+        self.assertEqual(stats.time_user, 2.5)
+        self.assertEqual(stats.start_time, 1000.0)
+
+        sampler.untrack('uuid')
+        self.assertEqual(sampler.get('uuid'), EMPTY_STATS)
+
+    def test_sampler_waits_for_cgroup(self):
+        """The cgroup of a container is picked up once it shows up"""
+        sampler = ContainerStatsSampler(cgroup_root=self.cgroup_root)
+        self.addCleanup(sampler.stop)
+        sampler.track('uuid', FakeContainer(CONTAINER_ID))
+        sampler.sample()
+        self.assertEqual(sampler.get('uuid').memory, 0)
+
+        self.write_v1_stats(user=100, system=0, memory=42, max_memory=42)
+        sampler.sample()
+        self.assertEqual(sampler.get('uuid').memory, 42)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from codalab.worker.disk_usage import DiskUsageTracker, EMPTY_USAGE, Observer, TrackedDirectory
+from codalab.worker.file_util import get_path_size, remove_path
+
+
+def write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+class DiskUsageTest(unittest.TestCase):
+    def setUp(self):
+        self.bundle_path = tempfile.mkdtemp()
+        self.addCleanup(lambda: remove_path(self.bundle_path))
+        write_file(os.path.join(self.bundle_path, 'stdout'), 'a' * 100)
+        write_file(os.path.join(self.bundle_path, 'dir', 'f1'), 'b' * 1000)
+        os.symlink('/etc/passwd', os.path.join(self.bundle_path, 'dependency'))
+
+    def test_walk_matches_get_path_size(self):
+        tracked_dir = TrackedDirectory(self.bundle_path)
+        tracked_dir.walk()
+        self.assertEqual(tracked_dir.usage.disk_utilization, get_path_size(self.bundle_path))
+
+    def test_incremental_update(self):
+        """ Only the paths marked as dirty are looked at again """
+        tracked_dir = TrackedDirectory(self.bundle_path)
+        tracked_dir.walk()
+
+        # Modify a file, add a file, and move a new directory into the tree
+        stdout_path = os.path.join(self.bundle_path, 'stdout')
+        write_file(stdout_path, 'a' * 2000)
+        new_file_path = os.path.join(self.bundle_path, 'dir', 'f2')
+        write_file(new_file_path, 'c' * 10)
+        tracked_dir.limit = get_path_size(self.bundle_path)
+        outside_dir = tempfile.mkdtemp()
+        write_file(os.path.join(outside_dir, 'nested', 'f3'), 'd' * 3000)
+        moved_dir_path = os.path.join(self.bundle_path, 'moved')
+        shutil.move(outside_dir, moved_dir_path)
+        for path in [moved_dir_path, stdout_path, new_file_path, self.bundle_path]:
+            tracked_dir.mark_dirty(path)
+        tracked_dir.update()
+        self.assertEqual(tracked_dir.usage.disk_utilization, get_path_size(self.bundle_path))
+        self.assertTrue(tracked_dir.usage.limit_exceeded)
+
+        # Remove a whole directory
+        remove_path(moved_dir_path)
+        tracked_dir.mark_dirty(moved_dir_path)
+        tracked_dir.mark_dirty(self.bundle_path)
+        tracked_dir.update()
+        self.assertEqual(tracked_dir.usage.disk_utilization, get_path_size(self.bundle_path))
+        self.assertFalse(tracked_dir.usage.limit_exceeded)
+
+    def test_tracker_fallback_to_walk(self):
+        tracker = DiskUsageTracker(use_notifications=False)
+        self.assertEqual(tracker.get('uuid'), EMPTY_USAGE)
+        tracker.track('uuid', self.bundle_path, 10)
+        tracker.update()
+        usage = tracker.get('uuid')
+        self.assertEqual(usage.disk_utilization, get_path_size(self.bundle_path))
+        self.assertTrue(usage.limit_exceeded)
+        tracker.untrack('uuid')
+        self.assertEqual(tracker.get('uuid'), EMPTY_USAGE)
+
+    @unittest.skipIf(Observer is None, 'watchdog is not installed')
+    def test_tracker_notifications(self):
+        tracker = DiskUsageTracker(update_interval=0.05)
+        tracker.start()
+        self.addCleanup(tracker.stop)
+        tracker.track('uuid', self.bundle_path)
+
+        def wait_for_usage():
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                if tracker.get('uuid').disk_utilization == get_path_size(self.bundle_path):
+                    return
+                time.sleep(0.05)
+            self.fail('Disk usage not updated')
+
+        wait_for_usage()
+        self.assertIsNotNone(tracker._tracked['uuid'].watch)
+        write_file(os.path.join(self.bundle_path, 'dir', 'nested', 'f2'), 'c' * 5000)
+        wait_for_usage()
+        remove_path(os.path.join(self.bundle_path, 'dir'))
+        wait_for_usage()
+
+    @unittest.skipIf(Observer is None, 'watchdog is not installed')
+    def test_tracker_reconciles_lost_notifications(self):
+        # Without starting the tracker, notifications are never delivered
+        tracker = DiskUsageTracker()
+        self.addCleanup(tracker.stop)
+        tracker.track('uuid', self.bundle_path)
+        tracker.update()
+        size = get_path_size(self.bundle_path)
+        self.assertEqual(tracker.get('uuid').disk_utilization, size)
+        write_file(os.path.join(self.bundle_path, 'stdout'), 'a' * 2000)
+        tracker.update()
+        self.assertEqual(tracker.get('uuid').disk_utilization, size)
+        # Until the directory is walked again
+        tracker._tracked['uuid'].next_walk_time = 0
+        tracker.update()
+        self.assertEqual(tracker.get('uuid').disk_utilization, get_path_size(self.bundle_path))
+
+    def test_walk_after_too_many_changes(self):
+        tracked_dir = TrackedDirectory(self.bundle_path)
+        tracked_dir.MAX_DIRTY_PATHS = 2
+        tracked_dir.walk()
+        write_file(os.path.join(self.bundle_path, 'stdout'), 'a' * 2000)
+        for name in ['f2', 'f3', 'f4']:
+            tracked_dir.mark_dirty(os.path.join(self.bundle_path, 'dir', name))
+        # The changed paths are dropped, since some might be missing
+        self.assertTrue(tracked_dir.needs_walk)
+        tracked_dir.update()
+        self.assertNotEqual(tracked_dir.usage.disk_utilization, get_path_size(self.bundle_path))
+        tracked_dir.walk()
+        self.assertFalse(tracked_dir.needs_walk)
+        self.assertEqual(tracked_dir.usage.disk_utilization, get_path_size(self.bundle_path))
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from codalab.worker.docker_image_manager import DockerImageManager, get_chain_ids
+from codalab.worker.file_util import remove_path
+
+CACHE_TAG = DockerImageManager.CACHE_TAG
+
+
+def diff_id(name):
+    return 'sha256:' + hashlib.sha256(name.encode()).hexdigest()
+
+
+class FakeImage(object):
+    def __init__(self, image_id, layers, last_used, virtual_size=0):
+        self.id = image_id
+        self.tags = ['%s:%s' % (CACHE_TAG, last_used)]
+        self.attrs = {
+            'RootFS': {'Layers': [diff_id(layer) for layer in layers]},
+            'VirtualSize': virtual_size,
+            'RepoTags': [image_id + ':latest'],
+        }
+
+
+class DockerImageManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.docker_root = tempfile.mkdtemp()
+        self.addCleanup(lambda: remove_path(self.docker_root))
+        self.docker = MagicMock()
+        self.docker.info.return_value = {'DockerRootDir': self.docker_root, 'Driver': 'overlay2'}
+        patcher = patch('docker.from_env', return_value=self.docker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = DockerImageManager(
+            os.path.join(self.docker_root, 'images-state.json'), 1000, None
+        )
+        self.images = []
+        self.docker.images.list.side_effect = lambda *args: list(self.images)
+
+    def add_image(self, image_id, layers, last_used):
+        """Adds an image made of layers, given as (name, size) pairs, to the layer database"""
+        image = FakeImage(image_id, [name for name, _ in layers], last_used)
+        chain_ids = get_chain_ids(image.attrs['RootFS']['Layers'])
+        for chain_id, (_, size) in zip(chain_ids, layers):
+            layer_dir = os.path.join(
+                self.docker_root, 'image', 'overlay2', 'layerdb', 'sha256', chain_id.split(':')[1]
+            )
+            os.makedirs(layer_dir, exist_ok=True)
+            with open(os.path.join(layer_dir, 'size'), 'w') as f:
+                f.write(str(size))
+        self.images.append(image)
+
+    def test_chain_ids(self):
+        first, second = diff_id('a'), diff_id('b')
+        self.assertEqual(
+            get_chain_ids([first, second]),
+            [first, 'sha256:' + hashlib.sha256((first + ' ' + second).encode()).hexdigest()],
+        )
+
+    def test_shared_layers_counted_once(self):
+        self.add_image('cuda1', [('base', 400), ('cuda', 300)], last_used=1)
+        self.add_image('cuda2', [('base', 400), ('cuda', 300), ('app', 100)], last_used=2)
+        self.assertEqual(self.manager._get_cache_use(), 800)
+
+    def test_fallback_to_virtual_size(self):
+        self.images.append(FakeImage('unknown', ['x'], last_used=1, virtual_size=123))
+        self.assertEqual(self.manager._get_cache_use(), 123)
+
+    def test_cleanup_evicts_by_freed_layers(self):
+        self.add_image('base', [('base', 500)], last_used=1)
+        self.add_image('app1', [('base', 500), ('app1', 300)], last_used=2)
+        self.add_image('other', [('other', 400)], last_used=3)
+        # Removing the least recently used image wouldn't free any layer, so the next least
+        # recently used image that frees space is removed instead, which is enough.
+        self.manager._cleanup()
+        self.docker.images.remove.assert_called_once_with('app1', force=True)
+
+    def test_cleanup_under_limit(self):
+        self.add_image('base', [('base', 500)], last_used=1)
+        self.manager._cleanup()
+        self.docker.images.remove.assert_not_called()
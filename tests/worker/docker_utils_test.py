@@ -1,6 +1,8 @@
 from docker.errors import APIError
+import mock
 import unittest
 
+from codalab.worker import docker_utils
 from codalab.worker.docker_utils import DockerUserErrorException, DockerException, wrap_exception
 
 
@@ -41,3 +43,13 @@ class DockerUtilsTest(unittest.TestCase):
         except Exception as e:
             self.assertEqual(str(e), 'Should throw DockerUserErrorException: ' + error)
             self.assertIsInstance(e, DockerUserErrorException)
+
+    def test_get_container_finish_time(self):
+        container = mock.Mock()
+        container.attrs = {'State': {'Status': 'running', 'FinishedAt': '0001-01-01T00:00:00Z'}}
+        with mock.patch.object(docker_utils, 'client') as client:
+            client.containers.get.return_value = container
+            self.assertIsNone(docker_utils.get_container_finish_time(container))
+            container.attrs['State'] = {'Status': 'exited', 'FinishedAt': '2020-01-01T00:00:10.5Z'}
+            self.assertEqual(docker_utils.get_container_finish_time(container), 1577836810.5)
+        self.assertIsNone(docker_utils.get_container_finish_time(None))
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from codalab.worker.file_util import remove_path
+from codalab.worker.read_cache import CachedFile, ReadCache
+
+
+class ReadCacheTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(lambda: remove_path(self.path))
+
+    def write(self, contents, mode='wb'):
+        with open(self.path, mode) as f:
+            f.write(contents)
+
+    def test_read_section_follows_appends(self):
+        self.write(b'hello\n')
+        cached_file = CachedFile(self.path)
+        self.assertEqual(cached_file.read_section(0, 100), b'hello\n')
+        self.write(b'world\n', mode='ab')
+        self.assertEqual(cached_file.read_section(6, 100), b'world\n')
+        self.assertEqual(cached_file.read_section(3, 4), b'lo\nw')
+        self.assertEqual(cached_file.read_section(100, 10), b'')
+
+    def test_read_section_detects_rewrites(self):
+        self.write(b'a' * 100)
+        cached_file = CachedFile(self.path)
+        cached_file.read_section(0, 10)
+        self.write(b'b' * 200)
+        self.assertEqual(cached_file.read_section(0, 200), b'b' * 200)
+
+    def test_read_section_after_large_append(self):
+        self.write(b'a' * 100)
+        cached_file = CachedFile(self.path)
+        cached_file.TAIL_SIZE = 200
+        cached_file.read_section(0, 10)
+        self.write(b'b' * 1000, mode='ab')
+        read_sizes = []
+
+        def open_file(path, mode):
+            fileobj = open(path, mode)
+            read = fileobj.read
+            fileobj.read = lambda size: read_sizes.append(size) or read(size)
+            return fileobj
+
+        with patch('codalab.worker.read_cache.open', open_file, create=True):
+            self.assertIsNone(cached_file.read_section(0, 10))
+            self.assertEqual(cached_file.read_section(900, 1000), b'b' * 200)
+        # Only the new tail is read, not everything that was appended
+        self.assertEqual(read_sizes, [200])
+
+    def test_read_section_outside_of_tail(self):
+        self.write(b'x' * (CachedFile.TAIL_SIZE + 10))
+        cached_file = CachedFile(self.path)
+        self.assertIsNone(cached_file.read_section(0, 10))
+        self.assertEqual(cached_file.read_section(CachedFile.TAIL_SIZE, 100), b'x' * 10)
+
+    def test_summary_cached_until_file_changes(self):
+        self.write(b'hello\n')
+        cached_file = CachedFile(self.path)
+        summarize = Mock(side_effect=[b'first', b'second'])
+        self.assertEqual(cached_file.get_summary('key', summarize), b'first')
+        self.assertEqual(cached_file.get_summary('key', summarize), b'first')
+        self.write(b'more\n', mode='ab')
+        self.assertEqual(cached_file.get_summary('key', summarize), b'second')
+        self.assertEqual(summarize.call_count, 2)
+
+    def test_lru(self):
+        read_cache = ReadCache(max_files=2)
+        first = read_cache.get('uuid1', 'stdout')
+        read_cache.get('uuid2', 'stdout')
+        self.assertIs(read_cache.get('uuid1', 'stdout'), first)
+        read_cache.get('uuid3', 'stdout')
+        self.assertIs(read_cache.get('uuid1', 'stdout'), first)
+        read_cache.forget_run('uuid1')
+        self.assertIsNot(read_cache.get('uuid1', 'stdout'), first)
@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from codalab.worker.bundle_state import BundleInfo, RunResources
+from codalab.worker.worker import Worker
+from codalab.worker.worker_run_state import RunStage, RunState
+
+
+def run_state(uuid, stage=RunStage.RUNNING):
+    return RunState(
+        stage=stage,
+        run_status='',
+        bundle=mock.Mock(spec=BundleInfo, uuid=uuid),
+        bundle_path='/tmp/' + uuid,
+        bundle_dir_wait_num_tries=0,
+        resources=mock.Mock(spec=RunResources),
+        bundle_start_time=0,
+        container_time_total=0,
+        container_time_user=0,
+        container_time_system=0,
+        container_id=None,
+        container=None,
+        docker_image=None,
+        is_killed=False,
+        has_contents=False,
+        cpuset=None,
+        gpuset=None,
+        max_memory=0,
+        disk_utilization=0,
+        exitcode=None,
+        failure_message=None,
+        kill_message=None,
+        finished=False,
+        finalized=False,
+        is_restaged=False,
+    )
+
+
+class WorkerRunTransitionsTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        with mock.patch('docker.from_env'):
+            self.worker = Worker(
+                image_manager=mock.Mock(),
+                dependency_manager=None,
+                commit_file=self.work_dir + '/state.json',
+                cpuset=set(),
+                gpuset=set(),
+                max_memory=None,
+                worker_id='w',
+                tag=None,
+                work_dir=self.work_dir,
+                local_bundles_dir=None,
+                exit_when_idle=False,
+                exit_after_num_runs=1000,
+                idle_seconds=0,
+                bundle_service=mock.Mock(),
+                shared_file_system=True,
+                tag_exclusive=False,
+            )
+        self.worker.run_state_manager = mock.Mock()
+        self.worker._run_transition_executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.worker._run_transition_executor.shutdown)
+
+    def wait_for_transitions(self):
+        for future in list(self.worker._transitioning.values()):
+            future.exception(timeout=5)
+
+    def test_transitions_run_concurrently(self):
+        # Each transition waits for the other one, so they only complete if they run concurrently
+        barrier = threading.Barrier(2, timeout=5)
+
+        def transition(state):
+            barrier.wait()
+            return state._replace(stage=RunStage.CLEANING_UP)
+
+        self.worker.run_state_manager.transition.side_effect = transition
+        self.worker.runs = {uuid: run_state(uuid) for uuid in ['a', 'b']}
+        self.worker.start_run_transitions()
+        self.wait_for_transitions()
+        self.assertEqual(
+            [state.stage for state in self.worker.runs.values()], [RunStage.CLEANING_UP] * 2
+        )
+        # Transitions that are done are collected, and the runs transitioned again
+        self.worker.start_run_transitions()
+        self.wait_for_transitions()
+        self.assertEqual(self.worker.run_state_manager.transition.call_count, 4)
+
+    def test_pending_changes_reapplied(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def transition(state):
+            started.set()
+            release.wait(5)
+            return state._replace(stage=RunStage.CLEANING_UP, run_status='Cleaning up')
+
+        self.worker.run_state_manager.transition.side_effect = transition
+        self.worker.runs = {'a': run_state('a')}
+        self.worker.start_run_transitions()
+        started.wait(5)
+        # The server kills the run while it is transitioned
+        self.worker.kill('a')
+        self.assertTrue(self.worker.runs['a'].is_killed)
+        release.set()
+        self.wait_for_transitions()
+        state = self.worker.runs['a']
+        self.assertEqual(
+            (state.stage, state.run_status, state.is_killed, state.kill_message),
+            (RunStage.CLEANING_UP, 'Cleaning up', True, 'Kill requested'),
+        )
+        self.assertEqual(self.worker._pending_run_changes, {})
+
+    def test_missing_run(self):
+        # The run can be dropped between the checkin test and the update
+        self.worker.kill('a')
+        self.worker.mark_finalized('a')
+        self.assertEqual(self.worker.runs, {})
+        reply = mock.Mock()
+        self.worker.read_with_reply('a', '/', {}, reply)
+        self.assertEqual(reply.call_args[0][0][0], 500)
+
+    def test_failed_transition_pauses_checkins(self):
+        self.worker.run_state_manager.transition.side_effect = Exception('Docker is down')
+        self.worker.runs = {'a': run_state('a')}
+        self.worker.CHECKIN_COOLDOWN = 0.01
+        self.worker.PROCESS_RUNS_INTERVAL = 0.01
+        checkins_during_backoff = []
+        self.worker.checkin = mock.Mock(side_effect=lambda: time.sleep(0.01))
+        sleep = time.sleep
+
+        def fake_sleep(seconds):
+            if seconds < 60:
+                return sleep(seconds)
+            # Backing off: the checkin thread stops checking in
+            sleep(0.1)
+            num_checkins = self.worker.checkin.call_count
+            sleep(0.1)
+            checkins_during_backoff.append(self.worker.checkin.call_count - num_checkins)
+            self.worker.terminate = True
+
+        with mock.patch('time.sleep', fake_sleep), mock.patch.object(Worker, 'save_state'):
+            self.worker.run_concurrently()
+        self.assertEqual(checkins_during_backoff, [0])
+        self.assertFalse(self.worker.last_checkin_successful)
+        # The run is left as it was
+        self.assertEqual(self.worker.runs['a'].stage, RunStage.RUNNING)
+
+    def test_channel_reopened_after_timeout(self):
+        def timed_out():
+            # No heartbeat received
+            raise socket.timeout()
+            yield
+
+        def terminate():
+            self.worker.terminate = True
+            return iter([])
+
+        channels = [mock.MagicMock(), mock.MagicMock()]
+        channels[0].__iter__.side_effect = timed_out
+        channels[1].__iter__.side_effect = terminate
+        self.worker.bundle_service.open_channel.side_effect = channels
+        self.worker.channel_loop()
+        self.assertEqual(self.worker.bundle_service.open_channel.call_count, 2)
+        channels[0].close.assert_called_once()